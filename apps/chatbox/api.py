@@ -17,12 +17,15 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from apps.clientwidget import tenants
+from apps.clientwidget.exceptions import create_logger
 from apps.clientwidget.models import ClientMediaHandler
 from apps.clientwidget.models import AdminMediaHandler
 from apps.clientwidget.models import ChatRoom as ClientwidgetChatroom
 from .chatbox_templates import ChatboxAppearanceTemplate
 
 from .apps import REDIS_CONNECTION
+from .bot_graph import invalidate_bot_graph
 from .bot_json_parser import BotJSONParseError, BotJSONParser
 from .models import (BotBuilderImage, Chatbox, ChatboxAppearance,
                      ChatboxDetail, ChatboxMobileAppearance, ChatboxPage,
@@ -40,6 +43,8 @@ from .serializers import (BotBuilderImageSerializer, ChatboxDetailSerializer,
 from .template import jsString
 from datetime import date, datetime, timedelta
 
+logger = create_logger(__name__)
+
 
 class SendEmail(generics.GenericAPIView):
     serializer_class = SendEmailSerializer
@@ -158,8 +163,9 @@ class ChatboxDetailAPI(APIView):
                     bot_full_json
                     )
                 
-                #if DEVELOPMENT == True:
-                #    parser.semantic_analysis()
+                # Type errors are always rejected. Messages with unset variables only in development
+                for warning in parser.semantic_analysis(strict=DEVELOPMENT):
+                    logger.warning(f"Bot {pk}: {warning}")
 
             except BotJSONParseError as ex:
                 error_msg = str(ex)
@@ -200,6 +206,7 @@ class ChatboxDetailAPI(APIView):
 
         if serializer.is_valid():
             serializer.save()
+            invalidate_bot_graph(chatbot_obj.bot_hash)
             return Response(serializer.data, status=status.HTTP_200_OK)
         print(serializer.errors)    
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -545,11 +552,13 @@ class PublishChatbox(APIView):
                 # with open(file_path, 'w') as file_obj:
                 #     file_obj.write(file_text)
                 chatbox.publish(url, serializer.data['js_file_path'])
+                invalidate_bot_graph(chatbox.bot_hash)
             else:
                 cache.set(f"CLIENTWIDGET_TEMPLATE_{url}", False, timeout=24 * 60 * 60)
                 cache.set(f"CLIENTWIDGET_ALLOW_SUBDOMAINS_{url}", request.data['allow_subdomain'], timeout=24 * 60 * 60)
                 
                 chatbox.publish(url, serializer.data['js_file_path'])
+                invalidate_bot_graph(chatbox.bot_hash)
         
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Exception as ex:
@@ -604,6 +613,7 @@ class PublishChatbox(APIView):
                 # with open(file_path, 'w') as file_obj:
                 #     file_obj.write(file_text)
                 chatbox.publish(url, serializer.data['js_file_path'])
+                invalidate_bot_graph(chatbox.bot_hash)
             else:
                 try:
                     cache.set(f"CLIENTWIDGET_TEMPLATE_{url}", False, timeout=24 * 60 * 60)
@@ -612,6 +622,7 @@ class PublishChatbox(APIView):
                     print(ex)
                 
                 chatbox.publish(url, serializer.data['js_file_path'])
+                invalidate_bot_graph(chatbox.bot_hash)
         
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Exception as ex:
@@ -693,7 +704,7 @@ class ClientMediaHandlerAPI(APIView):
             for med in media:
                 media_handler = ClientMediaHandler(room_id=room_id,
                 bot_id=request.data['bot_id'], media_file=med)
-                media_handler.save(using=bot_owner.owner.ext_db_label)
+                media_handler.save(using=tenants.get_user_db_label(bot_owner.owner))
                 media_list.append("https://" + current_site.domain + media_handler.media_file.url)
             return Response(media_list)    
         except Exception as e:
@@ -715,7 +726,7 @@ class AdminMediaHandlerAPI(APIView):
             for med in media:
                 media_handler = AdminMediaHandler(room_id=room_id,
                 bot_id=request.data['bot_id'], media_file=med)
-                media_handler.save(using=bot_owner.owner.ext_db_label)
+                media_handler.save(using=tenants.get_user_db_label(bot_owner.owner))
                 media_list.append("https://" + current_site.domain + media_handler.media_file.url)
             return Response(media_list)    
         except Exception as e:
@@ -781,6 +792,7 @@ class DeleteChatbot(APIView):
             if chatbox is not None:
                 chatbox.is_deleted = True
                 chatbox.save()
+                invalidate_bot_graph(chatbox.bot_hash)
             else:
                 return Response({'status':'Deleted'}, status=status.HTTP_200_OK)
             
@@ -940,13 +952,13 @@ class BotLevelMetric(generics.GenericAPIView):
 
             try:
                 if date_from is not None and date_to is not None:
-                    chatrooms = ClientwidgetChatroom.objects.using(request.user.ext_db_label).filter(bot_id=bot_id,
+                    chatrooms = ClientwidgetChatroom.objects.using(tenants.get_user_db_label(request.user)).filter(bot_id=bot_id,
                                                                                                     created_on__gte=date_from, created_on__lte=date_to + timedelta(days=1), admin_id=request.user.id)
                 elif date_from is not None and date_to is None:
-                    chatrooms = ClientwidgetChatroom.objects.using(request.user.ext_db_label).filter(bot_id=bot_id,
+                    chatrooms = ClientwidgetChatroom.objects.using(tenants.get_user_db_label(request.user)).filter(bot_id=bot_id,
                                                                                                     created_on=date_from, admin_id=request.user.id)
                 else:
-                    chatrooms = ClientwidgetChatroom.objects.using(request.user.ext_db_label).filter(bot_id=bot_id, admin_id=request.user.id)
+                    chatrooms = ClientwidgetChatroom.objects.using(tenants.get_user_db_label(request.user)).filter(bot_id=bot_id, admin_id=request.user.id)
 
                 bot_conversation = chatrooms.filter(is_lead=True).count()        
                 unique_chatrooms = chatrooms.count()
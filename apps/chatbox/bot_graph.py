@@ -0,0 +1,226 @@
+import json
+import threading
+import uuid
+from collections import OrderedDict
+
+from decouple import UndefinedValueError, config
+from django.core.cache import cache
+
+from apps.clientwidget import tenants
+from apps.clientwidget.exceptions import create_logger
+
+from .bot_json_parser import BotJSONParseError, BotJSONParser
+from .models import Chatbox
+
+logger = create_logger(__name__)
+
+# Maximum number of compiled bot graphs kept per process
+try:
+    BOT_GRAPH_CACHE_SIZE = int(config('BOT_GRAPH_CACHE_SIZE'))
+except UndefinedValueError:
+    BOT_GRAPH_CACHE_SIZE = 256
+
+
+class BotGraph():
+    """A compiled, read-only view of a bot's `bot_data_json`.
+
+    The node index is built once per content version, so that fetching a node
+    is a dictionary lookup instead of a DB query + a scan over every node.
+
+    Note:
+        Nodes are shared between every room running this bot, so callers must never
+        mutate what's stored here. `get_node()` and `get_init()` hand out shallow copies.
+    """
+
+    def __init__(self, bot_id, version, nodes, variables=None, leads=None, owner_id=None, owner_uuid=None,
+                 ext_db_label='default', chatbot_type='website', is_deleted=False):
+        self.bot_id = str(bot_id)
+        self.version = version
+        self.is_valid = isinstance(nodes, dict)
+        self.nodes = nodes if self.is_valid else {}
+        self.variables = variables if isinstance(variables, dict) else {}
+        self.leads = leads if isinstance(leads, dict) else {}
+        self.owner_id = owner_id
+        self.owner_uuid = owner_uuid
+        self.ext_db_label = ext_db_label if ext_db_label is not None else 'default'
+        self.chatbot_type = chatbot_type
+        self.is_deleted = is_deleted
+
+        self.init_id = None
+        for node_id, node in self.nodes.items():
+            if not isinstance(node, dict):
+                continue
+            if node.get('nodeType') == 'INIT' and self.init_id is None:
+                self.init_id = node_id
+            elif node.get('nodeType') == 'SET_VARIABLE_BETA' and 'expression' not in node:
+                self.compile_expression(node_id, node)
+
+
+    def compile_expression(self, node_id, node):
+        """Bots published before expressions were compiled at publish time only have the raw `value`.
+        We compile them once here, instead of on every message
+        """
+        try:
+            _, expression = BotJSONParser().compile_set_variable_expression(node.get('value', ''))
+            self.nodes[node_id] = {**node, 'expression': expression}
+        except BotJSONParseError as ex:
+            logger.warning(f"Couldn't compile expression of node {node_id} in bot {self.bot_id}: {ex}")
+
+
+    @classmethod
+    def from_chatbox(cls, bot_obj, version=None):
+        owner = bot_obj.owner
+        return cls(
+            bot_obj.bot_hash, version, bot_obj.bot_data_json,
+            variables=bot_obj.bot_variable_json, leads=bot_obj.bot_lead_json,
+            owner_id=owner.id, owner_uuid=owner.uuid, ext_db_label=tenants.get_user_db_label(owner),
+            chatbot_type=bot_obj.chatbot_type, is_deleted=bot_obj.is_deleted,
+        )
+
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+
+    def get_node(self, node_id):
+        """Returns a copy of the node `node_id`, or `None` if it doesn't exist
+        """
+        node = self.nodes.get(node_id)
+        if node is None:
+            return None
+        return dict(node)
+
+
+    def get_init(self):
+        """Returns a copy of the INIT node, or `None` if the bot doesn't have one
+        """
+        if self.init_id is None:
+            return None
+        return dict(self.nodes[self.init_id])
+
+
+    def get_variables(self):
+        return dict(self.variables)
+
+
+    def get_leads(self):
+        return dict(self.leads)
+
+
+class BotGraphCache():
+    """A bounded, thread-safe LRU of `BotGraph`s keyed by `(bot_id, version)`.
+    """
+
+    def __init__(self, maxsize=BOT_GRAPH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, bot_id, version):
+        key = (str(bot_id), version)
+        with self.lock:
+            graph = self.entries.get(key)
+            if graph is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return graph
+
+
+    def put(self, graph):
+        key = (graph.bot_id, graph.version)
+        with self.lock:
+            self.entries[key] = graph
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+    def discard(self, bot_id):
+        bot_id = str(bot_id)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == bot_id]:
+                del self.entries[key]
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+bot_graph_cache = BotGraphCache()
+
+
+def get_graph_version(bot_id, preview=False):
+    """Returns the current content version of the bot. The version lives in Redis so that
+    every worker process agrees on it, and is bumped by `invalidate_bot_graph()`
+    """
+    if preview == True:
+        key = f"BOT_PREVIEW_VERSION_{bot_id}"
+    else:
+        key = f"BOT_GRAPH_VERSION_{bot_id}"
+    version = cache.get(key)
+    if version is None:
+        # First lookup (or the key expired). Only one process gets to pick the version
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def get_bot_graph(bot_id):
+    """Fetches the compiled graph for the bot `bot_id`, loading it from the `Chatbox` model on a miss.
+
+    Args:
+        bot_id (uuid.UUID | str): The bot_hash of the bot
+
+    Raises:
+        Chatbox.DoesNotExist: If there is no such bot
+
+    Returns:
+        BotGraph: The compiled bot graph
+    """
+    bot_id = str(bot_id)
+    version = get_graph_version(bot_id)
+    graph = bot_graph_cache.get(bot_id, version)
+    if graph is None:
+        bot_obj = Chatbox.objects.select_related('owner').get(pk=bot_id)
+        graph = BotGraph.from_chatbox(bot_obj, version=version)
+        bot_graph_cache.put(graph)
+    return graph
+
+
+def get_preview_graph(bot_id):
+    """Fetches the compiled graph for the in-memory preview of `bot_id`.
+
+    Returns:
+        BotGraph: The compiled bot graph, or `None` if there is no preview for this bot
+    """
+    bot_id = str(bot_id)
+    version = get_graph_version(bot_id, preview=True)
+    graph = bot_graph_cache.get(f"preview_{bot_id}", version)
+    if graph is None:
+        content = cache.get(f"BOT_PREVIEW_{bot_id}")
+        if content in ({}, None):
+            return None
+        graph = BotGraph(f"preview_{bot_id}", version, json.loads(content))
+        bot_graph_cache.put(graph)
+    return graph
+
+
+def invalidate_bot_graph(bot_id, preview=False):
+    """Invalidates the compiled graph of a bot across all processes. This must be called
+    whenever `bot_data_json`, `bot_variable_json` or `bot_lead_json` is modified.
+    """
+    bot_id = str(bot_id)
+    if preview == True:
+        cache.set(f"BOT_PREVIEW_VERSION_{bot_id}", uuid.uuid4().hex, timeout=None)
+        bot_graph_cache.discard(f"preview_{bot_id}")
+    else:
+        cache.set(f"BOT_GRAPH_VERSION_{bot_id}", uuid.uuid4().hex, timeout=None)
+        bot_graph_cache.discard(bot_id)
@@ -1,23 +1,124 @@
 import json
+import re
 import uuid
 from collections import defaultdict
-from copy import deepcopy
 
-from decouple import config
+from decouple import UndefinedValueError, config
 
-from .lexer import Lexer, LexerError, Token
+from .expression import ExpressionError, compile_expression
+from .lexer import LexerError, tokenize
 
 try:
     WEBHOOK_TIMEOUT = float(config('WEBHOOK_TIMEOUT'))
 except:
     WEBHOOK_TIMEOUT = 20 # Default is 20 seconds
 
+re_message_variable = re.compile(r'(?<![\w@])\@[a-zA-Z_]\w*')
+
+# Maximum number of distinct scopes a single node is validated against during semantic analysis
+try:
+    SEMANTIC_ANALYSIS_MAX_SCOPES = int(config('SEMANTIC_ANALYSIS_MAX_SCOPES'))
+except UndefinedValueError:
+    SEMANTIC_ANALYSIS_MAX_SCOPES = 32
+
 
 class BotJSONParseError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
 
+class SymbolTable():
+    """A persistent symbol table, mapping a variable to `{'type': variable_type}`.
+
+    Tables are never modified. `define()` returns a new table which only stores the new binding,
+    and looks up everything else in its parent. So every branch of the flow shares the bindings
+    of its ancestors, instead of getting a copy of them.
+
+    `signature` is a hash of the set of visible bindings, irrespective of the order in which they were defined.
+    Different sets can collide, so tables with the same signature are compared with `same_bindings()`.
+    """
+
+    # Collapse the chain once it gets this long, so that lookups stay cheap
+    max_depth = 32
+
+    __slots__ = ('bindings', 'parent', 'depth', 'signature',)
+
+    def __init__(self, bindings=None, parent=None, signature=0):
+        self.bindings = bindings if bindings is not None else {}
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.signature = signature
+
+
+    @classmethod
+    def from_dict(cls, bindings):
+        table = cls()
+        for variable, entry in bindings.items():
+            table = table.define(variable, entry)
+        return table
+
+
+    @staticmethod
+    def binding_hash(variable, entry):
+        return hash((variable, entry.get('type', '<untyped>')))
+
+
+    def lookup(self, variable):
+        table = self
+        while table is not None:
+            if variable in table.bindings:
+                return table.bindings[variable]
+            table = table.parent
+        return None
+
+
+    def __contains__(self, variable):
+        return self.lookup(variable) is not None
+
+
+    def __getitem__(self, variable):
+        entry = self.lookup(variable)
+        if entry is None:
+            raise KeyError(variable)
+        return entry
+
+
+    def define(self, variable, entry):
+        """Returns a new table with `variable` bound to `entry`
+        """
+        previous = self.lookup(variable)
+        if previous == entry:
+            return self
+
+        signature = self.signature ^ self.binding_hash(variable, entry)
+        if previous is not None:
+            signature ^= self.binding_hash(variable, previous)
+
+        if self.depth >= self.max_depth:
+            return SymbolTable({**self.flatten(), variable: entry}, signature=signature)
+        return SymbolTable({variable: entry}, parent=self, signature=signature)
+
+
+    def same_bindings(self, other):
+        """Returns True if both tables see the same bindings"""
+        if self is other:
+            return True
+        return self.signature == other.signature and self.flatten() == other.flatten()
+
+
+    def flatten(self):
+        chain = []
+        table = self
+        while table is not None:
+            chain.append(table.bindings)
+            table = table.parent
+
+        bindings = {}
+        for local in reversed(chain):
+            bindings.update(local)
+        return bindings
+
+
 class BotJSONParser():
     def __init__(self, restricted_variables=None):
         self.node_dict = dict()
@@ -41,6 +142,10 @@ class BotJSONParser():
         self.target_port_name = defaultdict(list)
         self.source_port_name = defaultdict(list)
         self.visited_nodes = set()
+        # (node_id, signature) -> [SymbolTable] the node was validated against
+        self.validated_scopes = dict()
+        self.strict = True
+        self.warnings = []
         self.initialized_variables = set()
 
         self.restricted_variables = restricted_variables
@@ -50,8 +155,8 @@ class BotJSONParser():
 
     def message_to_variable_tokenizer(self, msg):
         if isinstance(msg, str):
-            tokens = msg.split(' ')
-            return list(filter(lambda x: x.startswith("@"), tokens))
+            # Variables can be followed by punctuation, like "Thanks @name, ..."
+            return re_message_variable.findall(msg)
         else:
             return list()
     
@@ -454,9 +559,30 @@ class BotJSONParser():
         self.set_lead_dict(node) 
         # ----------------------------- #
 
+        # Compile the expression once, so that it can be directly evaluated during the chat
+        node['tokens'], node['expression'] = self.compile_set_variable_expression(node['value'])
+
         return node
 
 
+    def compile_set_variable_expression(self, variable_expression):
+        try:
+            tokens = self.tokenize_expression(variable_expression)
+        except BotJSONParseError as ex:
+            raise BotJSONParseError(f"Inside component Set_variable_beta, {ex}")
+        
+        for token in tokens:
+            if token['type'] == 'EQUALS':
+                raise BotJSONParseError(f"Set Variable expression must not have '='")
+        
+        try:
+            expression = compile_expression(tokens)
+        except ExpressionError as ex:
+            raise BotJSONParseError(f"Inside component Set_variable_beta, {ex}")
+        
+        return tokens, expression
+
+
     def assign_targetid(self, node, key):
         if len(self.source_target[key]) == 0:
             node['targetId'] = ""
@@ -540,134 +666,141 @@ class BotJSONParser():
                 return None
     
 
+    def add_warning(self, msg):
+        if msg not in self.warnings:
+            self.warnings.append(msg)
+
+
+    def unset_variable(self, variable, node):
+        msg = f"Variable {variable} inside component {node['nodeType'].capitalize()} is not previously set"
+        if self.strict == True:
+            raise BotJSONParseError(msg)
+        # The variable is just displayed as it is, so this doesn't break the flow
+        self.add_warning(msg)
+
+
     def _dfs(self, init_id):
-        self.stack = [(init_id, dict(),)]
+        # Every declared variable (and restricted variable) is initialized when the room is created,
+        # so it's always set, but its type is only known once a component on this path assigns it
+        declared_variables = {**self.variable_dict, **(self.restricted_variables or {})}
+        root_scope = SymbolTable.from_dict({variable: {} for variable in declared_variables})
+        self.stack = [(init_id, root_scope,)]
+        scope_count = defaultdict(int)
 
         while self.stack != []:
             node_id, symbol_table = self.stack.pop()
-            symbol_table = deepcopy(symbol_table)
-            if node_id not in self.visited_nodes:
-                self.visited_nodes.add(node_id)
-            else:
+
+            if node_id not in self.node_dict:
+                # Dangling link. The flow simply ends here
                 continue
+
+            node = self.node_dict[node_id]
+
+            # Every node needs to be validated only once for every distinct set of variables reaching it
+            scopes = self.validated_scopes.setdefault((node_id, symbol_table.signature), [])
+            if any(symbol_table.same_bindings(scope) for scope in scopes):
+                continue
+            if scope_count[node_id] >= SEMANTIC_ANALYSIS_MAX_SCOPES:
+                self.add_warning(
+                    f"Component {node['nodeType'].capitalize()} is reached with more than {SEMANTIC_ANALYSIS_MAX_SCOPES} different sets of variables. "
+                    f"Only the first {SEMANTIC_ANALYSIS_MAX_SCOPES} were checked"
+                )
+                continue
+            scopes.append(symbol_table)
+            scope_count[node_id] += 1
+            self.visited_nodes.add(node_id)
             
             # Check if a variable is coming before it has been initialized
             list_components = ['choices', 'messages']
             for component in list_components:
-                if component in self.node_dict[node_id]:
-                    msgs = self.node_dict[node_id][component]
+                if component in node:
+                    msgs = node[component]
                     for msg in msgs:
                         variable_tokens = self.message_to_variable_tokenizer(msg)
                         for variable_token in variable_tokens:
                             if variable_token not in symbol_table:
-                                raise BotJSONParseError(f"Variable {variable_token} inside component {self.node_dict[node_id]['nodeType'].capitalize()} is not previously set")
+                                self.unset_variable(variable_token, node)
                         
             '''
             webhook_component = ['queryParams', 'requestBody', 'responseBody']
             for component in webhook_component:
-                if component in self.node_dict[node_id]:
-                    content = self.node_dict[node_id][component]
+                if component in node:
+                    content = node[component]
                     for _, variable_token in content.items():
                         if variable_token not in symbol_table:
-                            raise BotJSONParseError(f"Variable {variable_token} inside component {self.node_dict[node_id]['nodeType'].capitalize()} is not previously set")
+                            raise BotJSONParseError(f"Variable {variable_token} inside component {node['nodeType'].capitalize()} is not previously set")
             '''
+
+            if isinstance(node.get('variableList'), list):
+                for variable_node in node['variableList']:
+                    if 'variable' in variable_node and variable_node['variable'] not in symbol_table:
+                        symbol_table = symbol_table.define(variable_node['variable'], {'type': node.get('variableType', 'string')})
             
-            if 'variable' in self.node_dict[node_id]:
-                variable = self.node_dict[node_id]['variable']
+            if 'variable' in node:
+                variable = node['variable']
 
-                if 'variableType' in self.node_dict[node_id]:
-                    variable_type = self.node_dict[node_id]['variableType']
+                if 'variableType' in node:
+                    variable_type = node['variableType']
                     if variable not in symbol_table or 'type' not in symbol_table[variable]:
-                        symbol_table[variable] = {'type': variable_type}
+                        symbol_table = symbol_table.define(variable, {'type': variable_type})
                     elif symbol_table[variable]['type'] is not None and variable_type != symbol_table[variable]['type']:
-                        raise BotJSONParseError(f"Variable {variable} inside component {self.node_dict[node_id]['nodeType'].capitalize()} must be of type {variable_type}, but has {symbol_table[variable]['type']}")
+                        raise BotJSONParseError(f"Variable {variable} inside component {node['nodeType'].capitalize()} must be of type {variable_type}, but has {symbol_table[variable]['type']}")
                 else:
                     if variable in symbol_table:
-                        symbol_table[variable]['type'] = None
+                        symbol_table = symbol_table.define(variable, {'type': None})
                     else:
-                        symbol_table[variable] = {'type': 'string'}
+                        symbol_table = symbol_table.define(variable, {'type': 'string'})
                 
-                if self.node_dict[node_id]['nodeType'] == 'SET_VARIABLE_BETA':
-                    if 'value' in self.node_dict[node_id] and self.node_dict[node_id]['value'] is not None:
-                        variable_expression = self.node_dict[node_id]['value']
-
-                        try:    
-                            self.node_dict[node_id]['tokens'] = self.tokenize_expression(variable_expression)
-                        except BotJSONParseError as ex:
-                            raise BotJSONParseError(f"Inside component {self.node_dict[node_id]['nodeType'].capitalize()}, {ex}")
-                        
-                        tokens = self.node_dict[node_id]['tokens']
-                        
-                        for i in range(len(tokens)):
-                            if tokens[i]['type'] == 'EQUALS':
-                                raise BotJSONParseError(f"Set Variable expression must not have '='")
+                if node['nodeType'] == 'SET_VARIABLE_BETA':
+                    if 'value' in node and node['value'] is not None:
+                        if 'tokens' not in node:
+                            variable_expression = node['value']
+                            node['tokens'], node['expression'] = self.compile_set_variable_expression(variable_expression)
                         
                         try:
-                            self.parse_expression(self.node_dict[node_id]['tokens'], symbol_table, expression_type=self.node_dict[node_id].get('variableType', 'string'))
+                            self.parse_expression(node['tokens'], symbol_table, expression_type=node.get('variableType', 'string'))
                         except BotJSONParseError as  ex:
-                            raise BotJSONParseError(f"Inside component {self.node_dict[node_id]['nodeType'].capitalize()}, {ex}")
+                            raise BotJSONParseError(f"Inside component {node['nodeType'].capitalize()}, {ex}")
             
-            if 'buttons' in self.node_dict[node_id] and isinstance(self.node_dict[node_id]['buttons'], list):
-                for button in self.node_dict[node_id]['buttons']:
+            if 'buttons' in node and isinstance(node['buttons'], list):
+                for button in node['buttons']:
                     if 'text' in button:
                         msg = button['text']
                         variable_tokens = self.message_to_variable_tokenizer(msg)
                         for variable_token in variable_tokens:
                             if variable_token not in symbol_table:
-                                raise BotJSONParseError(f"Variable {variable_token} inside component {self.node_dict[node_id]['nodeType'].capitalize()} is not previously set")
+                                self.unset_variable(variable_token, node)
                     
                     if 'targetId' in button:
                         target_id = button['targetId']
                         self.stack.append((target_id, symbol_table,))
 
-            elif 'targetId' in self.node_dict[node_id] and self.node_dict[node_id]['targetId'] != "":
-                target_id = self.node_dict[node_id]['targetId']
+            elif 'targetId' in node and node['targetId'] != "":
+                target_id = node['targetId']
                 self.stack.append((target_id, symbol_table,))
             
             else:
                 continue
     
 
-    def semantic_analysis(self):   
+    def semantic_analysis(self, strict=True):
+        """Checks the types of variables along every path of the flow.
+
+        Args:
+            strict (bool, optional): If False, messages using a variable which isn't set are only added to `self.warnings`. Defaults to True.
+        """
+        self.strict = strict
         # Start from INIT Component
         if self.init_component_id is None:
             raise BotJSONParseError(f"INIT Component ID is invalid")
         self._dfs(self.init_component_id)
+        return self.warnings
     
 
     def tokenize_expression(self, expression):
-        tokens = []
-        lexer_rules = [
-            (r'[0-9]{1,2}\:[0-5][0-9]\:[0-5][0-9]', 'TIME'),
-            (r'[0-9]{2}-[0-9]{2}-[0-9]{4}', 'DATE'),
-            (r'[\'\"][a-zA-Z0-9_\s\(\)]*[\'\"]', 'STRING'),
-            (r'\d+\.\d+', 'FLOAT'),
-            (r'\d+', 'NUMBER'),
-            (r'\@[a-zA-Z_]\w*', 'IDENTIFIER'),
-            (r'True', 'TRUE'),
-            (r'False', 'FALSE'),
-            (r'and', 'AND'),
-            (r'or', 'OR'),
-            (r'not', 'NOT'),
-            (r'\+', 'PLUS'),
-            (r'\-', 'MINUS'),
-            (r'\*', 'MUL'),
-            (r'\/', 'DIV'),
-            (r'\(', 'LP'),
-            (r'\)', 'RP'),
-            (r'\{', 'LBP'),
-            (r'\}', 'RBP'),
-            (r'\%', 'MOD'),
-            (r'==', 'ISEQUAL'),
-            (r'=', 'EQUALS'),
-            (r'\?', 'TERNARY'),
-        ]
-
-        lex = Lexer(lexer_rules, skip_whitespace=True)
-        lex.input(expression)
-
         try:
-            tokens = [{'type': token.type, 'value': token.val} for token in lex.tokens()]
+            # Callers may modify the tokens, so we hand out fresh dicts
+            tokens = [{'type': tok_type, 'value': val} for tok_type, val in tokenize(expression)]
         except LexerError:
             raise BotJSONParseError(f"Invalid expression")
 
@@ -0,0 +1,232 @@
+"""
+chatbox/expression.py
+
+Compiles the token stream of a SET_VARIABLE_BETA expression into an expression tree, and evaluates it.
+
+The tree is made only of lists, strings and numbers, so that it can be stored as a part of `bot_data_json`:
+    ["lit", 10]                     -> Literal
+    ["date", "12-05-2020"]          -> datetime literal
+    ["time", 0, 12, 40, 0]          -> timedelta literal (days, hours, minutes, seconds)
+    ["var", "@name"]                -> Session variable
+    ["not", x], ["neg", x]          -> Unary operators
+    ["+", x, y], ["and", x, y], ... -> Binary operators
+
+Operators follow the precedence rules of Python, which is what these expressions used to be evaluated as.
+"""
+
+import datetime
+import operator
+
+
+class ExpressionError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return str(self.msg)
+
+
+# Binary operators, from the lowest to the highest precedence level
+BINARY_OPERATORS = [
+    {'OR': 'or'},
+    {'AND': 'and'},
+    {'ISEQUAL': '=='},
+    {'PLUS': '+', 'MINUS': '-'},
+    {'MUL': '*', 'DIV': '/', 'MOD': '%'},
+]
+
+# 'not' binds looser than the comparison operators, but tighter than 'and'
+NOT_LEVEL = 1
+
+ARITHMETIC_OPERATORS = {
+    '==': operator.eq,
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '%': operator.mod,
+}
+
+
+def parse_date(value):
+    if len(value.split()) > 1:
+        return datetime.datetime.strptime(value, '%d-%m-%Y %H:%M:%S')
+    return datetime.datetime.strptime(value, '%d-%m-%Y')
+
+
+def parse_time(value):
+    # timedelta can also be of the form: 2 days, 12:40:00
+    tmp = value.split(",", 1)
+    if len(tmp) == 2:
+        days = int(tmp[0].split()[0])
+        hours, minutes, seconds = (int(i) for i in tmp[1].split(":"))
+    else:
+        days = 0
+        hours, minutes, seconds = (int(i) for i in value.split(":"))
+    return days, hours, minutes, seconds
+
+
+class ExpressionCompiler():
+    """Recursive descent parser from a list of `{'type': ..., 'value': ...}` tokens to an expression tree
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]['type']
+        return None
+
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+
+    def compile(self):
+        if len(self.tokens) == 0:
+            raise ExpressionError("Expression is empty")
+        tree = self.binary(0)
+        if self.pos != len(self.tokens):
+            raise ExpressionError(f"Unexpected '{self.tokens[self.pos]['value']}' in expression")
+        return tree
+
+
+    def binary(self, level):
+        if level == len(BINARY_OPERATORS):
+            return self.unary()
+
+        left = self.operand(level)
+        while self.peek() in BINARY_OPERATORS[level]:
+            op = BINARY_OPERATORS[level][self.advance()['type']]
+            left = [op, left, self.operand(level)]
+        return left
+
+
+    def operand(self, level):
+        if level == NOT_LEVEL:
+            return self.negation(level)
+        return self.binary(level + 1)
+
+
+    def negation(self, level):
+        if self.peek() == 'NOT':
+            self.advance()
+            return ['not', self.negation(level)]
+        return self.binary(level + 1)
+
+
+    def unary(self):
+        token_type = self.peek()
+        if token_type in ('MINUS', 'PLUS'):
+            self.advance()
+            operand = self.unary()
+            return ['neg', operand] if token_type == 'MINUS' else operand
+        return self.atom()
+
+
+    def atom(self):
+        token_type = self.peek()
+        if token_type is None:
+            raise ExpressionError("Incomplete expression")
+
+        token = self.advance()
+        value = token['value']
+
+        if token_type == 'LP':
+            tree = self.binary(0)
+            if self.peek() != 'RP':
+                raise ExpressionError("Missing ')' in expression")
+            self.advance()
+            return tree
+        elif token_type == 'NUMBER':
+            return ['lit', int(value)]
+        elif token_type == 'FLOAT':
+            return ['lit', float(value)]
+        elif token_type == 'STRING':
+            return ['lit', value[1:-1]]
+        elif token_type == 'TRUE':
+            return ['lit', True]
+        elif token_type == 'FALSE':
+            return ['lit', False]
+        elif token_type == 'DATE':
+            try:
+                parse_date(value)
+            except ValueError:
+                raise ExpressionError(f"Invalid date {value}")
+            return ['date', value]
+        elif token_type == 'TIME':
+            return ['time', *parse_time(value)]
+        elif token_type == 'IDENTIFIER':
+            return ['var', value]
+
+        raise ExpressionError(f"Unexpected '{value}' in expression")
+
+
+def compile_expression(tokens):
+    """Compiles a list of tokens (from `BotJSONParser.tokenize_expression()`) to an expression tree
+
+    Raises:
+        ExpressionError: If the expression is invalid
+    """
+    return ExpressionCompiler(tokens).compile()
+
+
+def typecast_variable(value, variable_type):
+    """Casts a session variable (which is always stored as a string) to `variable_type`
+    """
+    if variable_type == 'string':
+        if value is None:
+            raise ExpressionError("Variable is not set")
+        return str(value)
+    elif variable_type == 'datetime':
+        return parse_date(value)
+    elif variable_type == 'int':
+        return int(value)
+    elif variable_type == 'float':
+        return float(value)
+    elif variable_type == 'bool':
+        return bool(value)
+    return value
+
+
+def evaluate_expression(tree, variables, variable_type='string'):
+    """Evaluates an expression tree against the session `variables`.
+
+    Args:
+        tree (list): The compiled expression tree
+        variables (dict): The session variables
+        variable_type (str, optional): The type of the variable being set. Variables are casted to this type.
+
+    Returns:
+        The value of the expression
+    """
+    op = tree[0]
+
+    if op == 'lit':
+        return tree[1]
+    elif op == 'var':
+        return typecast_variable(variables.get(tree[1]), variable_type)
+    elif op == 'date':
+        return parse_date(tree[1])
+    elif op == 'time':
+        return datetime.timedelta(days=tree[1], hours=tree[2], minutes=tree[3], seconds=tree[4])
+    elif op == 'not':
+        return not evaluate_expression(tree[1], variables, variable_type)
+    elif op == 'neg':
+        return -evaluate_expression(tree[1], variables, variable_type)
+    elif op == 'and':
+        return evaluate_expression(tree[1], variables, variable_type) and evaluate_expression(tree[2], variables, variable_type)
+    elif op == 'or':
+        return evaluate_expression(tree[1], variables, variable_type) or evaluate_expression(tree[2], variables, variable_type)
+    elif op in ARITHMETIC_OPERATORS:
+        return ARITHMETIC_OPERATORS[op](
+            evaluate_expression(tree[1], variables, variable_type),
+            evaluate_expression(tree[2], variables, variable_type),
+        )
+
+    raise ExpressionError(f"Unknown operator {op}")
@@ -1,5 +1,14 @@
 import re
 import sys
+from functools import lru_cache
+
+from decouple import UndefinedValueError, config
+
+# Maximum number of tokenized expressions kept per process
+try:
+    EXPRESSION_CACHE_SIZE = int(config('EXPRESSION_CACHE_SIZE'))
+except UndefinedValueError:
+    EXPRESSION_CACHE_SIZE = 4096
 
 
 class Token(object):
@@ -18,6 +27,14 @@ class LexerError(Exception):
 
 
 class Lexer():
+    """A single pass, regex based lexer.
+
+    All the rules are compiled once into a single master pattern. When `skip_whitespace` is set,
+    the leading whitespace is consumed by the master pattern itself, so every token costs exactly one match.
+
+    A `Lexer` object can be shared across threads, as long as you use `scan()`, which keeps no state on the object.
+    """
+
     def __init__(self, rules, skip_whitespace=True):
         idx = 1
         regex_parts = []
@@ -29,39 +46,97 @@ class Lexer():
             self.group_type[groupname] = type
             idx += 1
 
-        self.regex = re.compile('|'.join(regex_parts))
+        if skip_whitespace:
+            self.regex = re.compile(r'\s*(?:%s)' % '|'.join(regex_parts))
+        else:
+            self.regex = re.compile('|'.join(regex_parts))
         self.skip_whitespace = skip_whitespace
-        self.re_ws_skip = re.compile(r'(\"[^\"]*\"|\'[^\']*\'|[\S]+)+')
-
-    def input(self, buf):
-        self.buf = buf
-        self.pos = 0
+        self.re_ws = re.compile(r'\s*')
 
-    def token(self):
-        if self.pos >= len(self.buf):
-            return None
-        else:
-            if self.skip_whitespace:
-                m = self.re_ws_skip.search(self.buf, self.pos)
+    def scan(self, buf):
+        """Yields the `(type, value, pos)` of every token in `buf`
 
-                if m:
-                    self.pos = m.start()
-                else:
-                    return None
+        Raises:
+            LexerError: If no rule matches at some position
+        """
+        pos = 0
+        end = len(buf)
+        match = self.regex.match
+        group_type = self.group_type
 
-            m = self.regex.match(self.buf, self.pos)
+        while pos < end:
+            m = match(buf, pos)
             if m:
                 groupname = m.lastgroup
-                tok_type = self.group_type[groupname]
-                tok = Token(tok_type, m.group(groupname), self.pos)
-                self.pos = m.end()
-                return tok
+                yield group_type[groupname], m.group(groupname), m.start(groupname)
+                pos = m.end()
+                continue
+
+            if self.skip_whitespace:
+                pos = self.re_ws.match(buf, pos).end()
+                if pos == end:
+                    # Only trailing whitespace left
+                    return
 
             # if we're here, no rule matched
-            raise LexerError(self.pos)
+            raise LexerError(pos)
+
+    def input(self, buf):
+        self.buf = buf
+        self._scanner = self.scan(buf)
+
+    def token(self):
+        try:
+            tok_type, val, pos = next(self._scanner)
+        except StopIteration:
+            return None
+        return Token(tok_type, val, pos)
 
     def tokens(self):
         while 1:
             tok = self.token()
             if tok is None: break
-            yield tok
\ No newline at end of file
+            yield tok
+
+
+# Token rules for SET_VARIABLE_BETA expressions. Order matters: the first matching rule wins
+EXPRESSION_RULES = [
+    (r'[0-9]{1,2}\:[0-5][0-9]\:[0-5][0-9]', 'TIME'),
+    (r'[0-9]{2}-[0-9]{2}-[0-9]{4}', 'DATE'),
+    (r'[\'\"][a-zA-Z0-9_\s\(\)]*[\'\"]', 'STRING'),
+    (r'\d+\.\d+', 'FLOAT'),
+    (r'\d+', 'NUMBER'),
+    (r'\@[a-zA-Z_]\w*', 'IDENTIFIER'),
+    (r'True', 'TRUE'),
+    (r'False', 'FALSE'),
+    (r'and', 'AND'),
+    (r'or', 'OR'),
+    (r'not', 'NOT'),
+    (r'\+', 'PLUS'),
+    (r'\-', 'MINUS'),
+    (r'\*', 'MUL'),
+    (r'\/', 'DIV'),
+    (r'\(', 'LP'),
+    (r'\)', 'RP'),
+    (r'\{', 'LBP'),
+    (r'\}', 'RBP'),
+    (r'\%', 'MOD'),
+    (r'==', 'ISEQUAL'),
+    (r'=', 'EQUALS'),
+    (r'\?', 'TERNARY'),
+]
+
+# Compiled once per process, and shared by every caller
+expression_lexer = Lexer(EXPRESSION_RULES, skip_whitespace=True)
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def tokenize(expression):
+    """Tokenizes an expression with `expression_lexer`.
+
+    The result is cached, so it's an immutable tuple of `(type, value)` pairs.
+
+    Raises:
+        LexerError: If the expression has an invalid token
+    """
+    return tuple((tok_type, val) for tok_type, val, _ in expression_lexer.scan(expression))
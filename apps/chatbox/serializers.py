@@ -2,6 +2,7 @@ from django.contrib.auth import authenticate
 from rest_framework import serializers
 import uuid
 
+from apps.clientwidget import tenants
 from apps.clientwidget.models import ChatRoom
 
 from . import models
@@ -12,7 +13,7 @@ class ChatboxListSerializer(serializers.ModelSerializer):
     count_chat = serializers.SerializerMethodField('chat_count')
 
     def chat_count(self, obj):
-        return ChatRoom.objects.using(obj.owner.ext_db_label).filter(bot_id=obj.bot_hash).count()
+        return ChatRoom.objects.using(tenants.get_user_db_label(obj.owner)).filter(bot_id=obj.bot_hash).count()
 
     class Meta:
         model = models.Chatbox
@@ -1,3 +1,216 @@
-from django.test import TestCase
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from . import bot_json_parser
+from .bot_json_parser import BotJSONParseError, BotJSONParser, SymbolTable
+from .expression import evaluate_expression
+from .lexer import EXPRESSION_RULES, Lexer, expression_lexer, tokenize
 
 # Create your tests here.
+
+
+class SetVariableExpressionTests(SimpleTestCase):
+    """Tests for the compiled SET_VARIABLE_BETA expressions
+    """
+
+    def compile(self, expression):
+        _, tree = BotJSONParser().compile_set_variable_expression(expression)
+        return tree
+
+
+    def test_precedence(self):
+        self.assertEqual(evaluate_expression(self.compile('@a + 2 * 3'), {'@a': '4'}, 'int'), 10)
+        self.assertEqual(evaluate_expression(self.compile('(@a + 2) * 3 % 5'), {'@a': '4'}, 'int'), 3)
+        self.assertEqual(evaluate_expression(self.compile('-@a - -2'), {'@a': '1.5'}, 'float'), 0.5)
+        self.assertEqual(evaluate_expression(self.compile('not @a == 4 and True'), {'@a': '4'}, 'int'), False)
+
+
+    def test_string_concatenation(self):
+        tree = self.compile("@name + ' Doe'")
+        self.assertEqual(evaluate_expression(tree, {'@name': 'John'}, 'string'), 'John Doe')
+
+
+    def test_no_code_injection(self):
+        # Visitor input is only ever treated as data
+        tree = self.compile("@name + 'x'")
+        value = "\"; import os; os.system('ls'); \""
+        self.assertEqual(evaluate_expression(tree, {'@name': value}, 'string'), value + 'x')
+
+
+    def test_invalid_expressions(self):
+        for expression in ('', '1 +', '(1', '1 2', '@a = 1', '{1}'):
+            with self.assertRaises(BotJSONParseError):
+                self.compile(expression)
+
+
+class TokenizerBenchmark(SimpleTestCase):
+    """Micro-benchmark of tokenizing 10k expressions: a new `Lexer` per expression (what we used to do)
+    vs the shared `expression_lexer`, and the LRU cached `tokenize()`
+    """
+
+    num_expressions = 10000
+
+    def setUp(self):
+        # A published bot has a few hundred distinct expressions, which are tokenized again and again
+        self.expressions = [f"@var_{i % 500} + {i % 500} * (@total - 2.5) == 'ok'" for i in range(self.num_expressions)]
+        tokenize.cache_clear()
+
+
+    def per_call_lexer(self, expression):
+        lex = Lexer(EXPRESSION_RULES, skip_whitespace=True)
+        lex.input(expression)
+        return [(token.type, token.val) for token in lex.tokens()]
+
+
+    def timeit(self, func):
+        start = time.perf_counter()
+        for expression in self.expressions:
+            func(expression)
+        return time.perf_counter() - start
+
+
+    def test_tokenize_10k_expressions(self):
+        for expression in self.expressions[:500]:
+            self.assertEqual(tuple(self.per_call_lexer(expression)), tokenize(expression))
+        tokenize.cache_clear()
+
+        per_call = self.timeit(self.per_call_lexer)
+        shared = self.timeit(lambda expression: list(expression_lexer.scan(expression)))
+        cached = self.timeit(tokenize)
+
+        # Only reported. Wall-clock timings depend on the machine and its load, so they aren't asserted
+        print(f"\nTokenized {self.num_expressions} expressions: per-call Lexer {per_call:.3f}s, "
+              f"shared scanner {shared:.3f}s, cached {cached:.3f}s ({tokenize.cache_info()})")
+
+
+def synthetic_graph(num_nodes, fan_out=4, num_variables=50):
+    """A wide flow of `num_nodes` components. Every MULTI_CHOICE component branches out into `fan_out` components,
+    and the components at the end of the flow set variables, with a few of them joining back into another branch
+    """
+    nodes = {'0': {'nodeType': 'INIT', 'messages': ['Hello'], 'targetId': '1'}}
+    for i in range(1, num_nodes):
+        children = [str(child) for child in range(fan_out * (i - 1) + 2, fan_out * i + 2) if child < num_nodes]
+
+        if len(children) > 1:
+            nodes[str(i)] = {
+                'nodeType': 'MULTI_CHOICE', 'variable': f'@name_{i % num_variables}', 'variableType': 'string',
+                'buttons': [{'text': f'Option {child}', 'targetId': child} for child in children],
+            }
+            continue
+
+        target_id = children[0] if children else ''
+        if i % 7 == 0:
+            # Join back into another branch
+            target_id = str((i * 31) % num_nodes or 1)
+
+        if i % 2 == 0:
+            nodes[str(i)] = {
+                'nodeType': 'SET_VARIABLE_BETA', 'variable': f'@total_{i % num_variables}', 'variableType': 'int',
+                'value': f'@count_{(i + 1) % num_variables} + {i}', 'targetId': target_id,
+            }
+        else:
+            nodes[str(i)] = {
+                'nodeType': 'NUMBER', 'variable': f'@count_{i % num_variables}', 'variableType': 'int',
+                'messages': [f'Count for @name_{i % num_variables}?'], 'targetId': target_id,
+            }
+    return nodes
+
+
+def analyse(nodes, **kwargs):
+    parser = BotJSONParser()
+    parser.node_dict = nodes
+    parser.variable_dict = {node['variable']: '' for node in nodes.values() if 'variable' in node}
+    parser.init_component_id = '0'
+    parser.semantic_analysis(**kwargs)
+    return parser
+
+
+class SemanticAnalysisTests(SimpleTestCase):
+    """Tests for `BotJSONParser.semantic_analysis()`
+    """
+
+    def test_symbol_table(self):
+        root = SymbolTable.from_dict({'@a': {}})
+        child = root.define('@b', {'type': 'int'})
+        self.assertIn('@a', child)
+        self.assertNotIn('@b', root)
+        self.assertEqual(child['@b'], {'type': 'int'})
+        self.assertIs(child.define('@b', {'type': 'int'}), child)
+
+        # The signature doesn't depend on the order of definitions
+        other = SymbolTable.from_dict({'@b': {'type': 'int'}, '@a': {}})
+        self.assertEqual(child.signature, other.signature)
+
+        # Tables with colliding signatures aren't mistaken for each other
+        int_table = SymbolTable({'@a': {'type': 'int'}}, signature=1)
+        self.assertFalse(int_table.same_bindings(SymbolTable({'@a': {'type': 'string'}}, signature=1)))
+        self.assertTrue(int_table.same_bindings(SymbolTable({'@a': {'type': 'int'}}, signature=1)))
+
+        deep = root
+        for i in range(SymbolTable.max_depth * 3):
+            deep = deep.define(f'@v{i}', {'type': 'string'})
+        self.assertLessEqual(deep.depth, SymbolTable.max_depth)
+        self.assertIn('@a', deep)
+        self.assertIn('@v0', deep)
+
+
+    def test_branches_dont_share_types(self):
+        nodes = {
+            '0': {'nodeType': 'INIT', 'targetId': '1'},
+            '1': {'nodeType': 'MULTI_CHOICE', 'buttons': [{'text': 'A', 'targetId': '2'}, {'text': 'B', 'targetId': '3'}]},
+            '2': {'nodeType': 'NUMBER', 'variable': '@x', 'variableType': 'int', 'targetId': '4'},
+            '3': {'nodeType': 'TEXT', 'variable': '@x', 'variableType': 'string', 'targetId': '5'},
+            '4': {'nodeType': 'SET_VARIABLE_BETA', 'variable': '@y', 'variableType': 'int', 'value': '@x + 1', 'targetId': ''},
+            '5': {'nodeType': 'MESSAGE', 'messages': ['Got @x'], 'targetId': ''},
+        }
+        analyse(nodes)
+
+        # The same component reached with a different type for @x must be validated again
+        nodes['5'] = {'nodeType': 'MESSAGE', 'messages': ['Got @x'], 'targetId': '4'}
+        with self.assertRaises(BotJSONParseError):
+            analyse(nodes)
+
+
+    def test_unset_variables(self):
+        nodes = {
+            '0': {'nodeType': 'INIT', 'targetId': '1'},
+            '1': {'nodeType': 'MESSAGE', 'messages': ['Thanks @missing, bye'], 'targetId': ''},
+        }
+        with self.assertRaises(BotJSONParseError):
+            analyse(nodes)
+        self.assertEqual(len(analyse(nodes, strict=False).warnings), 1)
+
+
+    def test_max_scopes(self):
+        nodes = {
+            '0': {'nodeType': 'INIT', 'targetId': '1'},
+            '1': {'nodeType': 'MULTI_CHOICE', 'buttons': [{'text': t, 'targetId': str(i + 2)} for i, t in enumerate('ABC')]},
+            '2': {'nodeType': 'NUMBER', 'variable': '@x', 'variableType': 'int', 'targetId': '5'},
+            '3': {'nodeType': 'TEXT', 'variable': '@x', 'variableType': 'string', 'targetId': '5'},
+            '4': {'nodeType': 'TEXT', 'variable': '@x', 'variableType': 'float', 'targetId': '5'},
+            '5': {'nodeType': 'MESSAGE', 'messages': ['Got @x'], 'targetId': ''},
+        }
+        self.assertEqual(analyse(nodes).warnings, [])
+
+        with mock.patch.object(bot_json_parser, 'SEMANTIC_ANALYSIS_MAX_SCOPES', 2):
+            parser = analyse(nodes)
+        # Reported once, even though the flow goes on
+        self.assertEqual(len(parser.warnings), 1)
+        self.assertIn('more than 2 different sets of variables', parser.warnings[0])
+
+
+class SemanticAnalysisBenchmark(SimpleTestCase):
+    """Benchmark of `semantic_analysis()` on synthetic flows of 1k, 10k and 50k components
+    """
+
+    def test_synthetic_graphs(self):
+        for num_nodes in (1000, 10000, 50000):
+            nodes = synthetic_graph(num_nodes)
+            start = time.perf_counter()
+            parser = analyse(nodes)
+            elapsed = time.perf_counter() - start
+
+            print(f"\nSemantic analysis of {num_nodes} components: {elapsed:.3f}s, {sum(map(len, parser.validated_scopes.values()))} (component, scope) pairs")
+            self.assertEqual(len(parser.visited_nodes), num_nodes)
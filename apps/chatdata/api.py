@@ -15,8 +15,6 @@ from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from google.oauth2 import credentials
-from googleapiclient.discovery import build
 from pytz import country_timezones
 from rest_framework import generics, permissions, status
 from rest_framework.permissions import IsAuthenticated
@@ -24,6 +22,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from apps.chatbox.serializers import ChatboxListSerializer
+from apps.clientwidget import http_client, tenants
 from apps.clientwidget.events import get_variables
 from apps.clientwidget.serializers import VariableDataSerializer
 
@@ -34,6 +33,8 @@ from . import serializers, utils
 ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
 Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
 
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4/spreadsheets'
+
 
 class ChatbotListAPI(APIView):
     """API to list all the chatbots which have a chat history with users
@@ -60,7 +61,7 @@ class ChatbotListAPI(APIView):
         chatbox = []
         for q in queryset:
             chatbox.append(q.pk)
-        filtered_query = ChatRoom.objects.using(request.user.ext_db_label).filter(bot_id__in=chatbox)
+        filtered_query = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(bot_id__in=chatbox)
 
         for chatroom_obj in filtered_query:
             if chatroom_obj.variables is None:
@@ -163,13 +164,13 @@ class ChatDataGlobalAPI(APIView):
         
         if chat_type == 'global':
             # Every single bot
-            queryset = ChatRoom.using(request.user.ext_db_label).objects.all()
+            queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).all()
             serializer = VariableDataSerializer(queryset, many=True, context={'utc_offset': request.user.utc_offset})
             return Response(serializer.data, status=status.HTTP_200_OK)
         
         elif chat_type == 'user':
             # All bots for that user
-            queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(admin_id=request.user.id)
+            queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).summary().filter(admin_id=request.user.id)
             serializer = VariableDataSerializer(queryset, many=True, context={'utc_offset': request.user.utc_offset})
             return Response(serializer.data, status=status.HTTP_200_OK)
         
@@ -190,8 +191,9 @@ class ChatDataBotAPI(APIView):
         Returns:
             A `dict` of the form `{"@name": "xyz", "@email": "xyz@mail"}` on success, and `None` on failure
         """
-        room_object = ChatRoom.objects.using(owner.user.ext_db_label).get(pk=room_id)
-        queryset = ChatRoom.objects.using(owner.ext_db_label).filter(room_id=room_object.room_id)
+        db_label = tenants.get_user_db_label(owner)
+        room_object = ChatRoom.objects.using(db_label).get(pk=room_id)
+        queryset = ChatRoom.objects.using(db_label).filter(room_id=room_object.room_id)
         if queryset.count() == 0:
             # Empty Chat History. Return dict()
             return dict()
@@ -213,7 +215,7 @@ class ChatDataBotAPI(APIView):
             dict: A dictionary containing the variable data for that chat
         """
         bot = Chatbox.objects.get(bot_hash=bot_id)
-        queryset = ChatRoom.objects.using(bot.owner.ext_db_label).filter(bot_id=bot_id)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(bot.owner)).filter(bot_id=bot_id)
         if queryset.count() == 0:
             raise Http404
         else:
@@ -234,7 +236,7 @@ class ChatDataBotAPI(APIView):
         if queryset.count() == 0:
             return Response("Invalid bot_id. No such bot exists", status=status.HTTP_404_NOT_FOUND)
         instance = queryset.first()
-        queryset = ChatRoom.objects.using(instance.owner.ext_db_label).filter(bot_id=bot_id)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(instance.owner)).summary().filter(bot_id=bot_id)
         if queryset.count() == 0:
             return Response([], status=status.HTTP_204_NO_CONTENT)
             #return Response("No chat history exists for this bot", status=status.HTTP_400_BAD_REQUEST)
@@ -283,7 +285,7 @@ class ChatDataRoomAPI(APIView):
         Returns:
             HTTP_200_OK status code + content on success, and a HTTP_404_NOT_FOUND if the bot doesn't exist.
         """
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(room_name=room_name)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(room_name=room_name)
         if queryset.count() == 0:
             return Response(status=status.HTTP_404_NOT_FOUND)
         instance = queryset.first()
@@ -297,7 +299,7 @@ class ChatDataCountLeads(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, bot_id: uuid.UUID, start_date=None, end_date=None):        
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(bot_id=bot_id, is_lead=True)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(bot_id=bot_id, is_lead=True)
         
         if start_date is None and end_date is None:
             pass
@@ -330,7 +332,7 @@ class ChatDataCountVisitors(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, bot_id: uuid.UUID, start_date=None, end_date=None):
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(bot_id=bot_id)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(bot_id=bot_id)
 
         if start_date is None and end_date is None:
             pass
@@ -378,7 +380,7 @@ class ChatDataSortAPI(APIView):
         elif order not in ('asc', 'desc'):
             return Response("Order must be between one of (asc, desc)", status=status.HTTP_400_BAD_REQUEST)
         
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(bot_id=bot_id)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).summary().filter(bot_id=bot_id)
         if queryset.count() == 0:
             return Response([], status=status.HTTP_204_NO_CONTENT)
         
@@ -619,7 +621,7 @@ class UpdateLeadsAPI(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        for instance in ChatRoom.objects.using(request.user.ext_db_label).all():
+        for instance in ChatRoom.objects.using(tenants.get_user_db_label(request.user)).all():
             variables = instance.variables
             if '@email' in variables:
                 if variables['@email'] not in ('', None):
@@ -649,12 +651,12 @@ class ExportToGsheets(APIView):
 
         serializer = serializers.GsheetTokenSerializer(data=request.data)
         bot_list = Chatbox.objects.get(bot_hash=bot_id, owner_id=request.user.pk)
-        queryset = ChatRoom.objects.using(bot_list.owner.ext_db_label).filter(bot_id=bot_id).order_by('-created_on')
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(bot_list.owner)).filter(bot_id=bot_id).order_by('-created_on')
         
         if queryset.count() == 0:
             return Response([], status=status.HTTP_200_OK)
 
-        fields = [field.get_attname_column()[1] for field in ChatRoom._meta.fields if field.get_attname_column()[1] not in ['room_id', 'variables', 'bot_info', 'recent_messages', 'messages', 'bot_id', 'assignment_type', 'num_msgs']]
+        fields = [field.get_attname_column()[1] for field in ChatRoom._meta.fields if field.get_attname_column()[1] not in ['room_id', 'variables', 'bot_info', 'recent_messages', 'recent_seq', 'archived_seq', 'archived_on', 'messages', 'bot_id', 'assignment_type', 'num_msgs']]
 
         if f'chatdata_fields_{bot_id}' in request.session and f'chatdata_column_names_{bot_id}' in request.session:
             fields, column_names = request.session[f'chatdata_fields_{bot_id}'], request.session[f'chatdata_column_names_{bot_id}']
@@ -769,25 +771,23 @@ class ExportToGsheets(APIView):
                 }
             }
             try:
-
-
-                creds = credentials.Credentials(serializer.data['token'])
-                service = build('sheets', 'v4', credentials=creds)
-                request = service.spreadsheets().create(body=spreadsheet)
-                response = request.execute()
-                spreadsheet_id=response.get('spreadsheetId')
+                # Sheets API over the shared HTTP client: no discovery document, and the connection is kept alive
+                headers = {'Authorization': f"Bearer {serializer.data['token']}"}
+                response = http_client.post(SHEETS_API_URL, headers=headers, json=spreadsheet)
+                response.raise_for_status()
+                spreadsheet_id = response.json().get('spreadsheetId')
                 chatbot.spreadsheetId = spreadsheet_id
                 chatbot.save()
-                request = service.spreadsheets().values().append(
-                    spreadsheetId=spreadsheet_id,
-                    range='sheet1',
-                    valueInputOption='RAW',
-                    body=body
+                response = http_client.post(
+                    f"{SHEETS_API_URL}/{spreadsheet_id}/values/sheet1:append",
+                    headers=headers,
+                    params={'valueInputOption': 'RAW'},
+                    json=body
                     )
-                response = request.execute()
+                response.raise_for_status()
                 print(f'Chatbot{bot_id} --> {spreadsheet_id}')
                 
-                print(response)
+                print(response.json())
                 
             except Exception as ex:
                 print(ex)
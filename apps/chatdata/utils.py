@@ -20,6 +20,8 @@ from django.utils import timezone
 from django.utils.encoding import force_bytes, force_text
 from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 
+from apps.clientwidget import tenants
+
 Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
 ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
 
@@ -67,7 +69,7 @@ def excel_column_generator() -> Iterator[Tuple[int, str]]:
 def fetch_bot_data(bot_id, fields, column_names=None, frontend_override=False, send_email=False, email=None, fmt='csv', fetch_leads=False, export_only_lead_fields=True, filters={}):
     chatbot = Chatbox.objects.filter(pk=bot_id)
     owner = chatbot.first().owner
-    queryset = ChatRoom.objects.using(owner.ext_db_label).filter(bot_id=bot_id).order_by('-created_on')
+    queryset = ChatRoom.objects.using(tenants.get_user_db_label(owner)).filter(bot_id=bot_id).order_by('-created_on')
     if queryset.count() == 0:
         return HttpResponse(f"Bot {bot_id} not found in clientwidget.ChatRoom", status=404)
     
@@ -85,7 +87,7 @@ def fetch_bot_data(bot_id, fields, column_names=None, frontend_override=False, s
     if fields is None:
         # We need to add all fields
         flag = True
-        fields = [field.get_attname_column()[1] for field in ChatRoom._meta.fields if field.get_attname_column()[1] not in ['room_id', 'variables', 'bot_info', 'messages', 'bot_id', 'assignment_type', 'num_msgs']]
+        fields = [field.get_attname_column()[1] for field in ChatRoom._meta.fields if field.get_attname_column()[1] not in ['room_id', 'variables', 'bot_info', 'recent_seq', 'archived_seq', 'archived_on', 'messages', 'bot_id', 'assignment_type', 'num_msgs']]
         lead_fields = ['visitor_id', 'room_name', 'created_on', 'updated_on', 'end_time', 'channel_id']
         fields = lead_fields
     
@@ -341,11 +343,11 @@ def export_chat_data(request, bot_id: uuid.UUID, fields: tuple, fmt: str, send_e
         # Export to .csv
         if isinstance(bot_id, str) and bot_id == 'global':
             # All bots
-            queryset = ChatRoom.objects.using(request.user.ext_db_label).all()
+            queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).all()
         
         elif isinstance(bot_id, str) and bot_id == 'user':
             # Get all the bots for the current user
-            queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(admin_id=request.user.id)
+            queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(admin_id=request.user.id)
         
         if send_multiple == False:
             response, status = fetch_bot_data(bot_id, column_names=column_names, frontend_override=frontend_override, fields=fields[:], send_email=send_email, email=email, fmt='csv', fetch_leads=fetch_leads, export_only_lead_fields=export_only_lead_fields, filters=filters)
@@ -373,11 +375,11 @@ def export_chat_data(request, bot_id: uuid.UUID, fields: tuple, fmt: str, send_e
         # Export to xlsx
         if isinstance(bot_id, str) and bot_id == 'global':
             # All bots
-            queryset = ChatRoom.objects.using(request.user.ext_db_label).all()
+            queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).all()
 
         elif isinstance(bot_id, str) and bot_id == 'user':
             # Get all the bots for the current user
-            queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(admin_id=request.user.id)
+            queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(admin_id=request.user.id)
 
         if send_multiple == False:
             response, status = fetch_bot_data(bot_id, column_names=column_names, frontend_override=frontend_override, fields=fields[:], send_email=send_email, email=email, fmt='xlsx', fetch_leads=fetch_leads, export_only_lead_fields=export_only_lead_fields, filters=filters)
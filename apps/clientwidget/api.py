@@ -25,6 +25,8 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from apps.accounts.models import User
+from apps.chatbox.bot_graph import (get_bot_graph, get_preview_graph,
+                                    invalidate_bot_graph)
 from apps.chatbox.bot_json_parser import BotJSONParser
 from apps.chatbox.parse_json import parse_json
 from apps.clientwidget.models import ChatRoom, ChatSession
@@ -32,13 +34,14 @@ from apps.clientwidget.serializers import (ActiveChatRoomSerializer,
                                            VariableSerializer)
 from apps.taskscheduler.schedule_manager.management import DEVELOPMENT
 
-from . import serializers, tasks
+from . import archive, counters, history_seq, near_cache, room_state, serializers, tasks, tenants
 from .consumers import ClientWidgetConsumer
 from .events import (cleanup_room_redis, create_room, delete_history_from_db,
-                     delete_history_from_redis, fetch_history_from_db,
-                     fetch_history_from_redis, fetch_recent_history_from_db,
-                     fetch_variables_from_db, fetch_variables_from_redis,
-                     get_variables, reset_chatroom_state)
+                     delete_history_from_redis, fetch_history_from_redis,
+                     fetch_history_page_from_db, fetch_variables_from_db,
+                     fetch_variables_from_redis, get_variables,
+                     next_message_seq, reset_chatroom_state)
+from .flow import BotFlowExecutor
 from .views import BUFFER_TIME, lock_timeout
 
 Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
@@ -56,9 +59,9 @@ class TemplatePreviewChatbot(APIView):
         # Use Redis as an in-memory cache
         if isinstance(bot_id, uuid.UUID):
             bot_id = str(bot_id)
-        content = cache.get(f'BOT_PREVIEW_{bot_id}')
+        graph = get_preview_graph(bot_id)
         variable_data = {}
-        if content == {} or content is None:
+        if graph is None:
             raise Http404
         else:
             variables = cache.get(f'BOT_PREVIEW_VARIABLE_{bot_id}')
@@ -66,19 +69,13 @@ class TemplatePreviewChatbot(APIView):
                 pass
             else:
                 variable_data = json.loads(variables)
-            content = json.loads(content)
             if bot_com_tid:
-                for key_id in content:
-                    if key_id == bot_com_tid:
-                        bot_component_response = content[key_id]
-                        return bot_component_response, variable_data
-                raise Http404
+                bot_component_response = graph.get_node(bot_com_tid)
             else:
-                for key_id in content:
-                    if content[key_id]['nodeType'] == 'INIT':
-                        bot_component_response = content[key_id]
-                        return bot_component_response, variable_data
+                bot_component_response = graph.get_init()
+            if bot_component_response is None:
                 raise Http404
+            return bot_component_response, variable_data
 
 
     def get(self, request, bot_id: uuid.UUID, format=None) -> Response:
@@ -155,6 +152,7 @@ class TemplatePreviewChatbot(APIView):
             else:
                 cache.set(f"BOT_PREVIEW_VARIABLE_{bot_id}", variable_json)
             cache.set(f"BOT_PREVIEW_{bot_id}", bot_json)
+            invalidate_bot_graph(bot_id, preview=True)
             # Not send the INIT data
             bot_obj, variable_obj = self.get_bot_data(bot_id, None)
             return Response({**bot_obj, 'variables': variable_obj}, status=status.HTTP_200_OK)
@@ -198,67 +196,93 @@ class TemplateChatbot(APIView):
             Http404: If the `bot_id` does not exist in the `Chatbox` model.
         """
         try:
-            bot_obj = Chatbox.objects.get(pk=bot_id)
-            if not isinstance(bot_obj.bot_data_json, dict):
+            bot_obj = get_bot_graph(bot_id)
+            if not bot_obj.is_valid:
                 raise Http404
             if bot_obj.is_deleted == True:
                 raise Http404("No such bot exists")
             reset_state = False
             if bot_com_tid:
-                for key_id in bot_obj.bot_data_json:
-                    if key_id==bot_com_tid:
-                        bot_component_response = bot_obj.bot_data_json[key_id]
-                        var_response = bot_obj.bot_variable_json
-                        if room_id is not None:
-                            bot_component_response['room_id'] = room_id
-                            # Make it active again
-                            instance = ChatRoom.objects.using(bot_obj.owner.ext_db_label).get(room_id=room_id, admin_id=bot_obj.owner.id)
-                            if instance.status in ['resolve', 'disconnected']:
-                                # Un-assign this again
-                                instance.status = 'unassigned'
-                                reset_state = True
-                            instance.bot_is_active = True
-                            instance.save(using=bot_obj.owner.ext_db_label, send_update=True)
-                            if reset_state == False:
-                                return bot_component_response, var_response, None, None, bot_obj.owner.uuid
-                            else:
-                                # Go to INIT again
-                                return self.get_bot_data(bot_id, bot_com_tid=None, user='AnonymousUser', room_id=room_id, room_name=room_name, website_url=website_url)
+                bot_component_response = bot_obj.get_node(bot_com_tid)
+                if bot_component_response is not None:
+                    var_response = bot_obj.get_variables()
+                    if room_id is not None:
+                        bot_component_response['room_id'] = room_id
+                        # Make it active again
+                        instance = ChatRoom.objects.using(bot_obj.ext_db_label).get(room_id=room_id, admin_id=bot_obj.owner_id)
+                        if instance.status in ['resolve', 'disconnected']:
+                            # Un-assign this again
+                            instance.status = 'unassigned'
+                            reset_state = True
+                        instance.bot_is_active = True
+                        instance.save(using=bot_obj.ext_db_label, send_update=True)
+                        if reset_state == False:
+                            return bot_component_response, var_response, None, None, bot_obj.owner_uuid
+                        else:
+                            # Go to INIT again
+                            return self.get_bot_data(bot_id, bot_com_tid=None, user='AnonymousUser', room_id=room_id, room_name=room_name, website_url=website_url)
                 raise Http404
             else:
-                for key_id in bot_obj.bot_data_json:
-                    if bot_obj.bot_data_json[key_id]['nodeType'] == 'INIT':
-                        bot_component_response = bot_obj.bot_data_json[key_id]
-                        if user is not None:
-                            if room_id is None:
-                                bot_component_response['room_id'], _ = create_room(user, content={
-                                    'room_name': '',
-                                    'bot_id': str(bot_obj.bot_hash),
-                                    'bot_is_active': True,
-                                    'num_msgs': 0,
-                                    'chatbot_type': bot_obj.chatbot_type,
-                                    'website_url': website_url,
-                                    'channel_id': website_url,
-                                }, bot_id=bot_obj.bot_hash)
-                            else:
-                                bot_component_response['room_id'] = room_id
-                                # Make it active again
-                                try:
-                                    instance = ChatRoom.objects.using(bot_obj.owner.ext_db_label).get(room_id=room_id, bot_id=bot_obj.bot_hash, admin_id=bot_obj.owner.pk)
-                                    if instance.status in ['resolve', 'disconnected']:
-                                        # Un-assign this again
-                                        instance.status = 'unassigned'
-                                        reset_state = True
-                                    instance.bot_is_active=True
-                                    instance.save(using=bot_obj.owner.ext_db_label, send_update=True)
-                                except Exception as e:
-                                    print(e)
-                        return bot_component_response, bot_obj.bot_variable_json, bot_component_response['room_id'], None, bot_obj.owner.uuid
+                bot_component_response = bot_obj.get_init()
+                if bot_component_response is not None:
+                    if user is not None:
+                        if room_id is None:
+                            bot_component_response['room_id'], _ = create_room(user, content={
+                                'room_name': '',
+                                'bot_id': bot_obj.bot_id,
+                                'bot_is_active': True,
+                                'num_msgs': 0,
+                                'chatbot_type': bot_obj.chatbot_type,
+                                'website_url': website_url,
+                                'channel_id': website_url,
+                            }, bot_id=bot_obj.bot_id)
+                        else:
+                            bot_component_response['room_id'] = room_id
+                            # Make it active again
+                            try:
+                                instance = ChatRoom.objects.using(bot_obj.ext_db_label).get(room_id=room_id, bot_id=bot_obj.bot_id, admin_id=bot_obj.owner_id)
+                                if instance.status in ['resolve', 'disconnected']:
+                                    # Un-assign this again
+                                    instance.status = 'unassigned'
+                                    reset_state = True
+                                instance.bot_is_active=True
+                                instance.save(using=bot_obj.ext_db_label, send_update=True)
+                            except Exception as e:
+                                print(e)
+                    return bot_component_response, bot_obj.get_variables(), bot_component_response['room_id'], None, bot_obj.owner_uuid
                 raise Http404
         except Chatbox.DoesNotExist:
             raise Http404
     
 
+    def run_flow(self, bot_id, target_id, session_data):
+        """Runs through the automatic nodes (SET_VARIABLE, GOAL, SET_VARIABLE_BETA, WEBHOOK) starting at `target_id`.
+
+        Args:
+            bot_id (uuid.UUID): Bot ID of an existing bot
+            target_id (str): The `target_id` node sent by the client
+            session_data (dict): The session data for this bot, of the form `{'room_id': ..., 'variables': {...}}`. The variables are updated in place.
+
+        Returns:
+            str: The `target_id` of the next interactive node. If the flow ended, this is the last node which was executed.
+        """
+        try:
+            graph = get_bot_graph(bot_id)
+        except Chatbox.DoesNotExist:
+            raise Http404
+        
+        executor = BotFlowExecutor(graph, session_data.get('room_id'), bot_type=graph.chatbot_type, variables=session_data.get('variables', {}))
+        node = executor.run(target_id)
+        executor.commit()
+        
+        if executor.variables is not None:
+            session_data['variables'] = dict(executor.variables)
+        
+        if node is None:
+            return executor.last_id if executor.last_id is not None else target_id
+        return executor.target_id
+
+
     def generate_token(self, bot_id=None, room_id=None):
         """Generates an authentication token for the session
 
@@ -443,20 +467,16 @@ class TemplateChatbot(APIView):
                         print("An archived session. Re-activating the room and deleting the old session")
                         first_visit = False
                         qs.delete()
-                        ext = cache.get(room_id)
-                        if ext is None:
-                            b = Chatbox.objects.get(bot_hash=bot_id)
-                            cache.set(f"{room_id}", f"{b.owner.ext_db_label}", timeout=lock_timeout)
-                            ext = b.owner.ext_db_label
+                        ext = tenants.resolve_room_db_label(room_id, bot_id, timeout=lock_timeout)
                         try:
                             reset_chatroom_state(room_id, db_label=ext)
                         except Exception as ex:
                             print(f"Exception during reset_chatroom_state: {ex}")
-                        end = cache.get(f"CLIENTWIDGET_SESSION_END_{room_id}", False)
+                        end = room_state.get_room_field(room_id, room_state.SESSION_END, False)
                         if end == True:
                             # Go to INIT
                             print(f"Moving to INIT since previous chat was taken over")
-                            cache.delete(f"CLIENTWIDGET_SESSION_END_{room_id}")
+                            room_state.delete_room_fields(room_id, room_state.SESSION_END)
                             target_id = None
 
                         session_token = self.generate_token(bot_id=bot_id, room_id=room_id)
@@ -468,8 +488,7 @@ class TemplateChatbot(APIView):
                 print("Creating a new room...")
                 # We need to create a new room
                 bot_obj, variable_json, room_id, _, owner_id = self.get_bot_data(bot_id, user=user, website_url=website_url)
-                b = Chatbox.objects.get(bot_hash=bot_id)
-                cache.set(f"{room_id}", f"{b.owner.ext_db_label}", timeout=lock_timeout)
+                near_cache.set_db_label(room_id, tenants.get_bot_db_label(bot_id), timeout=lock_timeout)
                 # TODO: Add ChatSession Model
                 # Also a new token for this session - We'll use this to validate users for the current session
                 session_token = self.generate_token(bot_id=bot_id, room_id=room_id)
@@ -551,11 +570,7 @@ class TemplateChatbot(APIView):
                         except ChatSession.DoesNotExist:
                             return Response("Invalid Session Key", status=status.HTTP_400_BAD_REQUEST)
                     
-                    ext = cache.get(room_id)
-                    if ext is None:
-                        b = Chatbox.objects.get(bot_hash=bot_id)
-                        cache.set(f"{room_id}", f"{b.owner.ext_db_label}", timeout=lock_timeout)
-                        ext = b.owner.ext_db_label
+                    ext = tenants.resolve_room_db_label(room_id, bot_id, timeout=lock_timeout)
                     
                     queryset = ChatRoom.objects.using(ext).filter(room_id=room_id)
 
@@ -572,11 +587,11 @@ class TemplateChatbot(APIView):
                     except Exception as ex:
                         print(f"Exception during reset_chatroom_state: {ex}")
                     
-                    end = cache.get(f"CLIENTWIDGET_SESSION_END_{room_id}", False)
+                    end = room_state.get_room_field(room_id, room_state.SESSION_END, False)
                     if end == True:
                         # Go to INIT
                         print(f"Moving to INIT since previous chat was taken over")
-                        cache.delete(f"CLIENTWIDGET_SESSION_END_{room_id}")
+                        room_state.delete_room_fields(room_id, room_state.SESSION_END)
                         target_id = None
 
                     bot_obj, variable_json, _, _, owner_id = self.get_bot_data(
@@ -584,9 +599,9 @@ class TemplateChatbot(APIView):
                         room_id = uuid.UUID(str(room_id)),
                     )
                 
-                if room_id is not None and cache.get(f"VARIABLES_{room_id}") is None:
+                if room_id is not None and room_state.get_room_field(room_id, room_state.VARIABLES) is None:
                     # Set session variables
-                    cache.set(f"VARIABLES_{room_id}", request.session[session_key][session_bot_id]['variables'])
+                    room_state.set_variables(room_id, request.session[session_key][session_bot_id]['variables'])
         else:
             # TODO: Potential bugs wrt user and session expiry. Look at this later
             room_id = uuid.UUID(str(request.session[session_key][session_bot_id]['room_id']))
@@ -613,11 +628,7 @@ class TemplateChatbot(APIView):
                 
                 # Reset the state
                 print(f"Resetting the state")
-                ext = cache.get(room_id)
-                if ext is None:
-                    b = Chatbox.objects.get(bot_hash=bot_id)
-                    cache.set(f"{room_id}", f"{b.owner.ext_db_label}", timeout=lock_timeout)
-                    ext = b.owner.ext_db_label
+                ext = tenants.resolve_room_db_label(room_id, bot_id, timeout=lock_timeout)
                 try:
                     reset_chatroom_state(room_id, db_label=ext)
                 except Exception as ex:
@@ -695,6 +706,7 @@ class TemplateChatbot(APIView):
                 variable_name = request.data['variable']
                 # Store to session
                 request.session['bots'][session_bot_id]['variables'][variable_name] = request.data['post_data']
+                tid = self.run_flow(bot_id, tid, request.session['bots'][session_bot_id])
                 request.session.modified = True
                 bot_obj, var_obj, _, _, owner_id = self.get_bot_data(bot_id, tid)
                 # TODO: Overrding with session data. Remove this later
@@ -709,6 +721,8 @@ class TemplateChatbot(APIView):
             else:
                 # Get from session
                 if request.data['variable'] in request.session['bots'][session_bot_id]['variables']:
+                    tid = self.run_flow(bot_id, tid, request.session['bots'][session_bot_id])
+                    request.session.modified = True
                     bot_obj, var_obj, _, _, owner_id = self.get_bot_data(bot_id, tid)
                     # TODO: Overrding with session data. Remove this later
                     var_obj = request.session['bots'][session_bot_id]['variables']
@@ -722,6 +736,8 @@ class TemplateChatbot(APIView):
                 else:
                     return Response(status=status.HTTP_400_BAD_REQUEST)
         else:
+            tid = self.run_flow(bot_id, tid, request.session['bots'][session_bot_id])
+            request.session.modified = True
             bot_obj, var_obj, _, _, owner_id = self.get_bot_data(bot_id, tid)
         # TODO: Overwriting with session data. Change this later
         bot_obj = {**bot_obj, 'variables': request.session['bots'][session_bot_id]['variables']}
@@ -788,16 +804,8 @@ class ActiveChatBotListing(APIView):
 
         Fetches the bot related data and lists them, for all active bots.
         """
-        try:
-            if request.user.role not in ('AO'):
-                db_label = request.user.ext_db_label
-            else:
-                # Db label is the owner db_label
-                db_label = request.user.created_by.ext_db_label
-        except Exception as ex:
-            print(f"Error during db_label assignment")
-            print(f"{ex}")
-            db_label = "default"
+        # Operators use the db_label of their owner
+        db_label = tenants.get_user_db_label(request.user)
 
         if sort_date is None:
             sort_date = 'desc'
@@ -812,31 +820,24 @@ class ActiveChatBotListing(APIView):
             field = '-updated_on'
 
         if bot_type is None:
-            queryset = ChatRoom.objects.using(db_label).filter(bot_is_active=True, admin_id=request.user.id)
+            queryset = ChatRoom.objects.using(db_label).summary().filter(bot_is_active=True, admin_id=request.user.id)
         else:
             if bot_type not in ('website', 'whatsapp', 'facebook'):
                 return Response("Invalid Bot type", status=status.HTTP_400_BAD_REQUEST)
-            queryset = ChatRoom.objects.using(db_label).filter(bot_is_active=True, admin_id=request.user.id)    
+            queryset = ChatRoom.objects.using(db_label).summary().filter(bot_is_active=True, admin_id=request.user.id)    
         
         # Now sort based on field
         queryset = queryset.order_by(f'{field}')
-        serializer = ActiveChatRoomSerializer(queryset, many=True)
+        rooms = list(queryset)
+        serializer = ActiveChatRoomSerializer(rooms, many=True, context={'msg_counts': counters.get_msgcounts([room.room_id for room in rooms])})
         return Response(serializer.data)
     
 
     def post(self, request, bot_type=None, sort_date=None):
         """POST Request for performing filters for active Chatbots
         """
-        try:
-            if request.user.role not in ('AO'):
-                db_label = request.user.ext_db_label
-            else:
-                # Db label is the owner db_label
-                db_label = request.user.created_by.ext_db_label
-        except Exception as ex:
-            print(f"Error during db_label assignment")
-            print(f"{ex}")
-            db_label = "default"
+        # Operators use the db_label of their owner
+        db_label = tenants.get_user_db_label(request.user)
 
         if sort_date is None:
             sort_date = 'desc'
@@ -851,7 +852,7 @@ class ActiveChatBotListing(APIView):
             field = '-updated_on'
         
         # First filter on active bots for current owner
-        queryset = ChatRoom.objects.using(db_label).filter(bot_is_active=True, admin_id=request.user.id)
+        queryset = ChatRoom.objects.using(db_label).summary().filter(bot_is_active=True, admin_id=request.user.id)
         
 
         if 'channels' in request.data:
@@ -908,7 +909,8 @@ class ActiveChatBotListing(APIView):
                 gap = 5
                 queryset = queryset[gap*int(page)-gap:gap*int(page)]
             
-        serializer = ActiveChatRoomSerializer(queryset, many=True)        
+        rooms = list(queryset)
+        serializer = ActiveChatRoomSerializer(rooms, many=True, context={'msg_counts': counters.get_msgcounts([room.room_id for room in rooms])})
         return Response({'data': serializer.data})
 
 
@@ -923,7 +925,7 @@ class InactiveChatBotListing(APIView):
             if self.request.query_params['sort'] == 'asc':
                 sort = 'updated_on'
         
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(admin_id=request.user.id, bot_is_active=False)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).summary().filter(admin_id=request.user.id, bot_is_active=False)
 
         if 'channels' in self.request.query_params:
             channels = self.request.query_params['channels']
@@ -998,13 +1000,60 @@ class DeactivateChatbot(APIView):
         """Sets bot_is_active to False, for all the bots in room_name
         """
         try:
-            instance = ChatRoom.objects.using(request.user.ext_db_label).get(room_id=room_id)
-            instance.save(bot_is_active=False, using=request.user.ext_db_label, send_update=True)
+            db_label = tenants.get_user_db_label(request.user)
+            instance = ChatRoom.objects.using(db_label).get(room_id=room_id)
+            instance.save(bot_is_active=False, using=db_label, send_update=True)
         except Exception as e:
             print(e)
         return Response(status=status.HTTP_200_OK)
 
 
+def parse_history_cursor(request):
+    """Parses the `before` query parameter of the history APIs (the `X-History-Before` header of the previous page)
+    """
+    if 'before' not in request.query_params:
+        return True, None
+    try:
+        before = int(request.query_params['before'])
+    except ValueError:
+        return False, "before must be an integer"
+    if before < 1:
+        return False, f"Wrong value. before is {before}. Expected a positive integer"
+    return True, before
+
+
+def history_response(history, first_seq):
+    """Returns a page of the history. If there are older messages, `X-History-Before` is the cursor of the previous page
+    """
+    response = Response(history, status=status.HTTP_200_OK)
+    if first_seq is not None:
+        response['X-History-Before'] = str(first_seq)
+    return response
+
+
+def parse_history_after(request):
+    """Parses the `after` query parameter of the history APIs: the seq of the last message the client already has
+    """
+    if 'after' not in request.query_params:
+        return True, None
+    try:
+        after = int(request.query_params['after'])
+    except ValueError:
+        return False, "after must be an integer"
+    if after < 0:
+        return False, f"Wrong value. after is {after}. Expected a non negative integer"
+    return True, after
+
+
+def history_after_response(messages, has_more):
+    """Returns a page of the messages after a seq. If there are more, `X-History-After` is the cursor of the next page
+    """
+    response = Response(messages, status=status.HTTP_200_OK)
+    if has_more == True:
+        response['X-History-After'] = str(messages[-1]['seq'])
+    return response
+
+
 class ChatHistoryDB(APIView):
     """API for dealing with the Chat History from the persistent DB.
 
@@ -1021,6 +1070,8 @@ class ChatHistoryDB(APIView):
         If num_msgs is None, the whole history will be fetched.
         Otherwise, the last num_msgs will be fetched from the database.
 
+        With `?after=<seq>`, only the messages after that seq are fetched (from the DB and the session), num_msgs per page.
+
         Returns:
             HTTP_200_OK status code + history content on success, and a HTTP_400_BAD_REQUEST on failure, along with an error message.
         """
@@ -1051,36 +1102,45 @@ class ChatHistoryDB(APIView):
                 return Response([], status=status.HTTP_200_OK)
             
             if cache.has_key(room_id):
-                ext = cache.get(room_id)
+                ext = near_cache.get_db_label(room_id)
             else:
                 ext = "default"
         else:
-            if request.user.role == 'AM':
-                ext = request.user.ext_db_label
-            else:
-                ext = request.user.operator_of.ext_db_label        
+            ext = tenants.get_user_db_label(request.user)
 
-        queryset = ChatRoom.objects.using(ext).filter(room_id=room_id)    
+        instance = ChatRoom.objects.using(ext).filter(room_id=room_id).first()
         
-        if queryset.count() == 0:
+        if instance is None:
             return Response(f"Room - {room_id} not found in DB", status=status.HTTP_404_NOT_FOUND)
         
-        if not request.user.is_authenticated:
-            has_error, history = fetch_recent_history_from_db(room_id, num_msgs=num_msgs, db_name=ext)
-        else:
-            has_error, history = fetch_history_from_db(room_id, num_msgs=num_msgs, db_name=ext)
+        has_error, after = parse_history_after(request)
+        if has_error == False:
+            return Response(after, status=status.HTTP_400_BAD_REQUEST)
+        if after is not None:
+            # Only the messages the client doesn't have yet, from the DB and the session
+            messages, has_more = history_seq.fetch_history_after(instance, after, num_msgs=num_msgs or history_seq.HISTORY_PAGE_SIZE, db_label=ext, recent=(not request.user.is_authenticated))
+            return history_after_response(messages, has_more)
         
+        has_error, before = parse_history_cursor(request)
         if has_error == False:
-            return Response(history, status=status.HTTP_400_BAD_REQUEST)
-        else:
+            return Response(before, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Only the recent history is visible to the visitor
+        archive.ensure_rehydrated(instance, ext, recent=(not request.user.is_authenticated))
+        history, first_seq = fetch_history_page_from_db(room_id, num_msgs=num_msgs, before=before, recent=(not request.user.is_authenticated), recent_seq=instance.recent_seq, db_name=ext)
+        
+        if before is None:
             # Now also fetch the session history
             try:
                 session_history = fetch_history_from_redis(room_id, num_msgs)
             except Exception as ex:
                 print(ex)
                 session_history = []
-            
-            return Response(history + session_history, status=status.HTTP_200_OK)
+        else:
+            # Older pages are only in the DB
+            session_history = []
+        
+        return history_response(history + session_history, first_seq)
 
 
     def delete(self, request, room_id, num_msgs=None):
@@ -1094,10 +1154,10 @@ class ChatHistoryDB(APIView):
         if not request.user.is_authenticated:
             return Response([], status=status.HTTP_200_OK)
             
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(room_id=room_id)        
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(room_id=room_id)        
         if queryset.count() == 0:
             return Response(f"Room - {room_id} not found in DB", status=status.HTTP_404_NOT_FOUND)
-        result, error = delete_history_from_db(room_id, num_msgs)
+        result, error = delete_history_from_db(room_id, num_msgs, db_name=tenants.get_user_db_label(request.user))
         if result == 1 or result == True:
             return Response(status=status.HTTP_200_OK)
         else:
@@ -1150,19 +1210,26 @@ class ChatHistoryRedis(APIView):
                 return Response([], status=status.HTTP_200_OK)
 
             if cache.has_key(room_id):
-                ext = cache.get(room_id)
+                ext = near_cache.get_db_label(room_id)
             else:
                 ext = 'default'
         else:
-            if request.user.role == 'AM':
-                ext = request.user.ext_db_label
-            else:
-                ext = request.user.operator_of.ext_db_label
+            ext = tenants.get_user_db_label(request.user)
 
         queryset = ChatRoom.objects.using(ext).filter(room_id=room_id)        
         
         if queryset.count() == 0:
             return Response(status=status.HTTP_404_NOT_FOUND)
+
+        has_error, after = parse_history_after(request)
+        if has_error == False:
+            return Response(after, status=status.HTTP_400_BAD_REQUEST)
+        if after is not None:
+            page_size = num_msgs or history_seq.HISTORY_PAGE_SIZE
+            _, session = history_seq.fetch_redis_history_after(room_id, after, page_size + 1)
+            messages = [history_seq.with_seq(seq, message) for seq, message in session]
+            return history_after_response(messages[:page_size], len(messages) > page_size)
+
         history = fetch_history_from_redis(room_id, num_msgs)
         return Response(history, status=status.HTTP_200_OK)
 
@@ -1179,7 +1246,7 @@ class ChatHistoryRedis(APIView):
         if not request.user.is_authenticated:
             return Response([], status=status.HTTP_200_OK)
 
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(room_id=room_id)
+        queryset = ChatRoom.objects.using(tenants.get_user_db_label(request.user)).filter(room_id=room_id)
         
         if queryset.count() == 0:
             return Response(status=status.HTTP_404_NOT_FOUND)
@@ -1235,15 +1302,26 @@ class RecentChatHistoryDB(APIView):
                 print("Expired")
                 return Response([], status=status.HTTP_200_OK)
 
-        queryset = ChatRoom.objects.using(request.user.ext_db_label).filter(room_id=room_id)
+        db_label = tenants.get_user_db_label(request.user) if request.user.is_authenticated else near_cache.get_db_label(room_id, 'default')
+        instance = ChatRoom.objects.using(db_label).filter(room_id=room_id).first()
         
-        if queryset.count() == 0:
+        if instance is None:
             return Response(f"Room - {room_id} not found in DB", status=status.HTTP_404_NOT_FOUND)
-        has_error, history = fetch_recent_history_from_db(room_id, num_msgs=num_msgs)
+        
+        has_error, after = parse_history_after(request)
         if has_error == False:
-            return Response(history, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            return Response(history, status=status.HTTP_200_OK)
+            return Response(after, status=status.HTTP_400_BAD_REQUEST)
+        if after is not None:
+            messages, has_more = history_seq.fetch_history_after(instance, after, num_msgs=num_msgs or history_seq.HISTORY_PAGE_SIZE, db_label=db_label, recent=True)
+            return history_after_response(messages, has_more)
+        
+        has_error, before = parse_history_cursor(request)
+        if has_error == False:
+            return Response(before, status=status.HTTP_400_BAD_REQUEST)
+        
+        archive.ensure_rehydrated(instance, db_label, recent=True)
+        history, first_seq = fetch_history_page_from_db(room_id, num_msgs=num_msgs, before=before, recent=True, recent_seq=instance.recent_seq, db_name=db_label)
+        return history_response(history, first_seq)
     
 
     def post(self, request, room_id, num_msgs=None):
@@ -1264,21 +1342,19 @@ class RecentChatHistoryDB(APIView):
                 return Response("Please ensure that you contact our developers regarding using our API", status=status.HTTP_401_UNAUTHORIZED)
 
             if cache.has_key(room_id):
-                ext = cache.get(room_id)
+                ext = near_cache.get_db_label(room_id)
             else:
                 ext = 'default'
         else:
-            if request.user.role == 'AM':
-                ext = request.user.ext_db_label
-            else:
-                ext = request.user.operator_of.ext_db_label
+            ext = tenants.get_user_db_label(request.user)
         
         instance = ChatRoom.objects.using(ext).filter(room_id=room_id).first()
         
         if not instance:
             return Response(f"Room - {room_id} not found in DB", status=status.HTTP_404_NOT_FOUND)
         
-        instance.recent_messages = []
+        # Everything stored so far is no longer part of the recent history
+        instance.recent_seq = next_message_seq(room_id, ext)
         instance.save(using=ext)
         
         return Response("Updated", status=status.HTTP_200_OK)
@@ -1320,10 +1396,7 @@ class FetchVariablesRedis(APIView):
         else:
             override = False
         
-        if request.user.role == 'AM':
-            ext = request.user.ext_db_label
-        else:
-            ext = request.user.operator_of.ext_db_label        
+        ext = tenants.get_user_db_label(request.user)
 
         chatroom = ChatRoom.objects.using(ext).filter(room_id=room_id).first()
         if chatroom is None:
@@ -1380,10 +1453,7 @@ class FetchVariablesDB(APIView):
             Status Code: 404 if `room_id` is not found in DB.
         """
 
-        if request.user.role == 'AM':
-            ext = request.user.ext_db_label
-        else:
-            ext = request.user.operator_of.ext_db_label        
+        ext = tenants.get_user_db_label(request.user)
 
         chatroom = ChatRoom.objects.using(ext).filter(room_id=room_id).first()
         if chatroom is None:
@@ -1397,7 +1467,7 @@ class FetchVariablesDB(APIView):
         
         bot_name = chatbox.title
 
-        err, content = fetch_variables_from_db(room_id, db_name=request.user.ext_db_label)
+        err, content = fetch_variables_from_db(room_id, db_name=tenants.get_user_db_label(request.user))
 
         lead_variables = chatbox.bot_lead_json
         
@@ -1465,7 +1535,7 @@ class UTMCodeAPI(generics.GenericAPIView):
             serializer.is_valid(raise_exception=True)
             bot_id = serializer.data['bot_id']
             chatbox = Chatbox.objects.get(pk=uuid.UUID(bot_id))
-            db_label = chatbox.owner.ext_db_label
+            db_label = tenants.get_user_db_label(chatbox.owner)
             chatroom = ChatRoom.objects.using(db_label).get(room_id=room_id)
             chatroom.utm_source = serializer.data['utm_source']
             chatroom.utm_medium = serializer.data['utm_medium']
@@ -1493,7 +1563,7 @@ class MakeChatRoomsInactive(APIView):
         try:
             time.sleep(5)
             user = User.objects.get(uuid=owner_id)
-            chatroom = ChatRoom.objects.using(user.ext_db_label).get(pk=room_id)
+            chatroom = ChatRoom.objects.using(tenants.get_user_db_label(user)).get(pk=room_id)
             return Response({'status': 'Room Already Flushed'})
         except Exception as e:
             print(e)
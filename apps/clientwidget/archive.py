@@ -0,0 +1,196 @@
+"""
+clientwidget/archive.py
+
+Archive tier for the message history of old rooms.
+
+Rooms which were created more than `CHAT_ARCHIVE_AFTER_DAYS` days ago (and aren't active) have their `ChatMessage`
+rows moved into a gzipped JSON file on the local filesystem:
+
+    {CHAT_ARCHIVE_DIR}/{db_label}/{yyyy}/{mm}/{room_id}.json.gz    (year / month of `ChatRoom.created_on`)
+
+The `ChatRoom` row itself stays, so the listings and the analytics are unaffected. `ChatRoom.archived_seq` marks
+the messages with `seq <= archived_seq` as archived. New messages of an archived room are appended after them as usual,
+and the next run of the archive job adds them to the same file.
+
+Reading a page of the history which reaches into the archived messages (`ensure_rehydrated()`) moves them back
+into `ChatMessage` first. The file is removed once that's committed. Rehydrated rooms are archived again
+`CHAT_ARCHIVE_AFTER_DAYS` days later.
+"""
+
+import gzip
+import json
+import os
+from datetime import timedelta
+
+from decouple import UndefinedValueError, config
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .exceptions import logger
+
+try:
+    CHAT_ARCHIVE_ENABLED = config('CHAT_ARCHIVE_ENABLED', cast=bool)
+except UndefinedValueError:
+    CHAT_ARCHIVE_ENABLED = False
+
+try:
+    CHAT_ARCHIVE_AFTER_DAYS = int(config('CHAT_ARCHIVE_AFTER_DAYS'))
+except UndefinedValueError:
+    CHAT_ARCHIVE_AFTER_DAYS = 365
+
+try:
+    CHAT_ARCHIVE_DIR = config('CHAT_ARCHIVE_DIR')
+except UndefinedValueError:
+    # Not under MEDIA_ROOT, which is served publicly
+    CHAT_ARCHIVE_DIR = os.path.join(settings.BASE_DIR, '../../chat_archive/')
+
+ARCHIVE_BATCH_SIZE = 500
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_path(room_id, created_on, db_label='default'):
+    return os.path.join(CHAT_ARCHIVE_DIR, db_label, f"{created_on.year}", f"{created_on.month:02d}", f"{room_id}.json.gz")
+
+
+def write_archive(path, room_id, rows):
+    """Writes the archive file of a room. Written to a temporary file first, so a crash never leaves a partial archive"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    content = {
+        'room_id': str(room_id),
+        'messages': [{'seq': row['seq'], 'content': row['content'], 'created_on': row['created_on'].isoformat()} for row in rows],
+    }
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_archive(path):
+    """Returns the archived rows of a room, as [{'seq', 'content', 'created_on'}]"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        raise ArchiveError(f"Archive file {path} not found")
+    return [{'seq': row['seq'], 'content': row['content'], 'created_on': parse_datetime(row['created_on'])} for row in content['messages']]
+
+
+def remove_archive(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def archive_room(room_id, db_label='default'):
+    """Moves the messages of an inactive room into its archive file. Returns the number of messages archived, or None
+    if the room wasn't archived
+    """
+    from .models import ChatMessage, ChatRoom
+
+    with transaction.atomic(using=db_label):
+        room = ChatRoom.objects.using(db_label).select_for_update().filter(room_id=room_id).values('created_on', 'bot_is_active', 'archived_seq').first()
+        if room is None or room['bot_is_active'] == True:
+            return None
+
+        messages = ChatMessage.objects.using(db_label).filter(room_id=room_id)
+        rows = list(messages.order_by('seq').values('seq', 'content', 'created_on'))
+        path = archive_path(room_id, room['created_on'], db_label)
+        if room['archived_seq'] > 0 and len(rows) > 0:
+            # Archived before, and messages were appended since. Both go into the same file
+            rows = [row for row in read_archive(path) if row['seq'] <= room['archived_seq']] + rows
+        if len(rows) > 0:
+            # If the transaction is rolled back, the file is never read, since `archived_seq` stays the same
+            write_archive(path, room_id, rows)
+
+        messages.delete()
+        archived_seq = rows[-1]['seq'] if len(rows) > 0 else room['archived_seq']
+        ChatRoom.objects.using(db_label).filter(room_id=room_id).update(archived_seq=archived_seq, archived_on=timezone.now())
+    return len(rows)
+
+
+def rehydrate_room(room_id, db_label='default'):
+    """Moves the archived messages of a room back into `ChatMessage`. Returns the number of messages moved"""
+    from .models import ChatMessage, ChatRoom
+
+    with transaction.atomic(using=db_label):
+        room = ChatRoom.objects.using(db_label).select_for_update().filter(room_id=room_id).values('created_on', 'archived_seq').first()
+        if room is None or room['archived_seq'] == 0:
+            return 0
+
+        path = archive_path(room_id, room['created_on'], db_label)
+        # A newer file may have been left behind by a rolled back `archive_room()`
+        rows = [row for row in read_archive(path) if row['seq'] <= room['archived_seq']]
+        ChatMessage.objects.using(db_label).bulk_create(
+            [ChatMessage(room_id=room_id, seq=row['seq'], content=row['content'], created_on=row['created_on']) for row in rows],
+            batch_size=ARCHIVE_BATCH_SIZE, ignore_conflicts=True,
+        )
+        ChatRoom.objects.using(db_label).filter(room_id=room_id).update(archived_seq=0, archived_on=timezone.now())
+        transaction.on_commit(lambda: remove_archive(path), using=db_label)
+
+    logger.info(f"Rehydrated {len(rows)} archived messages of room {room_id} on {db_label}")
+    return len(rows)
+
+
+def ensure_rehydrated(room, db_label='default', recent=False):
+    """Rehydrates `room` (a `ChatRoom`) if the history about to be read reaches into its archived messages.
+
+    The recent history of the visitor usually doesn't, so it's served without touching the archive.
+    Returns `True` if the room was rehydrated
+    """
+    if room.archived_seq == 0:
+        return False
+    if recent == True and room.recent_seq > room.archived_seq:
+        return False
+    try:
+        rehydrate_room(room.room_id, db_label)
+    except ArchiveError as ex:
+        # Serve what's left in the DB, instead of failing the request
+        logger.error(f"Couldn't rehydrate room {room.room_id} on {db_label}: {ex}")
+        return False
+    room.archived_seq = 0
+    room.archived_on = timezone.now()
+    return True
+
+
+def archive_rooms(db_label='default', days=CHAT_ARCHIVE_AFTER_DAYS, limit=None):
+    """Archives the inactive rooms created more than `days` days ago, and the messages appended to archived rooms since.
+    Returns (number of rooms, number of messages) archived
+    """
+    from .models import ChatMessage, ChatRoom
+
+    horizon = timezone.now() - timedelta(days=days)
+    new_messages = ChatMessage.objects.using(db_label).filter(room_id=OuterRef('room_id'), seq__gt=OuterRef('archived_seq'))
+    room_ids = (
+        ChatRoom.objects.using(db_label).filter(created_on__lt=horizon, bot_is_active=False)
+        .annotate(has_new_messages=Exists(new_messages))
+        .filter(
+            # Rehydrated rooms (archived_seq = 0, archived_on set) are archived again `days` after they were rehydrated
+            (Q(archived_seq=0) & ~Q(archived_on__gte=horizon))
+            # Archived rooms with messages after the archived ones
+            | (Q(archived_seq__gt=0) & Q(has_new_messages=True))
+        ).values_list('room_id', flat=True)
+    )
+    if limit is not None:
+        room_ids = room_ids[:limit]
+
+    num_rooms, num_msgs = 0, 0
+    for room_id in room_ids.iterator(chunk_size=ARCHIVE_BATCH_SIZE):
+        try:
+            archived = archive_room(room_id, db_label)
+        except Exception as ex:
+            logger.warning(f"Couldn't archive room {room_id} on {db_label}: {ex}")
+            continue
+        if archived is not None:
+            num_rooms += 1
+            num_msgs += archived
+    logger.info(f"Archived {num_msgs} messages of {num_rooms} rooms on {db_label}")
+    return num_rooms, num_msgs
@@ -0,0 +1,162 @@
+"""
+clientwidget/async_consumers.py
+
+`AsyncWebsocketConsumer` versions of the consumers in `consumers`, selected per route in `routing`.
+
+The sync consumers run every event on a worker thread, including the group events (`chat_message`,
+`template_message`, ...) which are fanned out to every connection of a room / owner. Those events are most of the
+traffic, and they only serialize the event and send it. Here they're handled on the event loop, without a thread.
+
+The bot flow, connect and the session flush work with the ORM, so they still run the sync implementation
+(`handler`, an instance of the sync consumer which shares the scope, channel and send of this connection) on a
+worker thread, with `database_sync_to_async`. Events of a connection are still handled one at a time, in order.
+
+When someone leaves a room that still has other members, `AsyncClientWidgetConsumer.disconnect()` only needs Redis
+and the channel layer, so it's handled on the event loop too, with `async_redis`. So are the chat messages of the
+visitor / admin / operator in `AsyncClientWidgetConsumer.receive()` (see `ClientWidgetConsumer.parse_chat_message()`):
+the groups of the room are read, the message is fanned out and appended to the session history without a thread.
+
+`AsyncLongPollingConsumer` coalesces the listing updates, if `LISTING_UPDATE_WINDOW` is set (see `listing_updates`).
+"""
+
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from . import async_redis, counters, fanout, listing_updates
+from .consumers import (AdminConsumer, ClientWidgetConsumer,
+                        LongPollingConsumer, OperatorConsumer)
+from .exceptions import logger
+
+
+class AsyncBridgeConsumer(AsyncWebsocketConsumer):
+    """Runs connect / receive / disconnect of `sync_consumer_class` on a worker thread"""
+
+    sync_consumer_class = None
+
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.handler = self.sync_consumer_class(scope)
+
+    async def websocket_connect(self, message):
+        # `base_send` is only available now. The handler sends from its worker thread, through the event loop
+        self.handler.channel_layer = self.channel_layer
+        self.handler.channel_name = self.channel_name
+        self.handler.base_send = async_to_sync(self.base_send)
+        await super().websocket_connect(message)
+
+    async def connect(self):
+        await database_sync_to_async(self.handler.connect)()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        await database_sync_to_async(self.handler.receive)(text_data)
+
+    async def disconnect(self, close_code):
+        await database_sync_to_async(self.handler.disconnect)(close_code)
+
+    async def send_event(self, event):
+        try:
+            await self.send(text_data=json.dumps(event))
+        except Exception as ex:
+            print(ex)
+
+
+class AsyncLongPollingConsumer(AsyncBridgeConsumer):
+    sync_consumer_class = LongPollingConsumer
+
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.window = listing_updates.LISTING_UPDATE_WINDOW / 1000
+        self.coalescer = listing_updates.ListingCoalescer() if self.window > 0 else None
+        self.flush_task = None
+
+    async def bot_listing(self, event):
+        if 'payload' in event:
+            await self.send(text_data=json.dumps(event['payload']))
+
+    async def listing_channel_event(self, event):
+        if 'payload' in event:
+            await self.send(text_data=json.dumps(event['payload']))
+        elif self.coalescer is None or 'room_id' not in event:
+            await self.send(text_data=json.dumps(event))
+        elif self.coalescer.add(event):
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        for event in self.coalescer.drain():
+            await self.send(text_data=json.dumps(event))
+
+    async def disconnect(self, close_code):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await super().disconnect(close_code)
+
+
+class AsyncClientWidgetConsumer(AsyncBridgeConsumer):
+    sync_consumer_class = ClientWidgetConsumer
+
+    async def template_message(self, event):
+        await self.send(text_data=json.dumps(self.handler.template_payload(event)))
+
+    async def chat_message(self, event):
+        await self.send(text_data=json.dumps(self.handler.chat_payload(event)))
+
+    async def chat_status_update(self, event):
+        await self.send(text_data=json.dumps(event))
+
+    async def webhook_response(self, event):
+        await database_sync_to_async(self.handler.webhook_response)(event)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        chat_message = self.handler.parse_chat_message(text_data)
+        if chat_message is None:
+            await super().receive(text_data, bytes_data)
+            return
+
+        text_data_json, event = chat_message
+        logger.info(f"Client Widget: Received {text_data}")
+        groups = await async_redis.get_chat_groups(event['room_id'], event['owner_id'])
+        await fanout.group_send_many(self.channel_layer, groups, event)
+        await async_redis.append_msg_to_redis(event['room_id'], text_data_json, store_full=True, count=True)
+
+    async def disconnect(self, close_code):
+        handler = self.handler
+        if close_code == 400 or getattr(handler, 'room_id', None) is None or getattr(handler, 'room_name', None) is None \
+                or not hasattr(handler, 'room_group_name'):
+            # Errors, and admins leaving without an END packet
+            await database_sync_to_async(handler.disconnect)(close_code)
+            return
+
+        await self.channel_layer.group_discard(handler.room_group_name, self.channel_name)
+        num_users = await async_redis.incr_counter(counters.user_count_key(handler.room_name), -1, timeout=counters.USER_COUNT_TIMEOUT)
+        if num_users > 0:
+            # Others are still in the room
+            handler.num_users = num_users
+            return
+
+        # Last one out. Flush the session
+        await database_sync_to_async(handler.leave_room)(num_users, close_code)
+
+
+class AsyncAdminConsumer(AsyncBridgeConsumer):
+    sync_consumer_class = AdminConsumer
+
+    async def template_message(self, event):
+        await self.send_event(event)
+
+    async def chat_message(self, event):
+        await self.send_event(event)
+
+
+class AsyncOperatorConsumer(AsyncBridgeConsumer):
+    sync_consumer_class = OperatorConsumer
+
+    async def template_message(self, event):
+        await self.send_event(event)
+
+    async def chat_message(self, event):
+        await self.send_event(event)
@@ -0,0 +1,94 @@
+"""
+clientwidget/async_redis.py
+
+aioredis connection pool for the async consumers (see `async_consumers`), on the same Redis server / DB as the
+Django cache. Keys are made with `cache.make_key()`, so both sides read and write the same keys.
+
+There's one pool per event loop. Daphne runs a single loop per process, so that's one pool per process.
+"""
+
+import asyncio
+
+import aioredis
+from decouple import UndefinedValueError, config
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    ASYNC_REDIS_MAXSIZE = int(config('ASYNC_REDIS_MAXSIZE'))
+except UndefinedValueError:
+    ASYNC_REDIS_MAXSIZE = 50
+
+pools = {}
+
+
+def get_address():
+    """Returns (address, db, password) of the cache server. `LOCATION` is of the form "host: port"
+    """
+    cache_settings = settings.CACHES['default']
+    location = cache_settings['LOCATION']
+    if isinstance(location, (list, tuple)):
+        location = location[0]
+    host, port = location.replace(' ', '').rsplit(':', 1)
+    options = cache_settings.get('OPTIONS', {})
+    return (host, int(port)), options.get('DB', 0), options.get('PASSWORD')
+
+
+async def get_connection():
+    loop = asyncio.get_event_loop()
+    pool = pools.get(loop)
+    if pool is not None and not pool.closed:
+        return pool
+
+    address, db, password = get_address()
+    pool = await aioredis.create_redis_pool(address, db=db, password=password, maxsize=ASYNC_REDIS_MAXSIZE)
+    if loop in pools and not pools[loop].closed:
+        # Another coroutine created one while we were connecting
+        pool.close()
+        return pools[loop]
+    pools[loop] = pool
+    return pool
+
+
+async def incr_counter(key, amount=1, timeout=None):
+    """Async version of `counters.incr_counter()`"""
+    REDIS_CONNECTION = await get_connection()
+    transaction = REDIS_CONNECTION.multi_exec()
+    value = transaction.incrby(key, amount)
+    if timeout is not None:
+        transaction.expire(key, timeout)
+    await transaction.execute()
+    return int(await value)
+
+
+async def get_counter(key, default=0):
+    REDIS_CONNECTION = await get_connection()
+    value = await REDIS_CONNECTION.get(key)
+    return default if value is None else int(value)
+
+
+async def append_msg_to_redis(room_name, message_dict, store_full=False, timeout=24 * 60 * 60, count=False):
+    """Async version of `events.append_msg_to_redis()`. Returns the new length of the history"""
+    from . import events
+
+    room_name = str(room_name)
+    entries = [events.encode_entry(entry) for entry in events.history_entries(message_dict, store_full=store_full)]
+    REDIS_CONNECTION = await get_connection()
+    if len(entries) == 0:
+        return await REDIS_CONNECTION.llen(cache.make_key(f'HISTORY_{room_name}'))
+
+    transaction = REDIS_CONNECTION.multi_exec()
+    events.queue_append(transaction, room_name, entries, timeout=timeout, count=count)
+    return (await transaction.execute())[0]
+
+
+async def get_chat_groups(room_id, owner_id):
+    """Async version of `fanout.get_chat_groups()`. The teams and the operators of the room are read in one round trip"""
+    from . import fanout, operator_map, room_state
+
+    REDIS_CONNECTION = await get_connection()
+    pipe = REDIS_CONNECTION.pipeline()
+    teams = pipe.hget(room_state.room_state_key(room_id), room_state.TEAM)
+    operators = pipe.smembers(operator_map.room_operators_key(room_id))
+    await pipe.execute()
+    return fanout.chat_groups(room_id, owner_id, room_state.decode(await teams), operator_map.decode_members(await operators))
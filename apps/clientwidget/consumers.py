@@ -22,12 +22,15 @@ from django.utils import timezone
 from django.utils.encoding import force_bytes, force_text
 from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from apps.accounts.models import Teams, User
+from apps.chatbox.bot_graph import get_bot_graph
 from apps.clientwidget.models import ChatRoom
 
-from . import events, tasks
+from . import (counters, events, fanout, history_seq, http_client, near_cache, operator_map, room_state, tasks, teardown,
+               webhooks, write_behind)
 from .exceptions import LiveChatException, log_consumer_exceptions, logger
+from .flow import BotFlowExecutor
 from .serializers import ActiveChatRoomSerializer
-from .views import BUFFER_TIME, lock_timeout, server_addr, shared_client
+from .views import BUFFER_TIME, lock_timeout, server_addr
 
 Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
   
@@ -35,7 +38,7 @@ Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
 def chat_lead_send_update(room_id, is_lead, data):
     """Sends an Email Update if a lead is encountered during an ongoing live-chat
     """
-    ext = cache.get(room_id)
+    ext = near_cache.get_db_label(room_id)
     queryset = ChatRoom.objects.using(ext).filter(pk=room_id, bot_is_active=True)
     if queryset.count() == 0:
         return
@@ -55,7 +58,7 @@ def chat_lead_send_update(room_id, is_lead, data):
         data = chatroom.variables
     
     if is_lead == True:
-        if cache.get(f'CLIENTWIDGETROOMLOCK_{room_id}') is not None:
+        if room_state.is_room_locked(room_id):
             # Ongoing chat. Send Email
             messages = events.fetch_history_from_redis(room_id)
             message = render_to_string('clientwidget/send_lead_encounter_email.html', {'user': owner, 'lead_data': data, 'messages': messages})
@@ -67,7 +70,7 @@ def chat_lead_send_update(room_id, is_lead, data):
             # Chat has completed
             pass
     else:
-        if cache.get(f'CLIENTWIDGETROOMLOCK_{room_id}') is not None:
+        if room_state.is_room_locked(room_id):
             # Ongoing chat. Send Email
             messages = events.fetch_history_from_redis(room_id)
             message = render_to_string('clientwidget/send_nonlead_encounter_email.html', {'user': owner, 'nonlead_data': data, 'messages': messages})
@@ -83,22 +86,12 @@ def chat_lead_send_update(room_id, is_lead, data):
 def send_to_operator(room_id, owner_id, channel_layer, data):
     try:
         # Send to operator group
-        client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-        print(f"CLIENT MAP = {client_map}")
-        logger.info(f"CLIENT MAP = {client_map}")
+        operator_id = operator_map.get_room_operators(room_id)
+        print(f"OPERATORS = {operator_id}")
+        logger.info(f"OPERATORS = {operator_id}")
 
         #TODO: NEED TO ADD CELERY TASK HERE.
-        if client_map is not None:
-            operator_id = client_map.get(str(room_id))
-            for operator in operator_id:
-                async_to_sync(channel_layer.group_send)(
-                    operator,
-                    {
-                        **data,
-                        'type': 'chat_message',
-                    }
-
-                )
+        fanout.send_to_groups(operator_id, {**data, 'type': 'chat_message'}, channel_layer)
     except Exception as ex:
         print(ex)
 
@@ -202,8 +195,8 @@ class ClientWidgetConsumer(WebsocketConsumer):
         self.session_end = True
         self.exclude_count = True
         if hasattr(self, 'room_id') and self.room_id is not None:
-            ext = cache.get(str(self.room_id))
-            queryset = ChatRoom.objects.using(bot_obj.owner.ext_db_label).filter(pk=self.room_id)
+            ext = near_cache.get_db_label(str(self.room_id))
+            queryset = ChatRoom.objects.using(bot_obj.ext_db_label).filter(pk=self.room_id)
             if queryset.count() == 0:
                 logger.info('no_chatroom')
                 logger.info(f"{ext}")
@@ -212,11 +205,11 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 logger.info(f"<<----END CHAT--->>")
                 instance = queryset.first()
                 instance.end_chat = True
-                instance.save(using=bot_obj.owner.ext_db_label, send_update=True)
+                instance.save(using=bot_obj.ext_db_label, send_update=True)
 
 
-    def get_bot_data(self, bot_id, bot_com_tid=None, user=None, room_id=None, room_name=None):
-        """This method fetches the bot specific data from the `Chatbox` model.
+    def get_bot_data(self, bot_id, bot_com_tid=None, user=None, room_id=None, room_name=None, hops=0):
+        """This method fetches the bot specific data from the compiled bot graph of the `Chatbox` model.
 
         Note:
             We are returning a generated `room_id` and `room_name` in case we need to create a new room for the bot.
@@ -228,162 +221,109 @@ class ClientWidgetConsumer(WebsocketConsumer):
             user: The user object from the USER model. This is None for any anonymous user
             room_id: The UUID room identification object for the current room, it it is already created.
             room_name: The room name for the current room, if it is already created.
+            hops: The automatic nodes already run for this message, before a webhook.
 
         Returns:
             A tuple (bot_data_json, bot_variable_json, room_id, room_name) if successful, a tuple of (None, None, None, None) otherwise.
+            If the flow stopped at a blocking WEBHOOK node, this is (None, None, None, None) with `self.webhook_executor` set.
         """
+        self.flow_variables = None
+        self.webhook_executor = None
         try:
-            bot_obj = Chatbox.objects.get(pk=bot_id)
+            bot_obj = get_bot_graph(bot_id)
             if bot_com_tid:
-                for key_id in bot_obj.bot_data_json:
-                    if key_id == bot_com_tid:
-                        bot_component_response = bot_obj.bot_data_json[key_id]
-                        var_response = bot_obj.bot_variable_json
-
-                        # New Changes
-                        end = cache.get(f"CLIENTWIDGET_SESSION_END_{room_id}", False)
-                        if end == True:
-                            # Go to INIT
-                            logger.info(f"Moving to INIT since previous chat was taken over")
-                            return self.get_bot_data(bot_id, bot_com_tid=None, user='AnonymousUser', room_id=self.room_id, room_name=room_name)
-
-                        if 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'INIT':
-                            self.exclude_count = True
-
-                        if 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'END':
-                            # End of Session
-                            self.session_end = True
-                            self.exclude_count = True
-                            if hasattr(self, 'room_id') and self.room_id is not None:
-                                ext = cache.get(str(room_id))
-                                queryset = ChatRoom.objects.using(bot_obj.owner.ext_db_label).filter(pk=self.room_id)
-                                if queryset.count() == 0:
-                                    logger.info('no_chatroom')
-                                    logger.info(f"{ext}")
-                                    pass
-                                else:
-                                    logger.info(f"<<----END CHAT--->>")
-                                    instance = queryset.first()
-                                    instance.end_chat = True
-                                    instance.save(using=bot_obj.owner.ext_db_label, send_update=True)
-                        
-                        elif 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'SET_VARIABLE':
-                            try:
-                                variable_list = bot_component_response.get('variableList', [])
-
-                                for variable_node in variable_list:
-                                    variable = variable_node['variable']
-                                    value = variable_node.get('value', '')
-
-                                    events.set_session_variable(self.room_id, variable, value, bot_type="website")
-                                    status = self.check_if_lead(variable, value)
-                                    if status:
-                                        # Set the flag
-                                        cache.set(f"IS_LEAD_{self.room_name}", True, timeout=lock_timeout + BUFFER_TIME)
-                                
-                                target_id = bot_component_response.get('targetId')
-                                
-                                if target_id not in ['', None, 'END']:
-                                    return self.get_bot_data(bot_id, bot_com_tid=target_id)
-                                else:
-                                    self.end_chat(bot_obj)
-                                    return None, None, None, None
-                            
-                            except Exception as ex:
-                                logger.critical(f"Exception during SET_VARIABLE component: {ex}")
-                        
-                        elif 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'GOAL':
-                            try:
-                                variable = bot_component_response['variable']
-                                value = bot_component_response.get('value', 'true')
-                                target_id = bot_component_response.get('targetId')
-
-                                events.set_session_variable(self.room_id, variable, value, bot_type="website")
-                                status = self.check_if_lead(variable, value)
-                                if status:
-                                    # Set the flag
-                                    cache.set(f"IS_LEAD_{self.room_name}", True, timeout=lock_timeout + BUFFER_TIME)
-                                
-                                if target_id not in [None, '', 'END']:
-                                    return self.get_bot_data(bot_id, bot_com_tid=target_id)
-                                else:
-                                    self.end_chat(bot_obj)
-                                    return None, None, None, None
-                            except Exception as ex:
-                                 logger.critical(f"Exception during GOAL component: {ex}")
-                        
-                        elif 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'SET_VARIABLE_BETA':
-                            try:
-                                target_id, variable, value = events.parse_set_variable_expression(self.room_id, bot_id, bot_component_response, bot_obj.owner_id, bot_type='website')
-                                status = self.check_if_lead(variable, value)
-                                if status:
-                                    # Set the flag
-                                    cache.set(f"IS_LEAD_{self.room_name}", True, timeout=lock_timeout + BUFFER_TIME)
-                                
-                                if target_id not in [None, '', 'END']:
-                                    return self.get_bot_data(bot_id, bot_com_tid=target_id)
-                                else:
-                                    self.end_chat(bot_obj)
-                                    return None, None, None, None
-                            
-                            except Exception as ex:
-                                logger.critical(f"Exception during SET_VARIABLE_BETA component: {ex}")
-                        
-                        elif 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'WEBHOOK':
-                            try:
-                                target_id, _ = events.process_webhook_node(self.room_id, bot_id, bot_component_response, bot_obj.owner_id)
-                                if target_id not in [None, '', 'END']:
-                                    return self.get_bot_data(bot_id, bot_com_tid=target_id)
-                                else:
-                                    self.end_chat(bot_obj)
-                                    return None, None, None, None
-                            except Exception as ex:
-                                logger.critical(f"Exception during WEBHOOK component: {ex}")
-
-                        # Now check if the node is of type: AGENT_TRANSFER
-                        elif 'nodeType' in bot_component_response and bot_component_response['nodeType'] in ['AGENT_TRANSFER', 'TEAM_TRANSFER']:
-                            # End of Session after livechat
-                            self.session_end = True
-
-                            # Set the takeover field to be True
-                            if hasattr(self, 'room_id') and self.room_id is not None:
-                                ext = cache.get(str(room_id))
-                                queryset = ChatRoom.objects.using(bot_obj.owner.ext_db_label).filter(pk=self.room_id)
-                                if queryset.count() == 0:
-                                    logger.info('no_chatroom')
-                                    logger.info(f"{ext}")
-                                    pass
-                                else:
-                                    instance = queryset.first()
-                                    instance.takeover = True
-                                    instance.save(using=ext, send_update=True)
-                                    
-                                    if hasattr(self, 'is_subscribed') and self.is_subscribed == True:
-                                        if hasattr(self, 'is_lead') and self.is_lead == False:
-                                            # Not a Lead
-                                            try:
-                                                nonlead_data = cache.get(f"VARIABLES_{self.room_name}")
-                                                _thread.start_new_thread(chat_lead_send_update, (self.room_id, False, nonlead_data))
-                                            except Exception as ex:
-                                                print(ex)
-                                                pass
-                                        else:
-                                            # Send email to Admin
-                                            try:
-                                                lead_data = cache.get(f"VARIABLES_{self.room_name}")
-                                                lead_fields = cache.get(f"CLIENTWIDGETLEADDATA_{self.room_name}")
-                                                if lead_fields is not None and lead_data is not None:
-                                                    lead_data = {key: value for key, value in lead_data.items() if key in lead_fields}
-                                                _thread.start_new_thread(chat_lead_send_update, (self.room_id, True, lead_data))
-                                            except Exception as ex:
-                                                print(ex)
-                                                pass
-                        if bot_com_tid in ['', 'END']:
-                            logger.info(f"TargetID is empty. Exiting the chat...")
+                if bot_com_tid in bot_obj:
+                    # New Changes
+                    end = room_state.get_room_field(room_id, room_state.SESSION_END, False)
+                    if end == True:
+                        # Go to INIT
+                        logger.info(f"Moving to INIT since previous chat was taken over")
+                        return self.get_bot_data(bot_id, bot_com_tid=None, user='AnonymousUser', room_id=self.room_id, room_name=room_name)
+
+                    # Run through any automatic nodes till we need input from the user
+                    executor = BotFlowExecutor(bot_obj, self.room_id, bot_type='website', lead_check=self.check_if_lead, defer_webhooks=True)
+                    executor.hops = hops
+                    bot_component_response = executor.run(bot_com_tid)
+                    executor.commit()
+                    self.flow_variables = executor.variables
+
+                    if executor.webhook_node is not None:
+                        # Waits on the webhook, off this thread
+                        self.webhook_executor = executor
+                        return None, None, None, None
+
+                    if bot_component_response is None:
+                        if executor.ended:
                             self.end_chat(bot_obj)
-                            return None, None, None, None
-                        
-                        return bot_component_response, var_response, None, None
+                        return None, None, None, None
+                    
+                    bot_com_tid = executor.target_id
+                    var_response = bot_obj.get_variables()
+
+                    if 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'INIT':
+                        self.exclude_count = True
+
+                    if 'nodeType' in bot_component_response and bot_component_response['nodeType'] == 'END':
+                        # End of Session
+                        self.session_end = True
+                        self.exclude_count = True
+                        if hasattr(self, 'room_id') and self.room_id is not None:
+                            ext = near_cache.get_db_label(str(room_id))
+                            queryset = ChatRoom.objects.using(bot_obj.ext_db_label).filter(pk=self.room_id)
+                            if queryset.count() == 0:
+                                logger.info('no_chatroom')
+                                logger.info(f"{ext}")
+                                pass
+                            else:
+                                logger.info(f"<<----END CHAT--->>")
+                                instance = queryset.first()
+                                instance.end_chat = True
+                                instance.save(using=bot_obj.ext_db_label, send_update=True)
+                    
+                    # Now check if the node is of type: AGENT_TRANSFER
+                    if 'nodeType' in bot_component_response and bot_component_response['nodeType'] in ['AGENT_TRANSFER', 'TEAM_TRANSFER']:
+                        # End of Session after livechat
+                        self.session_end = True
+
+                        # Set the takeover field to be True
+                        if hasattr(self, 'room_id') and self.room_id is not None:
+                            ext = near_cache.get_db_label(str(room_id))
+                            queryset = ChatRoom.objects.using(bot_obj.ext_db_label).filter(pk=self.room_id)
+                            if queryset.count() == 0:
+                                logger.info('no_chatroom')
+                                logger.info(f"{ext}")
+                                pass
+                            else:
+                                instance = queryset.first()
+                                instance.takeover = True
+                                instance.save(using=ext, send_update=True)
+                                
+                                if hasattr(self, 'is_subscribed') and self.is_subscribed == True:
+                                    if hasattr(self, 'is_lead') and self.is_lead == False:
+                                        # Not a Lead
+                                        try:
+                                            nonlead_data = room_state.get_variables(self.room_name)
+                                            _thread.start_new_thread(chat_lead_send_update, (self.room_id, False, nonlead_data))
+                                        except Exception as ex:
+                                            print(ex)
+                                            pass
+                                    else:
+                                        # Send email to Admin
+                                        try:
+                                            state = room_state.RoomState(self.room_name).load()
+                                            lead_data, lead_fields = state.get_variables(), state.get(room_state.LEAD_DATA)
+                                            if lead_fields is not None and lead_data is not None:
+                                                lead_data = {key: value for key, value in lead_data.items() if key in lead_fields}
+                                            _thread.start_new_thread(chat_lead_send_update, (self.room_id, True, lead_data))
+                                        except Exception as ex:
+                                            print(ex)
+                                            pass
+                    if bot_com_tid in ['', 'END']:
+                        logger.info(f"TargetID is empty. Exiting the chat...")
+                        self.end_chat(bot_obj)
+                        return None, None, None, None
+                    
+                    return bot_component_response, var_response, None, None
                 
                 if bot_com_tid in ['', 'END']:
                     logger.info(f"TargetID is empty. Exiting the chat...")
@@ -392,26 +332,25 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 
                 return None, None, None, None
             else:
-                for key_id in bot_obj.bot_data_json:
-                    if bot_obj.bot_data_json[key_id]['nodeType'] == 'INIT':
-                        bot_component_response = bot_obj.bot_data_json[key_id]
-                        self.exclude_count = True
-                        if room_id is None:
-                            bot_component_response['room_id'], bot_component_response['room_name'] = events.create_room(user, content={
-                                'room_name': '',
-                                'bot_id': str(bot_obj.bot_hash),
-                                'bot_is_active': True,
-                                'num_msgs': 0,
-                            }, bot_id=bot_obj.bot_hash)
-                        else:
-                            bot_component_response['room_id'], bot_component_response['room_name'] = room_id, room_name
-                            # Make it active again
-                            ext = cache.get(str(room_id))
-                            queryset = ChatRoom.objects.using(ext).filter(room_id=room_id)
-                            instance = queryset.first()
-                            instance.bot_is_active = True
-                            instance.save(using=ext, send_update=True)
-                        return bot_component_response, bot_obj.bot_variable_json, bot_component_response['room_id'], bot_component_response['room_name']
+                bot_component_response = bot_obj.get_init()
+                if bot_component_response is not None:
+                    self.exclude_count = True
+                    if room_id is None:
+                        bot_component_response['room_id'], bot_component_response['room_name'] = events.create_room(user, content={
+                            'room_name': '',
+                            'bot_id': bot_obj.bot_id,
+                            'bot_is_active': True,
+                            'num_msgs': 0,
+                        }, bot_id=bot_obj.bot_id)
+                    else:
+                        bot_component_response['room_id'], bot_component_response['room_name'] = room_id, room_name
+                        # Make it active again
+                        ext = near_cache.get_db_label(str(room_id))
+                        queryset = ChatRoom.objects.using(ext).filter(room_id=room_id)
+                        instance = queryset.first()
+                        instance.bot_is_active = True
+                        instance.save(using=ext, send_update=True)
+                    return bot_component_response, bot_obj.get_variables(), bot_component_response['room_id'], bot_component_response['room_name']
                 return None, None, None, None
         except Chatbox.DoesNotExist:
             return None, None, None, None
@@ -425,7 +364,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 return False
             if variable in self.lead_fields and value not in (None, ""):
                 self.lead_fields = set() # New filter -> Match if atleast one lead field is non empty
-                cache.set(f"CLIENTWIDGETLEADFIELDS_{self.room_name}", list(self.lead_fields), timeout=lock_timeout + BUFFER_TIME)
+                room_state.set_room_field(self.room_name, room_state.LEAD_FIELDS, list(self.lead_fields))
             if self.lead_fields == set():
                 self.is_lead = True
                 return True
@@ -521,27 +460,30 @@ class ClientWidgetConsumer(WebsocketConsumer):
         
         self.exclude_count = False
 
+        # Fetch the whole room state in one go
+        state = room_state.RoomState(self.room_name).load()
+
         # Get the room lock
-        lock = cache.get(f'CLIENTWIDGETROOMLOCK_{self.room_name}')
+        lock = state.get(room_state.LOCK)
         if lock == True:
             # Someone's there. Don't hit the DB
-            room_information = cache.get(f'CLIENTWIDGETROOMINFO_{self.room_name}')
+            room_information = state.get(room_state.ROOM_INFO)
             
             # Get the lead information from cache
-            self.lead_fields = cache.get(f"CLIENTWIDGETLEADFIELDS_{room_name}")
+            self.lead_fields = state.get(room_state.LEAD_FIELDS)
             if self.lead_fields is None:
                 pass
             elif isinstance(self.lead_fields, list):
                 self.lead_fields = set(self.lead_fields)
             
             # Get the subscription information
-            self.is_subscribed = cache.get(f"CLIENTWIDGETSUBSCRIBED_{room_name}")
+            self.is_subscribed = state.get(room_state.SUBSCRIBED)
             if self.is_subscribed is None:
                 self.is_subscribed = False
 
             if room_information is None:
                 # TODO: Change this later
-                ext = cache.get(str(self.room_id))
+                ext = near_cache.get_db_label(str(self.room_id))
                 try:
                     if self.room_id is None:
                         
@@ -554,19 +496,24 @@ class ClientWidgetConsumer(WebsocketConsumer):
                     self.disconnect(400)
             else:
                 self.room_id, self.chatbot_type = room_information
+
+            if self.room_id is not None and history_seq.get_sequence(self.room_id) is None:
+                # The sequence expired during the session. Seeded after the session history
+                ext = near_cache.get_db_label(str(self.room_id))
+                history_seq.sync_sequence(self.room_id, events.next_message_seq(self.room_id, ext) - 1)
             
             # Session End Flag
             user = self.scope['user']
             if hasattr(user, 'role') and user.role in ('AM', 'AO'):
                 # Set it to True
-                cache.set(f"CLIENTWIDGET_SESSION_END_{self.room_name}", True, timeout=lock_timeout + BUFFER_TIME)
+                state.set(room_state.SESSION_END, True)
                 self.session_end = True
         else:
             # Hit the DB
             self.is_subscribed = False
             with transaction.atomic():
                 try:
-                    ext = cache.get(self.room_id)
+                    ext = near_cache.get_db_label(self.room_id)
                     logger.info(f'{ext}--->')
                     instance = ChatRoom.objects.using(ext).get(room_id=self.room_id)
                 except ChatRoom.DoesNotExist as e:
@@ -586,7 +533,11 @@ class ClientWidgetConsumer(WebsocketConsumer):
             if hasattr(instance, 'num_msgs'):
                 # Initialize the Counter
                 num_msgs = instance.num_msgs
-                cache.set(f"CLIENTWIDGET_COUNT_{self.room_name}", num_msgs, timeout=lock_timeout + BUFFER_TIME)
+                state.set(room_state.COUNT, num_msgs)
+
+            if instance is not None:
+                # New session. The messages of the session are numbered after the ones in the DB
+                history_seq.sync_sequence(instance.room_id, events.next_message_seq(instance.room_id, ext) - 1)
 
             # Start our expiry timer (this is the oldest key for this room)
             cache.set(f"CLIENTWIDGET_EXPIRY_LOCK_{self.room_name}", True, timeout=lock_timeout)
@@ -597,7 +548,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 if hasattr(chatbox_instance, 'subscription_type') and chatbox_instance.subscription_type in ('email', 'all',):
                     self.is_subscribed = True
                 
-                lead_fields = cache.get(f"CLIENTWIDGETLEADFIELDS_{room_name}")
+                lead_fields = state.get(room_state.LEAD_FIELDS)
                 if lead_fields is None:
                     # Fresh Session
                     if self.lead_fields is not None:
@@ -610,10 +561,10 @@ class ClientWidgetConsumer(WebsocketConsumer):
                         self.lead_fields = None
                     
                     if self.lead_fields is not None:
-                        cache.set(f"CLIENTWIDGETLEADFIELDS_{room_name}", list(self.lead_fields), timeout=lock_timeout + BUFFER_TIME)
-                        cache.set(f"CLIENTWIDGETLEADDATA_{room_name}", {key: "" for key in list(self.lead_fields)}, timeout=lock_timeout + BUFFER_TIME)
+                        state.set(room_state.LEAD_FIELDS, list(self.lead_fields))
+                        state.set(room_state.LEAD_DATA, {key: "" for key in list(self.lead_fields)})
                         # Subscribe only if there are lead fields available
-                        cache.set(f"CLIENTWIDGETSUBSCRIBED_{room_name}", self.is_subscribed, timeout=lock_timeout + BUFFER_TIME)
+                        state.set(room_state.SUBSCRIBED, self.is_subscribed)
                 else:
                     # Existing Session
                     self.lead_fields = set(lead_fields) if isinstance(lead_fields, list) else None
@@ -647,20 +598,21 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 logger.newline()
             
             # Set the room information on the cache
-            cache.set(f'CLIENTWIDGETROOMINFO_{self.room_name}', tuple((str(self.room_id), self.chatbot_type)), timeout=lock_timeout + BUFFER_TIME)
+            state.set(room_state.ROOM_INFO, [str(self.room_id), self.chatbot_type])
 
-        self.num_msgs = events.get_msgcount(self.room_name)
+        self.num_msgs = state.get(room_state.COUNT, 0)
 
-        self.num_users = events.increment_usercount(self.room_name)
+        self.num_users = counters.increment_usercount(self.room_name)
         print(f"Now group has {self.num_users} members")
         logger.info(f"Now group has {self.num_users} members")
 
-        # Set the room lock
-        cache.set(f'CLIENTWIDGETROOMLOCK_{self.room_name}', True, timeout=lock_timeout + BUFFER_TIME)
+        # Set the room lock, along with everything else we've modified so far
+        state.set(room_state.LOCK, True)
+        state.save()
 
         # This must be atomic
         if self.num_users == 1 and self.chatbot_type == 'website':
-            ext = cache.get(self.room_id)
+            ext = near_cache.get_db_label(self.room_id)
             if self.room_id is None:
                 queryset = ChatRoom.objects.filter(room_name=self.room_name)
             else:
@@ -685,31 +637,67 @@ class ClientWidgetConsumer(WebsocketConsumer):
                     if _modified == True:
                         instance.save(send_update=True, using=ext)
             
-            variables = cache.get(f"VARIABLES_{self.room_name}")
+            variables = state.get_variables()
             if variables is None:
                 # Get the variables from the DB, if the room exists already
                 if queryset.count() == 0:
-                    cache.set(f"VARIABLES_{self.room_name}", dict(), timeout=lock_timeout + BUFFER_TIME)
+                    state.set_variables(dict())
                 else:
                     # Fetch from DB
-                    cache.set(f"VARIABLES_{self.room_name}", instance.variables, timeout=lock_timeout + BUFFER_TIME)
+                    state.set_variables(instance.variables if isinstance(instance.variables, dict) else dict())
 
         else:
             # Get it from the cache. Somebody's already there
-            variables = cache.get(f"VARIABLES_{self.room_name}")
+            variables = state.get_variables()
             if variables is None:
                 variables = dict()
-                cache.set(f"VARIABLES_{self.room_name}", dict(), timeout=lock_timeout + BUFFER_TIME)
+                state.set_variables(dict())
+        
+        state.save()
 
         # Lead Filters
         self.is_lead = False
 
         # Session Flag
-        session_end = cache.get(f"CLIENTWIDGET_SESSION_END_{self.room_name}")
+        session_end = state.get(room_state.SESSION_END)
         if session_end is None:
             self.session_end = False
         else:
             self.session_end = session_end
+
+        # A reconnecting widget passes the seq of the last message it has, and only gets the ones after it
+        self.send_missed_history(query_params)
+
+        # The room may have been waiting on a webhook, which responded to the previous socket
+        self.resume_pending_webhook()
+
+
+    def resume_pending_webhook(self):
+        event = webhooks.claim_response(self.room_name)
+        if event is not None:
+            logger.info(f"Resuming the flow of room {self.room_name} after a webhook, on the new socket")
+            self.resume_flow(event)
+
+
+    def send_missed_history(self, query_params):
+        after = urllib.parse.parse_qs(query_params).get('after')
+        if after is None or self.room_id is None:
+            return
+        try:
+            after = int(after[0])
+        except ValueError:
+            return
+        
+        ext = near_cache.get_db_label(str(self.room_id), 'default')
+        instance = ChatRoom.objects.using(ext).filter(room_id=self.room_id).first()
+        if instance is None:
+            return
+        
+        # Only the recent history is visible to the visitor
+        user = self.scope['user']
+        recent = not (hasattr(user, 'role') and user.role in ('AM', 'AO'))
+        messages, has_more = history_seq.fetch_history_after(instance, after, db_label=ext, recent=recent)
+        self.send(text_data=json.dumps({'history': messages, 'has_more': has_more}))
     
 
     def flush_session(self, room_name=None, room_id=None):
@@ -719,65 +707,49 @@ class ClientWidgetConsumer(WebsocketConsumer):
         if room_id is None:
             room_id = self.room_id
         
-        session_variables = cache.get(f"VARIABLES_{self.room_name}")
-        is_lead = cache.get(f"IS_LEAD_{self.room_name}")
+        if self.chatbot_type != 'website':
+            if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
+                state = room_state.RoomState(self.room_name).load()
+                is_lead = state.get(room_state.IS_LEAD) == True
+                _ = tasks.flush_db_task.delay(self.room_id, str(self.scope['user']), state.get_variables(), is_lead=is_lead)
+            return
+
+        # Snapshot the room, and delete the locks (and the chat information, if the session has ended) in one go
+        session_end = hasattr(self, 'session_end') and self.session_end == True
+        snapshot = teardown.teardown_room(self.room_name, room_id=self.room_id, session_end=session_end)
+        is_lead = snapshot.is_lead
         if is_lead != True:
             is_lead = False
+
+        if write_behind.WRITE_BEHIND_ENABLED:
+            # Flushed (and made inactive) along with the other ended rooms of the DB label
+            write_behind.enqueue_flush(self.room_id, near_cache.get_db_label(self.room_id), variables=snapshot.variables, messages=snapshot.messages,
+                                       first_seq=snapshot.first_seq, is_lead=is_lead, num_msgs=snapshot.count, takeover=snapshot.takeover)
+            return
+
         if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
-            _ = tasks.flush_db_task.delay(self.room_id, str(self.scope['user']), session_variables, is_lead=is_lead)
+            _ = tasks.flush_db_task.delay(self.room_id, str(self.scope['user']), snapshot.variables, is_lead=is_lead, messages=snapshot.messages)
         else:
-            if self.chatbot_type == 'website':
-                # Only flush to DB for website bot
-                events.flush_to_db(self.room_id, self.scope['user'], session_variables, is_lead=is_lead)
+            # Only flush to DB for website bot
+            events.flush_to_db(self.room_id, self.scope['user'], snapshot.variables, is_lead=is_lead, messages=snapshot.messages)
         
         # Make the chat inactive
-        if self.chatbot_type == 'website':
-            if (cache.get(f"CLIENTWIDGET_SESSION_END_{self.room_name}") == True) or (hasattr(self, 'session_end') and self.session_end == True):
-                # Delete token only if session has ended
-                cache.delete(f"CLIENTWIDGET_SESSION_TOKEN_{str(self.room_id)}")
-            
-            takeover = cache.get(f"CLIENTWIDGET_TAKEOVER_{self.room_name}")
-
-            num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{self.room_name}", 0)
-            
-            with transaction.atomic():
-                if self.room_id is None:
-                    ext = cache.get(self.room_id)
-                    queryset = ChatRoom.objects.using(ext).filter(room_name=self.room_name)
-                else:
-                    ext = cache.get(self.room_id)
-                    queryset = ChatRoom.objects.using(ext).filter(room_id=self.room_id)
-                if queryset.count() == 1:
-                    instance = queryset.first()
-                    instance.bot_is_active = False
-                    instance.num_msgs = num_msgs
-                    if hasattr(instance, 'end_time'):
-                        instance.end_time = timezone.now()
-                    if takeover == True:
-                        instance.takeover = True
-                    instance.save(send_update=True, using=ext)
-            
-            # Delete the locks
-            cache.delete(f'CLIENTWIDGETROOMLOCK_{self.room_name}') # Lock for the room
-            cache.delete(f'CLIENTWIDGETLOCK_{self.room_name}') # Lock for the room messages
-            cache.delete(f"CLIENTWIDGETTIMEOUT_{self.room_name}")
-
-            # Delete the expiry lock
-            cache.delete(f"CLIENTWIDGET_EXPIRY_LOCK_{self.room_name}")
-
-            if (cache.get(f"CLIENTWIDGET_SESSION_END_{self.room_name}") == True) or (hasattr(self, 'session_end') and self.session_end == True):
-                # Only if session has ended
-                # Delete the chat information
-                cache.delete(f"CLIENTWIDGET_SESSION_END_{self.room_name}")
-                cache.delete(f"CLIENTWIDGET_TAKEOVER_{self.room_name}")
-                cache.delete(f"CLIENTWIDGET_COUNT_{self.room_name}")
-                cache.delete(f'CLIENTWIDGETLEADFIELDS_{self.room_name}')
-                cache.delete(f"CLIENTWIDGETLEADDATA_{self.room_name}")
-                cache.delete(f'CLIENTWIDGETROOMINFO_{self.room_name}')
-                cache.delete(f"CLIENTWIDGETSUBSCRIBED_{self.room_name}")
-                cache.delete(f"CLIENTWIDGET_USER_LIST_{self.room_name}")
-                cache.delete(f'IS_LEAD_{self.room_name}')
-                cache.delete(f'TEAM_{self.room_name}')
+        with transaction.atomic():
+            if self.room_id is None:
+                ext = near_cache.get_db_label(self.room_id)
+                queryset = ChatRoom.objects.using(ext).filter(room_name=self.room_name)
+            else:
+                ext = near_cache.get_db_label(self.room_id)
+                queryset = ChatRoom.objects.using(ext).filter(room_id=self.room_id)
+            if queryset.count() == 1:
+                instance = queryset.first()
+                instance.bot_is_active = False
+                instance.num_msgs = snapshot.count
+                if hasattr(instance, 'end_time'):
+                    instance.end_time = timezone.now()
+                if snapshot.takeover == True:
+                    instance.takeover = True
+                instance.save(send_update=True, using=ext)
 
 
     def disconnect(self, close_code):
@@ -799,7 +771,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 if room_list is not None:
                     room_set = set(room_list)
                     for room_id in room_set:
-                        num_users = events.decrement_usercount(room_id)
+                        num_users = counters.decrement_usercount(room_id)
                         print(f"For {room_id}, num users = {num_users}")
                         if num_users == 0:
                             # Complete the session
@@ -824,11 +796,17 @@ class ClientWidgetConsumer(WebsocketConsumer):
             self.channel_name
         )
         
-        self.num_users = events.decrement_usercount(self.room_name)
+        self.leave_room(counters.decrement_usercount(self.room_name), close_code)
+
+
+    def leave_room(self, num_users, close_code):
+        """Ends the session if nobody's left in the room, after the user count was decremented to `num_users`
+        """
+        self.num_users = num_users
 
         if self.num_users < 0:
             print(f'Having negative number {self.num_users}. Setting to 0...')
-            cache.set(f'NUM_USERS_{self.room_name}', 0, timeout=lock_timeout + BUFFER_TIME)
+            counters.reset_usercount(self.room_name)
 
         print(f"Now group has {self.num_users} members")
         logger.info(f"Disconnect: Now Group has {self.num_users} members")
@@ -929,7 +907,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
         After the server responds with a reply, this will append the message content to the session history, if the receive method is successful.
         """
         try:
-            session_variables = cache.get(f"VARIABLES_{self.room_name}")
+            session_variables = room_state.get_variables(self.room_name)
             print(f"Client Widget: Received {text_data} - session = {session_variables}")
             logger.info(f"Client Widget: Received {text_data} - session = {session_variables}")
 
@@ -946,10 +924,10 @@ class ClientWidgetConsumer(WebsocketConsumer):
                         if cache.get(f"CLIENTWIDGET_MAP_{user_id}_{room_id}") is None:
                             cache.set(f"CLIENTWIDGET_MAP_{user_id}_{room_id}", True, timeout=lock_timeout + BUFFER_TIME)
 
-                            self.num_users = events.increment_usercount(room_id)
+                            self.num_users = counters.increment_usercount(room_id)
                             logger.info(f"Now, num_users = {self.num_users}")
                             
-                            user_list = cache.get(f'CLIENTWIDGET_USER_LIST_{room_id}')
+                            user_list = room_state.get_room_field(room_id, room_state.USER_LIST)
                             room_list = cache.get(f"CLIENTWIDGET_ROOM_LIST_{user_id}")
                             
                             if user_list is None:
@@ -961,7 +939,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
                             user_set = set(user_list)
                             if user_id not in user_set:
                                 user_set.add(user_id)
-                                cache.set(f'CLIENTWIDGET_USER_LIST_{room_id}', list(user_set))
+                                room_state.set_room_field(room_id, room_state.USER_LIST, list(user_set))
                             
                             room_set = set(room_list)
                             if room_id not in room_set:
@@ -978,19 +956,19 @@ class ClientWidgetConsumer(WebsocketConsumer):
                     if hasattr(self.scope['user'], 'uuid') and self.scope['user'].role in ('AM', 'AO'):
                         user_id = str(self.scope['user'].uuid)
                         if cache.get(f"CLIENTWIDGET_MAP_{user_id}_{room_id}") is not None:
-                            self.num_users = events.decrement_usercount(room_id)
+                            self.num_users = counters.decrement_usercount(room_id)
                             logger.info(f"Now, num_users = {self.num_users}")
                             cache.delete(f"CLIENTWIDGET_MAP_{user_id}_{room_id}")
                             
-                            user_list = cache.get(f'CLIENTWIDGET_USER_LIST_{room_id}')
+                            user_list = room_state.get_room_field(room_id, room_state.USER_LIST)
                             
                             if user_list is not None:                    
                                 user_set = set(user_list)
                                 user_set.discard(user_id)
                                 if user_list != set():
-                                    cache.set(f'CLIENTWIDGET_USER_LIST_{room_id}', list(user_set))
+                                    room_state.set_room_field(room_id, room_state.USER_LIST, list(user_set))
                                 else:
-                                    cache.delete(f'CLIENTWIDGET_USER_LIST_{room_id}')
+                                    room_state.delete_room_fields(room_id, room_state.USER_LIST)
 
                             room_list = cache.get(f'CLIENTWIDGET_ROOM_LIST_{user_id}')
                             
@@ -1014,38 +992,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
 
             email = ''
 
-            first_name = ''
-            last_name = ''
-
-            if 'first_name' in text_data_json:
-                first_name = text_data_json['first_name']
-            else:
-                if not hasattr(self.scope['user'], 'first_name'):
-                    first_name = 'Anonymous'
-                else:
-                    first_name = getattr(self.scope['user'], 'first_name')
-                text_data_json['first_name'] = first_name
-
-            if 'last_name' in text_data_json:
-                last_name = text_data_json['last_name']
-            else:
-                if not hasattr(self.scope['user'], 'last_name'):
-                    last_name = 'User'
-                else:
-                    last_name = getattr(self.scope['user'], 'last_name')
-                text_data_json['last_name'] = last_name
-
-            if 'time' in text_data_json:
-                timestamp = text_data_json['time']
-            else:
-                timestamp = timezone.now().strftime("%d/%m/%Y %H:%M:%S") # Current time
-                text_data_json['time'] = timestamp
-            
-            if 'room_id' in text_data_json:
-                room_id = text_data_json['room_id']
-            else:
-                room_id = str(self.room_id)
-                text_data_json['room_id'] = str(room_id)
+            first_name, last_name, timestamp, room_id = self.fill_sender(text_data_json)
 
             if user in ('admin', 'operator'):
                 if 'email' not in text_data_json:
@@ -1077,7 +1024,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 if hasattr(self, 'chatbot_type') and self.chatbot_type == 'whatsapp' and user in ('admin', 'operator'):
                     # Send a POST request using the shared client
                     try:
-                        response = shared_client.post(f'{server_addr}/api/whatsappbot/agenttakeover/{self.room_name}', json={'user': user, 'message': message})
+                        response = http_client.post(f'{server_addr}/api/whatsappbot/agenttakeover/{self.room_name}', json={'user': user, 'message': message})
                     except:
                         self.disconnect(400)
                     
@@ -1125,83 +1072,11 @@ class ClientWidgetConsumer(WebsocketConsumer):
                             }, data=text_data_json, store_full=True,
                         )
                     else:
-                        async_to_sync(self.channel_layer.group_send)(
-                            str(room_id),
-                            {
-                                'type': 'chat_message',
-                                'message': message,
-                                'time': timestamp,
-                                'room_id': str(room_id),
-                                'owner_id': str(owner_id),
-                                'user': user,
-                                'email': email,
-                                'first_name': first_name,
-                                'last_name': last_name,
-                            }
-                        )
-
-                        async_to_sync(self.channel_layer.group_send)(
-                            str(owner_id),
-                            {
-                                'type': 'chat_message',
-                                'message': message,
-                                'time': timestamp,
-                                'room_id': str(room_id),
-                                'owner_id': str(owner_id),
-                                'user': user,
-                                'email': email,
-                                'first_name': first_name,
-                                'last_name': last_name,
-                            }
-                        )
-
-                        # Send to operator group
-                        team_operators = cache.get(f"TEAM_{room_id}")
-                        if team_operators is not None:
-                            for team in team_operators:
-                                _team = team.replace(" ", "")
-                                async_to_sync(self.channel_layer.group_send)(
-                                    'operator_team_{}_{}'.format(owner_id, str(_team)),
-                                    {
-                                        'type': 'chat_message',
-                                        'message': message,
-                                        'time': timestamp,
-                                        'room_id': str(room_id),
-                                        'owner_id': str(owner_id),
-                                        'user': user,
-                                        'email': email,
-                                        'first_name': first_name,
-                                        'last_name': last_name,
-                                    }
-                                )
-                        else:
-                            client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-                            if client_map is not None and room_id in client_map:
-                                operator_id = client_map[room_id]
-
-                                #TODO: Need To add Celery
-                                logger.info(f'chats_op---->{operator_id}')
-                                for operator in operator_id:
-                                    async_to_sync(self.channel_layer.group_send)(
-                                        operator,
-                                        {
-                                            'type': 'chat_message',
-                                            'message': message,
-                                            'time': timestamp,
-                                            'room_id': str(room_id),
-                                            'owner_id': str(owner_id),
-                                            'user': user,
-                                            'email': email,
-                                            'first_name': first_name,
-                                            'last_name': last_name,
-                                        }
-                                    )
+                        # Room, owner and operators, in one go
+                        fanout.send_to_groups(fanout.get_chat_groups(room_id, owner_id), self.chat_event(text_data_json, owner_id), self.channel_layer)
 
                         # Append contents to Redis List
-                        events.append_msg_to_redis(room_id, text_data_json, store_full=True)
-                        num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{room_id}", 0)
-                        num_msgs += 1
-                        cache.set(f"CLIENTWIDGET_COUNT_{room_id}", num_msgs, timeout=lock_timeout + BUFFER_TIME)
+                        events.append_msg_to_redis(room_id, text_data_json, store_full=True, count=True)
             
             elif user == 'bot':
                 for reqd_field in set({'bot_id', 'data'}):
@@ -1212,6 +1087,10 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 bot_id = text_data_json['bot_id']
                 data = text_data_json['data']
 
+                if webhooks.is_waiting(self.room_name):
+                    logger.info(f"Room {self.room_name} is waiting on a webhook. Dropping the bot message")
+                    return
+
                 message = text_data_json['message'] if 'message' in text_data_json else None
 
                 if 'target_id' not in data:
@@ -1222,27 +1101,14 @@ class ClientWidgetConsumer(WebsocketConsumer):
                 variable, value = (data['variable'] if 'variable' in data else None, data['post_data'] if 'post_data' in data else None)
 
                 if variable is not None and value is not None:
-                    session_variables = cache.get(f"VARIABLES_{self.room_name}")
-                    session_variables[variable] = value
-                    cache.set(f"VARIABLES_{self.room_name}", session_variables, timeout=lock_timeout + BUFFER_TIME)
-                    
-                    variables = cache.get(f"VARIABLES_{self.room_name}")
-
-                    if variables is None:
-                        variables = {}
-                        cache.set(f"VARIABLES_{self.room_name}", variables, timeout=lock_timeout + BUFFER_TIME)
-
-                    variables[variable] = value
-
-                    # TODO: Add Celery task for cache setting
-                    cache.set(f"VARIABLES_{self.room_name}", variables, timeout=lock_timeout + BUFFER_TIME)
+                    room_state.set_variable(self.room_name, variable, value)
 
                     # Check if the user matches a lead
                     if not self.is_lead:
                         status = self.check_if_lead(variable, value)
                         if status:
                             # Set the flag
-                            cache.set(f"IS_LEAD_{self.room_name}", True, timeout=lock_timeout + BUFFER_TIME)
+                            room_state.set_room_field(self.room_name, room_state.IS_LEAD, True)
                             
                             # Send an email -> Background Task
                             if False:
@@ -1250,8 +1116,8 @@ class ClientWidgetConsumer(WebsocketConsumer):
                                 if hasattr(self, 'is_subscribed') and self.is_subscribed == True:
                                     # Background task
                                     try:
-                                        lead_data = cache.get(f"VARIABLES_{self.room_name}")
-                                        lead_fields = cache.get(f"CLIENTWIDGETLEADDATA_{self.room_name}")
+                                        state = room_state.RoomState(self.room_name).load()
+                                        lead_data, lead_fields = state.get_variables(), state.get(room_state.LEAD_DATA)
                                         if lead_fields is not None and lead_data is not None:
                                             lead_data = {key: value for key, value in lead_data.items() if key in lead_fields}
                                         if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
@@ -1273,74 +1139,7 @@ class ClientWidgetConsumer(WebsocketConsumer):
                     owner_id = str(self.owner_id)
                             
                 # Go to the corresponding target_id None
-                logger.info(f"Target id = {target_id}")
-                bot_obj, var_obj, _, _ = self.get_bot_data(bot_id, bot_com_tid=target_id)
-                var_obj = cache.get(f"VARIABLES_{self.room_name}")
-                if var_obj is None:
-                    var_obj = dict()
-
-                if bot_obj is None or var_obj is None:
-                    # Bot error. Deactivate
-                    logger.critical("Error during fetching bot details. Disconnecting...")
-                    self.disconnect(200)
-                
-                bot_obj = {**bot_obj, 'variables': var_obj}
-
-                reply = {
-                    'data': bot_obj,
-                    'time': timestamp,
-                    'room_id': str(room_id),
-                    'owner_id': str(owner_id),
-                    'message': message,
-                    'user': user,
-                    'first_name': 'System',
-                    'last_name': 'Message',
-                }
-
-                # Send message to room group
-                if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
-                    _ = tasks.send_template_message.delay(
-                        self.sender_group_name, self.receiver_group_name, reply,
-                        self.room_name, message, store_full=True,
-                    )
-                else:
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.sender_group_name, {
-                            'type': 'template_message',
-                            **reply,
-                        }
-                    )
-
-                    if self.room_name is not None:
-                        async_to_sync(self.channel_layer.group_send)(
-                            self.receiver_group_name, {
-                                'type': 'template_message',
-                                **reply,
-                            }
-                        )
-                    
-                    # Send to operator group
-                    client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-                    if client_map is not None and room_id in client_map:
-                        operator_id = client_map[room_id]
-                        for operator in operator_id:
-                            async_to_sync(self.channel_layer.group_send)(
-                                operator,
-                                {
-                                    'type': 'template_message',
-                                    **reply,
-                                }
-                            )
-
-                    # Append the BOT response to Redis List
-                    events.append_msg_to_redis(self.room_name, reply, store_full=True)
-                    if self.exclude_count == False:
-                        num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{self.room_name}", 0)
-                        num_msgs += 1
-                        cache.set(f"CLIENTWIDGET_COUNT_{self.room_name}", num_msgs, timeout=lock_timeout + BUFFER_TIME)
-                    else:
-                        # Set to false again
-                        self.exclude_count = False
+                self.send_bot_reply(bot_id, target_id, message, timestamp, room_id, owner_id, user)
             
             elif user == 'session_timeout':
                 async_to_sync(self.channel_layer.group_send)(
@@ -1365,8 +1164,162 @@ class ClientWidgetConsumer(WebsocketConsumer):
             self.disconnect(400)
 
 
+    def fill_sender(self, text_data_json):
+        """Fills in the name of the sender, the time and the room of a payload which doesn't have them.
+        Returns (first_name, last_name, timestamp, room_id)
+        """
+        if 'first_name' not in text_data_json:
+            text_data_json['first_name'] = getattr(self.scope['user'], 'first_name', 'Anonymous')
+        if 'last_name' not in text_data_json:
+            text_data_json['last_name'] = getattr(self.scope['user'], 'last_name', 'User')
+        if 'time' not in text_data_json:
+            text_data_json['time'] = timezone.now().strftime("%d/%m/%Y %H:%M:%S") # Current time
+        if 'room_id' not in text_data_json:
+            text_data_json['room_id'] = str(self.room_id)
+        return text_data_json['first_name'], text_data_json['last_name'], text_data_json['time'], text_data_json['room_id']
+
+
+    def chat_event(self, text_data_json, owner_id):
+        """The `chat_message` event of a message from the visitor / admin / operator, for the groups of the room"""
+        return {
+            'type': 'chat_message',
+            'message': text_data_json['message'],
+            'time': text_data_json['time'],
+            'room_id': str(text_data_json['room_id']),
+            'owner_id': str(owner_id),
+            'user': text_data_json['user'],
+            'email': text_data_json.get('email', '') if text_data_json['user'] in ('admin', 'operator') else '',
+            'first_name': text_data_json['first_name'],
+            'last_name': text_data_json['last_name'],
+        }
+
+
+    def parse_chat_message(self, text_data):
+        """Returns (payload, `chat_message` event) if `text_data` is a chat message which only needs to be sent to the
+        groups of the room and appended to the session history, else None.
+
+        `AsyncClientWidgetConsumer` handles those on the event loop. Everything else (the bot flow, ENTER / EXIT,
+        WhatsApp rooms, celery, invalid payloads) goes through `receive()`
+        """
+        try:
+            text_data_json = json.loads(text_data)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(text_data_json, dict) or 'ENTER' in text_data_json or 'EXIT' in text_data_json:
+            return None
+        user = text_data_json.get('user')
+        if user not in ('end_user', 'admin', 'operator') or 'message' not in text_data_json:
+            return None
+        if getattr(self, 'chatbot_type', None) == 'whatsapp' or getattr(settings, 'CELERY_TASK', False) == True:
+            return None
+        if user in ('admin', 'operator') and 'email' not in text_data_json:
+            if not hasattr(self.scope['user'], 'email'):
+                return None
+            text_data_json['email'] = self.scope['user'].email
+        self.fill_sender(text_data_json)
+        return text_data_json, self.chat_event(text_data_json, self.owner_id)
+
+
+    def send_bot_reply(self, bot_id, target_id, message, timestamp, room_id, owner_id, user, hops=0):
+        """Runs the bot flow from `target_id`, and sends the next node to the room.
+
+        If the flow stops at a blocking WEBHOOK node, the node is sent on the webhook pool instead (see `webhooks`),
+        and `webhook_response()` carries on from the node it routes to.
+        """
+        logger.info(f"Target id = {target_id}")
+        bot_obj, var_obj, _, _ = self.get_bot_data(bot_id, bot_com_tid=target_id, hops=hops)
+        if self.webhook_executor is not None:
+            executor = self.webhook_executor
+            webhooks.submit_webhook_node(
+                self.room_name, executor.graph.bot_id, executor.target_id, executor.webhook_node, executor.graph.owner_id,
+                webhooks.resume_on_channel(self.room_name, self.channel_name, {
+                    'bot_id': str(bot_id),
+                    'message': message,
+                    'time': timestamp,
+                    'room_id': str(room_id),
+                    'owner_id': str(owner_id),
+                    'user': user,
+                    'hops': executor.hops,
+                }),
+                bot_type='website',
+            )
+            return
+
+        if self.flow_variables is not None:
+            # Already up to date with the variables set by the flow
+            var_obj = dict(self.flow_variables)
+        else:
+            var_obj = room_state.get_variables(self.room_name)
+        if var_obj is None:
+            var_obj = dict()
+
+        if bot_obj is None or var_obj is None:
+            # Bot error. Deactivate
+            logger.critical("Error during fetching bot details. Disconnecting...")
+            self.disconnect(200)
+        
+        bot_obj = {**bot_obj, 'variables': var_obj}
+
+        reply = {
+            'data': bot_obj,
+            'time': timestamp,
+            'room_id': str(room_id),
+            'owner_id': str(owner_id),
+            'message': message,
+            'user': user,
+            'first_name': 'System',
+            'last_name': 'Message',
+        }
+
+        # Send message to room group
+        if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
+            _ = tasks.send_template_message.delay(
+                self.sender_group_name, self.receiver_group_name, reply,
+                self.room_name, message, store_full=True,
+            )
+        else:
+            groups = [self.sender_group_name]
+            if self.room_name is not None:
+                groups.append(self.receiver_group_name)
+            # Send to operator group
+            groups.extend(operator_map.get_room_operators(room_id))
+            fanout.send_to_groups(groups, {'type': 'template_message', **reply}, self.channel_layer)
+
+            # Append the BOT response to Redis List
+            events.append_msg_to_redis(self.room_name, reply, store_full=True, count=(self.exclude_count == False))
+            # Set to false again
+            self.exclude_count = False
+
+
+    def webhook_response(self, event):
+        """Handler for the response of a webhook which the room was waiting on. Resumes the flow from the routed node,
+        unless another socket of the room already did
+        """
+        event = webhooks.claim_response(self.room_name)
+        if event is not None:
+            self.resume_flow(event)
+
+
+    def resume_flow(self, event):
+        target_id = event.get('target_id')
+        if target_id in (None, ''):
+            # Same as the end of the flow
+            target_id = 'END'
+        try:
+            self.send_bot_reply(event['bot_id'], target_id, event.get('message'), event['time'], event['room_id'], event['owner_id'], event['user'], hops=event.get('hops', 0))
+        except LiveChatException:
+            raise
+        except Exception as ex:
+            logger.critical(f"Disconnecting... Error with ClientwidgetConsumer: {ex}")
+            self.disconnect(400)
+
+
     # Template messages
     def template_message(self, event):
+        self.send(text_data=json.dumps(self.template_payload(event)))
+        #self.num_msgs += 1
+
+    def template_payload(self, event):
         data = event['data']
         timestamp = event['time']
         message = event['message']
@@ -1375,20 +1328,22 @@ class ClientWidgetConsumer(WebsocketConsumer):
         last_name = event['last_name'] if 'last_name' in event else 'Message'
         room_id = event['room_id'] if 'room_id' in event else self.room_id
         owner_id = event['owner_id'] if 'owner_id' in event else self.owner_id
-        self.send(text_data=json.dumps({
-                'data': data,
-                'time': timestamp,
-                'message': message,
-                'user': user,
-                'first_name': first_name,
-                'last_name': last_name,
-                'room_id': str(room_id),
-                'owner_id': str(owner_id),
-            }))
-        #self.num_msgs += 1
+        return {
+            'data': data,
+            'time': timestamp,
+            'message': message,
+            'user': user,
+            'first_name': first_name,
+            'last_name': last_name,
+            'room_id': str(room_id),
+            'owner_id': str(owner_id),
+        }
     
     # Livechat messages
     def chat_message(self, event):
+        self.send(text_data=json.dumps(self.chat_payload(event)))
+
+    def chat_payload(self, event):
         message = event['message']
         timestamp = event['time']
         room_id = event['room_id']
@@ -1402,30 +1357,17 @@ class ClientWidgetConsumer(WebsocketConsumer):
         owner_id = event['owner_id'] if 'owner_id' in event else self.owner_id
         print(message, user)
         logger.info(f"{message}, {user}")
-        if "api" in event:
-            self.send(text_data=json.dumps({
-                'message': message,
-                'time': timestamp,
-                'room_id': str(room_id),
-                'owner_id': str(owner_id),
-                'user': user,
-                'email': email,
-                'api': True,
-                'first_name': first_name,
-                'last_name': last_name,
-            }))
-        else:
-            self.send(text_data=json.dumps({
-                'message': message,
-                'time': timestamp,
-                'room_id': str(room_id),
-                'owner_id': str(owner_id),
-                'user': user,
-                'email': email,
-                'api': False,
-                'first_name': first_name,
-                'last_name': last_name,
-            }))
+        return {
+            'message': message,
+            'time': timestamp,
+            'room_id': str(room_id),
+            'owner_id': str(owner_id),
+            'user': user,
+            'email': email,
+            'api': "api" in event,
+            'first_name': first_name,
+            'last_name': last_name,
+        }
     
     def chat_status_update(self, event):
         self.send(text_data=json.dumps(
@@ -1542,9 +1484,9 @@ class AdminConsumer(WebsocketConsumer):
     def disconnect(self, close_code):
         # Leave room group
 
-        if hasattr(self, 'last_room_id') and cache.get(f"NUM_USERS_{self.last_room_id}", 100) <= 0:
+        if hasattr(self, 'last_room_id') and counters.get_usercount(self.last_room_id, default=100) <= 0:
             # Set the session end flag
-            cache.set(f"CLIENTWIDGET_SESSION_END_{self.last_room_id}", True, timeout=lock_timeout + BUFFER_TIME)
+            room_state.set_room_field(self.last_room_id, room_state.SESSION_END, True)
 
         if not hasattr(self, 'group_name'):
             return
@@ -1574,7 +1516,7 @@ class AdminConsumer(WebsocketConsumer):
 
     def send_enter_msg(self, room_id, db_label, msg):
         try:
-            num_users = events.increment_usercount(room_id)
+            num_users = counters.increment_usercount(room_id)
             logger.info(f"Now, num_users = {num_users}")
 
             logger.info(f"Before, bot type = {self.bot_type}")
@@ -1640,19 +1582,19 @@ class AdminConsumer(WebsocketConsumer):
             """
 
             # Set the takeover flag
-            cache.set(f"CLIENTWIDGET_TAKEOVER_{room_id}", True, timeout=lock_timeout + BUFFER_TIME)
+            room_state.set_room_field(room_id, room_state.TAKEOVER, True)
         except Exception as ex:
             print(ex)
     
 
     def send_exit_msg(self, room_id, msg, override=False):
         try:
-            num_users = events.decrement_usercount(room_id)
+            num_users = counters.decrement_usercount(room_id)
             logger.info(f"Now, num_users = {num_users}")
 
-            if cache.get(f"NUM_USERS_{room_id}", 100) <= 0:
+            if counters.get_usercount(room_id, default=100) <= 0:
                 # Set the session end flag
-                cache.set(f"CLIENTWIDGET_SESSION_END_{room_id}", True, timeout=lock_timeout + BUFFER_TIME)
+                room_state.set_room_field(room_id, room_state.SESSION_END, True)
 
             if override == True:
                 if self.bot_type == 'website':
@@ -1667,32 +1609,19 @@ class AdminConsumer(WebsocketConsumer):
                             "message": msg,
                         }
 
-                        async_to_sync(self.channel_layer.group_send)(
-                            str(room_id),
-                            {
-                                **template,
-                                'type': 'chat_message',
-                            }
-                        )
-
+                        groups = [str(room_id)]
                         if hasattr(self, 'has_entered') and self.has_entered == False:
                             # Send to admin group also, as this is a normal disconnect
-                            async_to_sync(self.channel_layer.group_send)(
-                                str(self.owner_id),
-                                {
-                                    **template,
-                                    'type': 'chat_message',
-                                }
-                            )
-
-                        send_to_operator(room_id, self.owner_id, self.channel_layer, template)
+                            groups.append(str(self.owner_id))
+                        groups.extend(operator_map.get_room_operators(room_id))
+                        fanout.send_to_groups(groups, {**template, 'type': 'chat_message'}, self.channel_layer)
 
                     except Exception as ex:
                         print(ex)
 
             if num_users <= 0 and self.bot_type == "website":
                 # Flushing session
-                [events.increment_usercount(room_id) for _ in range(0 - num_users)]
+                counters.increment_usercount(room_id, amount=0 - num_users)
                 if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
                     _ = tasks.flush_session.delay(room_id, room_id, False)
                 else:
@@ -1719,7 +1648,7 @@ class AdminConsumer(WebsocketConsumer):
         user = text_data_json['user']
         room_id = text_data_json['room_id']
 
-        db_label = cache.get(str(room_id)) # TODO: Change this
+        db_label = near_cache.get_db_label(str(room_id)) # TODO: Change this
         
         owner_id = str(self.owner_id)
 
@@ -1771,39 +1700,19 @@ class AdminConsumer(WebsocketConsumer):
                         text_data_json['email'] = ''
                         print(ex)
                     
-                    async_to_sync(self.channel_layer.group_send)(
-                        str(room_id),
-                        {
-                            **text_data_json,
-                            'type': 'chat_message',
-                        }
-                    )
-                    
+                groups = []
+                if user == 'admin':
+                    groups.append(str(room_id))
                     try:
-                        client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-                        print(f"CLIENT MAP = {client_map}")
-                        logger.info(f"CLIENT MAP = {client_map}")
-                        if client_map is not None:
-                            operator_id = client_map.get(room_id)
-                            #TODO: Need to add celery tas here
-                            for operator in operator_id:
-                                async_to_sync(self.channel_layer.group_send)(
-                                    operator,
-                                    {
-                                        **text_data_json,
-                                        'type': 'chat_message',
-                                    }
-                                )
+                        operator_id = operator_map.get_room_operators(room_id)
+                        print(f"OPERATORS = {operator_id}")
+                        logger.info(f"OPERATORS = {operator_id}")
+                        groups.extend(operator_id)
                     except Exception as ex:
                         print(ex)
 
-                async_to_sync(self.channel_layer.group_send)(
-                    str(owner_id),
-                    {
-                        **text_data_json,
-                        'type': 'chat_message',
-                    }
-                )
+                groups.append(str(owner_id))
+                fanout.send_to_groups(groups, {**text_data_json, 'type': 'chat_message'}, self.channel_layer)
 
                 if user == 'admin':
                     try:
@@ -1812,10 +1721,7 @@ class AdminConsumer(WebsocketConsumer):
                     except Exception as ex:
                         print(f"Exception during sending Whatsapp message from admin: {ex}")
 
-                events.append_msg_to_redis(room_id, text_data_json, store_full=True)
-                num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{room_id}", 0)
-                num_msgs += 1
-                cache.set(f"CLIENTWIDGET_COUNT_{room_id}", num_msgs, timeout=lock_timeout + BUFFER_TIME)
+                events.append_msg_to_redis(room_id, text_data_json, store_full=True, count=True)
             
             except Exception as ex:
                 print(ex)
@@ -1916,9 +1822,9 @@ class OperatorConsumer(WebsocketConsumer):
         if not hasattr(self, 'group_name'):
             return
 
-        if hasattr(self, 'last_room_id') and cache.get(f"NUM_USERS_{self.last_room_id}", 100) <= 0:
+        if hasattr(self, 'last_room_id') and counters.get_usercount(self.last_room_id, default=100) <= 0:
             # Set the session end flag
-            cache.set(f"CLIENTWIDGET_SESSION_END_{self.last_room_id}", True, timeout=lock_timeout + BUFFER_TIME)
+            room_state.set_room_field(self.last_room_id, room_state.SESSION_END, True)
 
         if close_code == 400:
             print("Unauthorised User. Only operators can access this socket")
@@ -1945,7 +1851,7 @@ class OperatorConsumer(WebsocketConsumer):
 
     def send_enter_msg(self, room_id, db_label, msg):
         try:
-            num_users = events.increment_usercount(room_id)
+            num_users = counters.increment_usercount(room_id)
             logger.info(f"Now, num_users = {num_users}")
 
             logger.info(f"Before, bot type = {self.bot_type}")
@@ -2015,23 +1921,20 @@ class OperatorConsumer(WebsocketConsumer):
                     logger.info(f"{ex}")
             """
             
-            # Set the takeover flag
-            cache.set(f"CLIENTWIDGET_TAKEOVER_{room_id}", True, timeout=lock_timeout + BUFFER_TIME)
-
-            # Set the session end flag
-            cache.set(f"CLIENTWIDGET_SESSION_END_{room_id}", True, timeout=lock_timeout + BUFFER_TIME)
+            # Set the takeover flag, and the session end flag
+            room_state.set_room_fields(room_id, {room_state.TAKEOVER: True, room_state.SESSION_END: True})
         except Exception as ex:
             print(ex)
     
     
     def send_exit_msg(self, room_id, msg, override=False):
         try:
-            num_users = events.decrement_usercount(room_id)
+            num_users = counters.decrement_usercount(room_id)
             logger.info(f"Now, num_users = {num_users}")
 
-            if cache.get(f"NUM_USERS_{room_id}", 100) <= 0:
+            if counters.get_usercount(room_id, default=100) <= 0:
                 # Set the session end flag
-                cache.set(f"CLIENTWIDGET_SESSION_END_{room_id}", True, timeout=lock_timeout + BUFFER_TIME)
+                room_state.set_room_field(room_id, room_state.SESSION_END, True)
 
             if override == True:
                 if self.bot_type == 'website':
@@ -2046,38 +1949,18 @@ class OperatorConsumer(WebsocketConsumer):
                             "message": msg,
                         }
 
-                        async_to_sync(self.channel_layer.group_send)(
-                            str(room_id),
-                            {
-                                **template,
-                                'type': 'chat_message',
-                            }
-                        )
-
-                        async_to_sync(self.channel_layer.group_send)(
-                            str(self.owner_id),
-                            {
-                                **template,
-                                'type': 'chat_message',
-                            }
-                        )
-
+                        groups = [str(room_id), str(self.owner_id)]
                         if hasattr(self, 'has_entered') and self.has_entered == False:
                             # Send to operator group also, as this is a normal disconnect
-                            async_to_sync(self.channel_layer.group_send)(
-                                str(self.operator_id),
-                                {
-                                    **template,
-                                    'type': 'chat_message',
-                                }
-                            )
+                            groups.append(str(self.operator_id))
+                        fanout.send_to_groups(groups, {**template, 'type': 'chat_message'}, self.channel_layer)
 
                     except Exception as ex:
                         print(ex)
 
             if num_users <= 0 and self.bot_type == "website":
                 # Flushing session
-                [events.increment_usercount(room_id) for _ in range(0 - num_users)]
+                counters.increment_usercount(room_id, amount=0 - num_users)
                 if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
                     _ = tasks.flush_session.delay(room_id, room_id, False)
                 else:
@@ -2105,7 +1988,7 @@ class OperatorConsumer(WebsocketConsumer):
         room_id = text_data_json['room_id']
         owner_id = str(self.owner_id)
 
-        db_label = cache.get(str(room_id)) # TODO: Change this
+        db_label = near_cache.get_db_label(str(room_id)) # TODO: Change this
 
         if 'ENTER' in text_data_json:
             # Connection from admin / operator
@@ -2156,41 +2039,10 @@ class OperatorConsumer(WebsocketConsumer):
                     
                     logger.info(f"OPERATOR SENDING room_id {room_id}, OWNER ID {owner_id}")
 
-                    async_to_sync(self.channel_layer.group_send)(
-                        room_id,
-                        {
-                            **text_data_json,
-                            'type': 'chat_message',
-                        }
-                    )
-
-                    async_to_sync(self.channel_layer.group_send)(
-                        owner_id,
-                        {
-                            **text_data_json,
-                            'type': 'chat_message',
-                        }
-                    )
-                team_name = cache.get(f'TEAM_{room_id}')
-                if team_name is not None:
-                    for team in team_name:
-                        _team = team.replace(" ", "")
-                        async_to_sync(self.channel_layer.group_send)(
-                                'operator_team_{}_{}'.format(owner_id, str(_team)),
-                                {
-
-                                    **text_data_json,
-                                    'type': 'chat_message',
-                                }
-                            )
-                else:        
-                    async_to_sync(self.channel_layer.group_send)(
-                        str(self.operator_id),
-                        {
-                            **text_data_json,
-                            'type': 'chat_message',
-                        }
-                    )
+                groups = [room_id, owner_id] if user == 'operator' else []
+                # The teams of the room, else this operator
+                groups.extend(fanout.get_operator_groups(room_id, owner_id, 'operator_team_{owner_id}_{team}', operators=[self.operator_id]))
+                fanout.send_to_groups(groups, {**text_data_json, 'type': 'chat_message'}, self.channel_layer)
 
                 if user == "operator":
                     try:
@@ -2207,10 +2059,7 @@ class OperatorConsumer(WebsocketConsumer):
                     except Exception as ex:
                         logger.info(f"{ex}")
 
-                events.append_msg_to_redis(room_id, text_data_json, store_full=True)
-                num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{room_id}", 0)
-                num_msgs += 1
-                cache.set(f"CLIENTWIDGET_COUNT_{room_id}", num_msgs, timeout=lock_timeout + BUFFER_TIME)
+                events.append_msg_to_redis(room_id, text_data_json, store_full=True, count=True)
             
             except Exception as ex:
                 print(ex)
@@ -2238,9 +2087,8 @@ class OperatorConsumer(WebsocketConsumer):
             "secret": secret,
             "time": time
         }
-        client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-        if client_map is not None and str(room_id) in client_map:
-            operator_id = client_map[str(room_id)]
+        operator_id = operator_map.get_room_operators(room_id)
+        if len(operator_id) > 0:
             for operator in operator_id:
                 group_name = str(operator)
                 async_to_sync(channel_layer.group_send)(
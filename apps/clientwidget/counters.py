@@ -0,0 +1,113 @@
+"""
+clientwidget/counters.py
+
+Atomic counters for the live rooms.
+
+    NUM_USERS_{room_id} -> Number of websocket connections on the room. A plain integer key, updated with INCRBY / DECRBY
+    `count` field of the room state -> Number of messages in the session (see `room_state`)
+
+Every update is a single round trip (the increment and the TTL are pipelined), so there's no read-modify-write
+race between consumers. The listing APIs read the counters of a whole page of rooms in one round trip.
+"""
+
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Value, When
+
+from . import room_state
+
+# TTL of the user count of a room
+USER_COUNT_TIMEOUT = 24 * 60 * 60
+
+
+def user_count_key(room_id):
+    return cache.make_key(f"NUM_USERS_{room_id}")
+
+
+def incr_counter(key, amount=1, timeout=USER_COUNT_TIMEOUT):
+    """Atomically increments (or decrements, if `amount` is negative) the counter `key`, and returns the new value
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.incrby(key, amount)
+        pipe.expire(key, timeout)
+        value, _ = pipe.execute()
+    return int(value)
+
+
+def increment_usercount(room_id, amount=1):
+    return incr_counter(user_count_key(room_id), amount)
+
+
+def decrement_usercount(room_id, amount=1):
+    return incr_counter(user_count_key(room_id), -amount)
+
+
+def reset_usercount(room_id, timeout=USER_COUNT_TIMEOUT):
+    REDIS_CONNECTION = cache.get_client('')
+    REDIS_CONNECTION.set(user_count_key(room_id), 0, ex=timeout)
+
+
+def get_usercount(room_id, default=0):
+    REDIS_CONNECTION = cache.get_client('')
+    value = REDIS_CONNECTION.get(user_count_key(room_id))
+    return default if value is None else int(value)
+
+
+def get_usercounts(room_ids):
+    """Fetches the user counts of multiple rooms with a single MGET
+
+    Returns:
+        dict: {room_id (str): count}. Rooms without a counter are left out
+    """
+    room_ids = [str(room_id) for room_id in room_ids]
+    if len(room_ids) == 0:
+        return {}
+    REDIS_CONNECTION = cache.get_client('')
+    values = REDIS_CONNECTION.mget([user_count_key(room_id) for room_id in room_ids])
+    return {room_id: int(value) for room_id, value in zip(room_ids, values) if value is not None}
+
+
+def get_msgcount(room_id, default=0):
+    return room_state.get_room_field(room_id, room_state.COUNT, default)
+
+
+def update_msgcount(room_id, num_msgs):
+    room_state.set_room_field(room_id, room_state.COUNT, int(num_msgs))
+
+
+def get_msgcounts(room_ids):
+    """Fetches the message counts of multiple rooms in a single round trip
+
+    The message count is a field of the room state hash, so this pipelines one HGET per room instead of an MGET
+
+    Returns:
+        dict: {room_id (str): count}. Rooms without a live session are left out
+    """
+    room_ids = [str(room_id) for room_id in room_ids]
+    if len(room_ids) == 0:
+        return {}
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.hget(room_state.room_state_key(room_id), room_state.COUNT)
+        values = pipe.execute()
+    return {room_id: int(value) for room_id, value in zip(room_ids, values) if value is not None}
+
+
+def flush_msgcounts(room_ids, db_label='default'):
+    """Writes the live message counts of `room_ids` into `ChatRoom.num_msgs`, with a single UPDATE
+
+    Returns:
+        int: The number of rooms updated
+    """
+    from .models import ChatRoom
+
+    counts = get_msgcounts(room_ids)
+    if len(counts) == 0:
+        return 0
+
+    num_msgs = Case(
+        *[When(room_id=room_id, then=Value(count)) for room_id, count in counts.items()],
+        output_field=IntegerField(),
+    )
+    return ChatRoom.objects.using(db_label).filter(room_id__in=list(counts.keys())).update(num_msgs=num_msgs)
@@ -16,20 +16,24 @@ import uuid
 from itertools import zip_longest
 
 import requests
+from requests.structures import CaseInsensitiveDict
 # Celery related imports
 from celery import task
 from coolname import generate_slug
 # from celery import current_app
-from decouple import Config, RepositoryEnv, UndefinedValueError
+from decouple import Config, RepositoryEnv, UndefinedValueError, config
 from django.apps import apps
 from django.core.cache import cache
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
-from redis import StrictRedis, WatchError
+from redis import StrictRedis
 
-from apps.accounts.models import User
-from apps.clientwidget.models import ChatRoom
+from apps.chatbox.bot_json_parser import BotJSONParser
+from apps.chatbox.expression import evaluate_expression
+from apps.clientwidget.models import ChatMessage, ChatRoom
 
+from . import archive, counters, history_seq, http_client, near_cache, operator_map, room_state, tenants
+from .history_codec import decode_entries, encode_entry
 from .exceptions import logger
 from .views import WEBHOOK_TIMEOUT
 
@@ -37,6 +41,12 @@ from .views import WEBHOOK_TIMEOUT
 
 Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
 
+# Number of rows per INSERT when appending messages to the DB
+try:
+    MESSAGE_BATCH_SIZE = int(config('MESSAGE_BATCH_SIZE'))
+except UndefinedValueError:
+    MESSAGE_BATCH_SIZE = 500
+
 
 # Define a Decorator for making uuid objects to string automatically
 def uuid_to_string(func): 
@@ -92,44 +102,6 @@ def update_session_redis(room_name, msg_number, content):
     REDIS_CONNECTION.hmset(cache.make_key(f"HISTORY_{room_name}_{msg_number % (N)}"), content)
 
 
-def atomic_set(key, value, timeout=24 * 60 * 60):
-    """
-        Atomically sets {key: value} on the redis store
-    """
-    REDIS_CONNECTION = cache.get_client('')
-    try:
-        with REDIS_CONNECTION.pipeline() as pipe:
-            try:
-                pipe.watch(key)
-                pipe.multi()
-                pipe.set(key, value)
-                pipe.expire(key, timeout)
-                pipe.get(key)
-                return pipe.execute()[-1], False
-            except WatchError:
-                return pipe.get(key), True
-    except TypeError:
-        return REDIS_CONNECTION.get(key), True
-
-
-def atomic_get(key):
-    """
-        Atomically gets the most recent {key : value} pair from the redis store
-    """
-    REDIS_CONNECTION = cache.get_client('')
-    try:
-        with REDIS_CONNECTION.pipeline() as pipe:
-            try:
-                pipe.watch(key)
-                pipe.multi()
-                pipe.get(key)
-                return pipe.execute()[-1], False
-            except WatchError:
-                return pipe.get(key), True
-    except TypeError:
-        return REDIS_CONNECTION.get(key), True
-
-
 def get_variables(bot_variable_json: dict) -> dict:
     """Fetch the empty variable dictionary from `bot_variable_json`
 
@@ -182,94 +154,40 @@ def create_room(user, content, bot_id=None, room_name=None, preview=False, stand
     try:
         with transaction.atomic():
             if room_name is None:
-                instance.save(new_visitor=True, using=chatbox_instance.owner.ext_db_label, preview=preview, standalone=standalone)
+                instance.save(new_visitor=True, using=tenants.get_user_db_label(chatbox_instance.owner), preview=preview, standalone=standalone)
             else:
-                instance.save(using=chatbox_instance.owner.ext_db_label)
+                instance.save(using=tenants.get_user_db_label(chatbox_instance.owner))
         return instance.room_id, instance.room_name
     except IntegrityError:
         print('Room already there in DB!')
         return instance.room_id, instance.room_name
 
 
-@uuid_to_string
-def update_msgcount(room_name, num_msgs):
-    """
-        Updates the message count shared variable atomically on the redis cache
-    """
-    while True:
-        # Set the current message atomically
-        num_msgs, error = atomic_set(cache.make_key(f"CURR_MSG_{room_name}"), num_msgs)
-        if not error:
-            break
-        else:
-            # Someone else has updated this first
-            num_msgs += 1
-    return int(num_msgs)
-
-
-@uuid_to_string
-def get_msgcount(room_name):
-    """
-        Get the message count shared variable atomically from the redis cache
+def next_message_seq(room_id, db_name='default'):
+    """Returns the sequence number of the next message of `room_id`. Served from the (room_id, seq) index
     """
-    num_msgs = None
-    while True:
-        num_msgs, error = atomic_get(cache.make_key(f"CURR_MSG_{room_name}"))
-        if not error:
-            break
-    if num_msgs is None:
-        # The corresponding key doesn't exist in redis yet. Create it
-        num_msgs = 0
-        num_msgs = update_msgcount(room_name, num_msgs)
-    return int(num_msgs)
-
+    last_seq = ChatMessage.objects.using(db_name).filter(room_id=room_id).aggregate(largest=models.Max('seq'))['largest']
+    if last_seq is None:
+        # Every message may be in the archive tier
+        last_seq = ChatRoom.objects.using(db_name).filter(room_id=room_id).values_list('archived_seq', flat=True).first() or 0
+    return last_seq + 1
 
-@uuid_to_string
-def get_usercount(room_name):
-    """
-        Get the user count shared variable atomically from the redis cache
-    """
-    num_users = None
-    while True:
-        num_users, error = atomic_get(cache.make_key(f"NUM_USERS_{room_name}"))
-        if not error:
-            break
-    if num_users is None:
-        # The corresponding key doesn't exist in redis yet. Create it
-        num_users = 0
-        while True:
-            num_users, error = atomic_set(room_name, num_users)
-            if not error:
-                break
-    return int(num_users)
 
+def append_messages_to_db(room_id, messages, db_name='default'):
+    """Appends `messages` to the history of `room_id`, with a single bulk insert.
 
-@uuid_to_string
-def increment_usercount(room_name):
-    """
-        Increments the user count shared variable atomically on the redis cache
-    """
-    num_users = get_usercount(room_name)
-    while True:
-        # Set the current message atomically
-        num_users, error = atomic_set(cache.make_key(f"NUM_USERS_{room_name}"), num_users+1)
-        if not error:
-            break
-    return int(num_users)
-
-
-@uuid_to_string
-def decrement_usercount(room_name):
-    """
-        Decrement the room counter atomically whenever a Websocket connection is established
+    The caller must hold the row lock of the room (`select_for_update()`), so that concurrent writers
+    get consecutive sequence numbers. Returns the number of messages appended.
     """
-    num_users = get_usercount(room_name)
-    while True:
-        # Set the current message atomically
-        num_users, error = atomic_set(cache.make_key(f"NUM_USERS_{room_name}"), num_users-1)
-        if not error:
-            break
-    return int(num_users)
+    if messages is None or len(messages) == 0:
+        return 0
+    seq = next_message_seq(room_id, db_name)
+    ChatMessage.objects.using(db_name).bulk_create(
+        [ChatMessage(room_id=room_id, seq=seq + i, content=message) for i, message in enumerate(messages)],
+        batch_size=MESSAGE_BATCH_SIZE,
+    )
+    history_seq.sync_sequence_on_commit(room_id, seq + len(messages) - 1, db_name)
+    return len(messages)
 
 
 def append_msg_to_db(room_name, message_dict, db_name='secondary', store_full=False):
@@ -283,59 +201,72 @@ def append_msg_to_db(room_name, message_dict, db_name='secondary', store_full=Fa
         room_id = None
         queryset = ChatRoom.objects.using(db_name).filter(room_name=room_name)
     
-    if queryset.count() > 0:
-        room_object = queryset.first()
-        
-        if store_full:
-            room_object.messages.append(message_dict)
-            room_object.save(using=db_name)
+    with transaction.atomic(using=db_name):
+        room_object = queryset.select_for_update().first()
+        if room_object is not None:
+            append_messages_to_db(room_object.room_id, history_entries(message_dict, store_full=store_full), db_name=db_name)
             return True, None
-        
-        if 'message' in message_dict:
-            if isinstance(message_dict['message'], list):
-                room_object.messages.extend(message_dict['message'])
-            else:
-                room_object.messages.append(message_dict)
-        else:
-            room_object.messages.append(message_dict)
-        
-        room_object.save(using=db_name)
-        return True, None
+    
+    if room_id is None:
+        return False, f"Room Name {room_name} does not exist"
     else:
-        if room_id is None:
-            return False, f"Room Name {room_name} does not exist"
-        else:
-            return False, f"Room ID {room_id} does not exist"
+        return False, f"Room ID {room_id} does not exist"
 
 
-@uuid_to_string
-def append_msg_to_redis(room_name, message_dict, store_full=False, timeout=24 * 60 * 60):
+def history_entries(message_dict, store_full=False):
+    """Returns the list of entries to append to the history for a single websocket message
     """
-        Appends the message dictionary from the websocket to the Redis Message List
+    if store_full:
+        return [message_dict]
+    if 'message' in message_dict and isinstance(message_dict['message'], list):
+        # If we want to store an array of parsed messages
+        return message_dict['message']
+    return [message_dict]
+
+
+@uuid_to_string
+def append_msg_to_redis(room_name, message_dict, store_full=False, timeout=24 * 60 * 60, count=False):
     """
-    REDIS_CONNECTION = cache.get_client('')
+        Appends the message dictionary from the websocket to the Redis Message List.
 
-    if store_full:
-        REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
-        REDIS_CONNECTION.expire(cache.make_key(f'HISTORY_{room_name}'), timeout)
-        # Finally set a lock on this room name. We'll need it later for flushing to DB
-        cache.set(f'CLIENTWIDGETLOCK_{room_name}', room_name, timeout=timeout)
-        return
+        Everything is done in a single round trip: one variadic RPUSH of all the entries, the TTL of the history,
+        the sequence of the room (see `history_seq`), the history lock (which we need later for flushing to DB)
+        and, if `count` is set, the message counter of the room.
 
-    if 'message' in message_dict:
-        if isinstance(message_dict['message'], list):
-            # If we want to store an array of parsed messages
-            for msg in message_dict['message']:
-                REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(msg))
-        else:
-            REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
+        Returns the new length of the history
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    entries = [encode_entry(entry) for entry in history_entries(message_dict, store_full=store_full)]
+    if len(entries) == 0:
+        return REDIS_CONNECTION.llen(cache.make_key(f'HISTORY_{room_name}'))
+
+    with REDIS_CONNECTION.pipeline() as pipe:
+        queue_append(pipe, room_name, entries, timeout=timeout, count=count)
+        length = pipe.execute()[0]
+    return length
+
+
+def queue_append(pipe, room_name, entries, timeout=24 * 60 * 60, count=False):
+    """Queues the commands of `append_msg_to_redis()` for the encoded `entries` on `pipe`. The first one returns the
+    new length of the history. Only uses commands with the same signature in redis-py and aioredis, so it works on the
+    pipelines of both (see `async_redis.append_msg_to_redis()`)
+    """
+    history_key = cache.make_key(f'HISTORY_{room_name}')
+    pipe.rpush(history_key, *entries)
+    if timeout is not None:
+        pipe.expire(history_key, timeout)
+    seq_key = history_seq.seq_key(room_name)
+    pipe.incrby(seq_key, len(entries))
+    pipe.expire(seq_key, history_seq.HISTORY_SEQ_TIMEOUT)
+    lock_key = cache.make_key(f'CLIENTWIDGETLOCK_{room_name}')
+    if timeout is not None:
+        pipe.setex(lock_key, timeout, cache.prep_value(room_name))
     else:
-        REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
-    
-    REDIS_CONNECTION.expire(cache.make_key(f'HISTORY_{room_name}'), timeout)
-    
-    # Finally set a lock on this room name. We'll need it later for flushing to DB
-    cache.set(f'CLIENTWIDGETLOCK_{room_name}', room_name, timeout=timeout)
+        pipe.set(lock_key, cache.prep_value(room_name))
+    if count == True:
+        room_key = room_state.room_state_key(room_name)
+        pipe.hincrby(room_key, room_state.COUNT, 1)
+        pipe.expire(room_key, room_state.ROOM_STATE_TIMEOUT)
 
 
 @uuid_to_string
@@ -344,21 +275,20 @@ def fetch_variables_from_redis(room_name, override=False, bot_type='website'):
         Fetches all the variables from the current session, for `room_name`.
     """
     # Get the lock from the cache
+    state = room_state.RoomState(room_name).load()
+    variables = state.get_variables()
     if override == False:
-        lock = cache.get(f"CLIENTWIDGETROOMLOCK_{room_name}")
+        lock = state.get(room_state.LOCK)
     else:
         # Let's override this manually
         lock = True
 
     if bot_type != 'website':
-        
-        variables = cache.get(f"VARIABLES_{room_name}") 
         return True, variables
         
 
     if lock == True:
         # Ensure that the lock is set
-        variables = cache.get(f"VARIABLES_{room_name}")
         return True, variables
     else:
         # No lock. Session doesn't exist
@@ -389,66 +319,81 @@ def fetch_variables_from_db(room_name, db_name='default'):
     return True, instance.variables
 
 
-def fetch_recent_history_from_db(room_name, num_msgs=None, db_name='default'):
-    """
-        Fetches the recent messages from the DB
+def fetch_history_page_from_db(room_id, num_msgs=None, before=None, recent=False, recent_seq=1, db_name='default'):
+    """Fetches a page of the history of `room_id`, as a range scan on the (room_id, seq) index
+
+    Args:
+        room_id (uuid.UUID): The room ID
+        num_msgs (int, optional): Fetch only the last `num_msgs` messages before `before`. Defaults to None (all of them).
+        before (int, optional): Only fetch the messages with `seq < before`. Defaults to None.
+        recent (bool, optional): Only fetch the recent history (`seq >= recent_seq`). Defaults to False.
+        recent_seq (int, optional): `ChatRoom.recent_seq` of the room. Defaults to 1.
+        db_name (str, optional): The DB label. Defaults to 'default'.
+
+    Returns:
+        tuple: (messages, first_seq). `first_seq` is the seq of the first message of the page, to be passed as `before`
+        for fetching the previous page. None if there are no older messages
     """
-    if isinstance(room_name, uuid.UUID):
-        room_id = room_name
-        room_name = str(room_name)
+    queryset = ChatMessage.objects.using(db_name).filter(room_id=room_id)
+    if recent == True:
+        queryset = queryset.filter(seq__gte=recent_seq)
+    if before is not None:
+        queryset = queryset.filter(seq__lt=before)
+
+    if num_msgs is None:
+        rows = list(queryset.order_by('seq').values_list('seq', 'content'))
     else:
-        room_id = None
-    
-    if room_id is not None:
-        queryset = ChatRoom.objects.using(db_name).filter(room_id=room_id)
+        rows = list(queryset.order_by('-seq').values_list('seq', 'content')[:num_msgs])[::-1]
+
+    if len(rows) == 0 or rows[0][0] <= (recent_seq if recent == True else 1):
+        first_seq = None
     else:
-        queryset = ChatRoom.objects.using(db_name).filter(room_name=room_name)
-    
-    if queryset.count() == 0:
-        if room_id is not None:
-            return False, f"Room ID {room_id} not found in DB"
+        first_seq = rows[0][0]
+    return [content for _, content in rows], first_seq
+
+
+def get_room_from_db(room_name, db_name='default'):
+    """Returns the ChatRoom of `room_name` (a room ID or a room name), or None
+    """
+    if isinstance(room_name, uuid.UUID):
+        return ChatRoom.objects.using(db_name).filter(room_id=room_name).first()
+    return ChatRoom.objects.using(db_name).filter(room_name=room_name).first()
+
+
+def fetch_recent_history_from_db(room_name, num_msgs=None, db_name='default', before=None):
+    """
+        Fetches the recent messages from the DB
+    """
+    instance = get_room_from_db(room_name, db_name=db_name)
+    if instance is None:
+        if isinstance(room_name, uuid.UUID):
+            return False, f"Room ID {room_name} not found in DB"
         else:
             return False, f"Room Name {room_name} not found in DB"
     
-    instance = queryset.first()
-    if num_msgs is None:
-        return True, instance.recent_messages
-    else:
-        # Get last num_msgs from the DB
-        if num_msgs < 0:
-            return False, f"Wrong value. num_msgs is {num_msgs}. Expected a positive integer"
-        return True, instance.recent_messages[-num_msgs:]
+    if num_msgs is not None and num_msgs < 0:
+        return False, f"Wrong value. num_msgs is {num_msgs}. Expected a positive integer"
+    archive.ensure_rehydrated(instance, db_name, recent=True)
+    history, _ = fetch_history_page_from_db(instance.room_id, num_msgs=num_msgs, before=before, recent=True, recent_seq=instance.recent_seq, db_name=db_name)
+    return True, history
 
 
-def fetch_history_from_db(room_name, num_msgs=None, db_name='default'):
+def fetch_history_from_db(room_name, num_msgs=None, db_name='default', before=None):
     """
         Fetches the messages from the DB
     """
-    if isinstance(room_name, uuid.UUID):
-        room_id = room_name
-        room_name = str(room_name)
-    else:
-        room_id = None
-    
-    if room_id is not None:
-        queryset = ChatRoom.objects.using(db_name).filter(room_id=room_id)
-    else:
-        queryset = ChatRoom.objects.using(db_name).filter(room_name=room_name)
-    
-    if queryset.count() == 0:
-        if room_id is not None:
-            return False, f"Room ID {room_id} not found in DB"
+    instance = get_room_from_db(room_name, db_name=db_name)
+    if instance is None:
+        if isinstance(room_name, uuid.UUID):
+            return False, f"Room ID {room_name} not found in DB"
         else:
             return False, f"Room Name {room_name} not found in DB"
     
-    instance = queryset.first()
-    if num_msgs is None:
-        return True, instance.messages
-    else:
-        # Get last num_msgs from the DB
-        if num_msgs < 0:
-            return False, f"Wrong value. num_msgs is {num_msgs}. Expected a positive integer"
-        return True, instance.messages[-num_msgs:]
+    if num_msgs is not None and num_msgs < 0:
+        return False, f"Wrong value. num_msgs is {num_msgs}. Expected a positive integer"
+    archive.ensure_rehydrated(instance, db_name)
+    history, _ = fetch_history_page_from_db(instance.room_id, num_msgs=num_msgs, before=before, db_name=db_name)
+    return True, history
 
 
 @uuid_to_string
@@ -464,7 +409,7 @@ def fetch_history_from_redis(room_name, num_msgs=None, post_delete=False):
             return []
         else:
             history_bytes = REDIS_CONNECTION.lrange(cache.make_key(f'HISTORY_{room_name}'), 0, num_msgs-1)
-    history = list(json.loads(msg) for msg in history_bytes) # history is now a Python List of Dict
+    history = decode_entries(history_bytes) # history is now a Python List of Dict
     if post_delete:
         REDIS_CONNECTION.delete(cache.make_key(f"HISTORY_{room_name}"))
     return history
@@ -486,49 +431,56 @@ def delete_history_from_redis(room_name, num_msgs=None):
     return res, None
 
 
-def delete_history_from_db(room_name, num_msgs=None):
+def delete_history_from_db(room_name, num_msgs=None, db_name='default'):
     """
         Deletes history from the DB
     """
     if isinstance(room_name, uuid.UUID):
         room_id = room_name
         room_name = str(room_name)
-        queryset = ChatRoom.objects.filter(room_id=room_id)
+        queryset = ChatRoom.objects.using(db_name).filter(room_id=room_id)
     else:
         room_id = None
-        queryset = ChatRoom.objects.filter(room_name=room_name)
+        queryset = ChatRoom.objects.using(db_name).filter(room_name=room_name)
     
-    if queryset.count() == 0:
-        if room_id is None:
-            return False, f"Room Name {room_name} not there in DB"
+    with transaction.atomic(using=db_name):
+        instance = queryset.select_for_update().first()
+        if instance is None:
+            if room_id is None:
+                return False, f"Room Name {room_name} not there in DB"
+            else:
+                return False, f"Room ID {room_id} not there in DB"
+        
+        # The last messages may be in the archive tier
+        archive.ensure_rehydrated(instance, db_name)
+        messages = ChatMessage.objects.using(db_name).filter(room_id=instance.room_id)
+        if num_msgs is None:
+            # Delete all messages + variables
+            messages.delete()
         else:
-            return False, f"Room ID {room_id} not there in DB"
-    
-    instance = queryset.first()
-    if num_msgs is None:
-        # Delete all messages + variables
-        instance.messages = []
-        instance.variables = []
-        instance.save()
-    else:
-        # Remove last num_msgs + variables
-        instance.messages = instance.messages[:-num_msgs or None]
+            # Remove last num_msgs + variables
+            messages.filter(seq__gte=next_message_seq(instance.room_id, db_name) - num_msgs).delete()
+        instance.recent_seq = min(instance.recent_seq, next_message_seq(instance.room_id, db_name))
         instance.variables = []
-        instance.save()
+        instance.save(using=db_name)
     return True, None
 
 
-def flush_to_db(room_id, user, session_variables, is_lead=None, bot_type="website", other_db=""):
+def flush_to_db(room_id, user, session_variables, is_lead=None, bot_type="website", other_db="", messages=None):
     """
         Appends the session messages and variable content to the database.
+
+        If `messages` is None, the session history is fetched (and deleted) from Redis.
+        Otherwise, it's taken from the snapshot of a torn down room (see `teardown.teardown_room()`)
     """
-    with transaction.atomic():
-        ext = cache.get(str(room_id))
-        instance = ChatRoom.objects.using(ext).get(pk=room_id)
+    ext = near_cache.get_db_label(str(room_id))
+    with transaction.atomic(using=ext):
+        instance = ChatRoom.objects.using(ext).select_for_update().get(pk=room_id)
         if session_variables is not None:
             instance.variables = session_variables
-        instance.messages.extend(fetch_history_from_redis(instance.room_id, post_delete=False))
-        instance.recent_messages.extend(fetch_history_from_redis(instance.room_id, post_delete=True))
+        if messages is None:
+            messages = fetch_history_from_redis(instance.room_id, post_delete=True)
+        append_messages_to_db(instance.room_id, messages, db_name=ext)
         if is_lead is not None:
             instance.is_lead = is_lead
         if bot_type == "website":
@@ -540,57 +492,74 @@ def flush_to_db(room_id, user, session_variables, is_lead=None, bot_type="websit
             instance.save(using=ext, send_update=True)
 
 
+def dump_room_to_db(room_name, variables, messages, bot_type="website", db_label="default"):
+    """Dumps the session variables and messages of a room into the DB, and marks the chat as inactive
+    """
+    modified = False
+    
+    with transaction.atomic(using=db_label):
+        try:
+            room_id = uuid.UUID(str(room_name))
+            instance = ChatRoom.objects.using(db_label).select_for_update().get(room_id=room_id)
+        except ValueError:
+            instance = ChatRoom.objects.using(db_label).select_for_update().get(room_name=room_name)
+        if variables is not None:
+            instance.variables = variables
+            modified = True
+        if messages is not None:
+            if messages != []:
+                append_messages_to_db(instance.room_id, messages, db_name=db_label)
+                if bot_type != 'website':
+                    # Only the website widget shows the recent history
+                    instance.recent_seq = next_message_seq(instance.room_id, db_label)
+                modified = True
+        if modified:
+            instance.bot_is_active = False
+            instance.end_time = timezone.now()
+            instance.save(using=db_label)
+
+
+@uuid_to_string
+def dump_snapshot_to_db(room_name, snapshot, bot_type="website"):
+    """Dumps the snapshot of a torn down room (see `teardown.teardown_room()`) into the DB
+    """
+    if not snapshot.locked and bot_type == "website":
+        return
+    ext = near_cache.get_db_label(str(room_name), "default")
+    dump_room_to_db(room_name, snapshot.variables, snapshot.messages, bot_type=bot_type, db_label=ext)
+
+
 @uuid_to_string
 def cleanup_room_redis(room_name, reset_count=False, bot_type="website"):
     """Dumps the session content of the room into the DB
     """
     connection = cache.get_client('')
 
-    ext = cache.get(str(room_name), "default")
+    ext = near_cache.get_db_label(str(room_name), "default")
 
     # Get the room lock status from the cache
-    lock = cache.get(f'CLIENTWIDGETROOMLOCK_{room_name}')
+    state = room_state.RoomState(room_name).load()
+    lock, variables = state.get(room_state.LOCK), state.get_variables()
 
     if lock is None and bot_type=="website":
         return
 
     if lock == True or bot_type in ("whatsapp", "facebook",):
         # Dump to DB
-        variables = cache.get("VARIABLES_" + room_name)
         messages_bytes = connection.lrange(cache.make_key("HISTORY_" + room_name), 0, -1)
-        messages = list(json.loads(message) for message in messages_bytes)
-        modified = False
-        
-        with transaction.atomic():
-            try:
-                room_id = uuid.UUID(str(room_name))
-                instance = ChatRoom.objects.get(room_id=room_id)
-            except ValueError:
-                instance = ChatRoom.objects.get(room_name=room_name)
-            if variables is not None:
-                instance.variables = variables
-                modified = True
-            if messages is not None:
-                if messages != []:
-                    instance.messages.extend(messages)
-                    if bot_type == 'website' and hasattr(instance, 'recent_messages') and isinstance(getattr(instance, 'recent_messages'), list):
-                        instance.recent_messages.extend(messages)
-                    modified = True
-            if modified:
-                instance.bot_is_active = False
-                instance.end_time = timezone.now()
-                instance.save(using=ext)
+        dump_room_to_db(room_name, variables, decode_entries(messages_bytes), bot_type=bot_type, db_label=ext)
 
     if reset_count == True:
         # Reset the count to 0
-        cache.set(f"NUM_USERS_{room_name}", 0)
+        counters.reset_usercount(room_name)
         # Delete the locks
-        cache.delete(f'CLIENTWIDGETROOMLOCK_{room_name}')
         cache.delete(f'CLIENTWIDGETLOCK_{room_name}')
+        room_state.delete_variables(room_name, room_state.LOCK)
+    else:
+        room_state.delete_variables(room_name)
 
     # Delete the session history
     cache.delete(f"HISTORY_{room_name}")
-    cache.delete(f"VARIABLES_{room_name}")
 
 
 @uuid_to_string
@@ -603,9 +572,8 @@ def reset_chatroom_state(room_id, bot_type="website", db_label="default"):
         return
     
     try:
-        admin = User.objects.get(id=instance.admin_id)
-        cache.delete(f"CLIENT_MAP_{str(admin.uuid)}")
-        cache.delete(f"TEAM_{str(instance.room_id)}")
+        operator_map.clear_room_operators(instance.room_id)
+        room_state.delete_room_fields(instance.room_id, room_state.TEAM)
     except Exception as e:
         pass    
     instance.bot_is_active = True
@@ -625,9 +593,7 @@ def reset_chatroom_state(room_id, bot_type="website", db_label="default"):
 
 @uuid_to_string
 def set_session_variable(room_name, key, value, bot_type="website"):
-    variables = cache.get(f"VARIABLES_{room_name}", {})
-    variables[key] = value
-    cache.set(f"VARIABLES_{room_name}", variables)      
+    room_state.set_variable(room_name, key, value)
 
 
 @uuid_to_string
@@ -657,14 +623,19 @@ def add_new_variable(room_name, key, value, bot_id, bot_type='website'):
         return
 
 
-def make_substitution(items, room_id, bot_type='website'):
+def make_substitution(items, room_id, bot_type='website', session_variables=None):
     result = {}
     if not isinstance(items, list):
         # Single Dict
         if not isinstance(items, dict):
             return result, False
         
-        _, variables = fetch_variables_from_redis(room_id, override=True, bot_type=bot_type)
+        if session_variables is None:
+            # Only fetch the variables which we need to substitute
+            names = [variable for variable in items.values() if isinstance(variable, str) and variable.startswith('@')]
+            variables = room_state.get_variables(room_id, *names) if len(names) > 0 else {}
+        else:
+            variables = session_variables
         
         if variables is None:
             variables = {}
@@ -684,7 +655,7 @@ def make_substitution(items, room_id, bot_type='website'):
 
 
 @task
-def parse_response(room_id, bot_id, owner_id, bot_type='website', content={}, response_template={}):
+def parse_response(room_id, bot_id, owner_id, bot_type='website', content={}, response_template={}, session_variables=None):
     # Response Template: {"name": "@name"}
     if (content in ({}, None,)) or (response_template in ({}, None)):
         return
@@ -698,14 +669,24 @@ def parse_response(room_id, bot_id, owner_id, bot_type='website', content={}, re
         # Unsupported format. We only support a single JSON Object as a response
         raise ValueError(f"Response type is unsupported. Only a single JSON object is allowed")
 
-    _, session_variables = fetch_variables_from_redis(room_id, override=True, bot_type=bot_type)
+    if session_variables is None:
+        names = [variable for variable in response_template.values() if isinstance(variable, str)]
+        variables = room_state.get_variables(room_id, *names) if len(names) > 0 else {}
+        # Collect the updates, and write them back atomically
+        updates = {}
+    else:
+        # Update the caller's variables in place. The caller is responsible for writing them back
+        variables = session_variables
     
     for key, value in serialized_response.items():
         # Match with variables
-        if key in response_template and response_template[key] in session_variables:
-            set_session_variable(room_id, response_template[key], value)
+        if key in response_template and response_template[key] in variables:
+            if session_variables is None:
+                updates[response_template[key]] = value
+            else:
+                session_variables[response_template[key]] = value
         else:
-            if key in response_template and response_template[key] not in session_variables and response_template[key].startswith("@"):
+            if key in response_template and response_template[key] not in variables and response_template[key].startswith("@"):
                 # New Variable Data
                 pass
                 # logger.info(f"Adding a new variable: {key}")
@@ -713,11 +694,14 @@ def parse_response(room_id, bot_id, owner_id, bot_type='website', content={}, re
             else:
                 # Non-variable data. Ignore it
                 continue
+
+    if session_variables is None and len(updates) > 0:
+        room_state.set_variables(room_id, updates)
     return  
 
 
 @task
-def send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type='POST', request_headers={}, query_params=None, request_payload=None, response_template={}, timeout=WEBHOOK_TIMEOUT, bot_type='website', blocking=True):
+def send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type='POST', request_headers={}, query_params=None, request_payload=None, response_template={}, timeout=WEBHOOK_TIMEOUT, bot_type='website', blocking=True, session_variables=None):
     response = None
 
     try:
@@ -726,32 +710,31 @@ def send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type='POST',
         
         request_type = request_type.lower()
         
-        query_params, status = make_substitution(query_params, room_id, bot_type)
+        query_params, status = make_substitution(query_params, room_id, bot_type, session_variables=session_variables)
 
         if not status:
             logger.info("Error during substitution of query params")
 
-        request_payload, status = make_substitution(request_payload, room_id, bot_type)
+        request_payload, status = make_substitution(request_payload, room_id, bot_type, session_variables=session_variables)
 
         if not status:
             logger.info("Error during substitution of request payload")
         
-        session = requests.Session()
-        
+        # The shared session keeps the connections to the webhook hosts alive. The headers are per request
         if request_headers in (None, {},):
-            session.headers.update({"Content-Type": "application/json",})
+            headers = CaseInsensitiveDict({"Content-Type": "application/json",})
         else:
-            session.headers.update(request_headers)
+            headers = CaseInsensitiveDict(request_headers)
 
         if request_type in ['post', 'put']:
-            if session.headers.get('Content-Type') == 'application/json':
-                response = getattr(session, request_type)(webhook_url, json=request_payload, timeout=timeout)
+            if headers.get('Content-Type') == 'application/json':
+                response = http_client.request(request_type, webhook_url, headers=headers, json=request_payload, timeout=timeout)
             else:
-                response = getattr(session, request_type)(webhook_url, data=request_payload, timeout=timeout)
+                response = http_client.request(request_type, webhook_url, headers=headers, data=request_payload, timeout=timeout)
         
         elif request_type in ['get',]:
             url = webhook_url
-            response = getattr(session, request_type)(url, params=query_params, timeout=timeout)
+            response = http_client.request(request_type, url, headers=headers, params=query_params, timeout=timeout)
     
     except (requests.exceptions.Timeout) as timeoutexc:
         logger.critical(f"Timeout Exception: {timeoutexc}")
@@ -771,7 +754,7 @@ def send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type='POST',
     
     try:
         # Now parse the incoming response
-        _ = parse_response(room_id, bot_id, owner_id, bot_type, content=content, response_template=response_template)
+        _ = parse_response(room_id, bot_id, owner_id, bot_type, content=content, response_template=response_template, session_variables=session_variables)
         parsed_status = True
     except Exception as ex:
         parsed_status = False
@@ -780,11 +763,17 @@ def send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type='POST',
     return response, parsed_status
 
 
-def process_webhook_node(room_id, bot_id, bot_component_response, owner_id, bot_type='website'):
+def is_blocking_webhook(bot_component_response):
+    """Returns True if the WEBHOOK node must wait for the response before routing
+    """
+    response_template = bot_component_response.get('responseBody') if bot_component_response.get('customize' + 'responseBody') == True else None
+    return (bot_component_response.get('blocking', True) == True) or (response_template not in ({}, None,))
+
+
+def process_webhook_node(room_id, bot_id, bot_component_response, owner_id, bot_type='website', session_variables=None):
     # Send to the webhook URI
     webhook_url = bot_component_response.get('webhookUrl')
     request_type = bot_component_response.get('requestType')
-    is_blocking_component = bot_component_response.get('blocking', True)
     router = bot_component_response.get('routing', {})
     try:
         timeout = float(bot_component_response.get('timeout', WEBHOOK_TIMEOUT))
@@ -799,8 +788,8 @@ def process_webhook_node(room_id, bot_id, bot_component_response, owner_id, bot_
     parsed_status = None
     response = None
     
-    if (is_blocking_component == True) or (response_template not in ({}, None,)):
-        response, parsed_status = send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type=request_type, request_headers=request_headers, query_params=query_params, request_payload=request_payload, response_template=response_template, timeout=timeout, bot_type=bot_type)
+    if is_blocking_webhook(bot_component_response):
+        response, parsed_status = send_to_webhook(room_id, bot_id, owner_id, webhook_url, request_type=request_type, request_headers=request_headers, query_params=query_params, request_payload=request_payload, response_template=response_template, timeout=timeout, bot_type=bot_type, session_variables=session_variables)
         try:
             code = response.status_code
             content = response.content
@@ -839,23 +828,6 @@ def process_webhook_node(room_id, bot_id, bot_component_response, owner_id, bot_
     return None, None
 
 
-def variable_typecast(variable, variable_type):
-    if variable_type == 'string':
-        variable = "\"" + variable + "\""
-    elif variable_type == 'datetime':
-        if len(variable.split()) > 1:
-            variable = f"datetime.datetime.strptime(\"{variable}\", '%d-%m-%Y %H:%M:%S')"
-        else:
-            variable = f"datetime.datetime.strptime(\"{variable}\", '%d-%m-%Y')"
-    elif variable_type == 'int':
-        variable = str(int(variable))
-    elif variable_type == 'float':
-        variable = str(float(variable))
-    elif variable_type == 'bool':
-        variable = str(bool(variable))
-    return variable
-
-
 def cast_expression(expression_value, expression_type):
     if expression_type == 'datetime':
         try:
@@ -867,64 +839,47 @@ def cast_expression(expression_value, expression_type):
     return expression_value
 
 
+def evaluate_set_variable_expression(bot_component_response, session_variables):
+    """Evaluates the compiled expression of a SET_VARIABLE_BETA node against `session_variables`.
+
+    Returns:
+        The casted value of the expression
+
+    Raises:
+        ValueError: If the expression evaluates to None
+    """
+    variable_type = bot_component_response.get('variableType', 'string')
+    expression = bot_component_response.get('expression')
+
+    if expression is None:
+        # Bot was published before expressions were compiled
+        _, expression = BotJSONParser().compile_set_variable_expression(bot_component_response.get('value', ''))
+        bot_component_response['expression'] = expression
+
+    expression_value = None
+
+    try:
+        expression_value = evaluate_expression(expression, session_variables, variable_type)
+    except Exception as ex:
+        logger.critical(f"Exception during set variable: {ex}")
+    
+    logger.info(f"After variable set, value = {expression_value}")
+    
+    if expression_value is None:
+        raise ValueError(f"Expression is None")
+    
+    return cast_expression(expression_value, variable_type)
+
+
 def parse_set_variable_expression(room_id, bot_id, bot_component_response, owner_id, bot_type='website'):
     variable = bot_component_response.get('variable')
-    variable_type = bot_component_response.get('variableType', 'string')
-    tokens = bot_component_response.get('tokens', [])
     router = bot_component_response.get('routing', {})
 
     try:
         _, session_variables = fetch_variables_from_redis(room_id, override=True, bot_type=bot_type)
 
-        expression_value = None
-        
-        expression_string = "expression_value="
-
-        for token in tokens:
-            if (token['type'] != "IDENTIFIER"):
-                if token['type'] == 'STRING':
-                    value = token['value'].replace("'", "\"")
-                    expression_string += value
-                elif token['type'] == 'DATE':
-                    if len(token['value'].split()) > 1:
-                        value = f"datetime.datetime.strptime({token['value']}, '%d-%m-%Y %H:%M:%S')"
-                    else:
-                        value = f"datetime.datetime.strptime({token['value']}, '%d-%m-%Y')"
-                    expression_string += value
-                elif token['type'] == 'TIME':
-                    # datetime object can also be of the form: 2 days, 12:40:00
-                    tmp = token['value'].split(",", 1)
-                    if len(tmp) == 2:
-                        days = int(tmp[0].split()[0])
-                        hours, minutes, seconds = (int(i) for i in tmp[1].split(":"))
-                    else:
-                        days = 0
-                        hours, minutes, seconds = (int(i) for i in token['value'].split(":"))
-                    value = f"datetime.timedelta(days={days}, hours={hours}, minutes={minutes}, seconds={seconds})"
-                    expression_string += value
-                else:
-                    expression_string += token['value']
-            else:
-                value = variable_typecast(session_variables.get(token['value']), variable_type)
-                expression_string += value
-        
-        try:
-            local_namespace = {}
-            if variable_type == 'datetime':
-                expression_string = 'import datetime;' + expression_string
-            exec(expression_string, {}, local_namespace)
-            expression_value = local_namespace['expression_value']
-        except Exception as ex:
-            logger.critical(f"Exception during set variable: {ex}")
-        
-        logger.info(f"Expression string: {expression_string}")
-        logger.info(f"After variable set, value = {expression_value}")
-        
-        if expression_value is not None:
-            expression_value = cast_expression(expression_value, variable_type)
-            set_session_variable(room_id, variable, expression_value, bot_type="website")
-        else:
-            raise ValueError(f"Expression is None")
+        expression_value = evaluate_set_variable_expression(bot_component_response, session_variables)
+        set_session_variable(room_id, variable, expression_value, bot_type="website")
 
         target_id = router.get('success')
         
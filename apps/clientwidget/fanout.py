@@ -0,0 +1,136 @@
+"""
+clientwidget/fanout.py
+
+Sends one event to several channel layer groups at once.
+
+A chat message goes to the room, the owner, and the teams / operators of the room. With `group_send()`, that's
+one round trip to read the members of each group, another one to push the event, and a serialization of the event
+per group.
+
+`group_send_many()` reads the members of every group in one round trip per Redis host, and pushes the event to all
+of their channels with one script per host. The event is serialized once per channel key. With daphne, every
+process has a single key for all of its sockets, so that's once per process instead of once per group and process.
+A channel which is in several of the groups gets the event once.
+
+Layers other than `channels_redis` (e.g. the in-memory layer of the tests) fall back to a `group_send()` per group.
+"""
+
+import collections
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels_redis.core import RedisChannelLayer
+
+from .exceptions import logger
+
+# Members of every group in KEYS, after dropping the expired ones (ARGV[1] is the oldest score to keep)
+GROUP_MEMBERS_SCRIPT = """
+local members = {}
+for i = 1, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, ARGV[1])
+    for _, channel in ipairs(redis.call('ZRANGE', KEYS[i], 0, -1)) do
+        members[#members + 1] = channel
+    end
+end
+return members
+"""
+
+# Same as the script of `RedisChannelLayer.group_send()`, with the expiry in the last ARGV
+SEND_SCRIPT = """
+local over_capacity = 0
+local expiry = tonumber(ARGV[#ARGV])
+for i = 1, #KEYS do
+    if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS]) then
+        redis.call('LPUSH', KEYS[i], ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+def unique_groups(groups):
+    """Drops the empty and repeated group names, keeping the order"""
+    return list(dict.fromkeys(str(group) for group in groups if group is not None and str(group) != ''))
+
+
+async def get_group_channels(channel_layer, groups):
+    """Channel names in any of `groups`, without repetitions"""
+    host_groups = collections.defaultdict(list)
+    for group in groups:
+        assert channel_layer.valid_group_name(group), "Group name not valid"
+        host_groups[channel_layer.consistent_hash(group)].append(group)
+
+    oldest = int(time.time()) - channel_layer.group_expiry
+    channel_names = {}
+    for index, names in host_groups.items():
+        async with channel_layer.connection(index) as connection:
+            members = await connection.eval(GROUP_MEMBERS_SCRIPT, keys=[channel_layer._group_key(group) for group in names], args=[oldest])
+        for member in members:
+            channel_names[member.decode('utf8')] = True
+    return list(channel_names)
+
+
+async def group_send_many(channel_layer, groups, message):
+    """Sends `message` to every channel of `groups`"""
+    groups = unique_groups(groups)
+    if len(groups) == 0:
+        return
+
+    if not isinstance(channel_layer, RedisChannelLayer):
+        for group in groups:
+            await channel_layer.group_send(group, message)
+        return
+
+    channel_names = await get_group_channels(channel_layer, groups)
+    if len(channel_names) == 0:
+        return
+
+    connection_to_channel_keys, channel_keys_to_message, channel_keys_to_capacity = channel_layer._map_channel_keys_to_connection(channel_names, message)
+    for index, channel_keys in connection_to_channel_keys.items():
+        args = [channel_keys_to_message[key] for key in channel_keys] + [channel_keys_to_capacity[key] for key in channel_keys] + [channel_layer.expiry]
+        async with channel_layer.connection(index) as connection:
+            over_capacity = await connection.eval(SEND_SCRIPT, keys=channel_keys, args=args)
+        if over_capacity > 0:
+            logger.warning(f"{over_capacity} of {len(channel_keys)} channel keys over capacity, for the groups {groups}")
+
+
+def send_to_groups(groups, message, channel_layer=None):
+    """Sync version of `group_send_many()`. Uses the default channel layer if `channel_layer` isn't given"""
+    if channel_layer is None:
+        channel_layer = get_channel_layer()
+    async_to_sync(group_send_many)(channel_layer, groups, message)
+
+
+def get_operator_groups(room_id, owner_id, team_format, operator_format='{operator}', operators=None):
+    """Groups of the operators of a room: one per team of the room if it's assigned to teams, else one per operator
+    (`operators`, or the operators mapped to the room).
+
+    `team_format` and `operator_format` are formatted with `owner_id` and `team` / `operator`
+    """
+    from . import operator_map, room_state
+
+    teams = room_state.get_room_field(room_id, room_state.TEAM)
+    if teams is None and operators is None:
+        operators = operator_map.get_room_operators(room_id)
+    return operator_groups(owner_id, teams, operators, team_format, operator_format)
+
+
+def operator_groups(owner_id, teams, operators, team_format, operator_format='{operator}'):
+    """`get_operator_groups()`, with the teams and the operators of the room already read"""
+    if teams is not None:
+        return [team_format.format(owner_id=owner_id, team=team.replace(" ", "")) for team in teams]
+    return [operator_format.format(operator=operator) for operator in operators]
+
+
+def chat_groups(room_id, owner_id, teams, operators):
+    """`get_chat_groups()`, with the teams and the operators of the room already read"""
+    return [str(room_id), str(owner_id)] + operator_groups(owner_id, teams, operators, 'operator_team_{owner_id}_{team}')
+
+
+def get_chat_groups(room_id, owner_id):
+    """Groups which get the chat messages of a room: the room, the owner (admin sockets) and the operators"""
+    return [str(room_id), str(owner_id)] + get_operator_groups(room_id, owner_id, 'operator_team_{owner_id}_{team}')
@@ -0,0 +1,193 @@
+"""
+clientwidget/flow.py
+
+Executes the automatic nodes of a bot flow (SET_VARIABLE, GOAL, SET_VARIABLE_BETA and WEBHOOK),
+starting from a `target_id`, until we reach the next node which needs input from the user.
+
+Variable updates are buffered in memory, and written back to Redis once, in a single pipeline.
+"""
+
+from decouple import UndefinedValueError, config
+
+from . import events, room_state
+from .exceptions import logger
+
+# Upper bound on the number of automatic nodes executed for a single message
+try:
+    MAX_FLOW_HOPS = int(config('MAX_FLOW_HOPS'))
+except UndefinedValueError:
+    MAX_FLOW_HOPS = 50
+
+AUTOMATIC_NODES = ('SET_VARIABLE', 'GOAL', 'SET_VARIABLE_BETA', 'WEBHOOK',)
+
+
+class SessionVariables(dict):
+    """A dictionary of session variables which keeps track of the modified keys
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+
+class BotFlowExecutor():
+    """Walks the automatic nodes of a `BotGraph` iteratively.
+
+    Usage:
+        executor = BotFlowExecutor(graph, room_id, lead_check=consumer.check_if_lead)
+        node = executor.run(target_id)
+        executor.commit()
+
+    Args:
+        graph (BotGraph): The compiled bot graph
+        room_id (uuid.UUID | str): The room for this session
+        bot_type (str, optional): The bot type. Defaults to 'website'.
+        variables (dict, optional): The current session variables. If None, they're lazily fetched from Redis.
+        lead_check (callable, optional): Called as `lead_check(variable, value)` for every variable set. Returns True if the visitor is now a lead.
+        max_hops (int, optional): Maximum number of automatic nodes to walk through.
+        defer_webhooks (bool, optional): Stop at blocking WEBHOOK nodes instead of sending them, leaving the node in
+            `self.webhook_node`, for the caller to run it off its thread (see `webhooks`). Defaults to False.
+    """
+
+    def __init__(self, graph, room_id, bot_type='website', variables=None, lead_check=None, max_hops=MAX_FLOW_HOPS, defer_webhooks=False):
+        self.graph = graph
+        self.room_id = str(room_id) if room_id is not None else None
+        self.bot_type = bot_type
+        self.variables = SessionVariables(variables) if variables is not None else None
+        self.lead_check = lead_check
+        self.max_hops = max_hops
+        self.defer_webhooks = defer_webhooks
+        self.webhook_node = None
+        self.is_lead = False
+        self.ended = False
+        self.target_id = None
+        self.last_id = None
+        self.hops = 0
+
+
+    def load_variables(self):
+        if self.variables is None:
+            variables = None
+            if self.room_id is not None:
+                variables = room_state.get_variables(self.room_id)
+            self.variables = SessionVariables(variables if isinstance(variables, dict) else {})
+        return self.variables
+
+
+    def set_variable(self, variable, value):
+        self.load_variables()[variable] = value
+        if self.lead_check is not None and self.lead_check(variable, value):
+            self.is_lead = True
+
+
+    @property
+    def is_dirty(self):
+        return self.is_lead or (self.variables is not None and len(self.variables.dirty) > 0)
+
+
+    def commit(self):
+        """Writes back the buffered variable updates (and the lead flag) to Redis, in one round trip
+        """
+        if self.room_id is None or not self.is_dirty:
+            return
+
+        fields = {}
+        if self.variables is not None and len(self.variables.dirty) > 0:
+            # Only the modified variables are written back
+            fields.update(room_state.variable_fields({variable: self.variables[variable] for variable in self.variables.dirty}))
+        if self.is_lead:
+            fields[room_state.IS_LEAD] = True
+        room_state.set_room_fields(self.room_id, fields)
+
+        if self.variables is not None:
+            self.variables.dirty.clear()
+
+
+    def step(self, node):
+        """Executes a single automatic node, and returns the `target_id` of the next node
+        """
+        node_type = node.get('nodeType')
+
+        if node_type == 'SET_VARIABLE':
+            for variable_node in node.get('variableList', []):
+                self.set_variable(variable_node['variable'], variable_node.get('value', ''))
+            return node.get('targetId')
+
+        elif node_type == 'GOAL':
+            self.set_variable(node['variable'], node.get('value', 'true'))
+            return node.get('targetId')
+
+        elif node_type == 'SET_VARIABLE_BETA':
+            router = node.get('routing', {})
+            try:
+                value = events.evaluate_set_variable_expression(node, self.load_variables())
+            except Exception as ex:
+                logger.critical(f"Exception with Set Variable: {ex}")
+                return router.get('error', None)
+            self.set_variable(node.get('variable'), value)
+            return router.get('success')
+
+        elif node_type == 'WEBHOOK':
+            if events.is_blocking_webhook(node):
+                # The response is parsed directly into our buffered variables
+                target_id, _ = events.process_webhook_node(
+                    self.room_id, self.graph.bot_id, node, self.graph.owner_id,
+                    bot_type=self.bot_type, session_variables=self.load_variables(),
+                )
+            else:
+                # The request runs in the background and reads the variables from Redis
+                self.commit()
+                target_id, _ = events.process_webhook_node(self.room_id, self.graph.bot_id, node, self.graph.owner_id, bot_type=self.bot_type)
+            return target_id
+
+        raise ValueError(f"{node_type} is not an automatic node")
+
+
+    def run(self, target_id):
+        """Runs the flow from `target_id` up to the next interactive node.
+
+        Returns:
+            dict: A copy of the next interactive node. This is None if the flow ended (`self.ended` is set),
+            if a node doesn't exist, if we exceeded the hop limit, or if we stopped at a deferred WEBHOOK node
+            (`self.webhook_node` is set, and `self.target_id` is its id).
+        """
+        while True:
+            node = self.graph.get_node(target_id)
+            if node is None:
+                logger.warning(f"No such node {target_id} in bot {self.graph.bot_id}")
+                return None
+
+            self.last_id = target_id
+
+            if node.get('nodeType') not in AUTOMATIC_NODES:
+                self.target_id = target_id
+                return node
+
+            if self.hops >= self.max_hops:
+                logger.critical(f"Exceeded {self.max_hops} automatic nodes on bot {self.graph.bot_id}. Possible cycle at {target_id}")
+                return None
+
+            self.hops += 1
+
+            if self.defer_webhooks and node.get('nodeType') == 'WEBHOOK' and events.is_blocking_webhook(node):
+                # The webhook reads the variables from Redis
+                self.commit()
+                self.target_id = target_id
+                self.webhook_node = node
+                return None
+
+            try:
+                target_id = self.step(node)
+            except Exception as ex:
+                logger.critical(f"Exception during {node.get('nodeType')} component: {ex}")
+                self.target_id = self.last_id
+                return node
+
+            if target_id in (None, '', 'END'):
+                self.ended = True
+                return None
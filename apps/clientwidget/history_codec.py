@@ -0,0 +1,123 @@
+"""
+clientwidget/history_codec.py
+
+Encoding of the entries of the session history (`HISTORY_{room_id}`).
+
+Every entry starts with a version byte, which tells the reader how to decode the rest:
+
+    0x01 -> msgpack, with the envelope keys (`user`, `time`, `room_id`, ...) replaced by their index in `ENVELOPE_KEYS`
+    0x02 -> Same as 0x01, but zlib compressed. Only used for entries larger than `HISTORY_COMPRESS_THRESHOLD`
+
+Entries written before the codec existed are plain JSON, and always start with `{` (or `[` / `"`), so they're still decoded.
+
+The codec used for writing is picked with `HISTORY_CODEC` (json | msgpack | msgpack_zlib), and defaults to json, which
+every reader understands. Only switch it to msgpack / msgpack_zlib once every process (web, workers, celery) runs a reader
+which knows the versioned entries. Otherwise, a process still on the old reader can't decode them during a rolling deploy.
+"""
+
+import json
+import zlib
+
+from decouple import UndefinedValueError, config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    HISTORY_CODEC = str(config('HISTORY_CODEC'))
+except UndefinedValueError:
+    HISTORY_CODEC = 'json'
+
+# Entries larger than this (in bytes) are compressed by the msgpack_zlib codec
+try:
+    HISTORY_COMPRESS_THRESHOLD = int(config('HISTORY_COMPRESS_THRESHOLD'))
+except UndefinedValueError:
+    HISTORY_COMPRESS_THRESHOLD = 512
+
+MSGPACK_VERSION = b'\x01'
+MSGPACK_ZLIB_VERSION = b'\x02'
+
+# Keys repeated in every message envelope. NEVER reorder this list: only append to it,
+# since the stored entries refer to the keys by their index
+ENVELOPE_KEYS = (
+    'user', 'message', 'time', 'room_id', 'room_name', 'owner_id', 'first_name', 'last_name', 'email', 'data',
+    'type', 'bot_id', 'target_id', 'variables', 'nodeType', 'messages', 'targetId', 'variable', 'variableType',
+    'buttons', 'text', 'userInputVal', 'secret', 'post_data',
+)
+ENVELOPE_INDEX = {key: index for index, key in enumerate(ENVELOPE_KEYS)}
+
+
+def compact(value):
+    """Replaces the envelope keys of a message (and of its `data` / `message` objects) with their indices
+    """
+    if not isinstance(value, dict):
+        return value
+    return {ENVELOPE_INDEX.get(key, key): compact(item) if key in ('data', 'message') else item for key, item in value.items()}
+
+
+def expand(value):
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, item in value.items():
+        if isinstance(key, int):
+            key = ENVELOPE_KEYS[key]
+        result[key] = expand(item) if key in ('data', 'message') else item
+    return result
+
+
+class JSONCodec():
+    name = 'json'
+
+    def encode(self, entry):
+        return json.dumps(entry)
+
+
+class MsgpackCodec():
+    name = 'msgpack'
+
+    def __init__(self, compress_threshold=None):
+        self.compress_threshold = compress_threshold
+
+    def encode(self, entry):
+        content = msgpack.packb(compact(entry), use_bin_type=True)
+        if self.compress_threshold is not None and len(content) > self.compress_threshold:
+            return MSGPACK_ZLIB_VERSION + zlib.compress(content)
+        return MSGPACK_VERSION + content
+
+
+def get_codec(name=HISTORY_CODEC):
+    if name == 'json' or msgpack is None:
+        return JSONCodec()
+    if name == 'msgpack':
+        return MsgpackCodec()
+    if name == 'msgpack_zlib':
+        return MsgpackCodec(compress_threshold=HISTORY_COMPRESS_THRESHOLD)
+    raise ValueError(f"Unknown history codec {name}")
+
+
+history_codec = get_codec()
+
+
+def encode_entry(entry):
+    return history_codec.encode(entry)
+
+
+def decode_entry(content):
+    """Decodes a single history entry, written by any version of the codec
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    version = content[:1]
+    if version == MSGPACK_VERSION:
+        return expand(msgpack.unpackb(content[1:], raw=False, strict_map_key=False))
+    if version == MSGPACK_ZLIB_VERSION:
+        return expand(msgpack.unpackb(zlib.decompress(content[1:]), raw=False, strict_map_key=False))
+    # Legacy JSON entry
+    return json.loads(content)
+
+
+def decode_entries(entries):
+    return [decode_entry(content) for content in entries]
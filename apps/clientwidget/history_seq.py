@@ -0,0 +1,168 @@
+"""
+clientwidget/history_seq.py
+
+Sequence numbers of the messages of a room, across the session history in Redis and `ChatMessage` in the DB.
+
+    HISTORY_SEQ_{room_id} -> seq of the last message of the room, in Redis or in the DB
+
+The messages in the DB have their `ChatMessage.seq`. The session history (`HISTORY_{room_id}`) is a plain list, so
+the seq of an entry comes from its position: the last entry has seq `HISTORY_SEQ_{room_id}`, and the ones before it
+count down from there. `events.append_msg_to_redis()` pushes the entries and moves the sequence in the same
+transaction. When the session is flushed, its messages are appended after the last seq in the DB, so they keep
+the seq they had in Redis.
+
+The sequence is moved up to the last seq in the DB whenever the session history is empty (`sync_sequence()`):
+when a session starts, and after messages are appended to the DB directly. That covers the rooms which had messages
+before the sequence existed, and an expired sequence. If the sequence is missing while there's a session history
+(it expired during a long session), it's seeded as the last seq in the DB + the length of the session history.
+
+`fetch_history_after()` returns the messages after a given seq, from the DB and then from Redis. A reconnecting
+widget only fetches what it missed, instead of the whole history.
+"""
+
+from decouple import UndefinedValueError, config
+from django.core.cache import cache
+from django.db import transaction
+
+from . import archive
+from .exceptions import logger
+from .history_codec import decode_entries
+
+try:
+    HISTORY_SEQ_TIMEOUT = int(config('HISTORY_SEQ_TIMEOUT'))
+except UndefinedValueError:
+    HISTORY_SEQ_TIMEOUT = 30 * 24 * 60 * 60
+
+# Page size of `fetch_history_after()`, if none is given
+try:
+    HISTORY_PAGE_SIZE = int(config('HISTORY_PAGE_SIZE'))
+except UndefinedValueError:
+    HISTORY_PAGE_SIZE = 200
+
+# Moves the sequence up to ARGV[1] (the last seq in the DB) if the session history is empty. If it isn't, only
+# seeds a missing sequence, after the entries of the session history. Returns 1 if it was moved
+SYNC_SCRIPT = """
+local length = redis.call('LLEN', KEYS[2])
+local value = redis.call('GET', KEYS[1])
+if length > 0 then
+    if value then
+        return 0
+    end
+    redis.call('SET', KEYS[1], tonumber(ARGV[1]) + length, 'EX', ARGV[2])
+    return 1
+end
+local current = tonumber(value or '-1')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Returns {seq of the first entry, seq of the last entry, entries with seq > ARGV[1]}. At most ARGV[2] entries, if it's positive
+RANGE_SCRIPT = """
+local last = tonumber(redis.call('GET', KEYS[2]) or '0')
+local length = redis.call('LLEN', KEYS[1])
+local first = last - length + 1
+local start = math.max(tonumber(ARGV[1]) - first + 1, 0)
+local stop = -1
+if tonumber(ARGV[2]) > 0 then
+    stop = start + tonumber(ARGV[2]) - 1
+end
+return {first, last, redis.call('LRANGE', KEYS[1], start, stop)}
+"""
+
+scripts = {}
+
+
+def get_script(REDIS_CONNECTION, name, script):
+    if name not in scripts:
+        scripts[name] = REDIS_CONNECTION.register_script(script)
+    return scripts[name]
+
+
+def seq_key(room_id):
+    return cache.make_key(f"HISTORY_SEQ_{room_id}")
+
+
+def history_key(room_id):
+    return cache.make_key(f"HISTORY_{room_id}")
+
+
+def get_sequence(room_id):
+    value = cache.get_client('').get(seq_key(room_id))
+    return None if value is None else int(value)
+
+
+def sync_sequence(room_id, last_seq):
+    """Moves the sequence of the room up to `last_seq` (the last seq in the DB), if there's no session history.
+    If there is, a missing sequence is seeded after its entries. Returns `True` if it was moved
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    sync = get_script(REDIS_CONNECTION, 'sync', SYNC_SCRIPT)
+    return sync(keys=[seq_key(room_id), history_key(room_id)], args=[int(last_seq), HISTORY_SEQ_TIMEOUT], client=REDIS_CONNECTION) == 1
+
+
+def sync_sequence_on_commit(room_id, last_seq, db_label='default'):
+    """`sync_sequence()` once the current transaction on `db_label` commits"""
+    def sync():
+        try:
+            sync_sequence(room_id, last_seq)
+        except Exception as ex:
+            logger.warning(f"Couldn't sync the message sequence of room {room_id}: {ex}")
+    transaction.on_commit(sync, using=db_label)
+
+
+def with_seq(seq, message):
+    if isinstance(message, dict):
+        return {**message, 'seq': seq}
+    return {'message': message, 'seq': seq}
+
+
+def fetch_redis_history_after(room_id, after=0, num_msgs=None):
+    """Fetches the session history entries with seq > `after`
+
+    Returns:
+        tuple: (seq of the first entry in Redis, [(seq, message)]). The first seq is None if there's no session history
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    fetch = get_script(REDIS_CONNECTION, 'range', RANGE_SCRIPT)
+    first, last, entries = fetch(keys=[history_key(room_id), seq_key(room_id)], args=[int(after), num_msgs or 0], client=REDIS_CONNECTION)
+    if first > last:
+        return None, []
+    return first, list(zip(range(max(first, int(after) + 1), last + 1), decode_entries(entries)))
+
+
+def fetch_history_after(room, after=0, num_msgs=HISTORY_PAGE_SIZE, db_label='default', recent=False):
+    """Fetches a page of the messages of `room` (a `ChatRoom`) with seq > `after`: the ones in the DB, followed by
+    the ones in the session history. Each message gets its `seq`.
+
+    Args:
+        recent (bool, optional): Only the recent history (`seq >= ChatRoom.recent_seq`), for the visitor. Defaults to False.
+
+    Returns:
+        tuple: (messages, has_more). If `has_more` is set, the next page starts after the seq of the last message
+    """
+    from .models import ChatMessage
+
+    after = max(int(after), 0)
+    if recent == True:
+        after = max(after, room.recent_seq - 1)
+    limit = None if num_msgs is None else num_msgs + 1
+
+    # Redis first: a session flushed in between is then still found in the DB
+    first_session_seq, session = fetch_redis_history_after(room.room_id, after, limit)
+
+    if room.archived_seq > after:
+        archive.ensure_rehydrated(room, db_label)
+    rows = ChatMessage.objects.using(db_label).filter(room_id=room.room_id, seq__gt=after)
+    if first_session_seq is not None:
+        rows = rows.filter(seq__lt=first_session_seq)
+    rows = rows.order_by('seq').values_list('seq', 'content')
+    if limit is not None:
+        rows = rows[:limit]
+
+    messages = [with_seq(seq, content) for seq, content in rows] + [with_seq(seq, message) for seq, message in session]
+    if num_msgs is not None and len(messages) > num_msgs:
+        return messages[:num_msgs], True
+    return messages, False
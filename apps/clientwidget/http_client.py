@@ -0,0 +1,168 @@
+"""
+clientwidget/http_client.py
+
+The shared HTTP client of the outbound integrations: webhook nodes, the WhatsApp agent takeover, the Google Sheets
+export, CSV fetches, ...
+
+Every process has one `requests.Session`, with a pool of up to `HTTP_POOL_MAXSIZE` keep-alive connections per host
+(for up to `HTTP_POOL_CONNECTIONS` hosts). A request to a host we've talked to recently reuses an open connection,
+instead of paying for DNS, TCP and TLS again. The session is recreated after a fork (celery workers), so processes
+never share sockets.
+
+Don't set headers / auth on the session. Pass them per request, since it's shared by every integration. For the
+same reason, the session never stores cookies: a cookie set by the webhook of one bot would be sent on the requests
+of every other bot to that host.
+
+Requests without a timeout get (`HTTP_CONNECT_TIMEOUT`, `HTTP_READ_TIMEOUT`).
+
+The requests and new connections of every host are counted by the urllib3 pools. Every process writes them to
+`HTTP_CLIENT_STATS` at most once every `HTTP_CLIENT_STATS_INTERVAL` seconds, after a request.
+Use `python manage.py http_client_stats` to see the reuse rates.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from decouple import UndefinedValueError, config
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from .exceptions import logger
+
+# Hosts with a connection pool. The least recently used pool is closed beyond that
+try:
+    HTTP_POOL_CONNECTIONS = int(config('HTTP_POOL_CONNECTIONS'))
+except UndefinedValueError:
+    HTTP_POOL_CONNECTIONS = 50
+
+# Open connections kept per host. Should be at least the webhook workers (`webhooks.WEBHOOK_WORKERS`)
+try:
+    HTTP_POOL_MAXSIZE = int(config('HTTP_POOL_MAXSIZE'))
+except UndefinedValueError:
+    HTTP_POOL_MAXSIZE = 20
+
+try:
+    HTTP_CONNECT_TIMEOUT = float(config('HTTP_CONNECT_TIMEOUT'))
+except UndefinedValueError:
+    HTTP_CONNECT_TIMEOUT = 3.05
+
+try:
+    HTTP_READ_TIMEOUT = float(config('HTTP_READ_TIMEOUT'))
+except UndefinedValueError:
+    HTTP_READ_TIMEOUT = 20
+
+HTTP_CLIENT_STATS = 'HTTP_CLIENT_STATS'
+HTTP_CLIENT_STATS_INTERVAL = 60
+
+session = None
+session_pid = None
+session_lock = threading.Lock()
+
+# Counters of the pools which were closed, per host
+closed_pools = {}
+last_published = 0
+
+
+def host_name(pool):
+    return f"{pool.scheme}://{pool.host}:{pool.port}"
+
+
+def add_counters(counters, num_requests, num_connections):
+    counters['requests'] = counters.get('requests', 0) + num_requests
+    counters['connections'] = counters.get('connections', 0) + num_connections
+
+
+def retire_pool(pool):
+    """Keeps the counters of a pool which the pool manager is closing"""
+    try:
+        add_counters(closed_pools.setdefault(host_name(pool), {}), pool.num_requests, pool.num_connections)
+    finally:
+        pool.close()
+
+
+def create_session():
+    new_session = requests.Session()
+    # No cookies are kept between requests
+    new_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    for prefix in ('http://', 'https://'):
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+        adapter.poolmanager.pools.dispose_func = retire_pool
+        new_session.mount(prefix, adapter)
+    new_session.hooks['response'].append(after_response)
+    return new_session
+
+
+def get_session():
+    """Returns the `requests.Session` of this process"""
+    global session, session_pid
+    if session_pid != os.getpid():
+        with session_lock:
+            if session_pid != os.getpid():
+                closed_pools.clear()
+                session = create_session()
+                session_pid = os.getpid()
+    return session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """`requests.request()` on the shared session"""
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('get', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('post', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('put', url, **kwargs)
+
+
+def stats():
+    """Returns {host: {'requests', 'connections', 'reused', 'reuse_rate'}} for this process. `connections` is the
+    number of new connections
+    """
+    counters = {host: dict(host_counters) for host, host_counters in closed_pools.items()}
+    if session is not None and session_pid == os.getpid():
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    add_counters(counters.setdefault(host_name(pool), {}), pool.num_requests, pool.num_connections)
+
+    for host_counters in counters.values():
+        host_counters['reused'] = max(host_counters['requests'] - host_counters['connections'], 0)
+        host_counters['reuse_rate'] = round(host_counters['reused'] / host_counters['requests'], 4) if host_counters['requests'] > 0 else None
+    return counters
+
+
+def publish_stats(REDIS_CONNECTION):
+    field = f"{socket.gethostname()}:{os.getpid()}"
+    key = cache.make_key(HTTP_CLIENT_STATS)
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        pipe.hset(key, field, json.dumps(stats()))
+        pipe.expire(key, 5 * HTTP_CLIENT_STATS_INTERVAL)
+        pipe.execute()
+
+
+def after_response(response, *args, **kwargs):
+    """Response hook of the session. Publishes the stats of this process, if they're due"""
+    global last_published
+    if time.monotonic() - last_published < HTTP_CLIENT_STATS_INTERVAL:
+        return
+    last_published = time.monotonic()
+    try:
+        publish_stats(cache.get_client(''))
+    except Exception as ex:
+        logger.warning(f"Couldn't publish the HTTP client stats: {ex}")
@@ -0,0 +1,87 @@
+"""
+clientwidget/listing_updates.py
+
+Coalescing of the `listing_channel_event`s sent to a listing socket (`LongPollingConsumer`).
+
+Every `ChatRoom.save(send_update=True)` sends the full state of the room to the listings of the owner, teams and
+operators. A busy dashboard gets one event per state change of every room. With `LISTING_UPDATE_WINDOW` (in ms) set,
+each listing socket keeps the events it got over a window, merged per room, and then sends:
+
+* one event per room which changed, with only the fields that differ from what this socket last sent for the room
+  (plus `ALWAYS_SENT`, and `'partial': True` if any field was left out)
+* nothing for rooms that ended up in the state they were in before the window
+
+Events without a `room_id` (e.g. the ones with a `payload`) are sent right away, as before.
+
+Coalescing needs the async listing consumer (`ASYNC_CONSUMERS` containing "listing"), which can wait for the
+window without holding a worker thread. The sync consumer sends every event as it comes.
+"""
+
+import collections
+
+from decouple import UndefinedValueError, config
+
+try:
+    LISTING_UPDATE_WINDOW = int(config('LISTING_UPDATE_WINDOW'))
+except UndefinedValueError:
+    LISTING_UPDATE_WINDOW = 0
+
+# Rooms whose last sent state is remembered, per socket. Older rooms get their full state again
+LISTING_STATE_MAXSIZE = 5000
+
+ALWAYS_SENT = ('type', 'room_id')
+
+
+class ListingCoalescer:
+    """Merges the listing events of a socket per room, until `drain()`"""
+
+    def __init__(self, maxsize=LISTING_STATE_MAXSIZE):
+        self.maxsize = maxsize
+        self.pending = collections.OrderedDict()
+        self.sent = collections.OrderedDict()
+        self.received_events = 0
+        self.sent_events = 0
+
+    def add(self, event):
+        """Adds an event. Returns `True` if it's the first one pending, in which case a `drain()` is due after the window"""
+        self.received_events += 1
+        room_id = event['room_id']
+        was_empty = len(self.pending) == 0
+        if room_id in self.pending:
+            # Later fields supersede the earlier ones
+            self.pending[room_id].update(event)
+        else:
+            self.pending[room_id] = dict(event)
+        return was_empty
+
+    def diff(self, room_id, state):
+        """The fields of `state` which differ from the last sent state of the room, or `None` if none do"""
+        previous = self.sent.get(room_id)
+        if previous is None:
+            return dict(state)
+        changed = {field: value for field, value in state.items() if field not in previous or previous[field] != value}
+        if len(changed) == 0:
+            return None
+        payload = {field: state[field] for field in ALWAYS_SENT if field in state}
+        payload.update(changed)
+        if len(payload) < len(state):
+            payload['partial'] = True
+        return payload
+
+    def drain(self):
+        """Returns the events to send for the pending rooms, and forgets them"""
+        events = []
+        for room_id, state in self.pending.items():
+            payload = self.diff(room_id, state)
+            if payload is None:
+                continue
+            previous = self.sent.pop(room_id, {})
+            previous.update(state)
+            self.sent[room_id] = previous
+            events.append(payload)
+        self.pending.clear()
+
+        while len(self.sent) > self.maxsize:
+            self.sent.popitem(last=False)
+        self.sent_events += len(events)
+        return events
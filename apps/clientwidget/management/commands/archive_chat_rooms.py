@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from apps.clientwidget import archive, tenants
+
+
+class Command(BaseCommand):
+    help = 'Moves the message history of old, inactive rooms into the archive tier, or rehydrates a single room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases', help='DB label to archive. Defaults to every DB label in use')
+        parser.add_argument('--days', type=int, default=archive.CHAT_ARCHIVE_AFTER_DAYS, help='Archive the rooms created more than these many days ago')
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of rooms to archive per DB label')
+        parser.add_argument('--rehydrate', metavar='ROOM_ID', default=None, help='Move the archived messages of this room back into the DB instead')
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or tenants.get_db_labels()
+        for db_name in databases:
+            if options['rehydrate'] is not None:
+                num_msgs = archive.rehydrate_room(options['rehydrate'], db_name)
+                self.stdout.write(f"{db_name}: Rehydrated {num_msgs} messages of room {options['rehydrate']}")
+                continue
+            num_rooms, num_msgs = archive.archive_rooms(db_name, days=options['days'], limit=options['limit'])
+            self.stdout.write(f'{db_name}: Archived {num_msgs} messages of {num_rooms} rooms into {archive.CHAT_ARCHIVE_DIR}')
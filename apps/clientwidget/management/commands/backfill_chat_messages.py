@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.clientwidget.models import ChatMessage, ChatRoom
+
+CHUNK_SIZE = 500
+
+
+def backfill_room(room_id, db_name):
+    """Moves the legacy message arrays of a room into `ChatMessage`, and empties them.
+
+    Messages which were already appended to `ChatMessage` (by a session which ended after the table was added)
+    are newer than the legacy ones, so they're shifted after them. Returns the number of messages moved
+    """
+    with transaction.atomic(using=db_name):
+        room = ChatRoom.objects.using(db_name).select_for_update().filter(room_id=room_id).values('messages', 'recent_messages', 'recent_seq').first()
+        if room is None or not room['messages']:
+            return 0
+
+        messages, recent_messages = room['messages'], room['recent_messages'] or []
+        num_msgs = len(messages)
+
+        # Shift the newer messages, from the last one, so that (room_id, seq) stays unique
+        existing = ChatMessage.objects.using(db_name).filter(room_id=room_id)
+        for message_id, seq in existing.order_by('-seq').values_list('id', 'seq'):
+            ChatMessage.objects.using(db_name).filter(pk=message_id).update(seq=seq + num_msgs)
+
+        # The legacy recent history is always a suffix of the full history
+        if room['recent_seq'] > 1:
+            recent_seq = room['recent_seq'] + num_msgs
+        else:
+            recent_seq = max(num_msgs - len(recent_messages) + 1, 1)
+
+        rows = [ChatMessage(room_id=room_id, seq=seq, content=message) for seq, message in enumerate(messages, start=1)]
+        ChatMessage.objects.using(db_name).bulk_create(rows, batch_size=CHUNK_SIZE)
+        ChatRoom.objects.using(db_name).filter(room_id=room_id).update(messages=[], recent_messages=[], recent_seq=recent_seq)
+    return num_msgs
+
+
+class Command(BaseCommand):
+    help = 'Moves the ChatRoom.messages / recent_messages arrays into the ChatMessage table. Safe to run multiple times'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases', help='DB label to backfill. Defaults to every DB')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Number of room IDs fetched at a time')
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or list(settings.DATABASES.keys())
+        for db_name in databases:
+            num_rooms, num_msgs = 0, 0
+            # Backfilled rooms have their arrays emptied, so they're skipped the next time
+            room_ids = ChatRoom.objects.using(db_name).exclude(messages=[]).values_list('room_id', flat=True)
+            for room_id in room_ids.iterator(chunk_size=options['chunk_size']):
+                moved = backfill_room(room_id, db_name)
+                if moved > 0:
+                    num_rooms += 1
+                    num_msgs += moved
+            self.stdout.write(f'{db_name}: Moved {num_msgs} messages of {num_rooms} rooms')
@@ -10,6 +10,9 @@ from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
+from apps.clientwidget import room_state
+from apps.clientwidget.events import append_messages_to_db
+from apps.clientwidget.history_codec import decode_entries
 from apps.clientwidget.models import ChatRoom
 
 DOTENV_FILE = os.path.join(os.getcwd(), 'chatbot', '.env')
@@ -54,18 +57,18 @@ def redis_server_cleanup():
             # Dump to DB
             for key in batch:
                 room_name = json.loads(connection.get(key))
-                variables = cache.get("VARIABLES_" + room_name)
+                variables = room_state.get_variables(room_name)
                 messages_bytes = connection.lrange(cache.make_key("HISTORY_" + room_name), 0, -1)
-                messages = list(json.loads(message) for message in messages_bytes)[::-1]
+                messages = decode_entries(messages_bytes)[::-1]
                 modified = False
                 with transaction.atomic():
-                    instance = ChatRoom.objects.get(room_name=room_name)
+                    instance = ChatRoom.objects.select_for_update().get(room_name=room_name)
                     if variables is not None:
                         instance.variables = variables
                         modified = True
                     if messages is not None:
                         if messages != []:
-                            instance.messages.extend(messages)
+                            append_messages_to_db(instance.room_id, messages)
                             modified = True
                     if modified:
                         instance.save()
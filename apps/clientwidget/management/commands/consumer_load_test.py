@@ -0,0 +1,130 @@
+import asyncio
+import time
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.urls import path
+
+from apps.clientwidget import routing
+from apps.clientwidget.models import ChatMessage, ChatRoom
+
+
+def get_application(consumer_class, route='admin'):
+    """The admin / clientwidget route, without the session / auth middleware (which need a logged in user)"""
+    if route == 'clientwidget':
+        router = URLRouter([path('ws/chat_updated/<uuid:owner_id>/<uuid:room_id>', consumer_class)])
+    else:
+        router = URLRouter([path('ws/chat_updated/<uuid:owner_id>/admin', consumer_class)])
+    return lambda scope: router(dict(scope, user=AnonymousUser()))
+
+
+async def run_load_test(consumer_class, num_connections, num_messages, timeout):
+    """Connects `num_connections` admin sockets of one owner, then sends `num_messages` group events to all of them.
+
+    Returns (connections / second, delivered messages / second), within this process
+    """
+    application = get_application(consumer_class)
+    owner_id = uuid.uuid4()
+    channel_layer = get_channel_layer()
+
+    start = time.perf_counter()
+    communicators = [WebsocketCommunicator(application, f'/ws/chat_updated/{owner_id}/admin') for _ in range(num_connections)]
+    results = await asyncio.gather(*[communicator.connect(timeout=timeout) for communicator in communicators])
+    connect_time = time.perf_counter() - start
+    if not all(connected for connected, _ in results):
+        raise RuntimeError(f"Only {sum(1 for connected, _ in results if connected)} of {num_connections} connections were accepted")
+
+    async def receive_all(communicator):
+        for _ in range(num_messages):
+            await communicator.receive_from(timeout=timeout)
+
+    start = time.perf_counter()
+    receivers = asyncio.gather(*[receive_all(communicator) for communicator in communicators])
+    for i in range(num_messages):
+        await channel_layer.group_send(str(owner_id), {
+            'type': 'chat_message', 'message': f'Message {i}', 'user': 'end_user', 'time': time.time(), 'room_id': str(owner_id),
+        })
+    await receivers
+    message_time = time.perf_counter() - start
+
+    await asyncio.gather(*[communicator.disconnect(timeout=timeout) for communicator in communicators])
+    return num_connections / connect_time, num_connections * num_messages / message_time
+
+
+@database_sync_to_async
+def create_rooms(num_rooms):
+    rooms = [ChatRoom(room_id=uuid.uuid4(), bot_id=uuid.uuid4()) for _ in range(num_rooms)]
+    for room in rooms:
+        room.room_name = str(room.room_id)
+    return [room.room_id for room in ChatRoom.objects.bulk_create(rooms)]
+
+
+@database_sync_to_async
+def delete_rooms(room_ids):
+    ChatMessage.objects.filter(room_id__in=room_ids).delete()
+    ChatRoom.objects.filter(room_id__in=room_ids).delete()
+
+
+async def run_receive_load_test(consumer_class, num_rooms, num_messages, timeout):
+    """Connects a visitor socket to each of `num_rooms` new rooms, then every visitor sends `num_messages` chat
+    messages, each one after the echo of the previous one. That's the receive path of the clientwidget route: reading
+    the groups of the room, the fan out, and the append to the session history.
+
+    The rooms are deleted afterwards. Returns (connections / second, messages / second), within this process
+    """
+    application = get_application(consumer_class, route='clientwidget')
+    owner_id = uuid.uuid4()
+    room_ids = await create_rooms(num_rooms)
+    try:
+        start = time.perf_counter()
+        communicators = [WebsocketCommunicator(application, f'/ws/chat_updated/{owner_id}/{room_id}') for room_id in room_ids]
+        results = await asyncio.gather(*[communicator.connect(timeout=timeout) for communicator in communicators])
+        connect_time = time.perf_counter() - start
+        if not all(connected for connected, _ in results):
+            raise RuntimeError(f"Only {sum(1 for connected, _ in results if connected)} of {num_rooms} connections were accepted")
+
+        async def chat(communicator):
+            for i in range(num_messages):
+                await communicator.send_json_to({'user': 'end_user', 'message': f'Message {i}'})
+                await communicator.receive_json_from(timeout=timeout)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[chat(communicator) for communicator in communicators])
+        message_time = time.perf_counter() - start
+
+        # The last one out of each room flushes its session
+        await asyncio.gather(*[communicator.disconnect(timeout=timeout) for communicator in communicators])
+    finally:
+        await delete_rooms(room_ids)
+    return num_rooms / connect_time, num_rooms * num_messages / message_time
+
+
+class Command(BaseCommand):
+    help = 'Measures the connections / second and the delivered messages / second of the sync and async consumers, in a single process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=('sync', 'async', 'both'), default='both')
+        parser.add_argument('--route', choices=('admin', 'clientwidget'), default='admin',
+                            help='admin: group events sent to the admin sockets. clientwidget: chat messages received from visitor sockets')
+        parser.add_argument('--connections', type=int, default=200, help='Number of sockets in the group (admin) / rooms (clientwidget)')
+        parser.add_argument('--messages', type=int, default=50, help='Number of group events delivered to every socket (admin) / messages sent by every visitor (clientwidget)')
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        sync_consumer, async_consumer = routing.CONSUMER_CLASSES[options['route']]
+        load_test = run_receive_load_test if options['route'] == 'clientwidget' else run_load_test
+        modes = [('sync', sync_consumer), ('async', async_consumer)]
+        if options['mode'] != 'both':
+            modes = [mode for mode in modes if mode[0] == options['mode']]
+
+        for mode, consumer_class in modes:
+            connections_per_second, messages_per_second = asyncio.get_event_loop().run_until_complete(
+                load_test(consumer_class, options['connections'], options['messages'], options['timeout'])
+            )
+            self.stdout.write(f"{mode} ({consumer_class.__name__}): {options['connections']} connections, {options['messages']} messages -> "
+                              f"{connections_per_second:.1f} connections/s, {messages_per_second:.1f} messages/s")
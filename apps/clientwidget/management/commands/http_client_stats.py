@@ -0,0 +1,34 @@
+import json
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from apps.clientwidget import http_client
+
+
+class Command(BaseCommand):
+    help = 'Shows the connection reuse of the shared outbound HTTP client, per host, across every daphne / celery process'
+
+    def handle(self, *args, **options):
+        REDIS_CONNECTION = cache.get_client('')
+        content = REDIS_CONNECTION.hgetall(cache.make_key(http_client.HTTP_CLIENT_STATS))
+
+        if len(content) == 0:
+            self.stdout.write(f'No stats yet. Every process writes them at most once every {http_client.HTTP_CLIENT_STATS_INTERVAL} seconds, after a request')
+            return
+
+        totals = {}
+        for process, process_stats in sorted(content.items()):
+            process = process.decode() if isinstance(process, bytes) else process
+            self.stdout.write(process)
+            for host, counters in sorted(json.loads(process_stats).items()):
+                self.stdout.write(f"    {host}: {counters['requests']} requests, {counters['connections']} new connections, "
+                                  f"{counters['reused']} reused, reuse rate {counters['reuse_rate']}")
+                total = totals.setdefault(host, {'requests': 0, 'connections': 0, 'reused': 0})
+                for name in total:
+                    total[name] += counters[name]
+
+        self.stdout.write('Total')
+        for host, total in sorted(totals.items()):
+            reuse_rate = round(total['reused'] / total['requests'], 4) if total['requests'] > 0 else None
+            self.stdout.write(f"    {host}: {total['requests']} requests, {total['connections']} new connections, reuse rate {reuse_rate}")
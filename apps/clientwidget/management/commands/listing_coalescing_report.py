@@ -0,0 +1,84 @@
+import json
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from apps.clientwidget import listing_updates
+
+STATUSES = ('pending', 'open', 'resolved')
+
+
+def simulate_events(num_rooms, duration, changes_per_minute, seed):
+    """Listing events of `num_rooms` rooms of one owner over `duration` seconds, as [(time, event)]
+
+    Each state change of a room saves it a few times in quick succession (variables, status, takeover, ...),
+    like the bot / live chat flow does.
+    """
+    rng = random.Random(seed)
+    start = datetime(2021, 1, 1)
+    events = []
+    for _ in range(num_rooms):
+        room_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        state = {
+            'type': 'listing_channel_event', 'room_id': room_id, 'bot_id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'room_name': f'Visitor{rng.randint(1, 10 ** 5)}', 'created_on': str(start), 'bot_is_active': True,
+            'variables': {}, 'status': 'pending', 'takeover': False, 'assignment_type': 'manual', 'assigned_operator': [],
+            'bot_type': 'website', 'is_deleted': False, 'owner': 'owner@example.com',
+        }
+        t = rng.expovariate(changes_per_minute / 60)
+        while t < duration:
+            for i in range(rng.randint(1, 4)):
+                saved_at = t + i * rng.uniform(0.005, 0.08)
+                state = dict(state, updated_on=str(start + timedelta(seconds=saved_at)))
+                change = rng.random()
+                if change < 0.5:
+                    state['variables'] = dict(state['variables'], **{f'var{rng.randint(1, 10)}': rng.randint(1, 100)})
+                elif change < 0.7:
+                    state['status'] = rng.choice(STATUSES)
+                elif change < 0.8:
+                    state['takeover'] = not state['takeover']
+                elif change < 0.9:
+                    state['bot_is_active'] = not state['bot_is_active']
+                events.append((saved_at, state))
+            t += rng.expovariate(changes_per_minute / 60)
+    events.sort(key=lambda item: item[0])
+    return events
+
+
+def replay(events, window):
+    """Replays the events on one listing socket with the given window (in seconds). Returns the events it sends"""
+    coalescer = listing_updates.ListingCoalescer()
+    sent = []
+    flush_at = None
+    for t, event in events:
+        if flush_at is not None and t >= flush_at:
+            sent.extend(coalescer.drain())
+            flush_at = None
+        if coalescer.add(event):
+            flush_at = t + window
+    sent.extend(coalescer.drain())
+    return sent
+
+
+class Command(BaseCommand):
+    help = 'Simulates the listing updates of a busy owner, and reports how many events / bytes a listing socket gets with coalescing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=1000)
+        parser.add_argument('--duration', type=int, default=300, help='Simulated seconds')
+        parser.add_argument('--changes', type=float, default=4, help='State changes per room per minute')
+        parser.add_argument('--window', type=int, action='append', dest='windows', help='Coalescing window in ms. Defaults to 250')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        events = simulate_events(options['rooms'], options['duration'], options['changes'], options['seed'])
+        received_bytes = sum(len(json.dumps(event)) for _, event in events)
+        self.stdout.write(f"{options['rooms']} rooms, {options['duration']}s: {len(events)} events, {received_bytes} bytes without coalescing")
+
+        for window in options['windows'] or [250]:
+            sent = replay(events, window / 1000)
+            sent_bytes = sum(len(json.dumps(event)) for event in sent)
+            self.stdout.write(f"    {window} ms window: {len(sent)} events ({100 * (1 - len(sent) / max(len(events), 1)):.1f}% fewer), "
+                              f"{sent_bytes} bytes ({100 * (1 - sent_bytes / max(received_bytes, 1)):.1f}% fewer)")
@@ -0,0 +1,35 @@
+import json
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from apps.clientwidget import near_cache
+
+
+class Command(BaseCommand):
+    help = 'Shows the hit rates of the process local near caches, across every daphne / celery process'
+
+    def handle(self, *args, **options):
+        REDIS_CONNECTION = cache.get_client('')
+        content = REDIS_CONNECTION.hgetall(cache.make_key(near_cache.NEAR_CACHE_STATS))
+
+        if len(content) == 0:
+            self.stdout.write(f'No stats yet. Every process writes them once every {near_cache.NEAR_CACHE_STATS_INTERVAL} seconds')
+            return
+
+        totals = {}
+        for process, process_stats in sorted(content.items()):
+            process = process.decode() if isinstance(process, bytes) else process
+            self.stdout.write(process)
+            for name, counters in json.loads(process_stats).items():
+                self.stdout.write(f"    {name}: {counters['hits']} hits, {counters['misses']} misses, hit rate {counters['hit_rate']}, "
+                                  f"{counters['size']} entries, {counters['evictions']} evictions, {counters['invalidations']} invalidations")
+                total = totals.setdefault(name, {'hits': 0, 'misses': 0})
+                total['hits'] += counters['hits']
+                total['misses'] += counters['misses']
+
+        self.stdout.write('Total')
+        for name, total in totals.items():
+            lookups = total['hits'] + total['misses']
+            hit_rate = round(total['hits'] / lookups, 4) if lookups > 0 else None
+            self.stdout.write(f"    {name}: {total['hits']} hits, {total['misses']} misses, hit rate {hit_rate}")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from apps.clientwidget import partitions, tenants
+
+
+class Command(BaseCommand):
+    help = 'Converts the ChatMessage table into monthly partitions on created_on (PostgreSQL 11+), and creates the upcoming partitions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases', help='DB label to partition. Defaults to every DB label in use')
+        parser.add_argument('--convert', action='store_true', help='Convert the existing table. Locks it while the rows are copied')
+        parser.add_argument('--keep-legacy', action='store_true', help='Keep the old table (renamed to <table>_legacy) after converting')
+        parser.add_argument('--months-ahead', type=int, default=partitions.PARTITION_MONTHS_AHEAD, help='Number of future monthly partitions to create')
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or tenants.get_db_labels()
+        for db_name in databases:
+            if options['convert'] and not partitions.is_partitioned(db_name):
+                num_rows = partitions.convert_to_partitioned(db_name, keep_legacy=options['keep_legacy'], months_ahead=options['months_ahead'])
+                self.stdout.write(f'{db_name}: Converted the table, and moved {num_rows} messages into the partitions')
+            elif not partitions.is_partitioned(db_name):
+                self.stdout.write(f'{db_name}: The table is not partitioned. Run with --convert first')
+                continue
+            created = partitions.ensure_partitions(db_name, months_ahead=options['months_ahead'])
+            self.stdout.write(f'{db_name}: Created {len(created)} new partitions')
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from apps.clientwidget import visitor_sequence
+from apps.clientwidget.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = 'Moves the per owner visitor sequences forward to MAX(visitor_id) of the rooms, if they are behind the DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases', help='DB label to reconcile. Defaults to every DB')
+        parser.add_argument('--reset', action='store_true', help='Drop the sequences instead, so that they are seeded from the DB on the next visitor')
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or list(settings.DATABASES.keys())
+        for db_name in databases:
+            num_admins, num_moved = 0, 0
+            largest_ids = ChatRoom.objects.using(db_name).exclude(admin_id=None).values('admin_id').annotate(largest=Max('visitor_id')).order_by()
+            for row in largest_ids.iterator():
+                num_admins += 1
+                if options['reset']:
+                    visitor_sequence.reset_sequence(row['admin_id'], db_name)
+                elif visitor_sequence.advance_sequence(row['admin_id'], row['largest'], db_name):
+                    num_moved += 1
+                    self.stdout.write(f"{db_name}: Moved the sequence of owner {row['admin_id']} to {row['largest']}")
+            if options['reset']:
+                self.stdout.write(f'{db_name}: Dropped the sequences of {num_admins} owners')
+            else:
+                self.stdout.write(f'{db_name}: Checked {num_admins} owners, moved {num_moved} sequences')
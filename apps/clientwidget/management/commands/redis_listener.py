@@ -4,12 +4,12 @@ import time
 
 import redis
 from decouple import UndefinedValueError, config
-from django.core.cache import cache
 from django.core.management.base import BaseCommand, CommandError
 
 from apps.clientwidget import events
 from apps.clientwidget.consumers import TemplateChatConsumer
 from apps.clientwidget.models import ChatRoom
+from apps.clientwidget.teardown import teardown_room
 
 
 class Command(BaseCommand):
@@ -50,21 +50,12 @@ class Command(BaseCommand):
                                     TemplateChatConsumer.send_from_api('', room_name, bot_type='website', user='session_timeout')
                                     print(f"Successfully disconnected the sessions for Room - {room_name}")
                                 else:
+                                    # Snapshot and delete all the cache keys of the room in one go
+                                    snapshot = teardown_room(room_name, session_end=True)
                                     queryset = ChatRoom.objects.filter(room_name=room_name)
                                     for instance in queryset:
                                         # Flush to DB
-                                        is_lead = cache.get(f"IS_LEAD_{instance.room_name}")
-                                        session_variables = cache.get(f"VARIABLES_{instance.room_name}")
-                                        events.flush_to_db(instance.room_id, 'AnonymousUser', session_variables, is_lead=is_lead)
+                                        events.flush_to_db(instance.room_id, 'AnonymousUser', snapshot.variables, is_lead=snapshot.is_lead, messages=snapshot.messages)
                                         # Make the chat inactive
                                         instance.bot_is_active = False
                                         instance.save()
-                                    
-                                    # Now finally force delete all the cache keys
-                                    cache.delete(f'CLIENTWIDGETROOMLOCK_{room_name}') # Lock for the room
-                                    cache.delete(f'CLIENTWIDGETLOCK_{room_name}') # Lock for the room messages                                
-                                    cache.delete(f'CLIENTWIDGETLEADFIELDS_{room_name}')
-                                    cache.delete(f'CLIENTWIDGETROOMINFO_{room_name}')
-                                    cache.delete(f'IS_LEAD_{room_name}')
-                                    cache.delete(f"CLIENTWIDGETTIMEOUT_{room_name}")
-                                    cache.delete(f"CLIENTWIDGET_EXPIRY_LOCK_{room_name}")
@@ -1,19 +1,20 @@
 import uuid
 from datetime import datetime
 
-from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.apps import apps
 from django.conf import settings
 # from django.contrib.postgres.fields import JSONField
-from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django_jsonfield_backport.models import JSONField
 
 from apps.accounts.models import Teams, User
 from apps.chatbox.models import Chatbox
+from . import fanout, near_cache, tenants, visitor_sequence
 from .exceptions import logger
 
 try:
@@ -56,6 +57,23 @@ class ChatSession(models.Model):
     ip_address = models.CharField(max_length=30, db_column='ip_address', null=True)
 
 
+# Fields used by the listing serializers (`ActiveChatRoomSerializer`, `VariableDataSerializer`)
+SUMMARY_FIELDS = ('room_id', 'room_name', 'bot_id', 'admin_id', 'visitor_id', 'chatbot_type', 'bot_is_active', 'is_lead', 'num_msgs',
+                  'variables', 'status', 'assignment_type', 'assigned_operator', 'channel_id', 'website_url', 'created_on', 'updated_on', 'end_time',
+                  'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content')
+
+
+class ChatRoomQuerySet(models.QuerySet):
+    def summary(self):
+        """Only loads the columns which are shown in the room listings"""
+        return self.only(*SUMMARY_FIELDS)
+
+
+class ChatRoomManager(models.Manager.from_queryset(ChatRoomQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().defer('messages', 'recent_messages')
+
+
 class ChatRoom(models.Model):
     """Model for storing the room information related to the template bot
        
@@ -66,7 +84,15 @@ class ChatRoom(models.Model):
         bot_id (uuid): Bot ID which maps to an existing bot from `apps.chatbox.models.Chatbox`
         bot_is_active (bool): Is the bot active or not?
         num_msgs (int): Total number of messages for the current room
+        messages (list): Legacy message array. The history is now stored in `ChatMessage`
+        recent_messages (list): Legacy recent message array. See `recent_seq`
+        recent_seq (int): The recent history (shown to the visitor) consists of the `ChatMessage` rows with `seq >= recent_seq`
+        archived_seq (int): The messages with `seq <= archived_seq` are in the archive tier (see `archive`), not in `ChatMessage`
+        archived_on (datetime): Time at which the room was last moved into (or back from) the archive tier
     """
+    # The legacy message arrays can be megabytes per room, so they're never fetched unless asked for
+    objects = ChatRoomManager()
+
     visitor_id = models.PositiveIntegerField(default=1, db_column='visitor_id')
     room_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_column='room_id')
     created_on = models.DateTimeField(_('chatroom created on'), default=current_utc_time)
@@ -108,24 +134,27 @@ class ChatRoom(models.Model):
     assigned_team = models.IntegerField(null=True, blank=True)
     end_chat = models.BooleanField(default=False)
     updated_on = models.DateTimeField(db_column='updated_on', null=True)
+    recent_seq = models.PositiveIntegerField(default=1, db_column='recent_seq')
+    archived_seq = models.PositiveIntegerField(default=0, db_column='archived_seq')
+    archived_on = models.DateTimeField(db_column='archived_on', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Active / Inactive listings of an owner, sorted by the last update
+            models.Index(fields=['admin_id', 'bot_is_active', 'updated_on'], name='chatroom_admin_active_idx'),
+            # Chat data of a bot, sorted by the creation date
+            models.Index(fields=['bot_id', 'created_on'], name='chatroom_bot_created_idx'),
+            # Leads of a bot. Only a small fraction of the rooms are leads
+            models.Index(fields=['bot_id', 'created_on'], name='chatroom_bot_lead_idx', condition=models.Q(is_lead=True)),
+        ]
 
     def save(self, *args, **kwargs):
         if 'new_visitor' in kwargs:
             try:
                 if kwargs['new_visitor'] == True:
                     if self._state.adding:
-                        if 'using' in kwargs:
-                            last_id = ChatRoom.objects.using(kwargs['using']).filter(admin_id=self.admin_id).aggregate(largest=models.Max('visitor_id'))
-                            last_id = last_id['largest']
-                        else:    
-                            last_id = ChatRoom.objects.filter(admin_id=self.admin_id).aggregate(largest=models.Max('visitor_id'))
-                            last_id = last_id['largest']
-                        if last_id is not None:
-                            self.visitor_id = last_id + 1
-                            self.room_name = f"Visitor{self.visitor_id}"
-                        else:
-                            self.visitor_id = 1
-                            self.room_name = f"Visitor{self.visitor_id}"
+                        self.visitor_id = visitor_sequence.next_visitor_id(self.admin_id, kwargs.get('using', 'default'))
+                        self.room_name = f"Visitor{self.visitor_id}"
             except Exception as ex:
                 print(ex)
             finally:
@@ -209,149 +238,127 @@ class ChatRoom(models.Model):
         super(ChatRoom, self).save(*args, **kwargs)
 
         if send_update:
-            fields = ('bot_id', 'room_id', 'room_name', 'created_on', 'updated_on', 'bot_is_active', 'variables', 'status', 'takeover', 'assignment_type', 'assigned_operator',)
-            if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
-                # Use Celery
-                try:
-                    
-                    user = User.objects.get(pk=self.admin_id)
-                    owner_id = user.uuidassigned_operator_id
-                    bot = Chatbox.objects.get(pk=self.bot_id)
-                    if owner_id is not None:
-                        field_dict = {field: getattr(self, field) if field not in ('room_id', 'bot_id', 'created_on', 'updated_on') else str(getattr(self, field)) for field in fields}
-                        field_dict['bot_type'] = bot.chatbot_type
-                        field_dict['is_deleted'] = bot.is_deleted
-                        field_dict['owner'] = bot.owner.email
-                        if self.assigned_team_name == '<All>':
-                            team_list_queryset = Teams.objects.filter(owner__id=self.admin_id).values_list('name', flat=True)
-                            # team_list = list(map(str, team_list_queryset))
-                            team_list = []
-                            for team in team_list_queryset:
-                                team_list.append(str(team))
-                        else:
-                            team_list = [self.assigned_team_name]
-
-                        _ = tasks.send_update.delay(str(owner_id), field_dict, team_name=team_list)
-
-                except Exception as ex:
-                    print(ex)
-            else:
-                # Status has changed. This is an update
-                try:
-                    channel_layer = get_channel_layer()
-                    user = User.objects.get(pk=self.admin_id)
-                    owner_id = user.uuid
-                    print('OWNER_ID', owner_id)
-                    bot = Chatbox.objects.get(pk=self.bot_id)
-                    if owner_id is not None:
-                        field_dict = {field: getattr(self, field) if field not in ('room_id', 'bot_id', 'created_on', 'updated_on') else str(getattr(self, field)) for field in fields}
-                        # Add bot_info
-                        field_dict['bot_type'] = bot.chatbot_type
-                        field_dict['is_deleted'] = bot.is_deleted
-                        field_dict['owner'] = bot.owner.email
-
-                        if assigned_operator is not None:
-                            # Update operator <-> owner mappings
-                            if self.room_id is not None and self.status is not None:
-                                assigned_team_op = [str(op_uuid.uuid) for op_uuid in assigned_operator]
-                                if self.assigned_team_name is not None:
-                                    previous_team = cache.get(f'TEAM_{self.room_id}')
-                                    logger.info(f'Previous Team---->{previous_team}')
-                                    if previous_team is not None:
-                                        dummy_fields = field_dict.copy()
-                                        dummy_fields['bot_is_active'] = False
-                                        for team in previous_team:
-                                            _team = team.replace(" ", "")
-                                            async_to_sync(channel_layer.group_send)(
-                                                'team_{}_{}'.format(owner_id, str(_team)),
-                                                {
-                                                    'type': 'listing_channel_event',
-                                                    **dummy_fields,
-                                                }
-                                            )
-                                    else:
-                                        client = cache.get(f"CLIENT_MAP_{owner_id}")
-                                        if client is not None and str(self.room_id) in client:
-                                            operators = client[str(self.room_id)]
-                                            dummy_fields = field_dict.copy()
-                                            dummy_fields['bot_is_active'] = False
-                                            for op in operators:
-                                                async_to_sync(channel_layer.group_send)(
-                                                f'listing_channel_{str(op)}',
-                                                {
-                                                        'type': 'listing_channel_event',
-                                                        **dummy_fields
-                                                } 
-                                                )
-                                    if self.assigned_team_name == '<All>':
-                                    
-                                        team_list_queryset = Teams.objects.filter(owner__id=self.admin_id).values_list('name', flat=True)
-                                        # team_list = list(map(str, team_list_queryset))
-                                        team_list = []
-                                        for team in team_list_queryset:
-                                            team_list.append(str(team))
-                                    else:
-                                        team_list = [self.assigned_team_name]
-                                    tasks.update_operator_mappings(str(owner_id), assigned_team_op, str(self.room_id), self.status, team_list)
+            self.send_listing_update(assigned_operator=assigned_operator, all_team=all_team, assigner=assigner, one_to_one=one_to_one, operator_partner=operator_partner)
+
+
+    def send_listing_update(self, assigned_operator=None, all_team=False, assigner=None, one_to_one=False, operator_partner=False):
+        """Sends the room to the listing channels of the owner, and of the assigned operators / teams
+        """
+        fields = ('bot_id', 'room_id', 'room_name', 'created_on', 'updated_on', 'bot_is_active', 'variables', 'status', 'takeover', 'assignment_type', 'assigned_operator',)
+        if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
+            # Use Celery
+            try:
+                
+                # Owner and bot metadata rarely change, so they're served from the near cache
+                user = near_cache.get_owner(self.admin_id)
+                owner_id = user['uuid']
+                bot = near_cache.get_bot(self.bot_id)
+                if owner_id is not None:
+                    field_dict = {field: getattr(self, field) if field not in ('room_id', 'bot_id', 'created_on', 'updated_on') else str(getattr(self, field)) for field in fields}
+                    field_dict['bot_type'] = bot['chatbot_type']
+                    field_dict['is_deleted'] = bot['is_deleted']
+                    field_dict['owner'] = near_cache.get_owner(bot['owner_id'])['email']
+                    if self.assigned_team_name == '<All>':
+                        team_list_queryset = Teams.objects.filter(owner__id=self.admin_id).values_list('name', flat=True)
+                        # team_list = list(map(str, team_list_queryset))
+                        team_list = []
+                        for team in team_list_queryset:
+                            team_list.append(str(team))
+                    else:
+                        team_list = [self.assigned_team_name]
+
+                    _ = tasks.send_update.delay(str(owner_id), field_dict, team_name=team_list)
+
+            except Exception as ex:
+                print(ex)
+        else:
+            # Status has changed. This is an update
+            try:
+                channel_layer = get_channel_layer()
+                user = near_cache.get_owner(self.admin_id)
+                owner_id = user['uuid']
+                print('OWNER_ID', owner_id)
+                bot = near_cache.get_bot(self.bot_id)
+                if owner_id is not None:
+                    field_dict = {field: getattr(self, field) if field not in ('room_id', 'bot_id', 'created_on', 'updated_on') else str(getattr(self, field)) for field in fields}
+                    # Add bot_info
+                    field_dict['bot_type'] = bot['chatbot_type']
+                    field_dict['is_deleted'] = bot['is_deleted']
+                    field_dict['owner'] = near_cache.get_owner(bot['owner_id'])['email']
+
+                    if assigned_operator is not None:
+                        # Update operator <-> owner mappings
+                        if self.room_id is not None and self.status is not None:
+                            assigned_team_op = [str(op_uuid.uuid) for op_uuid in assigned_operator]
+                            if self.assigned_team_name is not None:
+                                # Remove the room from the listings of the previous team / operators
+                                previous_groups = fanout.get_operator_groups(self.room_id, owner_id, 'team_{owner_id}_{team}', 'listing_channel_{operator}')
+                                logger.info(f'Previous Team---->{previous_groups}')
+                                fanout.send_to_groups(previous_groups, {'type': 'listing_channel_event', **field_dict, 'bot_is_active': False}, channel_layer)
+                                if self.assigned_team_name == '<All>':
+                                
+                                    team_list_queryset = Teams.objects.filter(owner__id=self.admin_id).values_list('name', flat=True)
+                                    # team_list = list(map(str, team_list_queryset))
+                                    team_list = []
+                                    for team in team_list_queryset:
+                                        team_list.append(str(team))
                                 else:
-                                    client = cache.get(f"CLIENT_MAP_{owner_id}")
-                                    if client is not None and str(self.room_id) in client:
-                                        operators = client[str(self.room_id)]
-                                        dummy_fields = field_dict.copy()
-                                        dummy_fields['bot_is_active'] = False
-                                        for op in operators:
-                                            async_to_sync(channel_layer.group_send)(
-                                               f'listing_channel_{str(op)}',
-                                               {
-                                                    'type': 'listing_channel_event',
-                                                    **dummy_fields
-                                               } 
-                                            )
-                                        logger.info(f"checkout operator--->{client[str(self.room_id)]}")        
-                                    tasks.update_operator_mappings(str(owner_id), assigned_team_op, str(self.room_id), self.status)
-                        else:
-                            pass
-                        
-                        async_to_sync(channel_layer.group_send)(
-                            f'listing_channel_{owner_id}',
-                            {
-                                'type': 'listing_channel_event',
-                                **field_dict
-                            }
-                        )
-                        
-                        client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-                        operator_team_name = cache.get(f"TEAM_{self.room_id}")
-                        if client_map is not None and str(self.room_id) in client_map:
-                            operator_id = client_map[str(self.room_id)]
-                            
-                            if assigner is not None and str(assigner.uuid) not in operator_id:
-                                operator_id.append(str(assigner.uuid))
-                            logger.info(f'operator_assignment--->team...{operator_team_name}')    
-                            if operator_team_name is not None and not one_to_one:
-                                logger.info(f'operator_assignment--->team...{operator_team_name}')
-                                for team in operator_team_name:
-                                    _team = team.replace(" ", "")
-                                    async_to_sync(channel_layer.group_send)(
-                                        'team_{}_{}'.format(owner_id, str(_team)),
-                                        {
-                                            'type': 'listing_channel_event',
-                                            **field_dict,
-                                        }
-                                    )
+                                    team_list = [self.assigned_team_name]
+                                tasks.update_operator_mappings(str(owner_id), assigned_team_op, str(self.room_id), self.status, team_list)
                             else:
-                                if len(operator_id) != 0:
-                                    logger.info(f'operator_assignment--->operator')
-                                    for operator in operator_id:
-                                        async_to_sync(channel_layer.group_send)(
-                                            'listing_channel_' + str(operator),
-                                            {
-                                                'type': 'listing_channel_event',
-                                                **field_dict,
-                                            }
-                                        )    
-                except Exception as ex:
-                    print(ex)
+                                from . import operator_map
+                                operators = operator_map.get_room_operators(self.room_id)
+                                fanout.send_to_groups([f'listing_channel_{op}' for op in operators], {'type': 'listing_channel_event', **field_dict, 'bot_is_active': False}, channel_layer)
+                                if len(operators) > 0:
+                                    logger.info(f"checkout operator--->{operators}")        
+                                tasks.update_operator_mappings(str(owner_id), assigned_team_op, str(self.room_id), self.status)
+                    else:
+                        pass
+                    
+                    # The owner, and the teams / operators of the room, in one go
+                    groups = [f'listing_channel_{owner_id}']
+                    
+                    from . import operator_map, room_state
+                    operator_id = operator_map.get_room_operators(self.room_id)
+                    operator_team_name = room_state.get_room_field(self.room_id, room_state.TEAM)
+                    if len(operator_id) > 0:
+                        
+                        if assigner is not None and str(assigner.uuid) not in operator_id:
+                            operator_id.append(str(assigner.uuid))
+                        logger.info(f'operator_assignment--->team...{operator_team_name}')    
+                        if operator_team_name is not None and not one_to_one:
+                            logger.info(f'operator_assignment--->team...{operator_team_name}')
+                            groups.extend('team_{}_{}'.format(owner_id, team.replace(" ", "")) for team in operator_team_name)
+                        else:
+                            logger.info(f'operator_assignment--->operator')
+                            groups.extend('listing_channel_' + str(operator) for operator in operator_id)
+
+                    fanout.send_to_groups(groups, {'type': 'listing_channel_event', **field_dict}, channel_layer)
+            except Exception as ex:
+                print(ex)
+
+
+class ChatMessage(models.Model):
+    """Append-only table of the messages of every room. Stored in the same DB as the `ChatRoom`
+
+    Attributes:
+        id (int): Auto Incrementing Integer ID (Primary Key)
+        room_id (uuid): Room Id to the ChatRoom relation
+        seq (int): Position of the message in the history of the room, starting from 1
+        content (dict): The message
+        created_on (datetime): Time at which the message was stored
+    """
+    id = models.BigAutoField(primary_key=True)
+    room_id = models.UUIDField(db_column='room_id')
+    seq = models.PositiveIntegerField(db_column='seq')
+    content = JSONField(db_column='content', default=dict)
+    created_on = models.DateTimeField(default=current_utc_time, db_column='created_on')
+
+    class Meta:
+        constraints = [
+            # Per partition, once the table is partitioned (see `partitions`)
+            models.UniqueConstraint(fields=['room_id', 'seq'], name='chatmessage_room_seq'),
+        ]
 
 
 # ClientMediaHandler
@@ -388,3 +395,15 @@ class AdminMediaHandler(models.Model):
     active = models.BooleanField(default=True)
     created = models.DateTimeField(auto_now_add=True)
     media_url = models.URLField(null=True)
+
+
+# Keep the near caches of every process coherent with the owner and bot metadata
+@receiver([post_save, post_delete], sender=User)
+def invalidate_owner(sender, instance, **kwargs):
+    near_cache.owners.invalidate(instance.pk)
+    tenants.invalidate_owner(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Chatbox)
+def invalidate_bot(sender, instance, **kwargs):
+    near_cache.bots.invalidate(instance.pk)
@@ -0,0 +1,328 @@
+"""
+clientwidget/near_cache.py
+
+Process local TTL / LRU cache, in front of Redis and the DB, for read-mostly room metadata.
+
+    db_labels   -> room_id -> External DB label of the room (`cache.get(room_id)`)
+    owners      -> User pk -> {'uuid', 'email'}
+    bots        -> Chatbox pk -> {'chatbot_type', 'is_deleted', 'owner_id'}
+
+(The operators of a room are cached in `operator_map`.)
+
+Every writer calls `invalidate()`, which drops the entry locally and publishes it on `NEAR_CACHE_CHANNEL`.
+A daemon thread in every daphne / celery process listens on that channel and drops the same entries there,
+so the processes stay coherent. Entries also expire after `NEAR_CACHE_TTL` seconds, which bounds the staleness
+if an invalidation is missed (bulk `.update()` calls don't fire the model signals).
+
+The hit / miss counters of every process are periodically written to `NEAR_CACHE_STATS`.
+Use `python manage.py near_cache_stats` to see the hit rates.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import UndefinedValueError, config
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from .exceptions import logger
+
+try:
+    NEAR_CACHE_ENABLED = config('NEAR_CACHE_ENABLED', cast=bool)
+except UndefinedValueError:
+    NEAR_CACHE_ENABLED = True
+
+try:
+    NEAR_CACHE_TTL = int(config('NEAR_CACHE_TTL'))
+except UndefinedValueError:
+    NEAR_CACHE_TTL = 60
+
+try:
+    NEAR_CACHE_MAXSIZE = int(config('NEAR_CACHE_MAXSIZE'))
+except UndefinedValueError:
+    NEAR_CACHE_MAXSIZE = 4096
+
+# How often (in seconds) every process writes its counters to `NEAR_CACHE_STATS`
+try:
+    NEAR_CACHE_STATS_INTERVAL = int(config('NEAR_CACHE_STATS_INTERVAL'))
+except UndefinedValueError:
+    NEAR_CACHE_STATS_INTERVAL = 60
+
+NEAR_CACHE_CHANNEL = 'NEAR_CACHE_INVALIDATION'
+NEAR_CACHE_STATS = 'NEAR_CACHE_STATS'
+
+MISSING = object()
+
+registry = {}
+
+listener_lock = threading.Lock()
+listener_pid = None
+
+
+class NearCache():
+    """A thread safe TTL / LRU cache, local to the process
+
+    Args:
+        name (str): Name of the cache. Used in the invalidation messages and the stats
+        maxsize (int, optional): Maximum number of entries. The least recently used entry is evicted after that
+        ttl (int, optional): Time (in seconds) after which an entry expires
+    """
+
+    def __init__(self, name, maxsize=NEAR_CACHE_MAXSIZE, ttl=NEAR_CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation, so that a value loaded before an invalidation is never stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        registry[name] = self
+
+
+    def get(self, key, loader, cache_none=False):
+        """Returns the value of `key`, calling `loader()` on a miss
+
+        Args:
+            key (str): The key
+            loader (function): Fetches the value from Redis / the DB
+            cache_none (bool, optional): Cache the value even if it's None. Defaults to False.
+        """
+        key = str(key)
+        if not NEAR_CACHE_ENABLED:
+            return loader()
+
+        ensure_listener()
+
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        value = loader()
+        if value is None and not cache_none:
+            return value
+
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (value, time.monotonic() + self.ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+
+    def get_many(self, keys, loader, cache_none=False):
+        """Returns {key: value} for `keys`, calling `loader(missing_keys)` once for all the misses
+
+        Args:
+            keys (list): The keys
+            loader (function): Fetches the values of a list of keys, as a dict, from Redis / the DB
+            cache_none (bool, optional): Cache the values even if they're None. Defaults to False.
+        """
+        keys = [str(key) for key in keys]
+        if not NEAR_CACHE_ENABLED:
+            return loader(keys) if len(keys) > 0 else {}
+
+        ensure_listener()
+
+        values = {}
+        missing = []
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key, MISSING)
+                if entry is not MISSING and entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    values[key] = entry[0]
+                else:
+                    self.misses += 1
+                    missing.append(key)
+            generation = self.generation
+
+        if len(missing) == 0:
+            return values
+
+        loaded = loader(missing)
+        values.update(loaded)
+
+        with self.lock:
+            if generation == self.generation:
+                expires = time.monotonic() + self.ttl
+                for key, value in loaded.items():
+                    if value is None and not cache_none:
+                        continue
+                    self.entries[key] = (value, expires)
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return values
+
+
+    def discard(self, *keys):
+        """Drops `keys` from the local process only. Use `invalidate()` to drop them everywhere
+        """
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.entries.pop(str(key), MISSING) is not MISSING:
+                    self.invalidations += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+    def invalidate(self, *keys):
+        """Drops `keys` from this process, and from every other process listening on `NEAR_CACHE_CHANNEL`
+        """
+        keys = [str(key) for key in keys]
+        if len(keys) == 0:
+            return
+        self.discard(*keys)
+        if not NEAR_CACHE_ENABLED:
+            return
+        try:
+            REDIS_CONNECTION = cache.get_client('')
+            REDIS_CONNECTION.publish(cache.make_key(NEAR_CACHE_CHANNEL), json.dumps({'cache': self.name, 'keys': keys}))
+        except Exception as ex:
+            logger.warning(f"Couldn't publish the invalidation of {self.name} {keys}: {ex}")
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else None,
+            }
+
+
+def stats():
+    """Returns the counters of every near cache of this process
+    """
+    return {name: near_cache.stats() for name, near_cache in registry.items()}
+
+
+def clear_all():
+    for near_cache in registry.values():
+        near_cache.clear()
+
+
+def handle_invalidation(message):
+    try:
+        content = json.loads(message['data'])
+        near_cache = registry.get(content['cache'])
+        if near_cache is not None:
+            near_cache.discard(*content['keys'])
+    except Exception as ex:
+        logger.warning(f"Invalid near cache invalidation {message}: {ex}")
+
+
+def publish_stats(REDIS_CONNECTION):
+    field = f"{socket.gethostname()}:{os.getpid()}"
+    key = cache.make_key(NEAR_CACHE_STATS)
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        pipe.hset(key, field, json.dumps(stats()))
+        pipe.expire(key, 5 * NEAR_CACHE_STATS_INTERVAL)
+        pipe.execute()
+
+
+def listen():
+    """Listens for invalidations on `NEAR_CACHE_CHANNEL`. Runs forever on a daemon thread
+    """
+    while True:
+        pubsub = None
+        try:
+            REDIS_CONNECTION = cache.get_client('')
+            pubsub = REDIS_CONNECTION.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(cache.make_key(NEAR_CACHE_CHANNEL))
+            # Anything cached while we weren't subscribed may have missed its invalidation
+            clear_all()
+            last_published = time.monotonic()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None and message['type'] == 'message':
+                    handle_invalidation(message)
+                if time.monotonic() - last_published >= NEAR_CACHE_STATS_INTERVAL:
+                    publish_stats(REDIS_CONNECTION)
+                    last_published = time.monotonic()
+        except Exception as ex:
+            logger.warning(f"Near cache listener disconnected: {ex}")
+            if pubsub is not None:
+                pubsub.close()
+            time.sleep(1)
+
+
+def ensure_listener():
+    """Starts the invalidation listener of this process, if it isn't running.
+    Checked against the pid, since the celery workers fork after the module is imported
+    """
+    global listener_pid
+    if listener_pid == os.getpid():
+        return
+    with listener_lock:
+        if listener_pid == os.getpid():
+            return
+        clear_all()
+        thread = threading.Thread(target=listen, name='near-cache-listener', daemon=True)
+        thread.start()
+        listener_pid = os.getpid()
+
+
+db_labels = NearCache('db_labels')
+owners = NearCache('owners')
+bots = NearCache('bots')
+
+
+def get_db_label(room_id, default=None):
+    """Returns the external DB label of `room_id`, which is set by the client widget API when the session starts
+    """
+    db_label = db_labels.get(room_id, lambda: cache.get(str(room_id)))
+    return default if db_label is None else db_label
+
+
+def set_db_label(room_id, db_label, timeout=DEFAULT_TIMEOUT):
+    cache.set(str(room_id), db_label, timeout=timeout)
+    db_labels.invalidate(room_id)
+
+
+def get_owner(user_id):
+    """Returns {'uuid', 'email'} of the user with pk `user_id`
+    """
+    def load():
+        from apps.accounts.models import User
+        user = User.objects.filter(pk=user_id).values('uuid', 'email').first()
+        if user is None:
+            return None
+        return {'uuid': str(user['uuid']), 'email': user['email']}
+    return owners.get(user_id, load)
+
+
+def get_bot(bot_id):
+    """Returns {'chatbot_type', 'is_deleted', 'owner_id'} of the Chatbox with pk `bot_id`
+    """
+    def load():
+        from apps.chatbox.models import Chatbox
+        return Chatbox.objects.filter(pk=bot_id).values('chatbot_type', 'is_deleted', 'owner_id').first()
+    return bots.get(bot_id, load)
@@ -0,0 +1,152 @@
+"""
+clientwidget/operator_map.py
+
+Routing index between the live rooms and the operators assigned to them, stored as Redis sets.
+
+    ROOM_OPERATORS_{room_id}       -> Set of the operators assigned to the room
+    OPERATOR_ROOMS_{operator_id}   -> Reverse index: set of the rooms assigned to the operator
+
+Finding the operators of a room is a single SMEMBERS, instead of unpickling a map of every live room of the owner,
+and assignments only touch the sets of the room and its operators, so concurrent updates don't overwrite each other.
+
+The operators of a room are also kept in a process local near cache (see `near_cache`), which every write invalidates.
+"""
+
+from django.core.cache import cache
+from redis.exceptions import WatchError
+
+from .near_cache import NearCache
+from .views import BUFFER_TIME, lock_timeout
+
+OPERATOR_MAP_TIMEOUT = lock_timeout + BUFFER_TIME
+
+room_operators = NearCache('room_operators')
+
+
+def room_operators_key(room_id):
+    return cache.make_key(f"ROOM_OPERATORS_{room_id}")
+
+
+def operator_rooms_key(operator_id):
+    return cache.make_key(f"OPERATOR_ROOMS_{operator_id}")
+
+
+def decode_members(members):
+    return sorted(member.decode() if isinstance(member, bytes) else member for member in members)
+
+
+def get_room_operators(room_id):
+    """Returns the list of operators assigned to `room_id`. Empty if there are none
+    """
+    def load():
+        REDIS_CONNECTION = cache.get_client('')
+        return decode_members(REDIS_CONNECTION.smembers(room_operators_key(room_id)))
+    return list(room_operators.get(room_id, load))
+
+
+def get_operators_for_rooms(room_ids):
+    """Fetches the operators of multiple rooms in a single round trip
+
+    Returns:
+        dict: {room_id (str): [operator_id, ...]}
+    """
+    room_ids = [str(room_id) for room_id in room_ids]
+    if len(room_ids) == 0:
+        return {}
+    def load(pending):
+        REDIS_CONNECTION = cache.get_client('')
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            for room_id in pending:
+                pipe.smembers(room_operators_key(room_id))
+            results = pipe.execute()
+        return {room_id: decode_members(members) for room_id, members in zip(pending, results)}
+
+    # Only the rooms missing from the near cache are fetched from Redis
+    operators = room_operators.get_many(room_ids, load)
+    return {room_id: list(operators[room_id]) for room_id in room_ids}
+
+
+def get_operator_rooms(operator_id):
+    """Returns the list of rooms assigned to `operator_id`
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    return decode_members(REDIS_CONNECTION.smembers(operator_rooms_key(operator_id)))
+
+
+def is_room_operator(room_id, operator_id):
+    REDIS_CONNECTION = cache.get_client('')
+    return bool(REDIS_CONNECTION.sismember(room_operators_key(room_id), str(operator_id)))
+
+
+def set_room_operators(room_id, operator_ids, timeout=OPERATOR_MAP_TIMEOUT):
+    """Assigns `operator_ids` to `room_id`, replacing the previous assignment. Both indexes are updated in one transaction.
+
+    The previous operators are read under a WATCH of the room's set, and the transaction is retried if the set changed
+    in between, so a concurrent assignment never leaves the room in the reverse index of an operator it was taken from
+    """
+    room_id = str(room_id)
+    operator_ids = [str(operator_id) for operator_id in operator_ids]
+    key = room_operators_key(room_id)
+
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                previous = set(decode_members(pipe.smembers(key)))
+                pipe.multi()
+                pipe.delete(key)
+                for operator_id in previous.difference(operator_ids):
+                    pipe.srem(operator_rooms_key(operator_id), room_id)
+                if len(operator_ids) > 0:
+                    pipe.sadd(key, *operator_ids)
+                    pipe.expire(key, timeout)
+                    for operator_id in operator_ids:
+                        pipe.sadd(operator_rooms_key(operator_id), room_id)
+                        pipe.expire(operator_rooms_key(operator_id), timeout)
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+    room_operators.invalidate(room_id)
+
+
+def add_room_operators(room_id, operator_ids, timeout=OPERATOR_MAP_TIMEOUT):
+    """Adds `operator_ids` to the operators of `room_id`
+    """
+    room_id = str(room_id)
+    operator_ids = [str(operator_id) for operator_id in operator_ids]
+    if len(operator_ids) == 0:
+        return
+    key = room_operators_key(room_id)
+
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.sadd(key, *operator_ids)
+        pipe.expire(key, timeout)
+        for operator_id in operator_ids:
+            pipe.sadd(operator_rooms_key(operator_id), room_id)
+            pipe.expire(operator_rooms_key(operator_id), timeout)
+        pipe.execute()
+    room_operators.invalidate(room_id)
+
+
+def remove_room_operators(room_id, operator_ids):
+    room_id = str(room_id)
+    operator_ids = [str(operator_id) for operator_id in operator_ids]
+    if len(operator_ids) == 0:
+        return
+
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.srem(room_operators_key(room_id), *operator_ids)
+        for operator_id in operator_ids:
+            pipe.srem(operator_rooms_key(operator_id), room_id)
+        pipe.execute()
+    room_operators.invalidate(room_id)
+
+
+def clear_room_operators(room_id):
+    """Removes every operator assignment of `room_id`
+    """
+    set_room_operators(room_id, [])
@@ -0,0 +1,140 @@
+"""
+clientwidget/partitions.py
+
+Monthly range partitioning (on `created_on`) of the `ChatMessage` table, on PostgreSQL 11+.
+
+    clientwidget_chatmessage                    -> Partitioned table
+    clientwidget_chatmessage_y2020m01           -> Rows created in January 2020
+    clientwidget_chatmessage_default            -> Rows outside of every monthly partition
+
+A partitioned table needs the partition key in every unique constraint, so the primary key becomes (id, created_on).
+The `chatmessage_room_seq` constraint on (room_id, seq) can't be kept on the partitioned table. Every partition has
+a unique index on (room_id, seq) instead (`{partition}_room_seq`), so a seq is unique within a month, and
+`INSERT ... ON CONFLICT DO NOTHING` still skips the rows which are already there (see `write_behind`).
+
+The limit: the same seq in two different months isn't caught by the DB. The sequence numbers are handed out under the
+row lock of the room (see `events.append_messages_to_db()`), and a flush which is retried keeps the `created_on` of
+its messages, so it lands in the same partition.
+
+`ChatRoom` isn't partitioned: almost every query looks a room up by `room_id` alone, which would have to probe every
+partition. Old rooms are instead moved out of the hot storage by the archive tier (see `archive`).
+
+The table is converted once with `python manage.py partition_chat_messages --convert`. After that, the
+`clientwidget_archive` job keeps `PARTITION_MONTHS_AHEAD` months of partitions ready.
+"""
+
+from datetime import datetime
+
+from decouple import UndefinedValueError, config
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .exceptions import logger
+
+try:
+    PARTITION_MONTHS_AHEAD = int(config('PARTITION_MONTHS_AHEAD'))
+except UndefinedValueError:
+    PARTITION_MONTHS_AHEAD = 3
+
+
+def get_table():
+    from .models import ChatMessage
+    return ChatMessage._meta.db_table
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=value.tzinfo)
+
+
+def add_months(month, num_months):
+    index = month.year * 12 + month.month - 1 + num_months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month, table=None):
+    return f"{table or get_table()}_y{month.year}m{month.month:02d}"
+
+
+def is_partitioned(db_label='default'):
+    with connections[db_label].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [get_table()])
+        return cursor.fetchone() is not None
+
+
+def create_partition(cursor, month, table=None):
+    """Creates the partition of `month`, if it doesn't exist. Returns `True` if it was created"""
+    table = table or get_table()
+    name = partition_name(month, table)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0] is not None:
+        return False
+    cursor.execute(
+        f'CREATE TABLE "{name}" PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+        [month, add_months(month, 1)],
+    )
+    create_room_seq_index(cursor, name)
+    return True
+
+
+def create_room_seq_index(cursor, name):
+    """The (room_id, seq) constraint of the model, on a single partition"""
+    cursor.execute(f'CREATE UNIQUE INDEX "{name}_room_seq" ON "{name}" (room_id, seq)')
+
+
+def ensure_partitions(db_label='default', months_ahead=PARTITION_MONTHS_AHEAD):
+    """Creates the partitions from the current month up to `months_ahead` months later. Returns the names of the new ones"""
+    if not is_partitioned(db_label):
+        return []
+    current = month_start(timezone.now())
+    created = []
+    with transaction.atomic(using=db_label), connections[db_label].cursor() as cursor:
+        for i in range(months_ahead + 1):
+            month = add_months(current, i)
+            if create_partition(cursor, month):
+                created.append(partition_name(month))
+    if len(created) > 0:
+        logger.info(f"Created the partitions {created} on {db_label}")
+    return created
+
+
+def convert_to_partitioned(db_label='default', keep_legacy=False, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Converts the `ChatMessage` table into a partitioned table, in a single transaction. Returns the number of rows moved
+
+    The old table is renamed to `{table}_legacy` and its rows are copied into the new partitions. It's dropped
+    afterwards, unless `keep_legacy` is set.
+    """
+    table = get_table()
+    legacy = f"{table}_legacy"
+    if is_partitioned(db_label):
+        return 0
+
+    with transaction.atomic(using=db_label), connections[db_label].cursor() as cursor:
+        cursor.execute(f'LOCK TABLE "{table}" IN ACCESS EXCLUSIVE MODE')
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence = cursor.fetchone()[0]
+
+        # Constraint (and index) names are unique per schema, so the old ones are renamed first
+        cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+        cursor.execute(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "{table}_pkey" TO "{legacy}_pkey"')
+        cursor.execute(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "chatmessage_room_seq" TO "chatmessage_room_seq_legacy"')
+
+        cursor.execute(f'CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS) PARTITION BY RANGE (created_on)')
+        cursor.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (id, created_on)')
+        if sequence is not None:
+            # Otherwise, dropping the old table drops the sequence of the IDs along with it
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY "{table}".id')
+
+        cursor.execute(f'SELECT min(created_on) FROM "{legacy}"')
+        oldest = cursor.fetchone()[0] or timezone.now()
+        month, last = month_start(oldest), add_months(month_start(timezone.now()), months_ahead)
+        while month <= last:
+            create_partition(cursor, month, table)
+            month = add_months(month, 1)
+        cursor.execute(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT')
+        create_room_seq_index(cursor, f"{table}_default")
+
+        cursor.execute(f'INSERT INTO "{table}" SELECT * FROM "{legacy}"')
+        num_rows = cursor.rowcount
+        if not keep_legacy:
+            cursor.execute(f'DROP TABLE "{legacy}"')
+    return num_rows
@@ -0,0 +1,288 @@
+"""
+clientwidget/room_state.py
+
+The session state of a live room, stored as a single Redis hash (`ROOMSTATE_{room_id}`) with a single TTL.
+
+Every field is JSON encoded. A `RoomState` loads the whole hash with one HGETALL, buffers the updates,
+and writes back all the modified fields in one pipeline. Tearing down a room is a single UNLINK.
+
+Each session variable is a field of its own (`var:@name`), so concurrent writers (the consumer, webhooks, the flow executor)
+only ever overwrite the variables they actually modified. The `variables` field marks that the variables have been initialised.
+
+The keys which need a TTL of their own are not a part of this hash:
+    CLIENTWIDGET_EXPIRY_LOCK_   -> Its expiry event ends the session
+    CLIENTWIDGET_SESSION_TOKEN_ -> Session token for the APIs
+    CLIENTWIDGETLOCK_           -> Lock on the message history
+    CLIENTWIDGETTIMEOUT_        -> Timestamp of the last message
+    CLIENTWIDGET_WEBHOOK_       -> The room is waiting on a webhook (see `webhooks`)
+"""
+
+import json
+
+from django.core.cache import cache
+
+from .views import BUFFER_TIME, lock_timeout
+
+ROOM_STATE_TIMEOUT = lock_timeout + BUFFER_TIME
+
+# Fields of the room state
+LOCK = 'lock' # Somebody is connected to the room
+ROOM_INFO = 'room_info' # [room_id, chatbot_type]
+LEAD_FIELDS = 'lead_fields' # Lead fields which aren't filled yet
+LEAD_DATA = 'lead_data'
+SUBSCRIBED = 'subscribed' # Admin is subscribed to lead updates
+IS_LEAD = 'is_lead'
+COUNT = 'count' # Number of messages
+TAKEOVER = 'takeover'
+TEAM = 'team'
+SESSION_END = 'session_end'
+USER_LIST = 'user_list' # Admins / Operators in the room
+VARIABLES = 'variables' # Set once the session variables are initialised
+
+VARIABLE_PREFIX = 'var:'
+
+
+def room_state_key(room_id):
+    return cache.make_key(f"ROOMSTATE_{room_id}")
+
+
+def variable_field(variable):
+    return VARIABLE_PREFIX + variable
+
+
+def variables_from_fields(fields):
+    """Extracts the session variables from the (decoded) fields of a room. Returns None if they aren't initialised
+    """
+    if fields.get(VARIABLES) is None:
+        return None
+    prefix_length = len(VARIABLE_PREFIX)
+    return {field[prefix_length:]: value for field, value in fields.items() if field.startswith(VARIABLE_PREFIX)}
+
+
+def variable_fields(variables):
+    """The fields to HSET for `variables`, including the marker
+    """
+    return {VARIABLES: True, **{variable_field(variable): value for variable, value in variables.items()}}
+
+
+def decode_fields(content):
+    return {field.decode() if isinstance(field, bytes) else field: decode(value) for field, value in content.items()}
+
+
+def encode(value):
+    return json.dumps(value)
+
+
+def decode(value):
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+class RoomState():
+    """A buffered view of the state of a room.
+
+    Usage:
+        state = RoomState(room_id).load()
+        if state.get(LOCK) == True:
+            state.set(SESSION_END, True)
+        state.save()
+
+    Args:
+        room_id (uuid.UUID | str): The room ID
+        timeout (int, optional): TTL of the hash, which is refreshed on every save. Defaults to ROOM_STATE_TIMEOUT.
+    """
+
+    def __init__(self, room_id, timeout=ROOM_STATE_TIMEOUT):
+        self.room_id = str(room_id)
+        self.key = room_state_key(self.room_id)
+        self.timeout = timeout
+        self.fields = None
+        self.dirty = {}
+        self.deleted = set()
+
+
+    def load(self):
+        """Fetches every field of the room in a single HGETALL
+        """
+        REDIS_CONNECTION = cache.get_client('')
+        self.fields = decode_fields(REDIS_CONNECTION.hgetall(self.key))
+        return self
+
+
+    def get(self, field, default=None):
+        if field in self.dirty:
+            return self.dirty[field]
+        if field in self.deleted:
+            return default
+        if self.fields is None:
+            self.load()
+        value = self.fields.get(field)
+        return default if value is None else value
+
+
+    def set(self, field, value):
+        self.dirty[field] = value
+        self.deleted.discard(field)
+
+
+    def update(self, fields):
+        for field, value in fields.items():
+            self.set(field, value)
+
+
+    def delete(self, *fields):
+        for field in fields:
+            self.dirty.pop(field, None)
+            self.deleted.add(field)
+
+
+    def get_variables(self):
+        """Returns a dictionary of the session variables, or None if they aren't initialised
+        """
+        if self.fields is None:
+            self.load()
+        fields = {**self.fields, **self.dirty}
+        for field in self.deleted:
+            fields.pop(field, None)
+        return variables_from_fields(fields)
+
+
+    def get_variable(self, variable, default=None):
+        return self.get(variable_field(variable), default)
+
+
+    def set_variables(self, variables):
+        self.update(variable_fields(variables))
+
+
+    @property
+    def is_dirty(self):
+        return len(self.dirty) > 0 or len(self.deleted) > 0
+
+
+    def save(self):
+        """Writes back every modified field, and refreshes the TTL, in one round trip
+        """
+        if not self.is_dirty:
+            return
+
+        REDIS_CONNECTION = cache.get_client('')
+        with REDIS_CONNECTION.pipeline() as pipe:
+            if len(self.dirty) > 0:
+                pipe.hset(self.key, mapping={field: encode(value) for field, value in self.dirty.items()})
+                pipe.expire(self.key, self.timeout)
+            if len(self.deleted) > 0:
+                pipe.hdel(self.key, *self.deleted)
+            pipe.execute()
+
+        if self.fields is not None:
+            self.fields.update(self.dirty)
+            for field in self.deleted:
+                self.fields.pop(field, None)
+        self.dirty = {}
+        self.deleted = set()
+
+
+    def clear(self):
+        """Tears down the whole room state
+        """
+        clear_room_state(self.room_id)
+        self.fields = {}
+        self.dirty = {}
+        self.deleted = set()
+
+
+def get_room_field(room_id, field, default=None):
+    REDIS_CONNECTION = cache.get_client('')
+    value = decode(REDIS_CONNECTION.hget(room_state_key(room_id), field))
+    return default if value is None else value
+
+
+def get_room_fields(room_id, *fields):
+    """Fetches the fields of a room in a single HMGET. Missing fields are None
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    return [decode(value) for value in REDIS_CONNECTION.hmget(room_state_key(room_id), fields)]
+
+
+def set_room_fields(room_id, fields, timeout=ROOM_STATE_TIMEOUT):
+    """Sets multiple fields of a room, and refreshes the TTL, in one round trip
+    """
+    key = room_state_key(room_id)
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.hset(key, mapping={field: encode(value) for field, value in fields.items()})
+        pipe.expire(key, timeout)
+        pipe.execute()
+
+
+def set_room_field(room_id, field, value, timeout=ROOM_STATE_TIMEOUT):
+    set_room_fields(room_id, {field: value}, timeout=timeout)
+
+
+def incr_room_field(room_id, field, amount=1, timeout=ROOM_STATE_TIMEOUT):
+    """Atomically increments an integer field, and returns the new value
+    """
+    key = room_state_key(room_id)
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.hincrby(key, field, amount)
+        pipe.expire(key, timeout)
+        value, _ = pipe.execute()
+    return int(value)
+
+
+def get_variables(room_id, *variables):
+    """Fetches the session variables of a room.
+
+    If `variables` are given, only those are fetched (with a single HMGET), and the missing ones are left out.
+    Otherwise, every variable is fetched, and the result is None if the variables aren't initialised.
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    if len(variables) > 0:
+        values = REDIS_CONNECTION.hmget(room_state_key(room_id), [variable_field(variable) for variable in variables])
+        return {variable: decode(value) for variable, value in zip(variables, values) if value is not None}
+    return variables_from_fields(decode_fields(REDIS_CONNECTION.hgetall(room_state_key(room_id))))
+
+
+def get_variable(room_id, variable, default=None):
+    return get_room_field(room_id, variable_field(variable), default)
+
+
+def set_variables(room_id, variables, timeout=ROOM_STATE_TIMEOUT):
+    """Atomically sets multiple session variables of a room. The other variables are left untouched
+    """
+    set_room_fields(room_id, variable_fields(variables), timeout=timeout)
+
+
+def set_variable(room_id, variable, value, timeout=ROOM_STATE_TIMEOUT):
+    set_variables(room_id, {variable: value}, timeout=timeout)
+
+
+def delete_variables(room_id, *fields):
+    """Deletes every session variable of a room, along with `fields`
+    """
+    key = room_state_key(room_id)
+    REDIS_CONNECTION = cache.get_client('')
+    names = [field.decode() if isinstance(field, bytes) else field for field in REDIS_CONNECTION.hkeys(key)]
+    names = [field for field in names if field.startswith(VARIABLE_PREFIX)]
+    REDIS_CONNECTION.hdel(key, VARIABLES, *names, *fields)
+
+
+def delete_room_fields(room_id, *fields):
+    REDIS_CONNECTION = cache.get_client('')
+    REDIS_CONNECTION.hdel(room_state_key(room_id), *fields)
+
+
+def is_room_locked(room_id):
+    """Returns True if somebody is connected to the room
+    """
+    return get_room_field(room_id, LOCK) == True
+
+
+def clear_room_state(room_id):
+    """Deletes the whole state of a room, with a single (non blocking) UNLINK
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    REDIS_CONNECTION.unlink(room_state_key(room_id))
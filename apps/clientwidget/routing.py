@@ -6,7 +6,9 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 # TODO: Wrap this up inside a separate application
 from django.urls import re_path
 
-from . import consumers
+from decouple import UndefinedValueError, config
+
+from . import async_consumers, consumers
 
 
 import os
@@ -20,11 +22,40 @@ import json
 from channels.generic.websocket import WebsocketConsumer
 
 
+# Routes served by the async consumers (see `async_consumers`). A comma separated list of route names, or "all"
+try:
+    ASYNC_CONSUMERS = config('ASYNC_CONSUMERS')
+except UndefinedValueError:
+    ASYNC_CONSUMERS = ''
+
+CONSUMER_CLASSES = {
+    'operator': (consumers.OperatorConsumer, async_consumers.AsyncOperatorConsumer),
+    'clientwidget': (consumers.ClientWidgetConsumer, async_consumers.AsyncClientWidgetConsumer),
+    'admin': (consumers.AdminConsumer, async_consumers.AsyncAdminConsumer),
+    'listing': (consumers.LongPollingConsumer, async_consumers.AsyncLongPollingConsumer),
+}
+
+
+def get_async_routes(value=None):
+    value = ASYNC_CONSUMERS if value is None else value
+    routes = set(route.strip() for route in value.split(',') if route.strip() != '')
+    if 'all' in routes:
+        return set(CONSUMER_CLASSES)
+    return routes
+
+
+def get_consumer(route, async_routes=None):
+    """Returns the consumer class of `route`, sync or async depending on `ASYNC_CONSUMERS`"""
+    async_routes = get_async_routes() if async_routes is None else async_routes
+    sync_consumer, async_consumer = CONSUMER_CLASSES[route]
+    return async_consumer if route in async_routes else sync_consumer
+
+
 websocket_urlpatterns = [
-    path('ws/chat_updated/<uuid:owner_id>/<uuid:operator_id>/operator', consumers.OperatorConsumer),
-    path('ws/chat_updated/<uuid:owner_id>/<uuid:room_id>', consumers.ClientWidgetConsumer),
-    path('ws/chat_updated/<uuid:owner_id>/admin', consumers.AdminConsumer),
-    path('ws/chat_updated/<uuid:owner_id>/listing', consumers.LongPollingConsumer),
+    path('ws/chat_updated/<uuid:owner_id>/<uuid:operator_id>/operator', get_consumer('operator')),
+    path('ws/chat_updated/<uuid:owner_id>/<uuid:room_id>', get_consumer('clientwidget')),
+    path('ws/chat_updated/<uuid:owner_id>/admin', get_consumer('admin')),
+    path('ws/chat_updated/<uuid:owner_id>/listing', get_consumer('listing')),
 ]
 
 application = ProtocolTypeRouter({
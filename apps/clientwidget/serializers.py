@@ -22,9 +22,14 @@ class BotInfoSerializer(serializers.ModelSerializer):
 
 class ActiveChatRoomSerializer(serializers.ModelSerializer):
     bot_info = BotInfoSerializer(read_only=True)
+    # The live counts (from `counters.get_msgcounts()`) are passed in the context as `msg_counts`
+    num_msgs = serializers.SerializerMethodField()
     class Meta:
         model = models.ChatRoom
-        fields = ('bot_id', 'room_id', 'room_name', 'created_on', 'bot_is_active', 'variables', 'bot_info', 'status', 'chatbot_type', 'assignment_type', 'assigned_operator', 'channel_id', 'updated_on')
+        fields = ('bot_id', 'room_id', 'room_name', 'created_on', 'bot_is_active', 'variables', 'bot_info', 'status', 'chatbot_type', 'assignment_type', 'assigned_operator', 'channel_id', 'updated_on', 'num_msgs')
+
+    def get_num_msgs(self, obj):
+        return self.context.get('msg_counts', {}).get(str(obj.room_id), obj.num_msgs)
 
 class ChatWidgetSerializer(serializers.ModelSerializer):
     variables = serializers.JSONField()
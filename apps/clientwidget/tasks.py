@@ -1,4 +1,3 @@
-import json
 import os
 import uuid
 from datetime import datetime
@@ -18,7 +17,9 @@ from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django.utils import timezone
 from chatbot.settings import CELERY_BROKER_URL, CELERY_RESULT_BACKEND
 
+from . import fanout, near_cache
 from .exceptions import LiveChatException, log_consumer_exceptions, logger
+from .history_codec import decode_entries
 
 # Create a celery object
 # Call it using eventlet for parallelism in Windows: `celery worker -A apps.chatbox.tasks --pool=eventlet --loglevel=info`
@@ -50,7 +51,7 @@ def fetch_history_from_redis(room_id, num_msgs=None, post_delete=False):
                 return []
             else:
                 history_bytes = REDIS_CONNECTION.lrange(cache.make_key(f'HISTORY_{room_name}'), 0, num_msgs-1)
-        history = list(json.loads(msg) for msg in history_bytes) # history is now a Python List of Dict
+        history = decode_entries(history_bytes) # history is now a Python List of Dict
         if post_delete:
             REDIS_CONNECTION.delete(cache.make_key(f"HISTORY_{room_name}"))
         print("in clientwidget_updated fetch_history_from_redis: ", room_name, history)
@@ -61,60 +62,46 @@ def fetch_history_from_redis(room_id, num_msgs=None, post_delete=False):
 
 
 
-def append_msg_to_redis(room_name, message_dict, store_full=False, timeout=None):
+def append_msg_to_redis(room_name, message_dict, store_full=False, timeout=None, count=False):
     """
         Appends the message dictionary from the websocket to the Redis Message List
     """
+    from . import events
     try:
         room_name = uuid.UUID(room_name)
-        REDIS_CONNECTION = cache.get_client('')
-
-        if store_full:
-            REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
-            # Finally set a lock on this room name. We'll need it later for flushing to DB
-            cache.set(f'CLIENTWIDGETLOCK_{room_name}', room_name, timeout=timeout)
-            return
-
-        if 'message' in message_dict:
-            if isinstance(message_dict['message'], list):
-                # If we want to store an array of parsed messages
-                for msg in message_dict['message']:
-                    REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(msg))
-            else:
-                REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
-        else:
-            REDIS_CONNECTION.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
-        
-        # Finally set a lock on this room name. We'll need it later for flushing to DB
-        cache.set(f'CLIENTWIDGETLOCK_{room_name}', room_name, timeout=timeout)
+        return events.append_msg_to_redis(room_name, message_dict, store_full=store_full, timeout=timeout, count=count)
     except Exception as ex:
         print(ex)
 
 
 @task
-def flush_db_task(room_id: uuid.UUID, user: str, variables: dict, is_lead=None, db_label='default', bot_type="website") -> None:
+def flush_db_task(room_id: uuid.UUID, user: str, variables: dict, is_lead=None, db_label='default', bot_type="website", messages=None) -> None:
     """Flushes the entire session content to the DB
 
     Args:
         room_id (uuid.UUID): The room id
         user (str): The user email (Will default to 'AnonymousUser' for non authenticated Users)
         variables (dict): A dictionary consisting of all variables for the current session
+        messages (list, optional): The session history, from the snapshot of a torn down room. If None, it's fetched (and deleted) from Redis
     """
 
     print("in flush_db_task:", room_id)
     ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
     
+    from .events import append_messages_to_db
+
     # Dump messages and session variables
-    with transaction.atomic():
-        instance = ChatRoom.objects.using(db_label).get(pk=room_id)
+    with transaction.atomic(using=db_label):
+        instance = ChatRoom.objects.using(db_label).select_for_update().get(pk=room_id)
         if variables is not None:
             instance.variables = variables
         else:
             print(f"Is there a bug with the flow? Variables is NULL for Room: {room_id}")
         
         print("in clientwidget_updated flush_to_db: ", room_id, instance.room_id, variables)
-        instance.messages.extend(fetch_history_from_redis(instance.room_id, post_delete=False))
-        instance.recent_messages.extend(fetch_history_from_redis(instance.room_id, post_delete=True))
+        if messages is None:
+            messages = fetch_history_from_redis(instance.room_id, post_delete=True)
+        append_messages_to_db(instance.room_id, messages, db_name=db_label)
         
         if is_lead is not None:
             instance.is_lead = is_lead
@@ -129,6 +116,16 @@ def flush_db_task(room_id: uuid.UUID, user: str, variables: dict, is_lead=None,
             print("there", instance.bot_is_active, instance.is_lead)
 
 
+@shared_task
+def flush_write_behind(db_label=None):
+    """Drains the write-behind queue of `db_label` (or of every DB label) into the DB
+    """
+    from . import write_behind
+    if db_label is None:
+        return write_behind.flush_all()
+    return write_behind.flush_pending(db_label)
+
+
 @shared_task
 def adding_task(x, y):
     """
@@ -142,20 +139,10 @@ def send_user_message(groups, event={}, data={}, store_full=False):
     """
         Sends the LiveChat message using websockets via Celery
     """
-    for group in groups:
-        async_to_sync(channel_layer.group_send)(
-            group,
-            {
-                'type': 'chat_message',
-                **event,
-            }
-        )
+    fanout.send_to_groups(groups, {'type': 'chat_message', **event}, channel_layer)
     
     if 'room_id' in event:
-        append_msg_to_redis(event['room_id'], data, store_full=store_full)
-        num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{event['room_id']}", 0)
-        num_msgs += 1
-        cache.set(f"CLIENTWIDGET_COUNT_{event['room_id']}", num_msgs, timeout=lock_timeout + BUFFER_TIME)
+        append_msg_to_redis(event['room_id'], data, store_full=store_full, count=True)
 
 
 @shared_task
@@ -163,20 +150,8 @@ def send_template_message(sender_group, receiver_group, reply, room_name, store_
     """
         Sends the Template Message using websockets via Celery
     """
-    async_to_sync(channel_layer.group_send)(
-        sender_group, {
-            'type': 'template_message',
-            **reply,
-        }
-    )
-
-    if room_name is not None:
-        async_to_sync(channel_layer.group_send)(
-            receiver_group, {
-                'type': 'template_message',
-                **reply,
-            }
-        )
+    groups = [sender_group, receiver_group] if room_name is not None else [sender_group]
+    fanout.send_to_groups(groups, {'type': 'template_message', **reply}, channel_layer)
 
     # Append the BOT response to Redis List
     append_msg_to_redis(room_name, reply, store_full=store_full)
@@ -191,12 +166,13 @@ def send_from_api_task(message: str, room_name: str, user: str = None):
         room_name (str): The name of the chat room
         user (str, optional): The name of the user. Defaults to None.
     """
+    from . import room_state
     group_name = 'chat_%s' % room_name
     
     # We can directly send a message to this group
     # only if nobody is there. So check the lock
     # TODO: Check this atomically
-    lock = cache.get(f'CLIENTWIDGETROOMLOCK_{room_name}')
+    lock = room_state.get_room_field(room_name, room_state.LOCK)
     
     if lock == True:
         async_to_sync(channel_layer.group_send)(
@@ -230,6 +206,7 @@ def send_from_api_task(message: str, room_name: str, user: str = None):
 def chat_lead_send_update(room_id, is_lead, data):
     """Sends an Email Update if a lead is encountered during an ongoing live-chat
     """
+    from . import room_state
     ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
 
     queryset = ChatRoom.objects.filter(pk=room_id, bot_is_active=True)
@@ -251,7 +228,7 @@ def chat_lead_send_update(room_id, is_lead, data):
         data = chatroom.variables
     
     if is_lead == True:
-        if cache.get(f'CLIENTWIDGETROOMLOCK_{room_id}') is not None:
+        if room_state.is_room_locked(room_id):
             # Ongoing chat. Send Email
             messages = fetch_history_from_redis(room_id)
             message = render_to_string('clientwidget/send_lead_encounter_email.html', {'user': owner, 'lead_data': data, 'messages': messages})
@@ -263,7 +240,7 @@ def chat_lead_send_update(room_id, is_lead, data):
             # Chat has completed
             pass
     else:
-        if cache.get(f'CLIENTWIDGETROOMLOCK_{room_id}') is not None:
+        if room_state.is_room_locked(room_id):
             # Ongoing chat. Send Email
             messages = fetch_history_from_redis(room_id)
             message = render_to_string('clientwidget/send_nonlead_encounter_email.html', {'user': owner, 'nonlead_data': data, 'messages': messages})
@@ -303,31 +280,34 @@ def send_update(owner_id, field_dict, team_name=None):
 
 @shared_task
 def flush_session(room_name, room_id, session_end):
+    from .teardown import teardown_room
     ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
 
     if not isinstance(room_id, uuid.UUID):
         room_id = uuid.UUID(room_id)
     
-    ext = cache.get(str(room_id), "default")
-    session_variables = cache.get(f"VARIABLES_{room_name}")
-    is_lead = cache.get(f"IS_LEAD_{room_name}")
+    ext = near_cache.get_db_label(str(room_id), "default")
+
+    # Snapshot the room, and delete the locks (and the chat information, if the session has ended) in one go
+    snapshot = teardown_room(room_name, room_id=room_id, session_end=(session_end == True))
+    is_lead = snapshot.is_lead
     if is_lead != True:
         is_lead = False
+
+    from . import write_behind
+    if write_behind.WRITE_BEHIND_ENABLED:
+        # Flushed (and made inactive) along with the other ended rooms of the DB label
+        write_behind.enqueue_flush(room_id, ext, variables=snapshot.variables, messages=snapshot.messages, first_seq=snapshot.first_seq,
+                                     is_lead=is_lead, num_msgs=snapshot.count, takeover=snapshot.takeover)
+        return
+
     if hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
-        _ = flush_db_task.delay(room_id, 'AnonymousUser', session_variables, is_lead=is_lead, db_label=ext)
+        _ = flush_db_task.delay(room_id, 'AnonymousUser', snapshot.variables, is_lead=is_lead, db_label=ext, messages=snapshot.messages)
     else:
         # Only flush to DB for website bot
-        flush_db_task(room_id, 'AnonymousUser', session_variables, is_lead=is_lead, db_label=ext)
-    
-    # Make the chat inactive
-    if (cache.get(f"CLIENTWIDGET_SESSION_END_{room_name}") == True) or (session_end == True):
-        # Delete token only if session has ended
-        cache.delete(f"CLIENTWIDGET_SESSION_TOKEN_{str(room_id)}")
-    
-    # Check the takeover flag
-    takeover = cache.get(f"CLIENTWIDGET_TAKEOVER_{room_name}")
-    num_msgs = cache.get(f"CLIENTWIDGET_COUNT_{room_name}", 0)
+        flush_db_task(room_id, 'AnonymousUser', snapshot.variables, is_lead=is_lead, db_label=ext, messages=snapshot.messages)
 
+    # Make the chat inactive
     with transaction.atomic():
         if room_id is None:
             queryset = ChatRoom.objects.using(ext).filter(room_name=room_name)
@@ -336,33 +316,12 @@ def flush_session(room_name, room_id, session_end):
         if queryset.count() == 1:
             instance = queryset.first()
             instance.bot_is_active = False
-            instance.num_msgs = num_msgs
+            instance.num_msgs = snapshot.count
             if hasattr(instance, 'end_time'):
                 instance.end_time = datetime.utcnow()
-            if takeover == True:
+            if snapshot.takeover == True:
                 instance.takeover = True
             instance.save(send_update=True, using=ext)
-    
-    # Delete the locks
-    cache.delete(f'CLIENTWIDGETROOMLOCK_{room_name}') # Lock for the room
-    cache.delete(f'CLIENTWIDGETLOCK_{room_name}') # Lock for the room messages
-    cache.delete(f"CLIENTWIDGETTIMEOUT_{room_name}")
-
-    # Delete the expiry lock
-    cache.delete(f"CLIENTWIDGET_EXPIRY_LOCK_{room_name}")
-
-    if (cache.get(f"CLIENTWIDGET_SESSION_END_{room_name}") == True) or (session_end == True):
-        # Only if session has ended
-        # Delete the chat information
-        cache.delete(f"CLIENTWIDGET_SESSION_END_{room_name}")
-        cache.delete(f"CLIENTWIDGET_TAKEOVER_{room_name}")
-        cache.delete(f"CLIENTWIDGET_COUNT_{room_name}")
-        cache.delete(f'CLIENTWIDGETLEADFIELDS_{room_name}')
-        cache.delete(f"CLIENTWIDGETLEADDATA_{room_name}")
-        cache.delete(f'CLIENTWIDGETROOMINFO_{room_name}')
-        cache.delete(f"CLIENTWIDGETSUBSCRIBED_{room_name}")
-        cache.delete(f"CLIENTWIDGET_USER_LIST_{room_name}")
-        cache.delete(f'IS_LEAD_{room_name}')
 
 
 
@@ -370,9 +329,10 @@ def flush_session(room_name, room_id, session_end):
 def check_active_room_status(room_id, bot_type='website'):
     """Periodically checks the status of an active room and deactivates it if no messages are received over a certain period of time
     """
+    from . import room_state
     from .views import BUFFER_TIME, lock_timeout
     if bot_type == 'website':
-        lock = cache.get(f"CLIENTWIDGETROOMLOCK_{room_id}")
+        lock = room_state.get_room_field(room_id, room_state.LOCK)
         if lock is None:
             return
         
@@ -394,7 +354,7 @@ def check_active_room_status(room_id, bot_type='website'):
 
 @shared_task
 def update_operator_mappings(owner_id, assigned_operator_id, room_id, status, team_name=None):
-    from .views import BUFFER_TIME, lock_timeout
+    from . import operator_map, room_state
     if room_id is None:
         return
     
@@ -406,56 +366,11 @@ def update_operator_mappings(owner_id, assigned_operator_id, room_id, status, te
         print(f"Insert {len(assigned_operator_id)} members to Room {room_id}")
 
         if team_name is not None:
-            cache.set(f"TEAM_{room_id}", team_name, timeout=lock_timeout + BUFFER_TIME)
-                
-            
-        owner_map = cache.get(f"OWNER_MAP_{owner_id}")
-        if owner_map is None:
-            for assigned_operator in assigned_operator_id:
-                owner_map = {str(assigned_operator): str(room_id)}
-
-                #TODO: need to change this to: owner_map = {str(room_id): assigned_operator_id} for efficiency
-        else:
-            for assigned_operator in assigned_operator_id:
-                owner_map[str(assigned_operator)] = str(room_id)
-            
-        cache.set(f"OWNER_MAP_{owner_id}", owner_map, timeout=lock_timeout + BUFFER_TIME)
-
-        client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-        if client_map is None:
-            client_map = {str(room_id): assigned_operator_id}
-        else:    
-            client_map[str(room_id)] = assigned_operator_id
-        cache.set(f"CLIENT_MAP_{owner_id}", client_map, timeout=lock_timeout + BUFFER_TIME)
-
-        #operator_map = cache.get(f"OPERATOR_MAP_{assigned_operator_id}")
-        #if operator_map is None:
-        #    operator_map = {str(owner_id): str(room_id)}
-        #else:
-        #    owner_map[str(owner_id)] = str(room_id)
-        #cache.set(f"OPERATOR_MAP_{assigned_operator_id}", operator_map, timeout=lock_timeout + BUFFER_TIME)
+            room_state.set_room_field(room_id, room_state.TEAM, team_name)
+
+        operator_map.set_room_operators(room_id, assigned_operator_id)
     
     elif status in ['resolve', 'disconnected']:
         # Remove items from the mapping
-        owner_map = cache.get(f"OWNER_MAP_{owner_id}")
-        if owner_map is None:
-            pass
-        else:
-            try:
-                for assigned_operator in assigned_operator_id:
-                    del owner_map[str(assigned_operator)]
-                    cache.set(f"OWNER_MAP_{owner_id}", owner_map, timeout=lock_timeout + BUFFER_TIME)
-            except:
-                pass
-        
-        client_map = cache.get(f"CLIENT_MAP_{owner_id}")
-        if client_map is None:
-            pass
-        else:
-            try:
-                del client_map[str(room_id)]
-                for assigned_operator in assigned_operator_id:
-                    cache.set(f"CLIENT_MAP_{assigned_operator}", client_map, timeout=lock_timeout + BUFFER_TIME)
-            except:
-                pass
+        operator_map.clear_room_operators(room_id)
 
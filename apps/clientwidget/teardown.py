@@ -0,0 +1,143 @@
+"""
+clientwidget/teardown.py
+
+Atomic teardown of a live room.
+
+A single Lua script snapshots the room state and the session history, and deletes every key of the room,
+so a reconnecting client never sees a half deleted room. The DB flush then runs from the returned `RoomSnapshot`.
+"""
+
+from django.core.cache import cache
+
+from . import counters, history_seq, room_state
+from .history_codec import decode_entries
+
+# KEYS: room state, history, session token, user count, history seq, followed by the keys which are always deleted
+# ARGV: session_end (0 | 1), reset_count (0 | 1), TTL of the user count, session end field, lock field
+TEARDOWN_SCRIPT = """
+local state = redis.call('HGETALL', KEYS[1])
+local history = redis.call('LRANGE', KEYS[2], 0, -1)
+local last_seq = redis.call('GET', KEYS[5]) or ''
+
+local session_end = ARGV[1] == '1'
+for i = 1, #state, 2 do
+    if state[i] == ARGV[4] and state[i + 1] == 'true' then
+        session_end = true
+    end
+end
+
+redis.call('UNLINK', KEYS[2])
+for i = 6, #KEYS do
+    redis.call('UNLINK', KEYS[i])
+end
+
+if session_end then
+    redis.call('UNLINK', KEYS[1], KEYS[3])
+else
+    redis.call('HDEL', KEYS[1], ARGV[5])
+end
+
+if ARGV[2] == '1' then
+    redis.call('SET', KEYS[4], 0, 'EX', ARGV[3])
+end
+
+return {session_end and 1 or 0, state, history, last_seq}
+"""
+
+teardown_script = None
+
+
+class RoomSnapshot():
+    """The state of a room at the moment it was torn down
+
+    Args:
+        fields (dict): The (decoded) fields of the room state
+        messages (list): The session history
+        session_end (bool): Whether the session has ended. If not, only the room lock and the history were deleted
+        last_seq (int, optional): The seq of the last message of the history (see `history_seq`). None if unknown
+    """
+
+    def __init__(self, fields, messages, session_end, last_seq=None):
+        self.fields = fields
+        self.messages = messages
+        self.session_end = session_end
+        self.last_seq = last_seq
+
+
+    @property
+    def first_seq(self):
+        """The seq of the first message of the history, or None if it's unknown"""
+        if self.last_seq is None or len(self.messages) == 0:
+            return None
+        first_seq = self.last_seq - len(self.messages) + 1
+        return first_seq if first_seq > 0 else None
+
+
+    @property
+    def variables(self):
+        return room_state.variables_from_fields(self.fields)
+
+
+    @property
+    def locked(self):
+        return self.fields.get(room_state.LOCK) == True
+
+
+    @property
+    def is_lead(self):
+        return self.fields.get(room_state.IS_LEAD)
+
+
+    @property
+    def takeover(self):
+        return self.fields.get(room_state.TAKEOVER) == True
+
+
+    @property
+    def count(self):
+        count = self.fields.get(room_state.COUNT)
+        return 0 if count is None else int(count)
+
+
+def teardown_room(room_name, room_id=None, session_end=False, reset_count=False):
+    """Snapshots the room, and deletes the history and the locks of the room, in a single atomic call.
+
+    If the session has ended (either `session_end` is set, or the room state says so), the whole room state
+    and the session token are deleted as well. Otherwise, only the room lock is released.
+
+    Args:
+        room_name (str): The room name (which keys the room state, history and the locks)
+        room_id (uuid.UUID | str, optional): The room ID (which keys the session token). Defaults to `room_name`.
+        session_end (bool, optional): End the session. Defaults to False.
+        reset_count (bool, optional): Reset the user count of the room to 0. Defaults to False.
+
+    Returns:
+        RoomSnapshot: The state of the room, before it was deleted
+    """
+    global teardown_script
+
+    room_name = str(room_name)
+    room_id = room_name if room_id is None else str(room_id)
+
+    REDIS_CONNECTION = cache.get_client('')
+    if teardown_script is None:
+        teardown_script = REDIS_CONNECTION.register_script(TEARDOWN_SCRIPT)
+
+    keys = [
+        room_state.room_state_key(room_name),
+        cache.make_key(f"HISTORY_{room_name}"),
+        cache.make_key(f"CLIENTWIDGET_SESSION_TOKEN_{room_id}"),
+        counters.user_count_key(room_name),
+        history_seq.seq_key(room_name),
+        cache.make_key(f"CLIENTWIDGETLOCK_{room_name}"),
+        cache.make_key(f"CLIENTWIDGETTIMEOUT_{room_name}"),
+        cache.make_key(f"CLIENTWIDGET_EXPIRY_LOCK_{room_name}"),
+    ]
+    args = [
+        int(session_end == True), int(reset_count == True), counters.USER_COUNT_TIMEOUT,
+        room_state.SESSION_END, room_state.LOCK,
+    ]
+    ended, state, history, last_seq = teardown_script(keys=keys, args=args, client=REDIS_CONNECTION)
+
+    fields = room_state.decode_fields(dict(zip(state[::2], state[1::2])))
+    return RoomSnapshot(fields, decode_entries(history), ended == 1, int(last_seq) if last_seq not in (b'', '') else None)
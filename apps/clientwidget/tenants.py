@@ -0,0 +1,113 @@
+"""
+clientwidget/tenants.py
+
+Resolves the external DB label (a key of `settings.DATABASES`) which holds the chat data of an owner, a bot or a room.
+
+    user  -> User.ext_db_label. Operators (AO) use the label of their owner (`operator_of`, else `created_by`)
+    bot   -> Label of the bot's owner
+    room  -> Label set by the client widget API when the session starts (`near_cache.get_db_label()`),
+             else the label of the room's bot
+
+Labels which aren't configured in `settings.DATABASES` resolve to "default". The lookups go through near caches,
+so resolving a label is usually a dict lookup.
+
+Queries on the chat data models always pass the resolved label to `.using()` / `save(using=...)`. Never read
+`ext_db_label` off a user directly: an operator's own label isn't the one which holds the chats of their owner.
+"""
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from . import near_cache
+from .near_cache import NearCache
+
+DEFAULT_DB_LABEL = 'default'
+
+owner_db_labels = NearCache('owner_db_labels')
+# Single entry (`ALL_DB_LABELS`) with the labels used by at least one owner
+used_db_labels = NearCache('used_db_labels', maxsize=1)
+ALL_DB_LABELS = 'all'
+
+
+def valid_db_label(db_label, default=DEFAULT_DB_LABEL):
+    return db_label if db_label in settings.DATABASES else default
+
+
+def get_user_db_label(user, default=DEFAULT_DB_LABEL):
+    """Returns the DB label of an authenticated user (owner or operator)"""
+    try:
+        if user.role == 'AO':
+            owner = user.operator_of if user.operator_of_id is not None else user.created_by
+            db_label = owner.ext_db_label
+        else:
+            db_label = user.ext_db_label
+    except Exception:
+        return default
+    return valid_db_label(db_label, default)
+
+
+def get_owner_db_label(owner_id, default=DEFAULT_DB_LABEL):
+    def load():
+        from apps.accounts.models import User
+        user = User.objects.filter(pk=owner_id).values(
+            'role', 'ext_db_label', 'operator_of_id', 'operator_of__ext_db_label', 'created_by__ext_db_label',
+        ).first()
+        if user is None:
+            return None
+        if user['role'] != 'AO':
+            return user['ext_db_label']
+        return user['operator_of__ext_db_label'] if user['operator_of_id'] is not None else user['created_by__ext_db_label']
+    return valid_db_label(owner_db_labels.get(owner_id, load), default)
+
+
+def get_bot_db_label(bot_id, default=DEFAULT_DB_LABEL):
+    bot = near_cache.get_bot(bot_id)
+    if bot is None:
+        return default
+    return get_owner_db_label(bot['owner_id'], default)
+
+
+def get_room_db_label(room_id, bot_id=None, default=DEFAULT_DB_LABEL):
+    db_label = near_cache.get_db_label(str(room_id))
+    if db_label is None and bot_id is not None:
+        db_label = get_bot_db_label(bot_id, None)
+    return valid_db_label(db_label, default)
+
+
+def resolve_room_db_label(room_id, bot_id, timeout=DEFAULT_TIMEOUT):
+    """Returns the DB label of a room, and sets it again (from the bot's owner) if it had expired"""
+    db_label = near_cache.get_db_label(str(room_id))
+    if db_label is None:
+        db_label = get_bot_db_label(bot_id)
+        near_cache.set_db_label(room_id, db_label, timeout=timeout)
+    return valid_db_label(db_label)
+
+
+def get_db_labels():
+    """Returns the configured DB labels which hold the chat data of at least one owner. Batch jobs only need to touch these"""
+    def load():
+        from apps.accounts.models import User
+        labels = set(User.objects.exclude(ext_db_label=None).values_list('ext_db_label', flat=True).distinct())
+        labels.add(DEFAULT_DB_LABEL)
+        return [db_label for db_label in settings.DATABASES if db_label in labels]
+    return used_db_labels.get(ALL_DB_LABELS, load)
+
+
+def group_rooms_by_db_label(room_ids):
+    """Groups `room_ids` by the DB label which holds them
+
+    Returns:
+        dict: {db_label: [room_id]}. Rooms whose label isn't known (the session key expired) are under `None`
+    """
+    groups = {}
+    for room_id in room_ids:
+        db_label = near_cache.get_db_label(str(room_id))
+        if db_label is not None:
+            db_label = valid_db_label(db_label)
+        groups.setdefault(db_label, []).append(room_id)
+    return groups
+
+
+def invalidate_owner(owner_id):
+    owner_db_labels.invalidate(owner_id)
+    used_db_labels.invalidate(ALL_DB_LABELS)
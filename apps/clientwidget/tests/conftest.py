@@ -0,0 +1,32 @@
+import uuid
+from typing import Callable, Iterator
+
+import pytest
+from django.core.cache import cache
+
+from apps.clientwidget.models import ChatRoom
+
+
+@pytest.fixture
+def message() -> Callable[[int], dict]:
+    """Returns a factory for the i-th message of a visitor"""
+    def make_message(i: int) -> dict:
+        return {'user': 'end_user', 'message': f'Message {i}'}
+    return make_message
+
+
+@pytest.fixture
+def create_room() -> Callable[..., ChatRoom]:
+    """Returns a factory for `ChatRoom`s of new visitors. Any field can be overridden.
+    Not blended with mixer, since random states (active, archived, ...) would change what the tests exercise
+    """
+    def make_room(**fields) -> ChatRoom:
+        return ChatRoom.objects.create(**{'room_id': uuid.uuid4(), 'room_name': 'Visitor1', 'bot_id': uuid.uuid4(), **fields})
+    return make_room
+
+
+@pytest.fixture
+def room(create_room: Callable[..., ChatRoom]) -> Iterator[ChatRoom]:
+    room = create_room()
+    yield room
+    cache.delete_many([f'HISTORY_{room.room_id}', f'HISTORY_SEQ_{room.room_id}', f'CLIENTWIDGETLOCK_{room.room_id}'])
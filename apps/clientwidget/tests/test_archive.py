@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+from typing import Callable
+
+import pytest
+from django.utils import timezone
+
+from apps.clientwidget import archive, events, partitions
+from apps.clientwidget.models import ChatMessage, ChatRoom
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(archive, 'CHAT_ARCHIVE_DIR', str(tmp_path))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def create_old_room(create_room: Callable[..., ChatRoom], message: Callable[[int], dict]) -> Callable[[int], ChatRoom]:
+    def make_old_room(num_msgs: int) -> ChatRoom:
+        room = create_room(created_on=timezone.now() - timedelta(days=400))
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(i) for i in range(num_msgs)])
+        return room
+    return make_old_room
+
+
+class TestArchive:
+
+    @pytest.mark.django_db
+    def test_archive_and_rehydrate(self, archive_dir: str, create_room: Callable, create_old_room: Callable, message: Callable) -> None:
+        room = create_old_room(5)
+        recent = create_room(room_name='Visitor2')
+
+        assert archive.archive_rooms(days=365) == (1, 5)
+        assert ChatMessage.objects.filter(room_id=room.room_id).count() == 0
+        room.refresh_from_db()
+        assert room.archived_seq == 5
+        recent.refresh_from_db()
+        assert recent.archived_on is None
+
+        # Appended after the archived messages
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(5)])
+        assert list(ChatMessage.objects.filter(room_id=room.room_id).values_list('seq', flat=True)) == [6]
+
+        # Reading the full history brings the archived messages back
+        assert events.fetch_history_from_db(room.room_id) == (True, [message(i) for i in range(6)])
+        room.refresh_from_db()
+        assert room.archived_seq == 0
+
+        # Rehydrated rooms aren't archived again right away
+        assert archive.archive_rooms(days=365) == (0, 0)
+
+
+    @pytest.mark.django_db
+    def test_archive_appended_messages(self, archive_dir: str, create_old_room: Callable, message: Callable) -> None:
+        room = create_old_room(3)
+        assert archive.archive_rooms(days=365) == (1, 3)
+        # Nothing new
+        assert archive.archive_rooms(days=365) == (0, 0)
+
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(3)])
+        assert archive.archive_rooms(days=365) == (1, 4)
+        assert ChatMessage.objects.filter(room_id=room.room_id).count() == 0
+        room.refresh_from_db()
+        assert room.archived_seq == 4
+        assert events.fetch_history_from_db(room.room_id) == (True, [message(i) for i in range(4)])
+
+
+    @pytest.mark.django_db
+    def test_recent_history_skips_archive(self, archive_dir: str, create_old_room: Callable, message: Callable) -> None:
+        room = create_old_room(3)
+        ChatRoom.objects.filter(room_id=room.room_id).update(recent_seq=4)
+        archive.archive_room(room.room_id)
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(3)])
+
+        assert events.fetch_recent_history_from_db(room.room_id) == (True, [message(3)])
+        room.refresh_from_db()
+        assert room.archived_seq == 3
+
+
+    def test_partition_names(self) -> None:
+        month = partitions.month_start(datetime(2020, 12, 15, 10, 30))
+        assert month == datetime(2020, 12, 1)
+        assert partitions.add_months(month, 1) == datetime(2021, 1, 1)
+        assert partitions.add_months(month, -12) == datetime(2019, 12, 1)
+        assert partitions.partition_name(month, 'clientwidget_chatmessage') == 'clientwidget_chatmessage_y2020m12'
@@ -0,0 +1,73 @@
+import json
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from apps.clientwidget import async_consumers, consumers, routing
+from apps.clientwidget.management.commands.consumer_load_test import run_load_test, run_receive_load_test
+
+# Use an in-memory channel layer for testing
+TEST_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+
+class TestAsyncConsumers:
+
+    def test_routes(self) -> None:
+        assert routing.get_async_routes('') == set()
+        assert routing.get_async_routes('all') == set(routing.CONSUMER_CLASSES)
+        assert routing.get_consumer('admin', routing.get_async_routes('admin, listing')) == async_consumers.AsyncAdminConsumer
+        assert routing.get_consumer('listing', routing.get_async_routes('admin, listing')) == async_consumers.AsyncLongPollingConsumer
+        assert routing.get_consumer('clientwidget', routing.get_async_routes('admin, listing')) == consumers.ClientWidgetConsumer
+
+
+    def test_payloads(self) -> None:
+        # The async consumer sends the same payload as the sync one
+        handler = async_consumers.AsyncClientWidgetConsumer({'type': 'websocket'}).handler
+        handler.room_id, handler.owner_id = uuid.uuid4(), uuid.uuid4()
+        payload = handler.chat_payload({'message': 'Hi', 'time': 'now', 'room_id': handler.room_id, 'user': 'admin', 'api': True})
+        assert payload['room_id'] == str(handler.room_id)
+        assert payload['owner_id'] == str(handler.owner_id)
+        assert payload['api'] == True
+        assert handler.template_payload({'data': {}, 'time': 'now', 'message': 'Hi', 'user': 'bot'})['first_name'] == 'Message'
+
+
+    @pytest.mark.asyncio
+    async def test_admin_group_events(self, settings) -> None:
+        settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+        connections_per_second, messages_per_second = await run_load_test(async_consumers.AsyncAdminConsumer, 5, 3, timeout=5)
+        assert connections_per_second > 0
+        assert messages_per_second > 0
+
+
+    def test_parse_chat_message(self) -> None:
+        handler = async_consumers.AsyncClientWidgetConsumer({'type': 'websocket', 'user': SimpleNamespace(first_name='Jane', last_name='Doe')}).handler
+        handler.room_id, handler.owner_id, handler.chatbot_type = uuid.uuid4(), uuid.uuid4(), 'website'
+
+        payload, event = handler.parse_chat_message(json.dumps({'user': 'end_user', 'message': {'userInputVal': 'Hi'}, 'email': 'x'}))
+        assert payload['room_id'] == str(handler.room_id) and payload['first_name'] == 'Jane' and 'time' in payload
+        assert event == {
+            'type': 'chat_message', 'message': {'userInputVal': 'Hi'}, 'time': payload['time'], 'room_id': str(handler.room_id),
+            'owner_id': str(handler.owner_id), 'user': 'end_user', 'email': '', 'first_name': 'Jane', 'last_name': 'Doe',
+        }
+
+        # Everything else runs on a worker thread
+        assert handler.parse_chat_message(json.dumps({'user': 'bot', 'bot_id': 'bot', 'data': {}})) is None
+        assert handler.parse_chat_message(json.dumps({'ENTER': True, 'room_id': str(handler.room_id)})) is None
+        assert handler.parse_chat_message(json.dumps({'user': 'admin', 'message': 'Hi'})) is None
+        assert handler.parse_chat_message('Not JSON') is None
+        handler.chatbot_type = 'whatsapp'
+        assert handler.parse_chat_message(json.dumps({'user': 'admin', 'message': 'Hi', 'email': 'admin@example.com'})) is None
+
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_clientwidget_receive(self, settings) -> None:
+        settings.CHANNEL_LAYERS = TEST_CHANNEL_LAYERS
+        connections_per_second, messages_per_second = await run_receive_load_test(async_consumers.AsyncClientWidgetConsumer, 3, 3, timeout=5)
+        assert connections_per_second > 0
+        assert messages_per_second > 0
@@ -0,0 +1,51 @@
+from typing import Callable
+
+import pytest
+
+from apps.clientwidget import events
+from apps.clientwidget.management.commands.backfill_chat_messages import backfill_room
+from apps.clientwidget.models import ChatMessage, ChatRoom
+
+
+class TestChatMessages:
+
+    @pytest.mark.django_db
+    def test_append_and_paginate(self, room: ChatRoom, message: Callable) -> None:
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(i) for i in range(5)])
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(i) for i in range(5, 8)])
+        assert list(ChatMessage.objects.filter(room_id=room.room_id).order_by('seq').values_list('seq', flat=True)) == list(range(1, 9))
+
+        history, first_seq = events.fetch_history_page_from_db(room.room_id, num_msgs=3)
+        assert history == [message(i) for i in range(5, 8)] and first_seq == 6
+
+        history, first_seq = events.fetch_history_page_from_db(room.room_id, num_msgs=3, before=first_seq)
+        assert history == [message(i) for i in range(2, 5)] and first_seq == 3
+
+        history, first_seq = events.fetch_history_page_from_db(room.room_id, num_msgs=3, before=first_seq)
+        assert history == [message(i) for i in range(2)] and first_seq is None
+
+        assert events.fetch_history_from_db(room.room_id) == (True, [message(i) for i in range(8)])
+
+
+    @pytest.mark.django_db
+    def test_delete_and_recent(self, room: ChatRoom, message: Callable) -> None:
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(i) for i in range(4)])
+        ChatRoom.objects.filter(room_id=room.room_id).update(recent_seq=events.next_message_seq(room.room_id))
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(4)])
+        assert events.fetch_recent_history_from_db(room.room_id) == (True, [message(4)])
+
+        events.delete_history_from_db(room.room_id, 2)
+        assert events.fetch_history_from_db(room.room_id) == (True, [message(i) for i in range(3)])
+        assert events.fetch_recent_history_from_db(room.room_id) == (True, [])
+
+
+    @pytest.mark.django_db
+    def test_backfill(self, room: ChatRoom, message: Callable) -> None:
+        ChatRoom.objects.filter(room_id=room.room_id).update(messages=[message(i) for i in range(3)], recent_messages=[message(2)])
+        # Appended after the table was added, so it's newer than the legacy array
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(3)])
+
+        assert backfill_room(room.room_id, 'default') == 3
+        assert backfill_room(room.room_id, 'default') == 0
+        assert events.fetch_history_from_db(room.room_id) == (True, [message(i) for i in range(4)])
+        assert events.fetch_recent_history_from_db(room.room_id) == (True, [message(2), message(3)])
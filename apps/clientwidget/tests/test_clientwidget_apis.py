@@ -17,6 +17,7 @@ from mixer.backend.django import mixer
 from rest_framework.test import APIClient
 
 from apps.accounts.models import User
+from apps.chatbox.bot_graph import get_bot_graph
 from apps.chatbox.models import Chatbox
 from apps.clientwidget.models import ChatRoom, ChatAssign
 
@@ -387,6 +388,9 @@ class TestApis:
             # This variable is not a lead field
             assert '@testvariable' in data['variable_columns'] and '@testvariable' not in data['bot_lead_json']
 
+            # The compiled bot graph must pick up the update
+            assert get_bot_graph(bot_id).variables == data['bot_variable_json']
+
             # Make a lead variable now
             nodes = bot_json['bot_full_json']['layers'][1]['models']
             lead_variable = None
@@ -429,7 +433,8 @@ class TestApis:
             data = json.loads(response.content)
             updated_variables = set(list(bot_variable_json.keys()) + [lead_variable]) - {old_lead_variable}
             assert set(data['bot_variable_json'].keys()) == updated_variables
-            assert set(data['bot_lead_json']) == set(list(bot_lead_json.keys()) + [lead_variable]) - {old_lead_variable}            
+            assert set(data['bot_lead_json']) == set(list(bot_lead_json.keys()) + [lead_variable]) - {old_lead_variable}
+            assert set(get_bot_graph(bot_id).leads) == set(data['bot_lead_json'])
 
 
     @pytest.mark.django_db
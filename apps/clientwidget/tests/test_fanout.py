@@ -0,0 +1,29 @@
+import pytest
+from channels.layers import InMemoryChannelLayer
+
+from apps.clientwidget import fanout
+
+
+class TestFanout:
+
+    def test_unique_groups(self) -> None:
+        assert fanout.unique_groups(['room', 'owner', None, '', 'room', 'operator']) == ['room', 'owner', 'operator']
+
+
+    @pytest.mark.asyncio
+    async def test_group_send_many(self) -> None:
+        channel_layer = InMemoryChannelLayer()
+        room_channel = await channel_layer.new_channel()
+        owner_channel = await channel_layer.new_channel()
+        other_channel = await channel_layer.new_channel()
+        await channel_layer.group_add('room', room_channel)
+        await channel_layer.group_add('owner', owner_channel)
+        await channel_layer.group_add('other', other_channel)
+
+        message = {'type': 'chat_message', 'message': 'Hi'}
+        await fanout.group_send_many(channel_layer, ['room', 'owner', 'room'], message)
+        assert await channel_layer.receive(room_channel) == message
+        assert await channel_layer.receive(owner_channel) == message
+        assert other_channel not in channel_layer.channels
+        # Sent to the room once
+        assert room_channel not in channel_layer.channels
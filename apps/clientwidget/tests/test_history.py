@@ -0,0 +1,157 @@
+import json
+import time
+import uuid
+
+import pytest
+from django.core.cache import cache
+
+from apps.clientwidget import events, history_codec, room_state
+
+
+class CountingPipeline:
+    """Wraps a redis pipeline. The whole pipeline is a single round trip
+    """
+
+    def __init__(self, pipe, counter):
+        self.pipe = pipe
+        self.counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pipe.reset()
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def execute(self):
+        self.counter.round_trips += 1
+        return self.pipe.execute()
+
+
+class CountingClient:
+    """Wraps the redis client, and counts the number of round trips to the server
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.round_trips = 0
+
+    def pipeline(self, *args, **kwargs):
+        return CountingPipeline(self.client.pipeline(*args, **kwargs), self)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self.round_trips += 1
+            return attr(*args, **kwargs)
+        return command
+
+
+def legacy_append(client, room_name, message_dict, timeout=24 * 60 * 60):
+    # What we used to do: one RPUSH per entry, a separate EXPIRE, a SET of the lock and a GET + SET of the counter
+    if 'message' in message_dict and isinstance(message_dict['message'], list):
+        for msg in message_dict['message']:
+            client.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(msg))
+    else:
+        client.rpush(cache.make_key(f'HISTORY_{room_name}'), json.dumps(message_dict))
+    client.expire(cache.make_key(f'HISTORY_{room_name}'), timeout)
+    client.set(cache.make_key(f'CLIENTWIDGETLOCK_{room_name}'), cache.prep_value(room_name), ex=timeout)
+    num_msgs = client.get(cache.make_key(f'CLIENTWIDGET_COUNT_{room_name}'))
+    num_msgs = 0 if num_msgs is None else int(num_msgs)
+    client.set(cache.make_key(f'CLIENTWIDGET_COUNT_{room_name}'), num_msgs + 1, ex=timeout)
+
+
+@pytest.fixture
+def room_name() -> str:
+    room_name = str(uuid.uuid4())
+    yield room_name
+    cache.delete_many([f'HISTORY_{room_name}', f'CLIENTWIDGETLOCK_{room_name}', f'CLIENTWIDGET_COUNT_{room_name}'])
+    room_state.clear_room_state(room_name)
+
+
+class TestHistory:
+
+    num_messages = 1000
+
+
+    def test_append_msg_to_redis(self, room_name: str) -> None:
+        assert events.append_msg_to_redis(room_name, {'user': 'end_user', 'message': 'Hi'}, store_full=True, count=True) == 1
+        length = events.append_msg_to_redis(room_name, {'user': 'bot', 'message': [{'text': 'a'}, {'text': 'b'}]}, count=True)
+        assert length == 3
+        assert cache.get(f'CLIENTWIDGETLOCK_{room_name}') == room_name
+        assert room_state.get_room_field(room_name, room_state.COUNT) == 2
+
+
+    def test_round_trips_per_message(self, room_name: str, monkeypatch) -> None:
+        client = CountingClient(cache.get_client(''))
+        monkeypatch.setattr(cache, 'get_client', lambda *args, **kwargs: client)
+        message = {'user': 'bot', 'message': [{'text': f'Message {i}'} for i in range(3)]}
+
+        start = time.perf_counter()
+        for _ in range(self.num_messages):
+            legacy_append(client, room_name, message)
+        legacy_time, legacy_round_trips = time.perf_counter() - start, client.round_trips
+
+        client.round_trips = 0
+        start = time.perf_counter()
+        for _ in range(self.num_messages):
+            events.append_msg_to_redis(room_name, message, count=True)
+        batched_time, batched_round_trips = time.perf_counter() - start, client.round_trips
+
+        print(f"\nAppended {self.num_messages} messages: legacy {legacy_round_trips / self.num_messages:.1f} round trips/message ({legacy_time:.3f}s), "
+              f"batched {batched_round_trips / self.num_messages:.1f} round trips/message ({batched_time:.3f}s)")
+
+        assert batched_round_trips == self.num_messages
+        assert batched_round_trips < legacy_round_trips
+
+
+def synthetic_room(num_messages, room_id=None, owner_id=None):
+    """A session of `num_messages` entries: visitor messages, and bot replies carrying the node payload
+    """
+    room_id = str(room_id or uuid.uuid4())
+    owner_id = str(owner_id or uuid.uuid4())
+    messages = []
+    for i in range(num_messages):
+        envelope = {'room_id': room_id, 'owner_id': owner_id, 'time': f"01/01/2021 10:{(i // 60) % 60:02d}:{i % 60:02d}"}
+        if i % 2 == 0:
+            messages.append({**envelope, 'user': 'end_user', 'message': {'userInputVal': f'Answer {i}'}, 'first_name': 'Anonymous', 'last_name': 'User'})
+        else:
+            node = {
+                'nodeType': 'MULTI_CHOICE', 'messages': [f'Question {i}? Please pick one of the options below'] * (1 + i % 3),
+                'buttons': [{'text': f'Option {j}', 'targetId': str(i + j)} for j in range(4)],
+                'variable': f'@choice_{i % 10}', 'variableType': 'string',
+            }
+            messages.append({**envelope, 'user': 'bot', 'message': None, 'data': {**node, 'variables': {f'@choice_{j}': f'Option {j}' for j in range(10)}}, 'first_name': 'System', 'last_name': 'Message'})
+    return messages
+
+
+class TestHistoryCodec:
+
+    num_messages = 1000
+
+
+    def test_roundtrip(self) -> None:
+        messages = synthetic_room(20)
+        for name in ('json', 'msgpack', 'msgpack_zlib'):
+            codec = history_codec.get_codec(name)
+            assert history_codec.decode_entries([codec.encode(message) for message in messages]) == messages
+
+        # Entries written before the codec existed are plain JSON
+        assert history_codec.decode_entries([json.dumps(message).encode() for message in messages]) == messages
+
+
+    def test_bytes_per_room(self) -> None:
+        messages = synthetic_room(self.num_messages)
+        sizes = {}
+        for name in ('json', 'msgpack', 'msgpack_zlib'):
+            codec = history_codec.get_codec(name)
+            sizes[name] = sum(len(codec.encode(message)) for message in messages)
+
+        print(f"\nBytes for a {self.num_messages} message room: " + ', '.join(f"{name} {size}" for name, size in sizes.items()))
+        assert sizes['msgpack'] < sizes['json']
+        assert sizes['msgpack_zlib'] <= sizes['msgpack']
@@ -0,0 +1,58 @@
+from typing import Callable
+
+import pytest
+from django.core.cache import cache
+
+from apps.clientwidget import events, history_seq
+from apps.clientwidget.models import ChatMessage, ChatRoom
+
+
+class TestHistorySeq:
+
+    @pytest.mark.django_db
+    def test_fetch_history_after(self, room: ChatRoom, message: Callable) -> None:
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(i) for i in range(3)])
+        # New session
+        history_seq.sync_sequence(room.room_id, 3)
+        events.append_msg_to_redis(room.room_id, message(3), store_full=True)
+        events.append_msg_to_redis(room.room_id, message(4), store_full=True)
+        assert history_seq.get_sequence(room.room_id) == 5
+
+        messages, has_more = history_seq.fetch_history_after(room, 0)
+        assert messages == [{**message(i), 'seq': i + 1} for i in range(5)]
+        assert has_more == False
+
+        # Pages span the DB and the session
+        messages, has_more = history_seq.fetch_history_after(room, 2, num_msgs=2)
+        assert [msg['seq'] for msg in messages] == [3, 4]
+        assert has_more == True
+        assert history_seq.fetch_history_after(room, 4) == ([{**message(4), 'seq': 5}], False)
+
+        # Flushed messages keep their seq
+        events.flush_to_db(room.room_id, 'AnonymousUser', {})
+        assert list(ChatMessage.objects.filter(room_id=room.room_id).order_by('seq').values_list('seq', flat=True)) == [1, 2, 3, 4, 5]
+        assert history_seq.fetch_history_after(room, 3) == ([{**message(3), 'seq': 4}, {**message(4), 'seq': 5}], False)
+
+
+    @pytest.mark.django_db
+    def test_sync_sequence(self, room: ChatRoom, message: Callable) -> None:
+        # Only moved up, and only when there's no session history
+        assert history_seq.sync_sequence(room.room_id, 10) == True
+        assert history_seq.sync_sequence(room.room_id, 5) == False
+        events.append_msg_to_redis(room.room_id, message(0), store_full=True)
+        assert history_seq.sync_sequence(room.room_id, 20) == False
+        assert history_seq.get_sequence(room.room_id) == 11
+
+
+    @pytest.mark.django_db
+    def test_expired_sequence(self, room: ChatRoom, message: Callable) -> None:
+        events.flush_to_db(room.room_id, 'AnonymousUser', {}, messages=[message(i) for i in range(3)])
+        history_seq.sync_sequence(room.room_id, 3)
+        events.append_msg_to_redis(room.room_id, message(3), store_full=True)
+        events.append_msg_to_redis(room.room_id, message(4), store_full=True)
+
+        # Expired during the session: seeded after the session history
+        cache.delete(f'HISTORY_SEQ_{room.room_id}')
+        assert history_seq.sync_sequence(room.room_id, 3) == True
+        assert history_seq.get_sequence(room.room_id) == 5
+        assert history_seq.fetch_history_after(room, 0) == ([{**message(i), 'seq': i + 1} for i in range(5)], False)
@@ -0,0 +1,72 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from apps.clientwidget import http_client
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """Answers with the path and headers of the request, keeping the connection alive"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'path': self.path, 'headers': dict(self.headers)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Set-Cookie', 'session=tenant; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer(('127.0.0.1', 0), EchoHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestHttpClient:
+
+    def test_connection_reuse(self, stub_server) -> None:
+        port = stub_server.server_address[1]
+        for i in range(5):
+            response = http_client.get(f"http://127.0.0.1:{port}/hook/{i}")
+            assert response.status_code == 200
+            assert response.json()['path'] == f"/hook/{i}"
+
+        counters = http_client.stats()[f"http://127.0.0.1:{port}"]
+        assert counters['requests'] == 5
+        assert counters['connections'] == 1
+        assert counters['reused'] == 4
+        assert counters['reuse_rate'] == 0.8
+
+
+    def test_headers_per_request(self, stub_server) -> None:
+        url = f"http://127.0.0.1:{stub_server.server_address[1]}/"
+        assert http_client.get(url, headers={'X-Token': 'secret'}).json()['headers']['X-Token'] == 'secret'
+        # Not kept on the shared session
+        assert 'X-Token' not in http_client.get(url).json()['headers']
+        assert 'X-Token' not in http_client.get_session().headers
+
+
+    def test_cookies_not_stored(self, stub_server) -> None:
+        url = f"http://127.0.0.1:{stub_server.server_address[1]}/"
+        # The stub sets a cookie on every response
+        assert http_client.get(url).cookies.get('session') == 'tenant'
+        # The cookie isn't sent back on the next request
+        assert 'Cookie' not in http_client.get(url).json()['headers']
+        assert len(http_client.get_session().cookies) == 0
@@ -0,0 +1,29 @@
+from apps.clientwidget.listing_updates import ListingCoalescer
+from apps.clientwidget.management.commands.listing_coalescing_report import replay, simulate_events
+
+
+def event(room_id: str, **fields) -> dict:
+    return {'type': 'listing_channel_event', 'room_id': room_id, 'room_name': 'Visitor1', 'status': 'pending', 'takeover': False, **fields}
+
+
+class TestListingUpdates:
+
+    def test_coalescing(self) -> None:
+        coalescer = ListingCoalescer()
+        assert coalescer.add(event('room1')) == True
+        assert coalescer.add(event('room2')) == False
+        # Full state the first time
+        assert coalescer.drain() == [event('room1'), event('room2')]
+
+        # Superseded states are dropped, and only the changed fields are sent
+        coalescer.add(event('room1', status='open'))
+        coalescer.add(event('room1', status='open', takeover=True))
+        coalescer.add(event('room2', status='open'))
+        coalescer.add(event('room2'))
+        assert coalescer.drain() == [{'type': 'listing_channel_event', 'room_id': 'room1', 'status': 'open', 'takeover': True, 'partial': True}]
+        assert (coalescer.received_events, coalescer.sent_events) == (6, 3)
+
+
+    def test_simulated_tenant(self) -> None:
+        events = simulate_events(num_rooms=100, duration=60, changes_per_minute=4, seed=0)
+        assert len(replay(events, 0.25)) < len(events)
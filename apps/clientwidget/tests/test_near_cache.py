@@ -0,0 +1,71 @@
+import json
+import time
+import uuid
+
+from django.core.cache import cache
+
+from apps.clientwidget import near_cache
+
+
+class TestNearCache:
+
+    def test_hits_and_lru(self) -> None:
+        local = near_cache.NearCache(f'test_{uuid.uuid4()}', maxsize=2)
+        loads = []
+
+        def loader(key):
+            def load():
+                loads.append(key)
+                return key.upper()
+            return load
+
+        assert local.get('a', loader('a')) == 'A'
+        assert local.get('a', loader('a')) == 'A'
+        assert local.get('b', loader('b')) == 'B'
+        # `a` was used more recently than `b`, so `b` is evicted
+        local.get('a', loader('a'))
+        local.get('c', loader('c'))
+        assert local.get('b', loader('b')) == 'B'
+        assert loads == ['a', 'b', 'c', 'b']
+
+        stats = local.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 4, 2)
+        assert stats['hit_rate'] == round(2 / 6, 4)
+
+
+    def test_ttl(self) -> None:
+        local = near_cache.NearCache(f'test_{uuid.uuid4()}', ttl=0.1)
+        assert local.get('a', lambda: 1) == 1
+        assert local.get('a', lambda: 2) == 1
+        time.sleep(0.2)
+        assert local.get('a', lambda: 3) == 3
+
+
+    def test_remote_invalidation(self) -> None:
+        local = near_cache.NearCache(f'test_{uuid.uuid4()}')
+        local.get('a', lambda: 1)
+        # What the listener receives when another process invalidates `a`
+        near_cache.handle_invalidation({'type': 'message', 'data': json.dumps({'cache': local.name, 'keys': ['a']})})
+        assert local.get('a', lambda: 2) == 2
+
+
+    def test_stale_load_is_not_stored(self) -> None:
+        local = near_cache.NearCache(f'test_{uuid.uuid4()}')
+
+        def load():
+            # Invalidated while the value was being loaded
+            local.discard('a')
+            return 1
+
+        assert local.get('a', load) == 1
+        assert local.get('a', lambda: 2) == 2
+
+
+    def test_db_label(self) -> None:
+        room_id = str(uuid.uuid4())
+        assert near_cache.get_db_label(room_id, 'default') == 'default'
+        near_cache.set_db_label(room_id, 'tenant', timeout=60)
+        assert near_cache.get_db_label(room_id) == 'tenant'
+        near_cache.set_db_label(room_id, 'other', timeout=60)
+        assert near_cache.get_db_label(room_id) == 'other'
+        cache.delete(room_id)
@@ -0,0 +1,73 @@
+import os
+import uuid
+
+import pytest
+from django.db import connection
+
+from apps.clientwidget.models import SUMMARY_FIELDS, ChatRoom
+
+# The planner only picks an index over a sequential scan once the table is big enough. Seeding that many rooms takes
+# a while, so the plans are only checked if QUERY_PLAN_ROWS is set (e.g. QUERY_PLAN_ROWS=1000000)
+NUM_ROWS = int(os.environ.get('QUERY_PLAN_ROWS', 0))
+NUM_BOTS = 1000
+NUM_OWNERS = 500
+
+
+def bot_uuid(i: int) -> uuid.UUID:
+    return uuid.UUID(int=i)
+
+
+@pytest.fixture
+def seeded_rooms() -> int:
+    """Seeds `NUM_ROWS` rooms spread over `NUM_BOTS` bots and `NUM_OWNERS` owners. 2% of the rooms are active and 10% are leads"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {ChatRoom._meta.db_table} (
+                room_id, visitor_id, room_name, created_on, updated_on, messages, recent_messages, variables, bot_id, admin_id, chatbot_type,
+                bot_is_active, num_msgs, is_lead, status, takeover, website_url, channel_id, assignment_type, team_assignment_type, end_chat, recent_seq, archived_seq
+            )
+            SELECT
+                md5(i::text)::uuid, i, 'Visitor' || i, now() - i * interval '1 minute', now() - i * interval '1 minute', '[]', '[]', '{{}}',
+                lpad(to_hex(i %% %s), 32, '0')::uuid, i %% %s, 'website',
+                i %% 50 = 0, 0, i %% 10 = 0, 'pending', false, '', '', '', '', false, 1, 0
+            FROM generate_series(1, %s) AS i
+        """, [NUM_BOTS, NUM_OWNERS, NUM_ROWS])
+        cursor.execute(f"ANALYZE {ChatRoom._meta.db_table}")
+    return NUM_ROWS
+
+
+def assert_uses_index(queryset, index_name: str) -> None:
+    plan = queryset.explain()
+    assert index_name in plan, plan
+    assert 'Seq Scan' not in plan, plan
+
+
+class TestQueryPlans:
+
+    @pytest.mark.skipif(NUM_ROWS == 0, reason="Set QUERY_PLAN_ROWS to seed the rooms and check the query plans")
+    @pytest.mark.django_db
+    def test_listing_indexes(self, seeded_rooms: int) -> None:
+        assert ChatRoom.objects.count() == seeded_rooms
+
+        # ActiveChatBotListing / InactiveChatBotListing
+        for bot_is_active in (True, False):
+            queryset = ChatRoom.objects.summary().filter(admin_id=50, bot_is_active=bot_is_active).order_by('-updated_on')[:10]
+            assert_uses_index(queryset, 'chatroom_admin_active_idx')
+
+        # ChatDataBotAPI / ChatDataSortAPI
+        queryset = ChatRoom.objects.summary().filter(bot_id=bot_uuid(7)).order_by('-created_on')
+        assert_uses_index(queryset, 'chatroom_bot_created_idx')
+
+        # ChatDataSortAPI with is_lead / ChatDataCountLeads
+        queryset = ChatRoom.objects.summary().filter(bot_id=bot_uuid(7), is_lead=True).order_by('-created_on')
+        assert_uses_index(queryset, 'chatroom_bot_lead_idx')
+
+
+    @pytest.mark.django_db
+    def test_summary_projection(self) -> None:
+        ChatRoom.objects.create(room_id=uuid.uuid4(), room_name='Visitor1', bot_id=uuid.uuid4(), admin_id=1)
+        sql = str(ChatRoom.objects.summary().filter(admin_id=1).query)
+        for column in ('messages', 'recent_messages', 'team_assignment_type', 'assigned_team'):
+            assert f'."{column}"' not in sql
+        room = ChatRoom.objects.summary().get(admin_id=1)
+        assert room.get_deferred_fields() == {field.attname for field in ChatRoom._meta.concrete_fields} - set(SUMMARY_FIELDS)
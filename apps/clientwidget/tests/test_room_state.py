@@ -0,0 +1,159 @@
+import threading
+import uuid
+
+import pytest
+from django.core.cache import cache
+
+from apps.clientwidget import counters, events, operator_map, room_state, teardown
+
+
+@pytest.fixture
+def room_id() -> str:
+    room_id = str(uuid.uuid4())
+    yield room_id
+    room_state.clear_room_state(room_id)
+
+
+class TestRoomState:
+
+    def test_buffered_state(self, room_id: str) -> None:
+        state = room_state.RoomState(room_id).load()
+        assert state.get(room_state.LOCK) is None
+        assert state.get_variables() is None
+
+        state.set(room_state.LOCK, True)
+        state.set_variables({'@name': 'John', '@age': 21})
+        state.save()
+
+        assert room_state.is_room_locked(room_id) == True
+        assert room_state.get_variables(room_id) == {'@name': 'John', '@age': 21}
+        assert room_state.get_variables(room_id, '@age', '@missing') == {'@age': 21}
+
+        assert room_state.incr_room_field(room_id, room_state.COUNT) == 1
+        assert room_state.incr_room_field(room_id, room_state.COUNT) == 2
+
+        room_state.delete_variables(room_id, room_state.LOCK)
+        assert room_state.get_variables(room_id) is None
+        assert room_state.is_room_locked(room_id) == False
+        assert room_state.get_room_field(room_id, room_state.COUNT) == 2
+
+
+    def test_concurrent_variable_updates(self, room_id: str) -> None:
+        # Concurrent writers must never lose each other's updates
+        room_state.set_variables(room_id, {})
+        num_writers = 20
+
+        def write(i):
+            room_state.set_variables(room_id, {f'@var_{i}': i, f'@other_{i}': str(i)})
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(num_writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        variables = room_state.get_variables(room_id)
+        assert len(variables) == 2 * num_writers
+        assert all(variables[f'@var_{i}'] == i for i in range(num_writers))
+
+
+class TestCounters:
+
+    def test_user_counts(self, room_id: str) -> None:
+        assert counters.get_usercount(room_id, default=100) == 100
+        assert counters.increment_usercount(room_id) == 1
+        assert counters.increment_usercount(room_id, amount=2) == 3
+        assert counters.decrement_usercount(room_id) == 2
+        assert counters.get_usercounts([room_id, uuid.uuid4()]) == {room_id: 2}
+
+        counters.reset_usercount(room_id)
+        assert counters.get_usercount(room_id) == 0
+        cache.delete(f"NUM_USERS_{room_id}")
+
+
+    def test_msg_counts(self, room_id: str) -> None:
+        for _ in range(5):
+            room_state.incr_room_field(room_id, room_state.COUNT)
+        assert counters.get_msgcount(room_id) == 5
+        assert counters.get_msgcounts([room_id, uuid.uuid4()]) == {room_id: 5}
+
+
+class TestOperatorMap:
+
+    def test_assignments(self, room_id: str) -> None:
+        other_room_id = str(uuid.uuid4())
+        operators = [str(uuid.uuid4()) for _ in range(3)]
+
+        operator_map.set_room_operators(room_id, operators[:2])
+        operator_map.add_room_operators(other_room_id, operators[1:])
+        assert operator_map.get_room_operators(room_id) == sorted(operators[:2])
+        assert operator_map.get_operator_rooms(operators[1]) == sorted([room_id, other_room_id])
+        assert operator_map.get_operators_for_rooms([room_id, other_room_id]) == {
+            room_id: sorted(operators[:2]), other_room_id: sorted(operators[1:]),
+        }
+
+        # Reassigning the room updates the reverse index of the previous operators
+        operator_map.set_room_operators(room_id, operators[2:])
+        assert operator_map.get_operator_rooms(operators[0]) == []
+        assert operator_map.is_room_operator(room_id, operators[2])
+
+        operator_map.remove_room_operators(other_room_id, operators[1:2])
+        assert operator_map.get_room_operators(other_room_id) == operators[2:]
+
+        for room in (room_id, other_room_id):
+            operator_map.clear_room_operators(room)
+        assert all(operator_map.get_operator_rooms(operator) == [] for operator in operators)
+
+
+    def test_concurrent_assignments(self, room_id: str) -> None:
+        # Concurrent reassignments must leave both indexes in agreement
+        operators = [str(uuid.uuid4()) for _ in range(6)]
+        num_writers = 10
+
+        def assign(i):
+            for j in range(20):
+                operator_map.set_room_operators(room_id, operators[(i + j) % 6:][:2])
+
+        threads = [threading.Thread(target=assign, args=(i,)) for i in range(num_writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assigned = operator_map.get_room_operators(room_id)
+        for operator in operators:
+            assert (room_id in operator_map.get_operator_rooms(operator)) == (operator in assigned)
+        operator_map.clear_room_operators(room_id)
+
+
+class TestTeardown:
+
+    def test_release_lock(self, room_id: str) -> None:
+        room_state.set_room_field(room_id, room_state.LOCK, True)
+        room_state.set_variables(room_id, {'@name': 'John'})
+        events.append_msg_to_redis(room_id, {'user': 'end_user', 'message': 'Hi'}, count=True)
+
+        snapshot = teardown.teardown_room(room_id)
+        assert snapshot.session_end == False
+        assert snapshot.locked == True
+        assert snapshot.variables == {'@name': 'John'}
+        assert snapshot.count == 1
+        assert [message['message'] for message in snapshot.messages] == ['Hi']
+
+        # Only the lock and the history are gone
+        assert room_state.is_room_locked(room_id) == False
+        assert room_state.get_variables(room_id) == {'@name': 'John'}
+        assert cache.get(f'HISTORY_{room_id}') is None
+        assert cache.get(f'CLIENTWIDGETLOCK_{room_id}') is None
+
+
+    def test_session_end(self, room_id: str) -> None:
+        room_state.set_room_fields(room_id, {room_state.LOCK: True, room_state.SESSION_END: True})
+        cache.set(f'CLIENTWIDGET_SESSION_TOKEN_{room_id}', 'token')
+
+        snapshot = teardown.teardown_room(room_id, reset_count=True)
+        assert snapshot.session_end == True
+        assert room_state.get_room_field(room_id, room_state.LOCK) is None
+        assert cache.get(f'CLIENTWIDGET_SESSION_TOKEN_{room_id}') is None
+        assert counters.get_usercount(room_id, default=100) == 0
+        cache.delete(f"NUM_USERS_{room_id}")
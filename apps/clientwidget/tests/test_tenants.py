@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+from mixer.backend.django import mixer
+
+from apps.accounts.models import User
+from apps.chatbox.models import Chatbox
+from apps.clientwidget import near_cache, tenants
+
+
+class TestTenants:
+
+    @pytest.mark.django_db
+    def test_resolution(self) -> None:
+        owner = mixer.blend(User, role='AM', ext_db_label='default')
+        operator = mixer.blend(User, role='AO', created_by=owner, ext_db_label=None)
+        # Operators don't use their own label, but the one of their owner
+        member = mixer.blend(User, role='AO', operator_of=owner, ext_db_label='no_such_db')
+        bot = mixer.blend(Chatbox, owner=owner)
+
+        assert tenants.get_user_db_label(owner) == 'default'
+        assert tenants.get_user_db_label(operator) == 'default'
+        assert tenants.get_owner_db_label(operator.pk) == 'default'
+        assert tenants.get_user_db_label(member, default=None) == 'default'
+        assert tenants.get_owner_db_label(member.pk, default=None) == 'default'
+        assert tenants.get_bot_db_label(bot.pk) == 'default'
+
+        # Labels which aren't configured fall back to "default"
+        owner.ext_db_label = 'no_such_db'
+        owner.save()
+        assert tenants.get_owner_db_label(owner.pk) == 'default'
+        assert tenants.get_owner_db_label(owner.pk, default=None) is None
+
+        # The label of a room is set again from its bot, once the session key expires
+        room_id = uuid.uuid4()
+        assert tenants.get_room_db_label(room_id, default=None) is None
+        assert tenants.resolve_room_db_label(room_id, bot.pk) == 'default'
+        assert near_cache.get_db_label(room_id) == 'default'
+        assert tenants.group_rooms_by_db_label([room_id, 'unknown']) == {'default': [room_id], None: ['unknown']}
+
+        assert 'default' in tenants.get_db_labels()
@@ -0,0 +1,52 @@
+import uuid
+
+import pytest
+from django.core import management
+
+from apps.clientwidget import visitor_sequence
+from apps.clientwidget.models import ChatRoom
+
+
+@pytest.fixture
+def admin_id() -> int:
+    admin_id = 424242
+    visitor_sequence.reset_sequence(admin_id)
+    yield admin_id
+    visitor_sequence.reset_sequence(admin_id)
+
+
+def new_visitor(admin_id: int) -> ChatRoom:
+    room = ChatRoom(room_id=uuid.uuid4(), bot_id=uuid.uuid4(), admin_id=admin_id)
+    room.save(new_visitor=True, using='default')
+    return room
+
+
+class TestVisitorSequence:
+
+    @pytest.mark.django_db
+    def test_seed_and_increment(self, admin_id: int) -> None:
+        ChatRoom.objects.create(room_id=uuid.uuid4(), room_name='Visitor41', visitor_id=41, bot_id=uuid.uuid4(), admin_id=admin_id)
+
+        # Seeded from the DB on the first visitor
+        assert [new_visitor(admin_id).room_name for _ in range(3)] == ['Visitor42', 'Visitor43', 'Visitor44']
+        assert visitor_sequence.get_sequence(admin_id) == 44
+
+        # Other owners have their own sequence
+        other = new_visitor(admin_id + 1)
+        visitor_sequence.reset_sequence(admin_id + 1)
+        assert other.visitor_id == 1
+
+
+    @pytest.mark.django_db
+    def test_reconcile(self, admin_id: int) -> None:
+        new_visitor(admin_id)
+        ChatRoom.objects.create(room_id=uuid.uuid4(), room_name='Visitor10', visitor_id=10, bot_id=uuid.uuid4(), admin_id=admin_id)
+        assert visitor_sequence.get_sequence(admin_id) == 1
+
+        management.call_command('reconcile_visitor_sequence', database=['default'])
+        assert visitor_sequence.get_sequence(admin_id) == 10
+        assert new_visitor(admin_id).visitor_id == 11
+
+        # Never moves a sequence backwards
+        assert visitor_sequence.advance_sequence(admin_id, 5) == False
+        assert visitor_sequence.get_sequence(admin_id) == 11
@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+
+from apps.clientwidget import webhooks
+from apps.clientwidget.flow import BotFlowExecutor
+
+DELAY = 0.5
+
+
+class SleepingHandler(BaseHTTPRequestHandler):
+    """Answers every POST with {"ok": true}, after `server.delay` seconds"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.delay)
+        body = json.dumps({'ok': True}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def stub_url():
+    server = StubServer(('127.0.0.1', 0), SleepingHandler)
+    server.delay = DELAY
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/hook"
+    server.shutdown()
+    server.server_close()
+
+
+def webhook_node(url, timeout=5):
+    return {
+        'nodeType': 'WEBHOOK', 'webhookUrl': url, 'requestType': 'POST', 'timeout': timeout, 'blocking': True,
+        'routing': {'200': 'success', 'error': 'failure', 'default': 'default'},
+    }
+
+
+class Graph:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.bot_id = uuid.uuid4()
+        self.owner_id = uuid.uuid4()
+
+    def get_node(self, target_id):
+        return self.nodes.get(target_id)
+
+
+class TestWebhooks:
+
+    def test_flow_stops_at_webhook(self, stub_url) -> None:
+        graph = Graph({
+            'start': {'nodeType': 'GOAL', 'variable': '@goal', 'targetId': 'hook'},
+            'hook': webhook_node(stub_url),
+            'success': {'nodeType': 'MESSAGE'},
+        })
+        executor = BotFlowExecutor(graph, None, defer_webhooks=True)
+        start = time.time()
+        assert executor.run('start') is None
+        assert time.time() - start < DELAY
+        assert executor.ended == False
+        assert executor.target_id == 'hook'
+        assert executor.webhook_node == graph.nodes['hook']
+        assert executor.variables == {'@goal': 'true'}
+
+
+    def test_latency(self, stub_url) -> None:
+        # Every request sleeps for DELAY. They're submitted without waiting, and run side by side
+        num_requests = min(webhooks.WEBHOOK_WORKERS, 8)
+        room_ids = [str(uuid.uuid4()) for _ in range(num_requests)]
+        routed = {}
+
+        def callback(room_id):
+            def resume(target_id, token):
+                routed[room_id] = (target_id, time.time())
+            return resume
+
+        start = time.time()
+        futures = [
+            webhooks.submit_webhook_node(room_id, uuid.uuid4(), 'hook', webhook_node(stub_url), uuid.uuid4(), callback(room_id))
+            for room_id in room_ids
+        ]
+        submitted = time.time() - start
+        assert submitted < DELAY / 2
+        assert all(webhooks.is_waiting(room_id) for room_id in room_ids)
+
+        assert [future.result(timeout=10) for future in futures] == ['success'] * num_requests
+        elapsed = time.time() - start
+        assert elapsed >= DELAY
+        assert elapsed < DELAY * min(num_requests, 3)
+        assert all(target_id == 'success' and finished - start >= DELAY for target_id, finished in routed.values())
+
+        for room_id in room_ids:
+            webhooks.clear_waiting(room_id)
+            assert not webhooks.is_waiting(room_id)
+
+
+    def test_timeout(self, stub_url) -> None:
+        room_id = str(uuid.uuid4())
+        start = time.time()
+        future = webhooks.submit_webhook_node(room_id, uuid.uuid4(), 'hook', webhook_node(stub_url, timeout=DELAY / 5), uuid.uuid4(), lambda target_id, token: None)
+        assert future.result(timeout=10) == 'failure'
+        assert time.time() - start < DELAY
+        webhooks.clear_waiting(room_id)
+
+
+    def test_resume_on_channel(self) -> None:
+        room_id = str(uuid.uuid4())
+        channel_layer = InMemoryChannelLayer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        webhooks.set_waiting(room_id, 'token', 5)
+        webhooks.resume_on_channel(room_id, channel_name, {'bot_id': 'bot', 'hops': 2}, channel_layer)('success', 'token')
+        response = {'bot_id': 'bot', 'hops': 2, 'type': 'webhook_response', 'target_id': 'success'}
+        assert async_to_sync(channel_layer.receive)(channel_name) == response
+
+        # Claimed by the first socket of the room which asks, and only once
+        assert webhooks.claim_response(room_id) == response
+        assert webhooks.claim_response(room_id) is None
+        webhooks.clear_waiting(room_id)
+
+
+    def test_claim_after_reconnect(self) -> None:
+        room_id = str(uuid.uuid4())
+        webhooks.set_waiting(room_id, 'token', 5)
+        # A socket which connects before the response doesn't stop the room from waiting
+        assert webhooks.claim_response(room_id) is None
+        assert webhooks.is_waiting(room_id)
+
+        # The socket which sent the request is gone by the time it responds
+        channel_layer = InMemoryChannelLayer()
+        webhooks.resume_on_channel(room_id, 'gone', {'bot_id': 'bot'}, channel_layer)('success', 'token')
+        assert webhooks.is_waiting(room_id)
+        assert webhooks.claim_response(room_id)['target_id'] == 'success'
+        assert not webhooks.is_waiting(room_id)
+
+
+    def test_late_response(self) -> None:
+        room_id = str(uuid.uuid4())
+        channel_layer = InMemoryChannelLayer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+
+        # The mark of the request expired before it responded
+        webhooks.resume_on_channel(room_id, channel_name, {'bot_id': 'bot'}, channel_layer)('success', 'expired')
+        assert not webhooks.is_waiting(room_id)
+        assert webhooks.claim_response(room_id) is None
+
+        # The room moved on to another webhook in the meantime
+        webhooks.set_waiting(room_id, 'newer', 5)
+        assert not webhooks.refresh_waiting(room_id, 'older', 5)
+        webhooks.resume_on_channel(room_id, channel_name, {'bot_id': 'bot'}, channel_layer)('success', 'older')
+        assert webhooks.claim_response(room_id) is None
+        assert webhooks.is_waiting(room_id)
+
+        # A stored response of a submission the room doesn't wait on anymore is dropped when claimed
+        webhooks.store_response(room_id, 'newer', {'type': 'webhook_response', 'target_id': 'success'})
+        webhooks.set_waiting(room_id, 'newest', 5)
+        assert webhooks.claim_response(room_id) is None
+        assert webhooks.is_waiting(room_id)
+        webhooks.clear_waiting(room_id)
+
+
+    def test_refresh_on_pickup(self) -> None:
+        # The request expired its mark while queued. The worker marks the room again once it picks the request up,
+        # for as long as connecting and reading may take
+        room_id = str(uuid.uuid4())
+        webhooks.set_waiting(room_id, 'token', 5)
+        webhooks.cache.delete(webhooks.pending_key(room_id))
+        assert webhooks.refresh_waiting(room_id, 'token', 5)
+        assert webhooks.is_waiting(room_id)
+        assert webhooks.cache.ttl(webhooks.pending_key(room_id)) > 2 * 5
+        webhooks.clear_waiting(room_id)
@@ -0,0 +1,84 @@
+from typing import Callable, List
+
+import pytest
+from django.core.cache import cache
+
+from apps.clientwidget import events, write_behind
+from apps.clientwidget.models import ChatRoom
+
+
+@pytest.fixture
+def db_label() -> str:
+    db_label = 'default'
+    yield db_label
+    cache.get_client('').delete(write_behind.queue_key(db_label), write_behind.inflight_key(db_label), write_behind.dead_key(db_label),
+                                write_behind.metrics_key(db_label), write_behind.lease_key(db_label))
+
+
+@pytest.fixture
+def create_rooms(create_room: Callable[..., ChatRoom]) -> Callable[[int], List[ChatRoom]]:
+    def make_rooms(num_rooms: int) -> List[ChatRoom]:
+        return [create_room(room_name=f'Visitor{i}', bot_is_active=True) for i in range(num_rooms)]
+    return make_rooms
+
+
+class TestWriteBehind:
+
+    @pytest.mark.django_db
+    def test_batched_flush(self, db_label: str, create_rooms: Callable) -> None:
+        rooms = create_rooms(5)
+        for i, room in enumerate(rooms):
+            write_behind.enqueue_flush(room.room_id, db_label, variables={'@name': f'User {i}'}, messages=[{'message': f'{i}'}], is_lead=(i % 2 == 0), num_msgs=1, send_update=False)
+        # The same session ended twice before the flush
+        write_behind.enqueue_flush(rooms[0].room_id, db_label, messages=[{'message': 'again'}], num_msgs=2, send_update=False)
+
+        assert write_behind.flush_pending(db_label) == 5
+
+        for i, room in enumerate(rooms):
+            room.refresh_from_db()
+            assert room.bot_is_active == False and room.end_time is not None
+            assert room.variables == {'@name': f'User {i}'} and room.is_lead == (i % 2 == 0)
+        assert rooms[0].num_msgs == 2
+        assert events.fetch_history_from_db(rooms[0].room_id) == (True, [{'message': '0'}, {'message': 'again'}])
+
+        metrics = write_behind.get_metrics(db_label)
+        assert metrics['batches'] == 1 and metrics['rooms'] == 5 and metrics['pending'] == 0
+
+
+    @pytest.mark.django_db
+    def test_retry(self, db_label: str, create_rooms: Callable, monkeypatch) -> None:
+        good, bad = create_rooms(2)
+        write_batch = write_behind.write_batch
+
+        def failing_write_batch(label, jobs):
+            if any(job['room_id'] == str(bad.room_id) for job in jobs):
+                raise ValueError('Bad room')
+            return write_batch(label, jobs)
+
+        monkeypatch.setattr(write_behind, 'write_batch', failing_write_batch)
+        for room in (good, bad):
+            write_behind.enqueue_flush(room.room_id, db_label, messages=[{'message': 'Hi'}], send_update=False)
+
+        # The batch fails, and the good room is flushed on its own
+        assert write_behind.flush_pending(db_label, max_batches=1) == 1
+        good.refresh_from_db()
+        assert good.bot_is_active == False
+
+        # The bad room is retried until it ends up in the dead letter list
+        for _ in range(write_behind.WRITE_BEHIND_MAX_ATTEMPTS):
+            write_behind.flush_pending(db_label, max_batches=1)
+        metrics = write_behind.get_metrics(db_label)
+        assert metrics['pending'] == 0 and metrics['dead_letters'] == 1
+
+
+    @pytest.mark.django_db
+    def test_flushed_twice(self, db_label: str, create_rooms: Callable) -> None:
+        room, = create_rooms(1)
+        messages = [{'message': 'Hi'}, {'message': 'Hello'}]
+        write_behind.enqueue_flush(room.room_id, db_label, messages=messages, first_seq=1, send_update=False)
+        assert write_behind.flush_pending(db_label) == 1
+
+        # A flusher died after the commit, and the same flush is delivered again
+        write_behind.enqueue_flush(room.room_id, db_label, messages=messages, first_seq=1, send_update=False)
+        assert write_behind.flush_pending(db_label) == 1
+        assert events.fetch_history_from_db(room.room_id) == (True, messages)
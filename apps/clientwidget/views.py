@@ -1,13 +1,11 @@
 import uuid
 
-import requests
 from decouple import UndefinedValueError, config
 from django.apps import apps
 from django.shortcuts import render
 
 Chatbox = apps.get_model(app_label='chatbox', model_name='Chatbox')
 ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
-shared_client = requests.Session() # Shared anonymous user client
 
 try:
     server_addr = str(config('serverhost'))
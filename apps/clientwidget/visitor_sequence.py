@@ -0,0 +1,80 @@
+"""
+clientwidget/visitor_sequence.py
+
+Per owner sequence of the visitor IDs (`ChatRoom.visitor_id`, shown as `Visitor{visitor_id}`).
+
+    VISITOR_SEQ_{db_label}_{admin_id} -> Last visitor ID handed out for the owner. A plain integer key, with no TTL
+
+A new visitor ID is a single INCR. The key is seeded from `MAX(visitor_id)` of the owner's rooms only when it's
+missing (first visitor since a Redis flush), and the seed is written with SET NX, so concurrent first visits still
+get distinct IDs. `manage.py reconcile_visitor_sequence` moves the sequences forward if they ever fall behind the DB.
+"""
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models import Max
+
+# Returns the next ID, or false if the sequence isn't seeded yet
+NEXT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCR', KEYS[1])
+end
+return false
+"""
+
+# Moves the sequence forward to ARGV[1], if it's behind. Returns 1 if it was moved
+ADVANCE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+scripts = {}
+
+
+def get_script(REDIS_CONNECTION, name, script):
+    if name not in scripts:
+        scripts[name] = REDIS_CONNECTION.register_script(script)
+    return scripts[name]
+
+
+def sequence_key(admin_id, db_label='default'):
+    return cache.make_key(f"VISITOR_SEQ_{db_label}_{admin_id}")
+
+
+def get_last_visitor_id(admin_id, db_label='default'):
+    """Returns the largest visitor ID of the owner's rooms in the DB, or 0 if there are none"""
+    ChatRoom = apps.get_model(app_label='clientwidget', model_name='ChatRoom')
+    largest = ChatRoom.objects.using(db_label).filter(admin_id=admin_id).aggregate(largest=Max('visitor_id'))['largest']
+    return largest or 0
+
+
+def next_visitor_id(admin_id, db_label='default'):
+    """Hands out the next visitor ID of the owner"""
+    REDIS_CONNECTION = cache.get_client('')
+    key = sequence_key(admin_id, db_label)
+    value = get_script(REDIS_CONNECTION, 'next', NEXT_SCRIPT)(keys=[key], client=REDIS_CONNECTION)
+    if value is None:
+        REDIS_CONNECTION.set(key, get_last_visitor_id(admin_id, db_label), nx=True)
+        value = REDIS_CONNECTION.incr(key)
+    return int(value)
+
+
+def get_sequence(admin_id, db_label='default'):
+    value = cache.get_client('').get(sequence_key(admin_id, db_label))
+    return None if value is None else int(value)
+
+
+def advance_sequence(admin_id, last_visitor_id, db_label='default'):
+    """Moves the sequence of the owner forward to `last_visitor_id`, if it's behind. Returns `True` if it was moved"""
+    REDIS_CONNECTION = cache.get_client('')
+    advance = get_script(REDIS_CONNECTION, 'advance', ADVANCE_SCRIPT)
+    return advance(keys=[sequence_key(admin_id, db_label)], args=[int(last_visitor_id)], client=REDIS_CONNECTION) == 1
+
+
+def reset_sequence(admin_id, db_label='default'):
+    """Drops the sequence, so that it's seeded from the DB again on the next visitor"""
+    cache.get_client('').delete(sequence_key(admin_id, db_label))
@@ -0,0 +1,237 @@
+"""
+clientwidget/webhooks.py
+
+Runs the blocking WEBHOOK nodes of the live chat off the consumer's thread.
+
+A blocking WEBHOOK node waits for the response (up to its timeout, `WEBHOOK_TIMEOUT` by default) before routing.
+Running it inline holds the worker thread of the consumer for that long, and a slow endpoint of one bot stalls
+every other room on the process. Instead, the consumer parks the room and hands the node to a bounded pool of
+`WEBHOOK_WORKERS` threads:
+
+1. `BotFlowExecutor(defer_webhooks=True)` stops at the node (`executor.webhook_node`)
+2. `submit_webhook_node()` marks the room as waiting (`CLIENTWIDGET_WEBHOOK_{room_id}`) with a token of the
+   submission, and queues the request. The worker refreshes the mark once it picks the request up
+3. The worker sends the request, parses the response into the session variables, stores the routed `target_id`
+   with the room (`CLIENTWIDGET_WEBHOOK_RESPONSE_{room_id}`), and sends a `webhook_response` event to the consumer's channel
+4. The consumer claims the stored response, clears the mark and resumes the flow from `target_id`
+
+The stored response carries the token of its submission, and is only claimed while the mark still holds that token.
+A response which comes back after its mark expired, or after the room moved on to another webhook, is dropped instead
+of resuming the flow from a stale node.
+
+If the socket reconnected in the meantime, the event goes to a channel nobody reads. The new socket claims the
+stored response when it connects instead. Claiming is atomic, so the flow is resumed only once.
+
+While the room is waiting, the bot messages of the visitor are dropped. The mark expires a little after the request
+could have timed out (the timeout applies to the connect and to the read separately), so a lost response doesn't park
+the room for good. A routed response waits
+`WEBHOOK_RESPONSE_TIMEOUT` seconds for a socket of the room.
+
+The REST APIs of the widget still run the webhooks inline, since they answer with the next node.
+"""
+
+import json
+import math
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from decouple import UndefinedValueError, config
+from django.core.cache import cache
+
+from . import events
+from .exceptions import logger
+from .views import WEBHOOK_TIMEOUT
+
+# Webhook requests in flight per process. The rest are queued
+try:
+    WEBHOOK_WORKERS = int(config('WEBHOOK_WORKERS'))
+except UndefinedValueError:
+    WEBHOOK_WORKERS = 16
+
+# Seconds the waiting mark outlives the worst case duration of the request
+WEBHOOK_PENDING_BUFFER = 10
+
+# Seconds a routed response waits for a socket of the room to pick it up
+WEBHOOK_RESPONSE_TIMEOUT = 5 * 60
+
+# Marks the room as waiting on the submission ARGV[1], for ARGV[2] seconds. Unless the room already waits on another one
+REFRESH_SCRIPT = """
+local token = redis.call('GET', KEYS[1])
+if token and token ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# Stores the response ARGV[2] of the submission ARGV[1], if the room still waits on it
+STORE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+redis.call('HSET', KEYS[2], 'token', ARGV[1], 'event', ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Returns the stored response of the room, and clears the waiting mark along with it. Nothing if there's no response yet.
+# A response of another submission than the one the room waits on is dropped
+CLAIM_SCRIPT = """
+local response = redis.call('HMGET', KEYS[2], 'token', 'event')
+if not response[1] then
+    return nil
+end
+if redis.call('GET', KEYS[1]) ~= response[1] then
+    redis.call('DEL', KEYS[2])
+    return nil
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+return response[2]
+"""
+
+scripts = {}
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        with executor_lock:
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='webhook')
+    return executor
+
+
+def get_script(REDIS_CONNECTION, name, script):
+    if name not in scripts:
+        scripts[name] = REDIS_CONNECTION.register_script(script)
+    return scripts[name]
+
+
+def pending_key(room_id):
+    return f"CLIENTWIDGET_WEBHOOK_{room_id}"
+
+
+def response_key(room_id):
+    return f"CLIENTWIDGET_WEBHOOK_RESPONSE_{room_id}"
+
+
+def get_timeout(node):
+    try:
+        return float(node.get('timeout', WEBHOOK_TIMEOUT))
+    except:
+        return float(WEBHOOK_TIMEOUT)
+
+
+def get_pending_timeout(timeout):
+    """Returns the seconds the room waits on a request with `timeout`. The timeout applies to connecting and to reading
+    the response separately, so the request can take up to twice as long
+    """
+    return 2 * math.ceil(timeout) + WEBHOOK_PENDING_BUFFER
+
+
+def is_waiting(room_id):
+    """Returns True if the room is waiting on a webhook response"""
+    return cache.get(pending_key(room_id)) is not None
+
+
+def set_waiting(room_id, token, timeout):
+    """Marks the room as waiting on the submission `token`, for a request with `timeout`"""
+    cache.set(pending_key(room_id), token, timeout=get_pending_timeout(timeout))
+
+
+def refresh_waiting(room_id, token, timeout):
+    """Marks the room as waiting on the submission `token` again, from now on. Returns False if the room waits on
+    another submission by now
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    refresh = get_script(REDIS_CONNECTION, 'refresh', REFRESH_SCRIPT)
+    return bool(refresh(keys=[cache.make_key(pending_key(room_id))], args=[token, get_pending_timeout(timeout)], client=REDIS_CONNECTION))
+
+
+def clear_waiting(room_id):
+    cache.delete_many([pending_key(room_id), response_key(room_id)])
+
+
+def store_response(room_id, token, event):
+    """Keeps the routed `webhook_response` event of the submission `token` with the room, until a socket of the room
+    claims it. The room keeps waiting until then.
+
+    Returns False if the room doesn't wait on the submission anymore. Nothing is stored then
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    store = get_script(REDIS_CONNECTION, 'store', STORE_SCRIPT)
+    return bool(store(
+        keys=[cache.make_key(pending_key(room_id)), cache.make_key(response_key(room_id))],
+        args=[token, json.dumps(event), WEBHOOK_RESPONSE_TIMEOUT], client=REDIS_CONNECTION,
+    ))
+
+
+def claim_response(room_id):
+    """Returns the stored `webhook_response` event of the room and stops waiting, or None if there's none. Only one
+    caller gets it
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    claim = get_script(REDIS_CONNECTION, 'claim', CLAIM_SCRIPT)
+    response = claim(keys=[cache.make_key(pending_key(room_id)), cache.make_key(response_key(room_id))], client=REDIS_CONNECTION)
+    return None if response is None else json.loads(response)
+
+
+def run_webhook_node(room_id, bot_id, node, owner_id, bot_type='website'):
+    """Sends the request of a WEBHOOK node and returns the `target_id` it routes to. The response is parsed into the
+    session variables in Redis
+    """
+    try:
+        target_id, _ = events.process_webhook_node(room_id, bot_id, node, owner_id, bot_type=bot_type)
+    except Exception as ex:
+        logger.critical(f"Exception during WEBHOOK component: {ex}")
+        target_id = node.get('routing', {}).get('error', node.get('routing', {}).get('default'))
+    return target_id
+
+
+def submit_webhook_node(room_id, bot_id, node_id, node, owner_id, callback, bot_type='website'):
+    """Marks the room as waiting, and runs the WEBHOOK node `node_id` on the pool. `callback(target_id, token)` is
+    called on the worker once it's routed, with the token of the submission
+
+    Returns:
+        concurrent.futures.Future: Resolves to the `target_id`
+    """
+    token = uuid.uuid4().hex
+    timeout = get_timeout(node)
+    set_waiting(room_id, token, timeout)
+
+    def run():
+        # The request may have been queued for a while. The room waits on it from now on
+        if not refresh_waiting(room_id, token, timeout):
+            logger.info(f"Room {room_id} moved on to another webhook. Skipping node {node_id}")
+            return None
+        target_id = run_webhook_node(room_id, bot_id, node, owner_id, bot_type=bot_type)
+        try:
+            callback(target_id, token)
+        except Exception as ex:
+            logger.critical(f"Couldn't resume the flow of room {room_id} after the webhook: {ex}")
+            clear_waiting(room_id)
+        return target_id
+
+    return get_executor().submit(run)
+
+
+def resume_on_channel(room_id, channel_name, event, channel_layer=None):
+    """A callback for `submit_webhook_node()` which stores `event` with the `target_id` for the room, and sends it to
+    `channel_name` as a `webhook_response`. Nothing is sent if the room stopped waiting on the submission
+    """
+    def callback(target_id, token):
+        response = {**event, 'type': 'webhook_response', 'target_id': target_id}
+        if not store_response(room_id, token, response):
+            logger.info(f"Room {room_id} stopped waiting on the webhook. Dropping its response")
+            return
+        layer = channel_layer if channel_layer is not None else get_channel_layer()
+        async_to_sync(layer.send)(channel_name, response)
+    return callback
@@ -0,0 +1,403 @@
+"""
+clientwidget/write_behind.py
+
+Write-behind queue for the DB flush of ended sessions.
+
+Instead of flushing every ended room in its own transaction, the snapshot of the room (see `teardown.teardown_room()`)
+is queued in Redis, and flushed with the other rooms of the same DB label in batches: one `bulk_create` of the messages,
+and one `bulk_update` of the rooms, per batch.
+
+    WRITE_BEHIND_{db_label}            -> List of the pending flushes. Encoded like the history entries (see `history_codec`)
+    WRITE_BEHIND_INFLIGHT_{db_label}   -> The batch being flushed. Flushed again if the flusher dies in the middle
+    WRITE_BEHIND_LEASE_{db_label}      -> Only one flusher per DB label at a time
+    WRITE_BEHIND_DEAD_{db_label}       -> Flushes which failed `WRITE_BEHIND_MAX_ATTEMPTS` times
+    WRITE_BEHIND_METRICS_{db_label}    -> Counters of the flusher (batches, rooms, messages, failures, last batch)
+    WRITE_BEHIND_LABELS                -> Set of the DB labels with a queue
+
+The queues are drained every `WRITE_BEHIND_INTERVAL` seconds by the scheduler, and as soon as a queue has a full batch
+(if celery is used), so a flush is delayed by at most `WRITE_BEHIND_INTERVAL` seconds.
+
+Flushes are delivered at least once: a flusher which dies between the commit and `complete_batch()` leaves the
+in-flight batch to be flushed again. A flush carries the seq of its first message (`first_seq`, from `HISTORY_SEQ_`,
+see `history_seq`), and the messages are inserted with `ignore_conflicts` on `(room_id, seq)`, so a batch flushed
+twice doesn't duplicate them. The `created_on` of the messages is the end of the session, so they land in the same
+partition both times. Flushes without a `first_seq` (queued by an older version, or without a sequence) still get
+their seqs after the last one in the DB, and aren't protected against a second flush.
+
+The lease is renewed before every batch. A flusher which lost it stops.
+
+Disabled by default (`WRITE_BEHIND_ENABLED`). Only enable it once the `chatmessage_room_seq` constraint exists on every
+DB label, since a batch flushed twice duplicates its messages without it, and once every scheduler runs the
+`clientwidget_write_behind` job. Otherwise the queued sessions aren't written until a scheduler which has the job is up.
+"""
+
+import time
+import uuid
+from collections import OrderedDict
+
+from decouple import UndefinedValueError, config
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import history_seq
+from .exceptions import logger
+from .history_codec import decode_entries, encode_entry
+
+try:
+    WRITE_BEHIND_ENABLED = config('WRITE_BEHIND_ENABLED', cast=bool)
+except UndefinedValueError:
+    WRITE_BEHIND_ENABLED = False
+
+try:
+    WRITE_BEHIND_BATCH_SIZE = int(config('WRITE_BEHIND_BATCH_SIZE'))
+except UndefinedValueError:
+    WRITE_BEHIND_BATCH_SIZE = 200
+
+# Maximum delay (in seconds) before a queued flush is written to the DB
+try:
+    WRITE_BEHIND_INTERVAL = int(config('WRITE_BEHIND_INTERVAL'))
+except UndefinedValueError:
+    WRITE_BEHIND_INTERVAL = 5
+
+try:
+    WRITE_BEHIND_MAX_ATTEMPTS = int(config('WRITE_BEHIND_MAX_ATTEMPTS'))
+except UndefinedValueError:
+    WRITE_BEHIND_MAX_ATTEMPTS = 5
+
+# Maximum number of batches flushed per DB label in a single run, so that one busy label doesn't starve the others
+try:
+    WRITE_BEHIND_MAX_BATCHES = int(config('WRITE_BEHIND_MAX_BATCHES'))
+except UndefinedValueError:
+    WRITE_BEHIND_MAX_BATCHES = 20
+
+WRITE_BEHIND_LEASE_TIMEOUT = 60
+
+ROOM_FIELDS = ['variables', 'is_lead', 'bot_is_active', 'num_msgs', 'end_time', 'takeover', 'recent_seq']
+
+# KEYS: queue, inflight
+# ARGV: batch size
+CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for i = 1, #items do
+        redis.call('RPUSH', KEYS[2], items[i])
+    end
+end
+return items
+"""
+
+# KEYS: lease
+# ARGV: token, timeout
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lease
+# ARGV: token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+scripts = {}
+
+
+def queue_key(db_label):
+    return cache.make_key(f"WRITE_BEHIND_{db_label}")
+
+
+def inflight_key(db_label):
+    return cache.make_key(f"WRITE_BEHIND_INFLIGHT_{db_label}")
+
+
+def lease_key(db_label):
+    return cache.make_key(f"WRITE_BEHIND_LEASE_{db_label}")
+
+
+def dead_key(db_label):
+    return cache.make_key(f"WRITE_BEHIND_DEAD_{db_label}")
+
+
+def metrics_key(db_label):
+    return cache.make_key(f"WRITE_BEHIND_METRICS_{db_label}")
+
+
+def labels_key():
+    return cache.make_key("WRITE_BEHIND_LABELS")
+
+
+def get_script(REDIS_CONNECTION, name, script):
+    if name not in scripts:
+        scripts[name] = REDIS_CONNECTION.register_script(script)
+    return scripts[name]
+
+
+def enqueue_flush(room_id, db_label, variables=None, messages=None, is_lead=None, num_msgs=None, takeover=False, bot_type="website", send_update=True, first_seq=None):
+    """Queues the DB flush of an ended session. The arguments mirror `tasks.flush_db_task()`
+
+    Args:
+        room_id (uuid.UUID | str): The room ID
+        db_label (str): The DB label of the room
+        variables (dict, optional): The session variables. Not updated if None
+        messages (list, optional): The session history, to be appended to the DB
+        is_lead (bool, optional): Not updated if None
+        num_msgs (int, optional): The message count of the session. Not updated if None
+        takeover (bool, optional): Mark the room as taken over. Defaults to False.
+        bot_type (str, optional): The bot type. Only the website widget shows the recent history. Defaults to "website".
+        send_update (bool, optional): Send the room to the listing channels after the flush. Defaults to True.
+        first_seq (int, optional): The seq of the first message (`RoomSnapshot.first_seq`). Defaults to None (after the last one in the DB).
+
+    Returns:
+        int: The number of pending flushes of `db_label`
+    """
+    db_label = db_label or 'default'
+    job = {
+        'room_id': str(room_id),
+        'variables': variables,
+        'messages': messages or [],
+        'first_seq': first_seq,
+        'is_lead': is_lead,
+        'num_msgs': num_msgs,
+        'takeover': takeover == True,
+        'bot_type': bot_type,
+        'send_update': send_update == True,
+        'end_time': timezone.now().isoformat(),
+        'enqueued_at': time.time(),
+        'attempts': 0,
+    }
+
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.rpush(queue_key(db_label), encode_entry(job))
+        pipe.sadd(labels_key(), db_label)
+        length, _ = pipe.execute()
+
+    if length >= WRITE_BEHIND_BATCH_SIZE and hasattr(settings, 'CELERY_TASK') and settings.CELERY_TASK == True:
+        # A full batch is waiting. Don't wait for the scheduler
+        from .tasks import flush_write_behind
+        _ = flush_write_behind.delay(db_label)
+    return length
+
+
+def job_entries(job):
+    """The messages of a flush, as [(seq, message, created_on)]. The seq is None if the flush doesn't have a `first_seq`"""
+    first_seq = job.get('first_seq')
+    created_on = parse_datetime(job['end_time'])
+    return [(None if first_seq is None else first_seq + i, message, created_on) for i, message in enumerate(job['messages'])]
+
+
+def merge_jobs(jobs):
+    """Merges the flushes of the same room (a session which ended more than once), in the order they were queued.
+    Each merged flush has its messages in `entries` (see `job_entries()`)
+    """
+    merged = OrderedDict()
+    for job in jobs:
+        room_id = job['room_id']
+        if room_id not in merged:
+            merged[room_id] = {**job, 'messages': list(job['messages']), 'entries': job_entries(job)}
+            continue
+        previous = merged[room_id]
+        previous['messages'].extend(job['messages'])
+        previous['entries'].extend(job_entries(job))
+        for field in ('variables', 'is_lead', 'num_msgs'):
+            if job[field] is not None:
+                previous[field] = job[field]
+        previous['takeover'] = previous['takeover'] or job['takeover']
+        previous['send_update'] = previous['send_update'] or job['send_update']
+        previous['end_time'] = job['end_time']
+    return merged
+
+
+def write_batch(db_label, jobs):
+    """Writes a batch of flushes in a single transaction. Returns the list of (ChatRoom, job) which were written
+    """
+    from .models import ChatMessage, ChatRoom
+
+    merged = merge_jobs(jobs)
+    room_ids = [uuid.UUID(room_id) for room_id in merged]
+
+    with transaction.atomic(using=db_label):
+        rooms = list(ChatRoom.objects.using(db_label).select_for_update().filter(room_id__in=room_ids))
+        last_seqs = dict(
+            ChatMessage.objects.using(db_label).filter(room_id__in=room_ids)
+            .values('room_id').annotate(largest=models.Max('seq')).values_list('room_id', 'largest')
+        )
+
+        rows = []
+        written = []
+        for room in rooms:
+            job = merged[str(room.room_id)]
+            # Every message of the room may be in the archive tier
+            last_seq = last_seqs.get(room.room_id) or room.archived_seq
+            for seq, message, created_on in job['entries']:
+                if seq is None:
+                    seq = last_seq + 1
+                rows.append(ChatMessage(room_id=room.room_id, seq=seq, content=message, created_on=created_on))
+                last_seq = max(last_seq, seq)
+            job['last_seq'] = last_seq
+            if job['bot_type'] != 'website':
+                # Only the website widget shows the recent history
+                room.recent_seq = last_seq + 1
+            if job['variables'] is not None:
+                room.variables = job['variables']
+            if job['is_lead'] is not None:
+                room.is_lead = job['is_lead']
+            if job['num_msgs'] is not None:
+                room.num_msgs = job['num_msgs']
+            if job['takeover'] == True:
+                room.takeover = True
+            room.bot_is_active = False
+            room.end_time = parse_datetime(job['end_time'])
+            written.append((room, job))
+
+        # The messages of a batch which is flushed again are already there
+        ChatMessage.objects.using(db_label).bulk_create(rows, batch_size=WRITE_BEHIND_BATCH_SIZE, ignore_conflicts=True)
+        ChatRoom.objects.using(db_label).bulk_update(rooms, ROOM_FIELDS, batch_size=WRITE_BEHIND_BATCH_SIZE)
+        # Rooms whose sequence expired while their flush was queued
+        for room, job in written:
+            if len(job['messages']) > 0:
+                history_seq.sync_sequence_on_commit(room.room_id, job['last_seq'], db_label)
+
+    missing = set(merged).difference(str(room.room_id) for room, _ in written)
+    if len(missing) > 0:
+        logger.warning(f"Write behind: rooms {sorted(missing)} not found in {db_label}. Dropping their flush")
+    return written
+
+
+def complete_batch(REDIS_CONNECTION, db_label, failed):
+    """Removes the in-flight batch. In the same transaction, the failed flushes are put back at the end of the queue,
+    or into the dead letter list after too many attempts
+    """
+    retry, dead = [], []
+    for job in failed:
+        job['attempts'] += 1
+        if job['attempts'] >= WRITE_BEHIND_MAX_ATTEMPTS:
+            dead.append(encode_entry(job))
+        else:
+            retry.append(encode_entry(job))
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.delete(inflight_key(db_label))
+        if len(retry) > 0:
+            pipe.rpush(queue_key(db_label), *retry)
+        if len(dead) > 0:
+            pipe.rpush(dead_key(db_label), *dead)
+        pipe.expire(lease_key(db_label), WRITE_BEHIND_LEASE_TIMEOUT)
+        pipe.execute()
+    if len(dead) > 0:
+        logger.critical(f"Write behind: {len(dead)} flushes of {db_label} failed {WRITE_BEHIND_MAX_ATTEMPTS} times. Moved them to {dead_key(db_label)}")
+    return len(dead)
+
+
+def flush_jobs(REDIS_CONNECTION, db_label, jobs):
+    """Flushes the in-flight batch. If the batch fails, every flush is retried on its own, so that a bad room doesn't hold back the rest
+    """
+    start = time.perf_counter()
+    failed = []
+    try:
+        written = write_batch(db_label, jobs)
+    except Exception as ex:
+        logger.warning(f"Write behind: batch of {len(jobs)} flushes failed on {db_label}: {ex}. Flushing them one by one")
+        written = []
+        for job in jobs:
+            try:
+                written.extend(write_batch(db_label, [job]))
+            except Exception as ex:
+                logger.warning(f"Write behind: flush of room {job['room_id']} failed on {db_label}: {ex}")
+                failed.append(job)
+    duration = time.perf_counter() - start
+
+    # Flushes are delivered at least once: only a crash between the commit and this call flushes the batch again
+    num_dead = complete_batch(REDIS_CONNECTION, db_label, failed)
+
+    # The listing updates go out only after the commit
+    for room, job in written:
+        if job['send_update'] == True:
+            try:
+                room.send_listing_update()
+            except Exception as ex:
+                print(ex)
+
+    num_msgs = sum(len(job['messages']) for _, job in written)
+    lag = time.time() - min(job['enqueued_at'] for job in jobs)
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        key = metrics_key(db_label)
+        pipe.hincrby(key, 'batches', 1)
+        pipe.hincrby(key, 'rooms', len(written))
+        pipe.hincrby(key, 'messages', num_msgs)
+        pipe.hincrby(key, 'failed', len(failed))
+        pipe.hincrby(key, 'dead', num_dead)
+        pipe.hset(key, mapping={
+            'last_batch_size': len(jobs), 'last_batch_ms': round(duration * 1000, 2),
+            'last_lag_ms': round(lag * 1000, 2), 'last_flushed_at': time.time(),
+        })
+        pipe.execute()
+
+    logger.info(f"Write behind: flushed {len(written)} rooms ({num_msgs} messages) on {db_label} in {duration * 1000:.1f} ms. "
+                f"{len(failed)} failed, oldest flush waited {lag:.2f} s")
+    return len(written)
+
+
+def flush_pending(db_label, max_batches=WRITE_BEHIND_MAX_BATCHES, batch_size=WRITE_BEHIND_BATCH_SIZE):
+    """Drains up to `max_batches` batches of the queue of `db_label`. Returns the number of rooms flushed
+
+    Does nothing if another process is already flushing `db_label`
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    token = uuid.uuid4().hex
+    if not REDIS_CONNECTION.set(lease_key(db_label), token, nx=True, ex=WRITE_BEHIND_LEASE_TIMEOUT):
+        return 0
+
+    claim = get_script(REDIS_CONNECTION, 'claim', CLAIM_SCRIPT)
+    renew = get_script(REDIS_CONNECTION, 'renew', RENEW_SCRIPT)
+    num_flushed = 0
+    try:
+        for _ in range(max_batches):
+            if renew(keys=[lease_key(db_label)], args=[token, WRITE_BEHIND_LEASE_TIMEOUT], client=REDIS_CONNECTION) != 1:
+                logger.warning(f"Write behind: lost the lease of {db_label}. Leaving the rest to the other flusher")
+                break
+            # A batch left behind by a flusher which died is flushed first
+            items = REDIS_CONNECTION.lrange(inflight_key(db_label), 0, -1)
+            if len(items) == 0:
+                items = claim(keys=[queue_key(db_label), inflight_key(db_label)], args=[batch_size], client=REDIS_CONNECTION)
+            if len(items) == 0:
+                break
+            num_flushed += flush_jobs(REDIS_CONNECTION, db_label, decode_entries(items))
+    finally:
+        release = get_script(REDIS_CONNECTION, 'release', RELEASE_SCRIPT)
+        release(keys=[lease_key(db_label)], args=[token], client=REDIS_CONNECTION)
+    return num_flushed
+
+
+def flush_all():
+    """Drains the queues of every DB label
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    num_flushed = 0
+    for db_label in REDIS_CONNECTION.smembers(labels_key()):
+        db_label = db_label.decode() if isinstance(db_label, bytes) else db_label
+        num_flushed += flush_pending(db_label)
+    return num_flushed
+
+
+def get_metrics(db_label):
+    """Returns the counters of the flusher of `db_label`, along with the current queue depth
+    """
+    REDIS_CONNECTION = cache.get_client('')
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        pipe.hgetall(metrics_key(db_label))
+        pipe.llen(queue_key(db_label))
+        pipe.llen(dead_key(db_label))
+        content, pending, dead_letters = pipe.execute()
+    metrics = {key.decode() if isinstance(key, bytes) else key: float(value) for key, value in content.items()}
+    metrics['pending'] = pending
+    metrics['dead_letters'] = dead_letters
+    return metrics
@@ -1,6 +1,6 @@
 from rest_framework.response import Response
 from rest_framework import status
-import requests
+from apps.clientwidget import http_client
 from .models import ScheduleTask
 from apps.whatsappbot.models import TemplateApproval
 from .serializers import WhatsappMakeScheduleRegDetailSerializer
@@ -22,7 +22,7 @@ settings_time_zone = pytimezone(settings.TIME_ZONE)
 print("this is time: ", dateformat.format(timezone.now(), 'd/m/Y H:i:s'))
 def fetch_csv(request, sched_obj):
     csv_url = request.data['data_url']
-    s=requests.get(csv_url).content
+    s=http_client.get(csv_url).content
     print(s)
     csv=pd.read_csv(io.StringIO(s.decode('utf-8')))
     csv_json = csv.to_json(orient='index')
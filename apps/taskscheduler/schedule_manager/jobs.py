@@ -4,8 +4,10 @@ import traceback
 from datetime import datetime, timedelta
 
 from apps.accounts.models import User
-from apps.clientwidget.events import cleanup_room_redis
+from apps.clientwidget import archive, counters, partitions, tenants, write_behind
+from apps.clientwidget.events import dump_snapshot_to_db
 from apps.clientwidget.exceptions import create_logger
+from apps.clientwidget.teardown import teardown_room
 from apps.clientwidget.views import BUFFER_TIME, lock_timeout
 from apps.clientwidget.consumers import ClientWidgetConsumer
 from decouple import UndefinedValueError, config
@@ -24,14 +26,6 @@ ChatSession = apps.get_model(app_label='clientwidget', model_name='ChatSession')
 
 logger = create_logger(__name__)
 
-try:
-    from chatbot.database import DATABASES
-    databases = [database for database in DATABASES]
-except ImportError:
-    # Only default label
-    databases = ["default"]
-
-
 def is_child(jobid):
     if cache.get(f"apscheduler_{jobid}", False) == False:
         cache.set(f"apscheduler_{jobid}", True, timeout=5*60)
@@ -87,13 +81,21 @@ class ClientWidgetJobs():
         if (is_child(jobid) == True):
             return
         
-        sessions = ChatSession.objects.exclude(updated_on__range=[timezone.now()-timezone.timedelta(seconds=24 * 60 * 60 + BUFFER_TIME), timezone.now()]).values()
+        sessions = list(ChatSession.objects.exclude(updated_on__range=[timezone.now()-timezone.timedelta(seconds=24 * 60 * 60 + BUFFER_TIME), timezone.now()]).values())
         
         logger.info("Performing the Cron session update for Clientwidget")
+
+        # Only look for a room on the DB label which holds it. Rooms whose label isn't known anymore are looked up on every label
+        room_ids = tenants.group_rooms_by_db_label([session['room_id'] for session in sessions])
+        unknown = set(room_ids.pop(None, []))
+        db_labels = tenants.get_db_labels()
         
-        for db_label in databases:
+        for db_label in db_labels + [db_label for db_label in room_ids if db_label not in db_labels]:
+            db_room_ids = set(room_ids.get(db_label, [])) | unknown
             for session in sessions:
                 room_id = session['room_id']
+                if room_id not in db_room_ids:
+                    continue
                 room_name = session['room_name']
 
                 logger.info(f"Room Id = {room_id}, room_name = {room_name}")
@@ -110,23 +112,15 @@ class ClientWidgetJobs():
                         logger.info("Successfully Disconnected the connection!")
                 
                 if room_name is not None:
-                    is_lead = cache.get(f"IS_LEAD_{room_name}")
+                    # Snapshot and delete all the cache keys of the room in one go
+                    snapshot = teardown_room(room_name, room_id=room_id, session_end=True, reset_count=True)
+                    is_lead = snapshot.is_lead
                     if is_lead is not None:
                         queryset.update(bot_is_active = False, is_lead = is_lead)
                     else:
                         queryset.update(bot_is_active = False)
                     
-                    cleanup_room_redis(room_name, reset_count=True, bot_type='website')
-
-                    # Now finally force delete all the cache keys
-                    cache.delete(f'CLIENTWIDGETLEADFIELDS_{room_id}')
-                    cache.delete(f"CLIENTWIDGETLEADDATA_{room_id}")
-                    cache.delete(f'CLIENTWIDGETROOMINFO_{room_id}')
-                    cache.delete(f'IS_LEAD_{room_id}')
-                    cache.delete(f"CLIENTWIDGETSUBSCRIBED_{room_id}")
-                    cache.delete(f"CLIENTWIDGETTIMEOUT_{room_id}")
-                    cache.delete(f"CLIENTWIDGET_SESSION_TOKEN_{room_id}")
-                    cache.delete(f"CLIENTWIDGET_EXPIRY_LOCK_{room_id}")
+                    dump_snapshot_to_db(room_name, snapshot, bot_type='website')
                 else:
                     # Worst case - Just update bot status
                     queryset.update(bot_is_active = False)
@@ -136,11 +130,10 @@ class ClientWidgetJobs():
 
     @staticmethod
     def clientwidget_session_update(jobid=3):
-        # TODO: Get the set of all db_labels across all owners and update all of them
         if (is_child(jobid) == True):
             return
         
-        for db_label in databases:
+        for db_label in tenants.get_db_labels():
             sessions = ChatRoom.objects.using(db_label).filter(chatbot_type='website', bot_is_active=True).exclude(updated_on__range=[timezone.now()-timezone.timedelta(seconds=lock_timeout + BUFFER_TIME), timezone.now()])
             
             logger.info("Performing the Cron session update for Clientwidget")
@@ -160,7 +153,16 @@ class ClientWidgetJobs():
                     logger.info("Successfully Disconnected the connection!")
                 
                 if room_id is not None:
-                    is_lead = cache.get(f"IS_LEAD_{room_id}")
+                    # Snapshot and delete all the cache keys of the room in one go
+                    snapshot = teardown_room(room_id, session_end=True, reset_count=True)
+                    is_lead = snapshot.is_lead
+
+                    if write_behind.WRITE_BEHIND_ENABLED:
+                        # Thousands of rooms can expire together. Flush them in batches
+                        locked = snapshot.locked
+                        write_behind.enqueue_flush(room_id, db_label, variables=snapshot.variables if locked else None, messages=snapshot.messages if locked else [],
+                                                   first_seq=snapshot.first_seq if locked else None, is_lead=is_lead, send_update=False)
+                        continue
                     if is_lead is not None:
                         session.bot_is_active = False
                         session.is_lead = is_lead
@@ -171,17 +173,43 @@ class ClientWidgetJobs():
 
                     session.save(using=db_label)
                     
-                    cleanup_room_redis(room_id, reset_count=True, bot_type='website')
+                    dump_snapshot_to_db(room_id, snapshot, bot_type='website')
+
+
+    @staticmethod
+    def clientwidget_flush_counts(jobid=5):
+        # Write back the live message counts of the active rooms into ChatRoom.num_msgs
+        if (is_child(jobid) == True):
+            return
 
-                    # Now finally force delete all the cache keys
-                    cache.delete(f'CLIENTWIDGETLEADFIELDS_{room_id}')
-                    cache.delete(f"CLIENTWIDGETLEADDATA_{room_id}")
-                    cache.delete(f'CLIENTWIDGETROOMINFO_{room_id}')
-                    cache.delete(f'IS_LEAD_{room_id}')
-                    cache.delete(f"CLIENTWIDGETSUBSCRIBED_{room_id}")
-                    cache.delete(f"CLIENTWIDGETTIMEOUT_{room_id}")
-                    cache.delete(f"CLIENTWIDGET_SESSION_TOKEN_{room_id}")
-                    cache.delete(f"CLIENTWIDGET_EXPIRY_LOCK_{room_id}")
+        for db_label in tenants.get_db_labels():
+            room_ids = list(ChatRoom.objects.using(db_label).filter(bot_is_active=True).values_list('room_id', flat=True))
+            num_updated = counters.flush_msgcounts(room_ids, db_label=db_label)
+            logger.info(f"Flushed the message counts of {num_updated} rooms on {db_label}")
+
+
+    @staticmethod
+    def clientwidget_write_behind():
+        # No `is_child()` check: every worker may try, and the lease of each DB label lets only one of them flush it
+        try:
+            write_behind.flush_all()
+        except Exception as ex:
+            logger.warning(f"Write behind flush failed: {ex}")
+
+
+    @staticmethod
+    def clientwidget_archive(jobid=6):
+        # Keep the upcoming message partitions ready, and move the old rooms into the archive tier
+        if (is_child(jobid) == True):
+            return
+
+        for db_label in tenants.get_db_labels():
+            try:
+                partitions.ensure_partitions(db_label)
+            except Exception as ex:
+                logger.warning(f"Couldn't create the message partitions on {db_label}: {ex}")
+            if archive.CHAT_ARCHIVE_ENABLED:
+                archive.archive_rooms(db_label)
 
 
     @staticmethod
@@ -220,7 +248,7 @@ class ClientWidgetJobs():
 
                 email = EmailMessage(mail_subject, message, from_email=from_email, to=to_email)
                 
-                fields = [field.get_attname_column()[1] for field in ChatRoom._meta.fields if field.get_attname_column()[1] not in ['room_id', 'variables', 'bot_info', 'recent_messages', 'messages', 'bot_id', 'assignment_type']]
+                fields = [field.get_attname_column()[1] for field in ChatRoom._meta.fields if field.get_attname_column()[1] not in ['room_id', 'variables', 'bot_info', 'recent_messages', 'recent_seq', 'archived_seq', 'archived_on', 'messages', 'bot_id', 'assignment_type']]
 
                 lead_fields = ['visitor_id', 'room_name', 'created_on', 'updated_on', 'end_time', 'channel_id']
 
@@ -240,7 +268,7 @@ class ClientWidgetJobs():
                     end_date = timezone.now()
                     start_date = end_date - timedelta(days=1)
                     
-                    queryset = ChatRoom.objects.using(bot.owner.ext_db_label).filter(bot_id=bot.bot_hash, updated_on__range=[start_date, end_date]).order_by('-updated_on', '-created_on')
+                    queryset = ChatRoom.objects.using(tenants.get_user_db_label(bot.owner)).filter(bot_id=bot.bot_hash, updated_on__range=[start_date, end_date]).order_by('-updated_on', '-created_on')
                     
                     if not queryset:
                         # Don't send any update, since it's empty
@@ -3,6 +3,7 @@ from decouple import config
 
 from apps.taskscheduler.schedule_manager.jobs import ClientWidgetJobs
 from apps.clientwidget.views import lock_timeout
+from apps.clientwidget.write_behind import WRITE_BEHIND_INTERVAL
 
 if lock_timeout // 3600 <= 0:
     session_timeout = 6 # 6 hours
@@ -16,12 +17,20 @@ try:
 except:
     DEVELOPMENT = False
 
+try:
+    COUNTER_FLUSH_INTERVAL = config('COUNTER_FLUSH_INTERVAL', cast=int)
+except:
+    COUNTER_FLUSH_INTERVAL = 10 # Minutes
+
 def start():
     # ------------------------- #
     # Clientwidget related jobs #
     # scheduler.add_job(ClientWidgetJobs.clientwidget_session_update, 'cron', hour="8") # 8AM Job
     scheduler.add_job(ClientWidgetJobs.clientwidget_send_email, 'cron', hour="8", minute="30") # 8:30 AM Job
     scheduler.add_job(ClientWidgetJobs.clientwidget_session_update, 'cron', hour=f"*/{session_timeout}") # Every session_timeout hours
+    scheduler.add_job(ClientWidgetJobs.clientwidget_flush_counts, 'cron', minute=f"*/{COUNTER_FLUSH_INTERVAL}") # Every COUNTER_FLUSH_INTERVAL minutes
+    scheduler.add_job(ClientWidgetJobs.clientwidget_archive, 'cron', hour="3") # 3 AM Job
+    scheduler.add_job(ClientWidgetJobs.clientwidget_write_behind, 'interval', seconds=WRITE_BEHIND_INTERVAL, max_instances=1, coalesce=True) # Every WRITE_BEHIND_INTERVAL seconds
 
     if DEVELOPMENT == True:
         scheduler.add_job(ClientWidgetJobs.send_dummy_email, 'cron', hour="*") # Every hour
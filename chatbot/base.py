@@ -145,4 +145,7 @@ X_FRAME_OPTIONS = 'SAMEORIGIN'
 try:
     from .database import *
 except ImportError:
-    raise ImproperlyConfigured("No database file")
\ No newline at end of file
+    raise ImproperlyConfigured("No database file")
+
+from .db_router import configure_connections
+DATABASES = configure_connections(DATABASES)
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""
+Connection settings for the external (tenant) databases.
+
+Every owner's chat data (`ChatRoom`, `ChatMessage`) lives in the database `User.ext_db_label`. The rest of the
+tables live in "default". The label of a query is resolved by `apps.clientwidget.tenants`, and passed to `.using()`.
+"""
+
+from decouple import UndefinedValueError, config
+
+
+def get_setting(label, name, default, cast=int):
+    """Reads `DB_{LABEL}_{NAME}`, then `DB_{NAME}`, then falls back to `default`"""
+    for key in (f'DB_{label.upper()}_{name}', f'DB_{name}'):
+        try:
+            return cast(config(key))
+        except UndefinedValueError:
+            pass
+    return default
+
+
+def configure_connections(DATABASES):
+    """Sets the connection reuse and timeout settings of every DB label, unless the database file sets them.
+
+    Django keeps one connection per label per thread, and reuses it for `CONN_MAX_AGE` seconds instead of
+    connecting on every request. For a real pool across the daphne / celery processes, point `HOST` / `PORT`
+    at a pgbouncer per label and set `DB_{LABEL}_CONN_MAX_AGE` to 0 there.
+
+        DB_CONN_MAX_AGE / DB_{LABEL}_CONN_MAX_AGE          -> Seconds to keep a connection open (default 60)
+        DB_CONNECT_TIMEOUT / DB_{LABEL}_CONNECT_TIMEOUT    -> Seconds to wait for a new connection (default 10)
+        DB_STATEMENT_TIMEOUT / DB_{LABEL}_STATEMENT_TIMEOUT -> Milliseconds, 0 to disable (default 0)
+    """
+    for label, database in DATABASES.items():
+        database.setdefault('CONN_MAX_AGE', get_setting(label, 'CONN_MAX_AGE', 60))
+        if 'postgresql' not in database.get('ENGINE', ''):
+            continue
+        options = database.setdefault('OPTIONS', {})
+        options.setdefault('connect_timeout', get_setting(label, 'CONNECT_TIMEOUT', 10))
+        # Detect connections dropped by a firewall / failover, instead of hanging on them
+        options.setdefault('keepalives', 1)
+        options.setdefault('keepalives_idle', 60)
+        statement_timeout = get_setting(label, 'STATEMENT_TIMEOUT', 0)
+        if statement_timeout > 0 and 'options' not in options:
+            options['options'] = f'-c statement_timeout={statement_timeout}'
+    return DATABASES